@@ -20,33 +20,45 @@ if [ -f "results/"*".csv" ] || [ -f "results/figures/"*".png" ]; then
     cp -r results/*.csv results/figures/*.png results/backups/${TIMESTAMP}/ 2>/dev/null || true
 fi
 
-echo "======================================================="
-echo "步骤1: 评估所有模型"
-echo "======================================================="
-# 检查评估脚本是否存在
-if [ -f "${SCRIPT_DIR}/evaluate_models.sh" ]; then
-    bash ${SCRIPT_DIR}/evaluate_models.sh
-    if [ $? -ne 0 ]; then
-        echo "警告: 评估脚本可能未完全成功"
+if [ $# -eq 0 ]; then
+    echo "======================================================="
+    echo "步骤1: 评估所有模型"
+    echo "======================================================="
+    # 检查评估脚本是否存在
+    if [ -f "${SCRIPT_DIR}/evaluate_models.sh" ]; then
+        bash ${SCRIPT_DIR}/evaluate_models.sh
+        if [ $? -ne 0 ]; then
+            echo "警告: 评估脚本可能未完全成功"
+        fi
+    else
+        echo "错误: 评估脚本 ${SCRIPT_DIR}/evaluate_models.sh 不存在!"
+        exit 1
     fi
-else
-    echo "错误: 评估脚本 ${SCRIPT_DIR}/evaluate_models.sh 不存在!"
-    exit 1
-fi
 
-echo
-echo "======================================================="
-echo "步骤2: 分析结果并生成可视化"
-echo "======================================================="
-# 检查分析脚本是否存在
-if [ -f "${SCRIPT_DIR}/analyze_results.py" ]; then
-    python ${SCRIPT_DIR}/analyze_results.py
-    if [ $? -ne 0 ]; then
-        echo "警告: 分析脚本可能未完全成功"
+    echo
+    echo "======================================================="
+    echo "步骤2: 分析结果并生成可视化"
+    echo "======================================================="
+    # 检查分析脚本是否存在
+    if [ -f "${SCRIPT_DIR}/analyze_results.py" ]; then
+        python ${SCRIPT_DIR}/analyze_results.py
+        if [ $? -ne 0 ]; then
+            echo "警告: 分析脚本可能未完全成功"
+        fi
+    else
+        echo "错误: 分析脚本 ${SCRIPT_DIR}/analyze_results.py 不存在!"
+        exit 1
     fi
 else
-    echo "错误: 分析脚本 ${SCRIPT_DIR}/analyze_results.py 不存在!"
-    exit 1
+    echo "======================================================="
+    echo "运行流水线: 训练 → 合并 → 评估 → 更新记录 → 分析"
+    echo "======================================================="
+    # 带参数时重新训练各方法: 依赖关系、跳过未变化的阶段、并行分支和阶段计时由 scripts/pipeline.py 负责
+    # 参数原样透传，例如: ./run_comparison.sh --model_size tiny --methods lora,qlora --evaluate_all
+    python ${SCRIPT_DIR}/pipeline.py "$@"
+    if [ $? -ne 0 ]; then
+        echo "警告: 流水线中有阶段失败，详见 results/pipeline/logs/"
+    fi
 fi
 
 # 验证文件确实被创建
@@ -74,4 +86,7 @@ echo "结果摘要已保存到: results/[task]_comparison.csv"
 echo "可视化图表已保存到: results/figures/ 目录"
 echo "原始评估数据: results/model_comparison/ 目录"
 echo "备份保存在: results/backups/${TIMESTAMP}/ 目录"
+if [ $# -gt 0 ]; then
+    echo "阶段耗时: results/pipeline/timings.json"
+fi
 echo "======================================================="
\ No newline at end of file
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+纯PyTorch实现的分块8-bit AdamW (无需bitsandbytes)
+
+两个动量状态 (exp_avg, exp_avg_sq) 按每256个值一块量化为uint8码本索引，每块保存一个
+fp32绝对值最大值。码本按对数间隔取值 (相对误差处处相同)，避免线性量化把很小的
+二阶矩量化为0、导致更新量爆炸。每步只为当前参数临时还原fp32状态，
+优化器状态从每个参数8字节降到约2字节。元素较少的参数 (偏置、norm) 仍使用fp32状态。
+
+train_instruction.py --use_8bit_adam: CUDA且安装了bitsandbytes时使用paged_adamw_8bit，否则使用本实现。
+
+用法 (CPU自检: 与fp32 AdamW比较训练轨迹，报告各方法的优化器状态内存，并检查保存/加载后继续训练):
+  python scripts/adam8bit.py --self_test
+"""
+
+import math
+import argparse
+
+import torch
+
+BLOCK_SIZE = 256
+# 少于该元素数的参数不量化
+MIN_8BIT_SIZE = 4096
+
+
+def build_codebook(signed, min_value=None):
+    """256个码值 (升序): 0 与对数间隔的正值 (有符号时正负对称)
+
+    一阶矩量化为0只是少更新一点，码值下限取1e-4换取更细的间隔; 二阶矩在分母上，下限取1e-7
+    """
+    if min_value is None:
+        min_value = 1e-4 if signed else 1e-7
+    if signed:
+        positive = torch.logspace(math.log10(min_value), 0, 127)
+        return torch.cat([-positive.flip(0), torch.zeros(1), positive, torch.ones(1)])
+    return torch.cat([torch.zeros(1), torch.logspace(math.log10(min_value), 0, 255)])
+
+class BlockQuantizer:
+    """按块归一化后映射到码本中最近的值"""
+
+    def __init__(self, signed, block_size=BLOCK_SIZE):
+        self.codebook = build_codebook(signed)
+        self.block_size = block_size
+        # 相邻码值的中点，searchsorted得到最近码值的索引
+        self.boundaries = (self.codebook[1:] + self.codebook[:-1]) / 2
+
+    def quantize(self, tensor):
+        flat = tensor.reshape(-1).float()
+        padding = (-flat.numel()) % self.block_size
+        if padding:
+            flat = torch.nn.functional.pad(flat, (0, padding))
+        blocks = flat.view(-1, self.block_size)
+        absmax = blocks.abs().amax(dim=1).clamp(min=1e-12)
+        normalized = blocks / absmax.unsqueeze(1)
+        codes = torch.searchsorted(self.boundaries.to(tensor.device), normalized.contiguous())
+        return codes.to(torch.uint8), absmax
+
+    def dequantize(self, codes, absmax, shape):
+        values = self.codebook.to(codes.device)[codes.long()] * absmax.unsqueeze(1)
+        return values.reshape(-1)[:math.prod(shape)].view(shape)
+
+class AdamW8bit(torch.optim.Optimizer):
+    """AdamW，动量状态分块量化为8-bit (接口与torch.optim.AdamW一致)"""
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01,
+                 block_size=BLOCK_SIZE, min_8bit_size=MIN_8BIT_SIZE):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+        self.min_8bit_size = min_8bit_size
+        self.signed_quantizer = BlockQuantizer(signed=True, block_size=block_size)
+        self.unsigned_quantizer = BlockQuantizer(signed=False, block_size=block_size)
+
+    def _init_state(self, param):
+        state = self.state[param]
+        state["step"] = 0
+        if param.numel() < self.min_8bit_size:
+            state["exp_avg"] = torch.zeros_like(param, dtype=torch.float32)
+            state["exp_avg_sq"] = torch.zeros_like(param, dtype=torch.float32)
+        else:
+            zeros = torch.zeros_like(param, dtype=torch.float32)
+            state["exp_avg_codes"], state["exp_avg_absmax"] = self.signed_quantizer.quantize(zeros)
+            state["exp_avg_sq_codes"], state["exp_avg_sq_absmax"] = self.unsigned_quantizer.quantize(zeros)
+        return state
+
+    def load_state_dict(self, state_dict):
+        """恢复状态时保持保存时的dtype
+
+        torch.optim.Optimizer.load_state_dict 会把状态张量转换为参数的dtype，uint8码本索引会变成浮点数
+        (内存回到fp32水平)，bf16参数时absmax也会损失精度。这里在父类加载之后用原始张量覆盖。
+        """
+        saved_ids = [index for group in state_dict["param_groups"] for index in group["params"]]
+        params = [param for group in self.param_groups for param in group["params"]]
+        saved_state = {index: {key: value for key, value in state.items() if torch.is_tensor(value) and key != "step"}
+                       for index, state in state_dict["state"].items()}
+        super().load_state_dict(state_dict)
+        for index, param in zip(saved_ids, params):
+            for key, value in saved_state.get(index, {}).items():
+                self.state[param][key] = value.to(device=param.device, copy=True)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for param in group["params"]:
+                if param.grad is None:
+                    continue
+                grad = param.grad.float()
+                state = self.state[param] if self.state[param] else self._init_state(param)
+                quantized = "exp_avg_codes" in state
+
+                if quantized:
+                    exp_avg = self.signed_quantizer.dequantize(state["exp_avg_codes"], state["exp_avg_absmax"], param.shape)
+                    exp_avg_sq = self.unsigned_quantizer.dequantize(state["exp_avg_sq_codes"], state["exp_avg_sq_absmax"],
+                                                                    param.shape)
+                else:
+                    exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+
+                state["step"] += 1
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                denom = (exp_avg_sq / bias_correction2).sqrt_().add_(group["eps"])
+                update = exp_avg / bias_correction1 / denom
+
+                if group["weight_decay"]:
+                    param.mul_(1 - group["lr"] * group["weight_decay"])
+                param.add_(update.to(param.dtype), alpha=-group["lr"])
+
+                if quantized:
+                    state["exp_avg_codes"], state["exp_avg_absmax"] = self.signed_quantizer.quantize(exp_avg)
+                    state["exp_avg_sq_codes"], state["exp_avg_sq_absmax"] = self.unsigned_quantizer.quantize(exp_avg_sq)
+        return loss
+
+def bitsandbytes_available():
+    try:
+        import bitsandbytes  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def optimizer_state_bytes(optimizer):
+    """优化器状态占用的字节数 (只统计张量)"""
+    total = 0
+    for state in optimizer.state.values():
+        for value in state.values():
+            if torch.is_tensor(value):
+                total += value.numel() * value.element_size()
+    return total
+
+def _build(method, seed=0):
+    from tiny_model import build_tiny_model
+
+    model, _ = build_tiny_model(hidden_size=128, num_layers=2, intermediate_size=256, seed=seed)
+    model.train()
+    if method == "full":
+        return model
+    from peft import LoraConfig, get_peft_model
+    if method == "qlora":
+        from quantized_linear import quantize_model
+        quantize_model(model, bits=4, verbose=False)
+    return get_peft_model(model, LoraConfig(r=16, lora_alpha=32, target_modules=["q_proj", "k_proj", "v_proj", "o_proj"],
+                                            lora_dropout=0.0, task_type="CAUSAL_LM"))
+
+def _make_optimizer(name, params, lr):
+    if name == "adamw":
+        return torch.optim.AdamW(params, lr=lr, weight_decay=0.01)
+    if name == "adamw_8bit":
+        # 自检中的LoRA矩阵较小，降低阈值使其也被量化
+        return AdamW8bit(params, lr=lr, weight_decay=0.01, min_8bit_size=1024)
+    from transformers.optimization import Adafactor
+    return Adafactor(params, lr=lr, scale_parameter=False, relative_step=False, weight_decay=0.01)
+
+def train_trajectory(method, optimizer_name, steps=30, lr=1e-3, seed=0):
+    """固定数据上训练若干步，返回 (损失列表, 优化器状态字节数, 最终参数)"""
+    model = _build(method, seed)
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = _make_optimizer(optimizer_name, params, lr)
+    input_ids = torch.randint(3, 1000, (4, 64), generator=torch.Generator().manual_seed(seed))
+    losses = []
+    for _ in range(steps):
+        loss = model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        losses.append(loss.item())
+    return losses, optimizer_state_bytes(optimizer), [p.detach().clone() for p in params]
+
+def check_resume(steps=10):
+    """保存/加载优化器状态后继续训练，与不中断的训练结果一致，且码本索引仍为uint8"""
+    import io
+
+    def run(model, optimizer, input_ids, n):
+        for _ in range(n):
+            model(input_ids=input_ids, labels=input_ids).loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+    input_ids = torch.randint(3, 1000, (4, 64), generator=torch.Generator().manual_seed(0))
+    model = _build("lora")
+    optimizer = _make_optimizer("adamw_8bit", [p for p in model.parameters() if p.requires_grad], 1e-3)
+    run(model, optimizer, input_ids, steps)
+    buffer = io.BytesIO()
+    torch.save({"model": model.state_dict(), "optimizer": optimizer.state_dict()}, buffer)
+    run(model, optimizer, input_ids, steps)
+
+    buffer.seek(0)
+    checkpoint = torch.load(buffer)
+    resumed = _build("lora")
+    resumed.load_state_dict(checkpoint["model"])
+    resumed_optimizer = _make_optimizer("adamw_8bit", [p for p in resumed.parameters() if p.requires_grad], 1e-3)
+    resumed_optimizer.load_state_dict(checkpoint["optimizer"])
+    dtypes = {value.dtype for state in resumed_optimizer.state.values() for key, value in state.items()
+              if key.endswith("_codes")}
+    state_bytes = optimizer_state_bytes(resumed_optimizer)
+    run(resumed, resumed_optimizer, input_ids, steps)
+
+    diff = max(float((p - r).detach().abs().max()) for p, r in zip(resumed.parameters(), model.parameters()))
+    print(f"恢复后码本索引类型: {dtypes}, 状态内存 {state_bytes / 1024 ** 2:.2f}MB "
+          f"(原 {optimizer_state_bytes(optimizer) / 1024 ** 2:.2f}MB), 继续训练后与不中断训练的参数最大差: {diff:.2e}")
+    return dtypes == {torch.uint8} and state_bytes == optimizer_state_bytes(optimizer) and diff < 1e-6
+
+def self_test(steps=30):
+    # 量化往返误差: 对数码本的相对误差应在几个百分点以内
+    quantizer = BlockQuantizer(signed=False)
+    values = torch.rand(10000).pow(6) * 1e-3
+    codes, absmax = quantizer.quantize(values)
+    restored = quantizer.dequantize(codes, absmax, values.shape)
+    mask = values > absmax.repeat_interleave(BLOCK_SIZE)[:values.numel()] * 1e-6
+    relative = float(((restored - values).abs() / values)[mask].max())
+    print(f"二阶矩量化往返最大相对误差: {relative * 100:.1f}%")
+    ok = relative < 0.05
+
+    print(f"\n{'方法':<6} {'优化器':<11} {'状态内存':>10} {'首步损失':>9} {'末步损失':>9} {'与fp32参数差':>12}")
+    for method in ["full", "lora", "qlora"]:
+        reference_losses, reference_bytes, reference_params = train_trajectory(method, "adamw", steps)
+        for name in ["adamw", "adamw_8bit", "adafactor"]:
+            if name == "adamw":
+                losses, state_bytes, params = reference_losses, reference_bytes, reference_params
+            else:
+                losses, state_bytes, params = train_trajectory(method, name, steps)
+            # 参数与fp32 AdamW结果的相对差 (相对于训练中参数的总变化)
+            drift = max(float((p - r).norm() / r.norm()) for p, r in zip(params, reference_params))
+            print(f"{method:<6} {name:<11} {state_bytes / 1024 ** 2:>8.2f}MB {losses[0]:>9.4f} {losses[-1]:>9.4f} "
+                  f"{drift:>12.4f}")
+            if name == "adamw_8bit":
+                # 8-bit状态: 内存约为fp32的1/4，训练轨迹与fp32 AdamW一致
+                ok = ok and state_bytes < reference_bytes * 0.3
+                ok = ok and abs(losses[-1] - reference_losses[-1]) < 0.05 * abs(reference_losses[0] - reference_losses[-1]) + 1e-3
+    print()
+    return check_resume() and ok
+
+def main():
+    parser = argparse.ArgumentParser(description="纯PyTorch分块8-bit AdamW")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上与fp32 AdamW比较")
+    parser.add_argument("--steps", type=int, default=30)
+    args = parser.parse_args()
+
+    if not args.self_test:
+        parser.print_help()
+        return
+
+    if not self_test(args.steps):
+        print("❌ 8-bit优化器自检失败")
+        raise SystemExit(1)
+    print("✅ 8-bit优化器自检通过")
+
+if __name__ == "__main__":
+    main()
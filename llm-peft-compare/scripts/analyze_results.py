@@ -8,6 +8,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib.colors import LinearSegmentedColormap
+from significance import compare_runs
 
 
 # 在import部分之后添加
@@ -49,10 +50,13 @@ def plot_horizontal_comparison():
             
             bars = plt.bar(x + offset, data[method], width, label=method_label, color=colors[i % len(colors)])
             
-            # 添加数值标签
-            for bar in bars:
+            # 添加数值标签 (子样本评估的结果加阴影并以≈标注)
+            for bar, model in zip(bars, models):
                 height = bar.get_height()
-                plt.annotate(f'{height:.1f}',
+                is_subsampled = (task, model, method) in subsampled_cells
+                if is_subsampled:
+                    bar.set_hatch('//')
+                plt.annotate(f'{"≈" if is_subsampled else ""}{height:.1f}',
                             xy=(bar.get_x() + bar.get_width() / 2, height),
                             xytext=(0, 3),  # 3点垂直偏移
                             textcoords="offset points",
@@ -68,6 +72,9 @@ def plot_horizontal_comparison():
         plt.grid(axis='y', linestyle='--', alpha=0.7)
         plt.ylim(0, max(100, data.values.max() * 1.1))
         
+        if any(cell[0] == task for cell in subsampled_cells):
+            plt.figtext(0.5, 0.01, '阴影/≈: 分层子样本评估的估计值 (见subsample_eval.py)', ha='center', fontsize=9)
+        
         plt.tight_layout()
 
         try:
@@ -163,6 +170,19 @@ def plot_improvement_heatmap():
                     except (ValueError, TypeError):
                         improvement_data.loc[model, method] = float('nan')
         
+        # 有逐样本数据时 (见significance.py)，用配对置换检验标注相对基础模型的显著性
+        annot_labels = np.empty(improvement_data.shape, dtype=object)
+        has_significance = False
+        for i, model in enumerate(improvement_data.index):
+            for j, method in enumerate(improvement_data.columns):
+                value = improvement_data.loc[model, method]
+                label = "" if pd.isna(value) else f"{float(value):.1f}"
+                comparison = compare_runs(f"{model}_base", f"{model}_{method}", task)
+                if comparison is not None and label:
+                    label += f"\n{comparison['stars']}"
+                    has_significance = True
+                annot_labels[i, j] = label
+        
         # 重命名列以便显示
         improvement_data.columns = [
             "完整微调", "LoRA", "QLoRA"
@@ -178,9 +198,13 @@ def plot_improvement_heatmap():
         # 创建自定义颜色映射 - 红色为负值，绿色为正值
         cmap = LinearSegmentedColormap.from_list('RdYlGn', ['#d62728', '#f7f7f7', '#2ca02c'])
         
-        ax = sns.heatmap(improvement_data, annot=True, fmt=".1f", cmap=cmap, center=0,
+        ax = sns.heatmap(improvement_data, annot=annot_labels, fmt="", cmap=cmap, center=0,
                         cbar_kws={'label': '相对改善 (%)'}, linewidths=0.5)
         
+        if has_significance:
+            plt.figtext(0.5, 0.01, '显著性 (配对置换检验): * p<0.05  ** p<0.01  *** p<0.001  n.s. 不显著',
+                        ha='center', fontsize=9)
+        
         # 设置标题和标签
         plt.title(f'{task_map[task]}任务上不同微调方法的性能提升', fontsize=15)
         plt.ylabel('模型', fontsize=12)
@@ -354,6 +378,9 @@ results_data = {}
 for task in task_map:
     results_data[task] = pd.DataFrame(index=models, columns=methods)
 
+# 子样本评估的 (任务, 模型, 方法)
+subsampled_cells = set()
+
 # 加载所有结果文件
 found_results = False
 for filename in os.listdir(results_dir):
@@ -446,6 +473,10 @@ for filename in os.listdir(results_dir):
                     if metric in metrics:
                         score = metrics[metric] * 100  # 转换为百分比
                         results_data[task].loc[model_name, method] = score
+                        if task_full in data.get("subsampled", {}):
+                            subsampled_cells.add((task, model_name, method))
+                        else:
+                            subsampled_cells.discard((task, model_name, method))
                         break
                         
         except Exception as e:
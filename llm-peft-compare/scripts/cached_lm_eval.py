@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+带log-likelihood缓存的lm-eval评估入口
+
+在lm-eval的HFLM之上缓存每个(模型指纹, 上下文, 续写)请求的log-likelihood:
+- 同一上下文的多个续写(HellaSwag的4个结尾、MMLU的4个选项)归为一组，
+  上下文只前向一次并复用其KV缓存 (见prefix_scoring.py)
+- 各组按总长度降序排列后分批，减少padding
+- 每批计算完成立即写入SQLite，中断后重跑只计算缺失的请求
+
+用法:
+  python scripts/cached_lm_eval.py --model_path models/tinyllama_1.1b-instruction-lora-merged \
+      --tasks hellaswag,mmlu_high_school_computer_science --output_file results/model_comparison/xxx.json
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import torch
+from lm_eval import simple_evaluate
+from lm_eval.models.huggingface import HFLM
+from lm_eval.utils import handle_non_serializable
+
+from eval_cache import fingerprint_model
+from loglik_cache import LoglikCache, request_key, DEFAULT_CACHE_PATH
+from prefix_scoring import PrefixScorer
+
+# 每次写入缓存前最多计算的请求数 (崩溃时最多损失这么多请求的计算)
+DEFAULT_FLUSH_SIZE = 256
+
+
+class CachedHFLM(HFLM):
+    """loglikelihood请求带持久化缓存的HFLM"""
+
+    def __init__(self, pretrained, cache_path=DEFAULT_CACHE_PATH, flush_size=DEFAULT_FLUSH_SIZE,
+                 shared_prefix=True, fingerprint_parts=None, **kwargs):
+        """fingerprint_parts: 传入已加载的模型实例时，用其权重来源的指纹 (与传入路径时的缓存键一致)"""
+        super().__init__(pretrained=pretrained, **kwargs)
+        self.loglik_cache = LoglikCache(cache_path)
+        self.flush_size = flush_size
+
+        # 共享前缀打分只适用于因果语言模型
+        self.prefix_scorer = None
+        if shared_prefix and self.backend == "causal":
+            max_batch_size = self.batch_size if isinstance(self.batch_size, int) else 32
+            self.prefix_scorer = PrefixScorer(self.model, max_length=self.max_length, max_batch_size=max_batch_size)
+
+        # 模型指纹: 权重/分词器 + 适配器 + 影响数值结果的加载参数
+        if fingerprint_parts is not None:
+            parts = list(fingerprint_parts)
+        else:
+            parts = [fingerprint_model(pretrained) if isinstance(pretrained, str) else repr(pretrained.config)]
+            if kwargs.get("peft"):
+                parts.append(fingerprint_model(kwargs["peft"]))
+        parts.append(f"dtype={self.model.dtype},max_length={self.max_length}")
+        self.model_fingerprint = hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def _tokenize_request(self, context, continuation):
+        """与TemplateLM.loglikelihood相同的分词逻辑 (空上下文使用prefix token)"""
+        if context == "":
+            continuation_enc = self.tok_encode(continuation, add_special_tokens=False)
+            if self.prefix_token_id != continuation_enc[0]:
+                return [self.prefix_token_id], continuation_enc
+            return continuation_enc[:1], continuation_enc[1:]
+        return self._encode_pair(context, continuation)
+
+    def _score_requests(self, requests):
+        """计算一批 ((context, continuation), context_enc, continuation_enc) 请求"""
+        if self.prefix_scorer is not None:
+            return self.prefix_scorer.score_requests(requests)
+        return super()._loglikelihood_tokens(requests, disable_tqdm=True)
+
+    def loglikelihood(self, requests, disable_tqdm=False):
+        keys = [request_key(*req.args) for req in requests]
+        results = self.loglik_cache.get_many(self.model_fingerprint, keys)
+
+        pending = {}
+        for key, req in zip(keys, requests):
+            if key not in results and key not in pending:
+                pending[key] = req.args
+
+        if pending:
+            if not disable_tqdm:
+                print(f"log-likelihood缓存: 命中 {len(keys) - len(pending)}/{len(keys)}，需计算 {len(pending)} 个请求")
+            self._compute_pending(pending, results)
+
+        return [results[key] for key in keys]
+
+    def _compute_pending(self, pending, results):
+        """按上下文分组、按长度排序计算未命中的请求，并分批写入缓存"""
+        groups = {}
+        for key, (context, continuation) in pending.items():
+            context_enc, continuation_enc = self._tokenize_request(context, continuation)
+            request = ((context, continuation), context_enc, continuation_enc)
+            groups.setdefault(tuple(context_enc), []).append((key, request))
+
+        # 同一上下文的续写保持在同一批中; 按最长序列降序排列使每批长度相近
+        ordered = sorted(
+            groups.values(),
+            key=lambda group: -max(len(req[1]) + len(req[2]) for _, req in group)
+        )
+
+        batch = []
+        done = 0
+        for group in ordered:
+            batch.extend(group)
+            if len(batch) >= self.flush_size:
+                done += self._flush(batch, results)
+                print(f"   已计算 {done}/{len(pending)} 个请求")
+                batch = []
+        if batch:
+            self._flush(batch, results)
+
+    def _flush(self, batch, results):
+        scores = self._score_requests([request for _, request in batch])
+        items = [(key, logprob, is_greedy) for (key, _), (logprob, is_greedy) in zip(batch, scores)]
+        self.loglik_cache.put_many(self.model_fingerprint, items)
+        for key, logprob, is_greedy in items:
+            results[key] = (logprob, is_greedy)
+        return len(batch)
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="带log-likelihood缓存的lm-eval评估")
+    parser.add_argument("--model_path", type=str, required=True, help="模型目录或Hub模型名")
+    parser.add_argument("--peft", type=str, default=None, help="可选的LoRA适配器目录")
+    parser.add_argument("--tasks", type=str, default="hellaswag,gsm8k,mmlu_high_school_computer_science")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="auto")
+    parser.add_argument("--batch_size", type=str, default="8")
+    parser.add_argument("--num_fewshot", type=int, default=None)
+    parser.add_argument("--limit", type=float, default=None)
+    parser.add_argument("--cache_path", type=str, default=DEFAULT_CACHE_PATH, help="log-likelihood缓存文件")
+    parser.add_argument("--flush_size", type=int, default=DEFAULT_FLUSH_SIZE, help="每次写入缓存的请求数")
+    parser.add_argument("--no_shared_prefix", action="store_true", help="禁用共享前缀打分，使用lm-eval原始打分路径")
+    parser.add_argument("--output_file", type=str, required=True, help="结果JSON输出路径")
+    args = parser.parse_args()
+
+    batch_size = args.batch_size if args.batch_size == "auto" else int(args.batch_size)
+    limit = args.limit
+    if limit is not None and limit.is_integer() and limit >= 1:
+        limit = int(limit)
+
+    print(f"评估模型: {args.model_path}")
+    lm = CachedHFLM(
+        pretrained=args.model_path,
+        peft=args.peft,
+        device=args.device,
+        dtype=args.dtype,
+        batch_size=batch_size,
+        cache_path=args.cache_path,
+        flush_size=args.flush_size,
+        shared_prefix=not args.no_shared_prefix
+    )
+    print(f"模型指纹: {lm.model_fingerprint[:16]}")
+
+    results = simple_evaluate(
+        model=lm,
+        tasks=[task.strip() for task in args.tasks.split(",") if task.strip()],
+        num_fewshot=args.num_fewshot,
+        limit=limit,
+        log_samples=False
+    )
+    if results is None:
+        print("❌ 评估未返回结果")
+        sys.exit(1)
+
+    # 与lm-eval命令行输出保持相同结构
+    results.pop("samples", None)
+    results["config"]["model_args"] = f"pretrained={args.model_path},dtype={args.dtype}"
+    results["loglik_cache"] = {
+        "model_fingerprint": lm.model_fingerprint,
+        "hits": lm.loglik_cache.hits,
+        "misses": lm.loglik_cache.misses
+    }
+
+    output_dir = os.path.dirname(args.output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output_file, 'w') as f:
+        json.dump(results, f, indent=2, default=handle_non_serializable)
+
+    lookups = lm.loglik_cache.hits + lm.loglik_cache.misses
+    print(f"✓ 评估结果已保存: {args.output_file}")
+    if lookups:
+        print(f"log-likelihood缓存命中率: {lm.loglik_cache.hits / lookups * 100:.1f}% ({lm.loglik_cache.hits}/{lookups})")
+    lm.loglik_cache.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练过程中在后台评估中间checkpoint
+
+监视 models/{MODEL_ID}-instruction-{method}/ 下新出现的 checkpoint-* 目录
+(trainer_state.json写入后才视为完整)，交给一个低优先级 (nice) 且限制线程数的
+评估子进程:
+- 留出集损失: 默认取数据文件末尾的若干条 (训练只用了前 --max_samples 条时，取紧随其后的样本)
+- 任务子集: 每个任务按分层顺序取固定的前N个样本 (各checkpoint评估同一批样本，可直接比较)，
+  log-likelihood经CachedHFLM缓存
+基础模型只加载一次，LoRA/QLoRA checkpoint只切换适配器。结果按步追加到JSONL时间序列，
+重启后跳过已评估的checkpoint。留出集损失连续 --stop_patience 次没有改善时在训练目录写入
+STOP_TRAINING，train_instruction.py 检测到后提前结束训练。
+
+用法:
+  # 与训练一起启动 (train_instruction.py自动在后台运行本脚本)
+  python scripts/train_instruction.py --method lora --model_size tiny --save_steps 200 --watch_checkpoints
+  # 或单独监视一个正在训练的目录
+  python scripts/checkpoint_watcher.py --run_dir models/tinyllama_1.1b-instruction-lora \\
+      --base_model TinyLlama/TinyLlama-1.1B-Chat-v1.0 --stop_patience 3
+  # CPU自检: 训练微型模型的同时评估其checkpoint
+  python scripts/checkpoint_watcher.py --self_test
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+OUTPUT_DIR = os.path.join(PROJECT_ROOT, "results", "checkpoint_evals")
+
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint-(\d+)$")
+# 评估进程的nice值 (越大优先级越低)
+DEFAULT_NICENESS = 10
+DEFAULT_TASKS = "hellaswag,mmlu_high_school_computer_science"
+
+
+def list_checkpoints(run_dir):
+    """已完整写入的checkpoint，按步数升序返回 [(step, 路径)]"""
+    if not os.path.isdir(run_dir):
+        return []
+    found = []
+    for name in os.listdir(run_dir):
+        match = CHECKPOINT_PATTERN.match(name)
+        path = os.path.join(run_dir, name)
+        # Trainer最后写trainer_state.json，存在即说明模型/优化器状态已保存完
+        if match and os.path.exists(os.path.join(path, "trainer_state.json")):
+            found.append((int(match.group(1)), path))
+    return sorted(found)
+
+def load_holdout_texts(eval_file, num_samples, skip_samples=None):
+    """留出集文本: 跳过训练用的前skip_samples条后取num_samples条，未指定时取文件末尾num_samples条"""
+    from train_instruction import format_example
+
+    with open(eval_file) as f:
+        lines = [line for line in f if line.strip()]
+    if skip_samples is not None:
+        selected = lines[skip_samples:skip_samples + num_samples]
+    else:
+        selected = lines[-num_samples:]
+        print(f"⚠️ 未指定 --skip_samples，取 {eval_file} 末尾 {len(selected)} 条; 若训练使用了整个文件，这些样本并非留出数据")
+    return [format_example(json.loads(line)) for line in selected]
+
+def read_trainer_state(checkpoint):
+    """checkpoint时刻的 (epoch, 最近一次记录的训练损失)"""
+    with open(os.path.join(checkpoint, "trainer_state.json")) as f:
+        state = json.load(f)
+    losses = [entry["loss"] for entry in state.get("log_history", []) if "loss" in entry]
+    return state.get("epoch"), losses[-1] if losses else None
+
+def read_time_series(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def heldout_loss(model, tokenizer, texts, max_length, batch_size=8):
+    """按token加权的平均交叉熵 (忽略padding)，返回 (损失, token数)"""
+    import torch
+    import torch.nn.functional as F
+
+    device = next(model.parameters()).device
+    total = 0.0
+    tokens = 0
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            batch = tokenizer(texts[start:start + batch_size], truncation=True, max_length=max_length,
+                              padding=True, return_tensors="pt").to(device)
+            logits = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]).logits
+            targets = batch["input_ids"][:, 1:].masked_fill(batch["attention_mask"][:, 1:] == 0, -100)
+            total += float(F.cross_entropy(logits[:, :-1].float().reshape(-1, logits.shape[-1]), targets.reshape(-1),
+                                           ignore_index=-100, reduction="sum"))
+            tokens += int((targets != -100).sum())
+    return total / max(tokens, 1), tokens
+
+def task_subset_scores(model, tokenizer, fingerprint_parts, name, tasks, num_samples, options):
+    """每个任务评估分层顺序中的前num_samples个样本，返回 {任务: {mean, stderr, n} 或 {error, stage}}
+
+    model为评估进程中已加载的模型 (基础模型+适配器)，不按路径重新加载;
+    fingerprint_parts为其权重来源的指纹，log-likelihood缓存键与按路径评估时相同。
+    任务加载失败 (如数据集无法下载) 记为 stage="load"，后续checkpoint不再重试;
+    评估本身出错时打印完整的错误堆栈，该任务在下一个checkpoint上仍会评估。
+    """
+    import traceback
+    from lm_eval.tasks import TaskManager, get_task_dict
+    from cached_lm_eval import CachedHFLM
+    from significance import TASK_METRICS
+    from subsample_eval import stratum_key, stratified_order, stratified_estimate, evaluate_subset
+
+    lm = CachedHFLM(pretrained=model, tokenizer=tokenizer, batch_size=options["batch_size"],
+                    cache_path=options["cache_path"], fingerprint_parts=fingerprint_parts)
+    task_manager = TaskManager(include_path=options.get("include_path"))
+    scores = {}
+    try:
+        for task in tasks:
+            try:
+                docs = list(get_task_dict([task], task_manager)[task].eval_docs)
+            except Exception as error:
+                print(f"⚠️ 任务 {task} 加载失败: {type(error).__name__}: {error}")
+                scores[task] = {"error": f"{type(error).__name__}: {error}", "stage": "load"}
+                continue
+            try:
+                strata_all = [stratum_key(task, doc) for doc in docs]
+                population_sizes = {}
+                for key in strata_all:
+                    population_sizes[key] = population_sizes.get(key, 0) + 1
+                # 固定种子: 所有checkpoint评估同一批样本
+                indices = stratified_order(strata_all, seed=options["seed"])[:num_samples]
+                per_doc = evaluate_subset(lm, task, indices, task_manager)
+                metric = ",".join(TASK_METRICS.get(task, ("acc", "none")))
+                mean, stderr = stratified_estimate([per_doc[index][metric] for index in indices],
+                                                   [strata_all[index] for index in indices], population_sizes)
+                scores[task] = {"metric": metric, "mean": mean, "stderr": stderr, "n": len(indices)}
+            except Exception as error:
+                print(f"❌ 任务 {task} 评估出错 ({name}):")
+                traceback.print_exc()
+                scores[task] = {"error": f"{type(error).__name__}: {error}", "stage": "evaluate"}
+    finally:
+        lm.loglik_cache.close()
+    return scores
+
+def eval_worker(options, jobs, results):
+    """评估子进程: 降低优先级，加载一次基础模型，逐个评估队列中的checkpoint"""
+    if hasattr(os, "nice"):
+        os.nice(options["niceness"])
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    torch.set_num_threads(options["threads"])
+    tokenizer = AutoTokenizer.from_pretrained(options["base_model"])
+    tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
+    texts = load_holdout_texts(options["eval_file"], options["eval_samples"], options["skip_samples"])
+    base = None
+    # 基础模型的指纹只计算一次 (需要读取全部权重文件)
+    base_fingerprint = None
+
+    while True:
+        checkpoint = jobs.get()
+        if checkpoint is None:
+            return
+        start = time.perf_counter()
+        record = {"niceness": os.nice(0) if hasattr(os, "nice") else None}
+        try:
+            is_adapter = os.path.exists(os.path.join(checkpoint, "adapter_config.json"))
+            if is_adapter:
+                from peft import PeftModel
+                if base is None:
+                    base = AutoModelForCausalLM.from_pretrained(options["base_model"], dtype=torch.float32)
+                    base.to(options["device"])
+                model = PeftModel.from_pretrained(base, checkpoint)
+            else:
+                model = AutoModelForCausalLM.from_pretrained(checkpoint, dtype=torch.float32).to(options["device"])
+            model.eval()
+            record["eval_loss"], record["eval_tokens"] = heldout_loss(model, tokenizer, texts, options["max_length"],
+                                                                      options["batch_size"])
+            record["eval_ppl"] = math.exp(min(record["eval_loss"], 50))
+
+            if options["tasks"]:
+                # 直接使用已加载的模型; 缓存键与按路径评估 (基础模型+适配器) 时相同
+                from eval_cache import fingerprint_model
+                if is_adapter:
+                    if base_fingerprint is None:
+                        base_fingerprint = fingerprint_model(options["base_model"])
+                    fingerprint_parts = [base_fingerprint, fingerprint_model(checkpoint)]
+                else:
+                    fingerprint_parts = [fingerprint_model(checkpoint)]
+                record["tasks"] = task_subset_scores(model, tokenizer, fingerprint_parts, os.path.basename(checkpoint),
+                                                     options["tasks"], options["task_samples"], options)
+                # 加载失败的任务 (如数据集无法下载) 不再在后续checkpoint上重试
+                failed = [task for task, score in record["tasks"].items() if score.get("stage") == "load"]
+                if failed:
+                    print(f"⚠️ 以下任务无法加载，后续checkpoint跳过: {failed}")
+                    options["tasks"] = [task for task in options["tasks"] if task not in failed]
+
+            # 基础模型保留给下一个checkpoint，只卸下适配器
+            base = model.unload() if is_adapter else None
+            del model
+        except Exception as error:
+            record["error"] = f"{type(error).__name__}: {error}"
+        record["eval_seconds"] = time.perf_counter() - start
+        results.put(record)
+
+def training_alive(pid):
+    """pid为None时视为一直在训练; 也可传入Popen (自检中由本进程启动的训练)"""
+    if pid is None:
+        return True
+    if hasattr(pid, "poll"):
+        return pid.poll() is None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def plateaued(records, patience, min_delta):
+    """最近patience次评估的留出集损失都没有比之前的最好值降低min_delta以上"""
+    losses = [record["eval_loss"] for record in records if record.get("eval_loss") is not None]
+    if patience <= 0 or len(losses) <= patience:
+        return False
+    best_before = min(losses[:-patience])
+    return min(losses[-patience:]) > best_before - min_delta
+
+def watch(run_dir, options, output_file, poll_interval=30, training_pid=None, stop_patience=0, min_delta=0.0,
+          once=False):
+    """轮询run_dir，评估新checkpoint并追加到output_file; 训练结束 (final/出现或训练进程退出) 且没有待评估时返回"""
+    import multiprocessing
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    records = read_time_series(output_file)
+    done = {record["checkpoint"] for record in records}
+    if done:
+        print(f"✓ {output_file} 中已有 {len(done)} 个checkpoint的结果，跳过")
+
+    context = multiprocessing.get_context("spawn")
+    jobs, results = context.Queue(), context.Queue()
+    worker = None
+    stop_written = False
+    try:
+        while True:
+            finished = once or os.path.isdir(os.path.join(run_dir, "final")) or not training_alive(training_pid)
+            pending = [(step, path) for step, path in list_checkpoints(run_dir) if os.path.basename(path) not in done]
+            if not pending:
+                if finished:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            if worker is None:
+                worker = context.Process(target=eval_worker, args=(options, jobs, results), daemon=True)
+                worker.start()
+                print(f"✓ 评估进程 pid={worker.pid} (nice +{options['niceness']}, {options['threads']} 线程)")
+
+            # 按步数顺序逐个评估积压的checkpoint
+            step, path = pending[0]
+            epoch, train_loss = read_trainer_state(path)
+            jobs.put(path)
+            while True:
+                try:
+                    record = results.get(timeout=5)
+                    break
+                except Exception:
+                    if not worker.is_alive():
+                        raise SystemExit(f"❌ 评估进程意外退出 (exitcode={worker.exitcode})")
+
+            record = {"time": datetime.now().isoformat(timespec="seconds"), "checkpoint": os.path.basename(path),
+                      "step": step, "epoch": epoch, "train_loss": train_loss, **record}
+            with open(output_file, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+            records.append(record)
+            done.add(record["checkpoint"])
+            print(format_record(record, records))
+            sys.stdout.flush()
+
+            if not stop_written and not finished and plateaued(records, stop_patience, min_delta):
+                reason = f"留出集损失连续 {stop_patience} 次评估没有改善 (step {step})"
+                with open(os.path.join(run_dir, "STOP_TRAINING"), 'w') as f:
+                    f.write(reason + "\n")
+                print(f"⚠️ {reason}，已写入 {os.path.join(run_dir, 'STOP_TRAINING')}")
+                stop_written = True
+    finally:
+        if worker is not None:
+            jobs.put(None)
+            worker.join(timeout=60)
+            if worker.is_alive():
+                worker.terminate()
+    return records
+
+def format_record(record, records):
+    if "error" in record:
+        return f"❌ {record['checkpoint']}: {record['error']}"
+    losses = [entry["eval_loss"] for entry in records[:-1] if entry.get("eval_loss") is not None]
+    trend = f" ({record['eval_loss'] - losses[-1]:+.4f})" if losses else ""
+    train = f"train_loss {record['train_loss']:.4f}, " if record.get("train_loss") is not None else ""
+    line = (f"[step {record['step']}] {train}eval_loss {record['eval_loss']:.4f}{trend}, "
+            f"ppl {record['eval_ppl']:.2f}, 用时 {record['eval_seconds']:.1f}s")
+    for task, score in record.get("tasks", {}).items():
+        line += f", {task} " + (f"{score['mean'] * 100:.1f}±{score['stderr'] * 100:.1f}%" if "mean" in score
+                                else f"失败 ({score['error']})")
+    return line
+
+def build_options(args):
+    return {
+        "base_model": args.base_model,
+        "eval_file": args.eval_file,
+        "eval_samples": args.eval_samples,
+        "skip_samples": args.skip_samples,
+        "max_length": args.max_length,
+        "batch_size": args.batch_size,
+        "device": args.device,
+        "tasks": [task.strip() for task in args.tasks.split(",") if task.strip()],
+        "task_samples": args.task_samples,
+        "cache_path": args.cache_path,
+        "include_path": args.include_path,
+        "seed": args.seed,
+        "niceness": args.niceness,
+        "threads": args.threads or max(1, (os.cpu_count() or 1) // 4)
+    }
+
+def self_test(work_dir):
+    """训练微型模型 (子进程) 的同时评估checkpoint; 再验证重启跳过已评估的和损失停滞时的提前停止"""
+    from tiny_model import create_tiny_model
+    from subsample_eval import write_local_task
+
+    model_dir = create_tiny_model(os.path.join(work_dir, "model"), hidden_size=128, num_layers=2,
+                                  intermediate_size=256, seed=0)
+    train_file = os.path.join(PROJECT_ROOT, "data", "alpaca_train_5k.jsonl")
+    # 本地lm-eval任务 (离线)，检查任务子集的得分出现在每个checkpoint的记录中
+    task = write_local_task(os.path.join(work_dir, "tasks"))
+    args = build_parser().parse_args(["--base_model", model_dir, "--eval_file", train_file, "--skip_samples", "64",
+                                      "--eval_samples", "32", "--max_length", "64", "--tasks", task,
+                                      "--task_samples", "8", "--include_path", os.path.join(work_dir, "tasks"),
+                                      "--cache_path", os.path.join(work_dir, "loglik_cache.sqlite"), "--threads", "1"])
+    options = build_options(args)
+
+    def start_training(run_dir, max_steps, save_steps=4):
+        cmd = [sys.executable, os.path.join(SCRIPT_DIR, "train_instruction.py"), "--method", "lora",
+               "--model_name", model_dir, "--train_file", train_file, "--max_samples", "64", "--max_length", "64",
+               "--batch_size", "4", "--gradient_accumulation_steps", "1", "--warmup_steps", "0", "--lr", "2e-3",
+               "--max_steps", str(max_steps), "--save_steps", str(save_steps), "--logging_steps", "2", "--output_dir", run_dir]
+        # 训练日志写入文件 (不读取的管道写满后会阻塞训练)
+        with open(f"{run_dir}.log", 'w') as log:
+            return subprocess.Popen(cmd, cwd=PROJECT_ROOT, stdout=log, stderr=subprocess.STDOUT)
+
+    # 1) 训练16步，每4步一个checkpoint，同时评估
+    run_dir = os.path.join(work_dir, "run")
+    output_file = os.path.join(work_dir, "evals.jsonl")
+    start = time.perf_counter()
+    training = start_training(run_dir, 16)
+    records = watch(run_dir, options, output_file, poll_interval=1, training_pid=training)
+    training.wait()
+    elapsed = time.perf_counter() - start
+    steps = [record["step"] for record in records]
+    losses = [record.get("eval_loss") for record in records]
+    print(f"训练+评估用时 {elapsed:.1f}s，评估的checkpoint: {steps}")
+    ok = training.returncode == 0 and steps == [4, 8, 12, 16] and all(loss is not None for loss in losses)
+    ok = ok and losses[-1] < losses[0] and all((record.get("niceness") or 0) >= options["niceness"] for record in records)
+    task_ok = all(record.get("tasks", {}).get(task, {}).get("n") == 8 for record in records)
+    print(f"每个checkpoint都有任务子集得分: {task_ok}")
+    ok = ok and task_ok
+    if training.returncode != 0:
+        with open(f"{run_dir}.log") as f:
+            print(f.read()[-3000:])
+
+    # 2) 重启后不重复评估
+    again = watch(run_dir, options, output_file, once=True)
+    print(f"重启后时间序列条数: {len(again)}")
+    ok = ok and len(again) == len(records)
+
+    # 3) 损失停滞 (要求每次至少下降10) 时写入STOP_TRAINING，训练远早于max_steps结束
+    #    (单核CPU上低优先级的评估进程只能分到很少的CPU，停止前训练还会继续一段)
+    run_dir = os.path.join(work_dir, "run_stop")
+    training = start_training(run_dir, 2000, save_steps=20)
+    # 只看留出集损失 (任务子集已在1中检查，这里会积压很多checkpoint)
+    records = watch(run_dir, dict(options, tasks=[]), os.path.join(work_dir, "evals_stop.jsonl"), poll_interval=1,
+                    training_pid=training, stop_patience=1, min_delta=10.0)
+    training.wait()
+    with open(os.path.join(run_dir, "STOP_TRAINING")) as f:
+        print(f"停止原因: {f.read().strip()}")
+    last_step = max(step for step, _ in list_checkpoints(run_dir))
+    print(f"提前停止: 最后的checkpoint为 step {last_step} (max_steps=2000)")
+    return ok and training.returncode == 0 and last_step < 2000
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="训练过程中在后台低优先级进程中评估新checkpoint")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上训练微型模型的同时评估其checkpoint")
+    parser.add_argument("--run_dir", type=str, default=None, help="训练输出目录 (包含checkpoint-*)")
+    parser.add_argument("--base_model", type=str, default=None, help="基础模型 (加载分词器和LoRA的基础权重)")
+    parser.add_argument("--eval_file", type=str, default=os.path.join(PROJECT_ROOT, "data", "alpaca_train_5k.jsonl"))
+    parser.add_argument("--eval_samples", type=int, default=64, help="留出集样本数")
+    parser.add_argument("--skip_samples", type=int, default=None, help="跳过训练使用的前N条 (默认取文件末尾)")
+    parser.add_argument("--max_length", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--device", type=str, default="cpu", help="评估设备 (默认CPU，不占用训练的GPU)")
+    parser.add_argument("--tasks", type=str, default=DEFAULT_TASKS, help="逗号分隔的任务子集，空字符串表示只算留出集损失")
+    parser.add_argument("--task_samples", type=int, default=100, help="每个任务评估的样本数")
+    parser.add_argument("--cache_path", type=str, default="results/loglik_cache.sqlite", help="log-likelihood缓存文件")
+    parser.add_argument("--include_path", type=str, default=None, help="额外的lm-eval任务YAML目录 (本地任务)")
+    parser.add_argument("--seed", type=int, default=1234, help="任务子集的分层抽样种子")
+    parser.add_argument("--niceness", type=int, default=DEFAULT_NICENESS, help="评估进程的nice增量")
+    parser.add_argument("--threads", type=int, default=None, help="评估进程的线程数 (默认CPU核数的1/4)")
+    parser.add_argument("--output_file", type=str, default=None,
+                        help="时间序列JSONL (默认 results/checkpoint_evals/<run_dir名>.jsonl)")
+    parser.add_argument("--poll_interval", type=float, default=30, help="轮询间隔 (秒)")
+    parser.add_argument("--training_pid", type=int, default=None, help="训练进程pid，退出后评估完剩余checkpoint即结束")
+    parser.add_argument("--once", action="store_true", help="只评估当前已有的checkpoint后退出")
+    parser.add_argument("--stop_patience", type=int, default=0,
+                        help="留出集损失连续N次没有改善时写入STOP_TRAINING让训练提前结束 (0: 不停止)")
+    parser.add_argument("--min_delta", type=float, default=0.0, help="视为改善的最小损失下降")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+
+    if args.self_test:
+        with tempfile.TemporaryDirectory() as work_dir:
+            ok = self_test(work_dir)
+        if not ok:
+            print("❌ checkpoint后台评估自检失败")
+            raise SystemExit(1)
+        print("✅ checkpoint后台评估自检通过")
+        return
+
+    if not args.run_dir or not args.base_model:
+        raise SystemExit("❌ 需要 --run_dir 和 --base_model")
+    output_file = args.output_file or os.path.join(OUTPUT_DIR, f"{os.path.basename(os.path.normpath(args.run_dir))}.jsonl")
+    records = watch(args.run_dir, build_options(args), output_file, args.poll_interval, args.training_pid,
+                    args.stop_patience, args.min_delta, args.once)
+    print(f"✅ 共 {len(records)} 个checkpoint的评估结果: {output_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分块交叉熵损失: 不一次性生成完整的 [batch, seq, vocab] logits
+
+前向按token分块计算 lm_head + 交叉熵，只保留损失之和; 反向时逐块重新计算logits
+并直接得到对隐藏状态/lm_head的梯度。峰值只有一个块的logits (chunk_size × vocab)，
+而不是 batch × seq × vocab (Mistral-7B在2048长度、batch=4时约1GB fp32 logits再加梯度)。
+
+训练时通过 train_instruction.py --chunked_loss 启用，可与 --gradient_checkpointing 组合。
+
+用法 (CPU自检: 与标准损失比较数值，并测量四种组合的峰值内存和单步耗时):
+  python scripts/chunked_loss.py --self_test
+"""
+
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+DEFAULT_CHUNK_SIZE = 1024
+IGNORE_INDEX = -100
+
+
+class _ChunkedCrossEntropy(torch.autograd.Function):
+    """sum(cross_entropy(hidden @ W^T + b, labels))，logits按块计算，反向重新计算"""
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, labels, chunk_size, ignore_index):
+        total = torch.zeros((), dtype=torch.float32, device=hidden.device)
+        for start in range(0, hidden.shape[0], chunk_size):
+            logits = F.linear(hidden[start:start + chunk_size], weight, bias).float()
+            total += F.cross_entropy(logits, labels[start:start + chunk_size], ignore_index=ignore_index,
+                                     reduction="sum")
+        ctx.save_for_backward(hidden, weight, bias, labels)
+        ctx.chunk_size = chunk_size
+        ctx.ignore_index = ignore_index
+        return total
+
+    @staticmethod
+    def backward(ctx, grad_total):
+        hidden, weight, bias, labels = ctx.saved_tensors
+        need_hidden, need_weight, need_bias = ctx.needs_input_grad[:3]
+        grad_hidden = torch.empty_like(hidden) if need_hidden else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32) if need_weight else None
+        grad_bias = torch.zeros_like(bias, dtype=torch.float32) if need_bias else None
+
+        for start in range(0, hidden.shape[0], ctx.chunk_size):
+            chunk = hidden[start:start + ctx.chunk_size]
+            chunk_labels = labels[start:start + ctx.chunk_size]
+            logits = F.linear(chunk, weight, bias).float()
+            # d(交叉熵)/d(logits) = softmax - one_hot，忽略的位置梯度为0
+            grad_logits = torch.softmax(logits, dim=-1)
+            del logits
+            valid = chunk_labels != ctx.ignore_index
+            rows = torch.arange(chunk.shape[0], device=chunk.device)
+            grad_logits[rows, chunk_labels.clamp(min=0)] -= 1
+            grad_logits[~valid] = 0
+            grad_logits = (grad_logits * grad_total).to(chunk.dtype)
+
+            if need_hidden:
+                grad_hidden[start:start + ctx.chunk_size] = grad_logits @ weight
+            if need_weight:
+                grad_weight += (grad_logits.t() @ chunk).float()
+            if need_bias:
+                grad_bias += grad_logits.sum(dim=0).float()
+
+        if need_weight:
+            grad_weight = grad_weight.to(weight.dtype)
+        if need_bias:
+            grad_bias = grad_bias.to(bias.dtype)
+        return grad_hidden, grad_weight, grad_bias, None, None, None
+
+def chunked_causal_lm_loss(hidden_states, lm_head, labels, chunk_size=DEFAULT_CHUNK_SIZE,
+                           num_items_in_batch=None, ignore_index=IGNORE_INDEX):
+    """因果语言模型损失 (与transformers一致: 第t个位置预测第t+1个token)
+
+    num_items_in_batch: 梯度累积时整个有效批的有效token数 (Trainer传入)，为None时取本批平均
+    """
+    hidden = hidden_states[:, :-1, :].reshape(-1, hidden_states.shape[-1])
+    targets = labels[:, 1:].reshape(-1).to(hidden.device)
+    total = _ChunkedCrossEntropy.apply(hidden, lm_head.weight, lm_head.bias, targets, chunk_size, ignore_index)
+    if num_items_in_batch is None:
+        num_items_in_batch = (targets != ignore_index).sum().clamp(min=1)
+    if torch.is_tensor(num_items_in_batch):
+        num_items_in_batch = num_items_in_batch.to(total.device)
+    return total / num_items_in_batch
+
+def causal_lm_loss(model, inputs, chunk_size=DEFAULT_CHUNK_SIZE, num_items_in_batch=None):
+    """只运行解码器得到最后的隐藏状态，再用分块损失代替模型自带的lm_head + 交叉熵 (支持PEFT包装的模型)"""
+    unwrapped = model.get_base_model() if hasattr(model, "get_base_model") else model
+    decoder = unwrapped.get_decoder()
+    lm_head = unwrapped.get_output_embeddings()
+    if type(lm_head) is not nn.Linear:
+        raise ValueError(f"分块损失只支持普通nn.Linear的lm_head: {type(lm_head).__name__}")
+
+    inputs = dict(inputs)
+    labels = inputs.pop("labels")
+    outputs = decoder(**inputs, use_cache=False)
+    return chunked_causal_lm_loss(outputs[0], lm_head, labels, chunk_size, num_items_in_batch)
+
+def check_gradients(seq_len=96, chunk_size=40, seed=0):
+    """与模型自带的损失比较损失值和全部参数梯度，返回最大差值"""
+    from tiny_model import build_tiny_model
+
+    model, _ = build_tiny_model(hidden_size=64, num_layers=2, seed=seed)
+    model.train()
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(3, model.config.vocab_size, (3, seq_len), generator=generator)
+    labels = input_ids.clone()
+    labels[0, -20:] = IGNORE_INDEX
+    labels[2, :10] = IGNORE_INDEX
+
+    reference = model(input_ids=input_ids, labels=labels).loss
+    reference.backward()
+    reference_grads = {name: param.grad.clone() for name, param in model.named_parameters()}
+    model.zero_grad()
+
+    loss = causal_lm_loss(model, {"input_ids": input_ids, "labels": labels}, chunk_size)
+    loss.backward()
+    loss_diff = abs(loss.item() - reference.item())
+    grad_diff = max(float((param.grad - reference_grads[name]).abs().max()) for name, param in model.named_parameters())
+    return loss_diff, grad_diff
+
+def self_test(seq_len=1024, micro_batch=2, chunk_size=256):
+    """数值一致性 + 四种组合 (基线/梯度检查点/分块损失/两者) 的峰值内存和单步耗时"""
+    import tempfile
+    from tiny_model import build_tiny_model
+    from memory_planner import GB, ModelShape, estimate_memory, probe
+
+    loss_diff, grad_diff = check_gradients()
+    print(f"与标准损失相比: 损失差 {loss_diff:.2e}, 梯度最大差 {grad_diff:.2e}")
+    ok = loss_diff < 1e-5 and grad_diff < 1e-5
+
+    model, _ = build_tiny_model(hidden_size=256, num_layers=4, num_heads=8, num_kv_heads=4, intermediate_size=688,
+                                max_position_embeddings=seq_len)
+    shape = ModelShape.from_config(model.config)
+    results = {}
+    with tempfile.TemporaryDirectory() as model_dir:
+        model.config.save_pretrained(model_dir)
+        print(f"\n微型Llama (hidden=256, layers=4, vocab={shape.vocab_size}), seq={seq_len}, batch={micro_batch}, LoRA")
+        print(f"{'组合':<22} {'估算':>8} {'实测峰值':>9} {'单步耗时':>9}")
+        for gradient_checkpointing in [False, True]:
+            for loss_chunk_size in [None, chunk_size]:
+                name = ("梯度检查点" if gradient_checkpointing else "基线") + (" + 分块损失" if loss_chunk_size else "")
+                result = probe(model_dir, "lora", seq_len, micro_batch, "fp32", "adamw", "cpu",
+                               gradient_checkpointing=gradient_checkpointing, loss_chunk_size=loss_chunk_size)
+                if result is None:
+                    return False
+                estimate = estimate_memory(shape, "lora", seq_len, micro_batch,
+                                           gradient_checkpointing=gradient_checkpointing,
+                                           loss_chunk_size=loss_chunk_size)["total"]
+                results[(gradient_checkpointing, loss_chunk_size)] = result
+                print(f"{name:<22} {estimate / GB:>7.2f}G {result['peak_bytes'] / GB:>8.2f}G "
+                      f"{result['step_time']:>8.2f}s")
+
+    baseline = results[(False, None)]["peak_bytes"]
+    both = results[(True, chunk_size)]["peak_bytes"]
+    print(f"\n两者组合峰值为基线的 {both / baseline * 100:.0f}%")
+    ok = ok and results[(True, None)]["peak_bytes"] < baseline and results[(False, chunk_size)]["peak_bytes"] < baseline
+    return ok and both < baseline
+
+def main():
+    parser = argparse.ArgumentParser(description="分块交叉熵损失")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用微型模型自检并测量内存/耗时")
+    parser.add_argument("--seq_len", type=int, default=1024)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--chunk_size", type=int, default=256)
+    args = parser.parse_args()
+
+    if not args.self_test:
+        parser.print_help()
+        return
+
+    if not self_test(args.seq_len, args.batch_size, args.chunk_size):
+        print("❌ 分块损失自检失败")
+        raise SystemExit(1)
+    print("✅ 分块损失自检通过")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练数据加载的检查: 工作进程预取是否让模型不再等待数据
+
+train_instruction.py 的数据加载选项:
+  --dataloader_num_workers N      N个工作进程在后台取样本、分词和整理批次
+  --dataloader_prefetch_factor K  每个工作进程提前准备K个批次
+  --tokenize_on_the_fly           不预先分词，取样本时在工作进程中分词
+  --no_pin_memory                 有CUDA时默认使用锁页内存 (主机到设备的拷贝可以异步进行)
+每个优化器步等待数据的时间记录在日志 (data_wait_ms) 中，训练结束时汇总。
+
+本脚本用同一个微型模型和同一份数据，在不同的数据加载配置下各训练若干步，检查:
+- 预先分词与即时分词、有无工作进程时，每步的损失完全一致 (批次内容和顺序不变)
+- 样本预处理较慢时 (--sample_delay_ms 模拟复杂的预处理)，工作进程预取能把数据等待降下来
+并报告每步的数据等待时间及其占单步耗时的比例。
+
+用法:
+  python scripts/dataloader_check.py --self_test
+  python scripts/dataloader_check.py --workers 0,2,4 --sample_delay_ms 20 --max_steps 20
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+TRAIN_FILE = os.path.join(PROJECT_ROOT, "data", "alpaca_train_5k.jsonl")
+
+
+class DelayedDataset:
+    """每次取样本前等待固定时间，模拟较慢的样本预处理 (如打包、数据增强)"""
+
+    def __init__(self, dataset, delay):
+        self.dataset = dataset
+        self.delay = delay
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        time.sleep(self.delay)
+        return self.dataset[index]
+
+def run_config(model_dir, output_dir, num_workers=0, prefetch_factor=None, on_the_fly=False, sample_delay=0.0,
+               max_steps=12, max_samples=64, max_length=128, batch_size=2, gradient_accumulation_steps=2):
+    """用一种数据加载配置训练，返回 (数据等待汇总, 每次记录的损失)"""
+    from transformers import set_seed
+    from train_instruction import (TrainConfig, load_dataset_from_jsonl, load_tokenizer, run_training,
+                                   tokenize_dataset)
+
+    config = TrainConfig(method="lora", model_name=model_dir, train_file=TRAIN_FILE, max_samples=max_samples,
+                         max_length=max_length, max_steps=max_steps, batch_size=batch_size,
+                         gradient_accumulation_steps=gradient_accumulation_steps, warmup_steps=0, logging_steps=1,
+                         lr=1e-3, lora_dropout=0.0, output_dir=output_dir, no_save=True,
+                         dataloader_num_workers=num_workers, dataloader_prefetch_factor=prefetch_factor,
+                         tokenize_on_the_fly=on_the_fly)
+    tokenizer = load_tokenizer(model_dir)
+    dataset = tokenize_dataset(load_dataset_from_jsonl(TRAIN_FILE, max_samples), tokenizer, max_length, on_the_fly)
+    if sample_delay:
+        dataset = DelayedDataset(dataset, sample_delay)
+    # LoRA初始化在Trainer设置随机种子之前，固定种子使各配置的初始权重相同 (dropout为0，结果只取决于数据)
+    set_seed(config.seed)
+    trainer = run_training(config, tokenizer=tokenizer, tokenized_dataset=dataset)
+    losses = [entry["loss"] for entry in trainer.state.log_history if "loss" in entry]
+    logged_wait = all("data_wait_ms" in entry for entry in trainer.state.log_history if "loss" in entry)
+    summary = trainer.data_wait_summary()
+    if summary is None:
+        # 第一步不计入统计，至少需要2个训练步
+        print(f"⚠️ 训练步数太少 ({trainer.state.global_step} 步)，没有数据等待统计")
+        summary = {}
+    return dict(summary, logged_wait=logged_wait), losses
+
+def run_checks(workers, sample_delay_ms=20.0, prefetch_factor=None, max_steps=12, max_samples=64, max_length=128,
+               hidden_size=128, num_layers=2):
+    from tiny_model import create_tiny_model
+
+    configs = [("预先分词", 0, False, 0.0), ("即时分词", 0, True, 0.0)]
+    configs += [(f"即时分词 + {n} 个工作进程", n, True, 0.0) for n in workers if n > 0]
+    if sample_delay_ms:
+        configs += [(f"慢预处理 {sample_delay_ms:.0f}ms/样本, {n} 个工作进程", n, True, sample_delay_ms / 1000)
+                    for n in workers]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        model_dir = create_tiny_model(os.path.join(work_dir, "model"), hidden_size=hidden_size, num_layers=num_layers,
+                                      intermediate_size=hidden_size * 2, seed=0)
+        for name, num_workers, on_the_fly, delay in configs:
+            print(f"\n=== {name} ===")
+            results[name] = run_config(model_dir, os.path.join(work_dir, "run"), num_workers,
+                                       prefetch_factor if num_workers else None, on_the_fly, delay, max_steps,
+                                       max_samples, max_length)
+
+    print(f"\n{'配置':<32} {'等待/步':>9} {'最长':>9} {'单步':>8} {'等待占比':>8}")
+    for name, (summary, _) in results.items():
+        if "mean_wait" not in summary:
+            print(f"{name:<32} 步数太少，没有统计")
+            continue
+        print(f"{name:<32} {summary['mean_wait'] * 1000:>7.1f}ms {summary['max_wait'] * 1000:>7.1f}ms "
+              f"{summary['mean_step'] * 1000:>6.0f}ms {summary['wait_fraction'] * 100:>7.1f}%")
+
+    # 批次内容和顺序与数据加载方式无关
+    reference = results["预先分词"][1]
+    loss_diff = max(max(abs(a - b) for a, b in zip(losses, reference)) for _, losses in results.values())
+    logged = all(summary["logged_wait"] for summary, _ in results.values())
+    print(f"\n各配置逐步损失的最大差异: {loss_diff:.2e}, 日志中都有data_wait_ms: {logged}")
+    ok = loss_diff < 1e-5 and logged
+    if sample_delay_ms and len(workers) > 1:
+        slow = [results[f"慢预处理 {sample_delay_ms:.0f}ms/样本, {n} 个工作进程"][0] for n in workers]
+        if any("wait_fraction" not in summary for summary in slow):
+            print("⚠️ 训练步数太少，跳过工作进程的等待占比比较")
+            return ok
+        hidden = slow[-1]["wait_fraction"] < slow[0]["wait_fraction"]
+        print(f"慢预处理时 {workers[-1]} 个工作进程的等待占比 {slow[-1]['wait_fraction'] * 100:.1f}% "
+              f"(无工作进程 {slow[0]['wait_fraction'] * 100:.1f}%)")
+        ok = ok and hidden
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="训练数据加载 (工作进程/预取/即时分词) 的检查")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用微型模型自检")
+    parser.add_argument("--workers", type=str, default="0,2", help="逗号分隔的工作进程数")
+    parser.add_argument("--prefetch_factor", type=int, default=None)
+    parser.add_argument("--sample_delay_ms", type=float, default=20.0, help="模拟的每个样本预处理耗时 (0: 不模拟)")
+    parser.add_argument("--max_steps", type=int, default=12)
+    parser.add_argument("--max_length", type=int, default=128)
+    args = parser.parse_args()
+
+    workers = [int(n) for n in args.workers.split(",")]
+    if args.self_test:
+        ok = run_checks([0, 2], sample_delay_ms=20.0, max_steps=8, max_length=64)
+        if not ok:
+            print("❌ 数据加载自检失败")
+            raise SystemExit(1)
+        print("✅ 数据加载自检通过")
+        return
+
+    if not run_checks(workers, args.sample_delay_ms, args.prefetch_factor, args.max_steps, max_length=args.max_length):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据并行训练的检查与扩展性测试
+
+train_instruction.py 可以直接用 torchrun / accelerate launch 启动:
+  torchrun --nproc_per_node 2 scripts/train_instruction.py --method lora ...
+CPU上自动使用gloo后端，CUDA上使用nccl。
+
+本脚本用torchrun以1/2/4个进程训练同一个微型模型 (全局批大小固定)，检查:
+- 各进程的数据分片互不重叠且覆盖整个数据集
+- 训练后各进程的可训练参数完全一致 (DDP只同步适配器梯度)
+- 只有rank 0写checkpoint/指标文件
+并报告吞吐量和扩展效率。
+
+用法:
+  python scripts/distributed_check.py --self_test
+  python scripts/distributed_check.py --nprocs 1,2,4 --method lora --max_steps 20
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+OUTPUT_DIR = os.path.join(PROJECT_ROOT, "results", "distributed")
+
+
+def worker(request):
+    """在torchrun启动的每个进程中执行: 训练，然后汇总各进程的分片/参数/写入权限"""
+    import torch.distributed as dist
+    from train_instruction import TrainConfig, run_training, distributed_info, setup_rank_logging
+
+    rank, world_size, _ = distributed_info()
+    setup_rank_logging()
+    config = TrainConfig(**request["config"])
+    trainer = run_training(config)
+
+    # 本进程一个epoch看到的样本 (accelerate按进程切分dataloader)
+    samples = [tuple(ids.tolist()) for batch in trainer.get_train_dataloader() for ids in batch["input_ids"]]
+    checksum = sum(float(param.detach().double().sum()) for param in trainer.model.parameters() if param.requires_grad)
+    summary = next(entry for entry in reversed(trainer.state.log_history) if "train_runtime" in entry)
+    local = {"rank": rank, "samples": samples, "checksum": checksum, "should_save": trainer.args.should_save}
+
+    gathered = [None] * world_size
+    if world_size > 1:
+        dist.all_gather_object(gathered, local)
+    else:
+        gathered = [local]
+
+    if rank == 0:
+        shards = [set(entry["samples"]) for entry in gathered]
+        overlap = sum(len(shards[i] & shards[j]) for i in range(world_size) for j in range(i + 1, world_size))
+        metrics_lines = 0
+        if config.metrics_file and os.path.exists(config.metrics_file):
+            with open(config.metrics_file) as f:
+                metrics_lines = sum(1 for line in f if line.strip())
+        result = {
+            "world_size": world_size,
+            "shard_sizes": [len(entry["samples"]) for entry in gathered],
+            "covered": len(set().union(*shards)),
+            "overlap": overlap,
+            "checksums": [entry["checksum"] for entry in gathered],
+            "writers": [entry["rank"] for entry in gathered if entry["should_save"]],
+            "metrics_lines": metrics_lines,
+            "train_runtime": summary["train_runtime"],
+            "train_samples_per_second": summary["train_samples_per_second"],
+            "train_loss": summary["train_loss"],
+            "sync_bytes": sum(p.numel() * p.element_size() for p in trainer.model.parameters() if p.requires_grad)
+        }
+        with open(request["result_file"], 'w') as f:
+            json.dump(result, f)
+
+def launch(nproc, config, result_file, cpu_count):
+    """用torchrun启动nproc个worker，返回rank 0写出的结果"""
+    env = dict(os.environ)
+    # 每个进程平分CPU线程，避免进程间超额订阅
+    env["OMP_NUM_THREADS"] = str(max(1, cpu_count // nproc))
+    cmd = [sys.executable, "-m", "torch.distributed.run", "--standalone", f"--nproc_per_node={nproc}",
+           os.path.abspath(__file__), "--worker", json.dumps({"config": config, "result_file": result_file})]
+    start = time.perf_counter()
+    process = subprocess.run(cmd, capture_output=True, text=True, cwd=SCRIPT_DIR, env=env)
+    wall_time = time.perf_counter() - start
+    if process.returncode != 0 or not os.path.exists(result_file):
+        print(process.stdout[-3000:])
+        print(process.stderr[-3000:])
+        return None
+    with open(result_file) as f:
+        result = json.load(f)
+    result["wall_time"] = wall_time
+    return result
+
+def run_scaling(nprocs, method="lora", max_steps=10, global_batch=8, max_samples=64, max_length=128,
+                hidden_size=256, num_layers=4):
+    """固定全局批大小，比较不同进程数的吞吐量并检查分片/同步/写入"""
+    from tiny_model import create_tiny_model
+
+    cpu_count = os.cpu_count() or 1
+    ok = True
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        model_dir = create_tiny_model(os.path.join(work_dir, "model"), hidden_size=hidden_size, num_layers=num_layers,
+                                      intermediate_size=hidden_size * 2, seed=0)
+        for nproc in nprocs:
+            if global_batch % nproc or max_samples % global_batch:
+                print(f"⚠️ 跳过 {nproc} 个进程: 全局批大小 {global_batch} 或样本数 {max_samples} 不能整除")
+                continue
+            output_dir = os.path.join(work_dir, f"run_{nproc}")
+            config = {
+                "method": method, "model_name": model_dir, "train_file": "data/alpaca_train_5k.jsonl",
+                "max_samples": max_samples, "max_length": max_length, "max_steps": max_steps,
+                "batch_size": global_batch // nproc, "gradient_accumulation_steps": 1, "warmup_steps": 0,
+                "logging_steps": 2, "lr": 1e-3, "output_dir": output_dir,
+                "metrics_file": os.path.join(output_dir, "metrics.jsonl")
+            }
+            config["train_file"] = os.path.join(PROJECT_ROOT, config["train_file"])
+            print(f"启动 {nproc} 个进程 (每进程batch {global_batch // nproc}) ...")
+            result = launch(nproc, config, os.path.join(work_dir, f"result_{nproc}.json"), cpu_count)
+            if result is None:
+                print(f"❌ {nproc} 个进程的训练失败")
+                return False, results
+            result["final_saved"] = os.path.isdir(os.path.join(output_dir, "final"))
+            results.append(result)
+
+            # 分片互不重叠且覆盖全部样本; 各进程参数一致; 只有rank 0写入; 指标只写一份
+            checks = {
+                "分片": result["overlap"] == 0 and result["covered"] == max_samples,
+                "参数同步": max(result["checksums"]) - min(result["checksums"]) < 1e-9,
+                "rank0写入": result["writers"] == [0] and result["final_saved"],
+                "指标": result["metrics_lines"] == max_steps // 2
+            }
+            failed = [name for name, passed in checks.items() if not passed]
+            if failed:
+                print(f"❌ {nproc} 个进程检查失败: {failed} {result}")
+            ok = ok and not failed
+
+    if results:
+        base = results[0]["train_samples_per_second"] / results[0]["world_size"]
+        print(f"\nCPU核数: {cpu_count}, 方法: {method}, 全局批大小: {global_batch}, 步数: {max_steps}")
+        print(f"{'进程数':>6} {'每进程分片':>10} {'同步/步':>9} {'samples/s':>10} {'加速比':>7} {'效率':>6} {'train_loss':>10}")
+        for result in results:
+            speedup = result["train_samples_per_second"] / results[0]["train_samples_per_second"]
+            efficiency = result["train_samples_per_second"] / (base * result["world_size"])
+            print(f"{result['world_size']:>6} {result['shard_sizes'][0]:>10} {result['sync_bytes'] / 1024:>7.0f}KB "
+                  f"{result['train_samples_per_second']:>10.2f} {speedup:>6.2f}x {efficiency * 100:>5.0f}% "
+                  f"{result['train_loss']:>10.4f}")
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        with open(os.path.join(OUTPUT_DIR, f"scaling_{method}.json"), 'w') as f:
+            json.dump(results, f, indent=2)
+        if cpu_count < max(result["world_size"] for result in results):
+            print("⚠️ 进程数超过CPU核数，吞吐量数字只反映通信/调度开销，不代表真实扩展性")
+    return ok, results
+
+def main():
+    parser = argparse.ArgumentParser(description="数据并行训练的检查与扩展性测试")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用gloo后端以1/2/4个进程自检")
+    parser.add_argument("--nprocs", type=str, default="1,2,4", help="逗号分隔的进程数")
+    parser.add_argument("--method", type=str, default="lora", choices=["full", "lora", "qlora"])
+    parser.add_argument("--max_steps", type=int, default=10)
+    parser.add_argument("--global_batch", type=int, default=8)
+    parser.add_argument("--max_length", type=int, default=128)
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(json.loads(args.worker))
+        return
+
+    nprocs = [int(n) for n in args.nprocs.split(",")]
+    if args.self_test:
+        ok, _ = run_scaling(nprocs, "lora", max_steps=6, global_batch=8, max_samples=64, max_length=64,
+                            hidden_size=128, num_layers=2)
+        if not ok:
+            print("❌ 数据并行自检失败")
+            raise SystemExit(1)
+        print("✅ 数据并行自检通过")
+        return
+
+    ok, _ = run_scaling(nprocs, args.method, args.max_steps, args.global_batch, max_length=args.max_length)
+    if not ok:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
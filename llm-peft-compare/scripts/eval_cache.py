@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+评估结果缓存 - 以模型权重指纹、任务版本、few-shot配置和评估工具 (lm-eval / mini_eval) 为键缓存评估结果
+
+用法:
+  python scripts/eval_cache.py lookup --model_path models/xxx-merged --tasks hellaswag,gsm8k --output_file out.json
+  python scripts/eval_cache.py store --model_path models/xxx-merged --results_file out.json
+  python scripts/eval_cache.py stats
+  python scripts/eval_cache.py gc --max_age_days 30 --max_entries 200 --drop_stale
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from datetime import datetime
+
+# 配置
+CACHE_DIR = "results/eval_cache"
+ENTRIES_DIR = os.path.join(CACHE_DIR, "entries")
+STATS_FILE = os.path.join(CACHE_DIR, "stats.json")
+
+# 哈希时每次读取的块大小
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# 影响模型输出的元数据文件
+MODEL_META_FILES = [
+    "config.json",
+    "generation_config.json",
+    "adapter_config.json",
+    "tokenizer.json",
+    "tokenizer_config.json",
+    "special_tokens_map.json"
+]
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth")
+
+# 查找缓存时使用的已知任务版本 (与save_emergency_results.py一致)
+KNOWN_TASK_VERSIONS = {
+    "gsm8k": 3,
+    "hellaswag": 1,
+    "mmlu_high_school_computer_science": 1
+}
+
+# 产生结果的评估工具: lm-eval (包括cached_lm_eval.py) 或 mini_eval.py
+# mini_eval的few-shot抽样与lm-eval不同，两者的结果不能互相复用
+DEFAULT_EVALUATOR = "lm_eval"
+EVALUATORS = ["lm_eval", "mini_eval"]
+
+# 结果JSON中按任务存储的字段
+PER_TASK_FIELDS = ["results", "configs", "versions", "n-shot", "higher_is_better", "n-samples", "group_subtasks"]
+
+
+def _update_with_file(hasher, filepath):
+    """将文件的完整内容写入哈希
+
+    权重文件同样整体哈希: 同一基础模型的两个微调版本可能只在少数张量上不同，
+    只采样部分数据块会得到相同的指纹并错误地命中缓存。
+    """
+    size = os.path.getsize(filepath)
+    hasher.update(f"{os.path.basename(filepath)}:{size}".encode())
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+
+def fingerprint_model(model_path):
+    """计算模型目录的指纹; 非本地路径(如Hub模型名)按名称计算"""
+    if not os.path.isdir(model_path):
+        return hashlib.sha256(f"hub:{model_path}".encode()).hexdigest()
+
+    hasher = hashlib.sha256()
+    for filename in sorted(os.listdir(model_path)):
+        filepath = os.path.join(model_path, filename)
+        if not os.path.isfile(filepath):
+            continue
+        if filename in MODEL_META_FILES:
+            _update_with_file(hasher, filepath)
+        elif filename.endswith(WEIGHT_SUFFIXES) and filename not in ("training_args.bin", "optimizer.pt", "scheduler.pt", "rng_state.pth"):
+            _update_with_file(hasher, filepath)
+
+    # 适配器目录的结果还取决于基础模型
+    adapter_config = os.path.join(model_path, "adapter_config.json")
+    if os.path.exists(adapter_config):
+        with open(adapter_config, 'r') as f:
+            base_model = json.load(f).get("base_model_name_or_path")
+        if base_model:
+            hasher.update(fingerprint_model(base_model).encode())
+
+    return hasher.hexdigest()
+
+def resolve_task_version(task, explicit_versions=None):
+    """获取任务版本: 命令行指定 > 已知版本表 (lookup和store都只用这一来源，保证键一致)
+
+    不通过lm-eval解析任务配置: 构建TaskManager需要数秒且各版本接口不同，
+    升级lm-eval后任务版本变化时请用 --task_versions 显式指定。
+    """
+    if explicit_versions and task in explicit_versions:
+        return float(explicit_versions[task])
+    if task in KNOWN_TASK_VERSIONS:
+        return float(KNOWN_TASK_VERSIONS[task])
+    return None
+
+def parse_dtype(model_args):
+    """从lm-eval的model_args字符串中提取dtype"""
+    for part in (model_args or "").split(","):
+        if part.startswith("dtype="):
+            return part.split("=", 1)[1]
+    return "auto"
+
+def make_cache_key(fingerprint, task, task_version, num_fewshot, limit, dtype, evaluator=DEFAULT_EVALUATOR):
+    """生成缓存键"""
+    key_data = {
+        "model": fingerprint,
+        "task": task,
+        "task_version": task_version,
+        "num_fewshot": num_fewshot,
+        "limit": limit,
+        "dtype": dtype or "auto"
+    }
+    # 默认评估工具不写入键，保持已有缓存条目的键不变
+    if evaluator != DEFAULT_EVALUATOR:
+        key_data["evaluator"] = evaluator
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+def load_stats():
+    """读取缓存统计信息"""
+    if os.path.exists(STATS_FILE):
+        with open(STATS_FILE, 'r') as f:
+            return json.load(f)
+    return {"hits": 0, "misses": 0, "stores": 0, "evicted": 0, "seconds_saved": 0.0}
+
+def save_stats(stats):
+    """保存缓存统计信息"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(STATS_FILE, 'w') as f:
+        json.dump(stats, f, indent=2)
+
+def entry_path(key):
+    return os.path.join(ENTRIES_DIR, f"{key}.json")
+
+def read_entry(key):
+    """读取缓存条目，不存在或损坏时返回None"""
+    path = entry_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ 缓存条目损坏，忽略: {path} - {e}")
+        return None
+
+def write_entry(key, entry):
+    """原子地写入缓存条目"""
+    os.makedirs(ENTRIES_DIR, exist_ok=True)
+    tmp_path = entry_path(key) + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f, indent=2)
+    os.replace(tmp_path, entry_path(key))
+
+def detect_evaluator(data):
+    """从结果文件的config判断评估工具"""
+    return "mini_eval" if data.get("config", {}).get("model") == "mini_eval" else DEFAULT_EVALUATOR
+
+def lookup(model_path, tasks, num_fewshot=None, limit=None, dtype="auto", task_versions=None,
+           evaluator=DEFAULT_EVALUATOR):
+    """查找所有任务的缓存结果; 全部命中时返回合并后的结果JSON，否则返回(None, 缺失任务列表)"""
+    fingerprint = fingerprint_model(model_path)
+    stats = load_stats()
+
+    entries = {}
+    missing = []
+    for task in tasks:
+        version = resolve_task_version(task, task_versions)
+        key = make_cache_key(fingerprint, task, version, num_fewshot, limit, dtype, evaluator)
+        entry = read_entry(key)
+        if entry is None:
+            missing.append(task)
+        else:
+            entries[task] = (key, entry)
+
+    if missing:
+        stats["misses"] += 1
+        save_stats(stats)
+        return None, missing
+
+    # 合并为与lm-eval相同结构的结果文件
+    merged = {field: {} for field in PER_TASK_FIELDS}
+    merged["config"] = {}
+    total_eval_time = 0.0
+    for task, (key, entry) in entries.items():
+        for field in PER_TASK_FIELDS:
+            if task in entry["data"].get(field, {}):
+                merged[field][task] = entry["data"][field][task]
+        merged["config"] = entry["data"].get("config", merged["config"])
+        total_eval_time += entry.get("eval_seconds", 0.0)
+
+        entry["hits"] = entry.get("hits", 0) + 1
+        entry["last_used"] = time.time()
+        write_entry(key, entry)
+
+    merged["eval_cache"] = {
+        "hit": True,
+        "model_fingerprint": fingerprint,
+        "cache_keys": {task: key for task, (key, _) in entries.items()}
+    }
+
+    stats["hits"] += 1
+    stats["seconds_saved"] += total_eval_time
+    save_stats(stats)
+    return merged, []
+
+def store(model_path, data, num_fewshot=None, limit=None, dtype=None, task_versions=None, evaluator=None):
+    """将lm-eval结果文件按任务拆分写入缓存，返回写入的键"""
+    fingerprint = fingerprint_model(model_path)
+    config = data.get("config", {})
+    if evaluator is None:
+        evaluator = detect_evaluator(data)
+    elif evaluator != detect_evaluator(data):
+        print(f"⚠️ 指定的评估工具 {evaluator} 与结果文件 ({detect_evaluator(data)}) 不一致，按结果文件写入")
+        evaluator = detect_evaluator(data)
+    if dtype is None:
+        dtype = parse_dtype(config.get("model_args", ""))
+    if limit is None:
+        limit = config.get("limit")
+    if num_fewshot is None:
+        num_fewshot = config.get("num_fewshot")
+
+    # 整体评估耗时平摊到各任务，用于统计节省的时间
+    tasks = list(data.get("results", {}).keys())
+    eval_seconds = float(data.get("total_evaluation_time_seconds", 0) or 0) / max(len(tasks), 1)
+
+    stats = load_stats()
+    keys = {}
+    for task in tasks:
+        version = resolve_task_version(task, task_versions)
+        # 结果文件中的版本与键使用的版本不一致时不写入 (否则会以旧版本的键缓存新版本的结果)
+        reported = data.get("versions", {}).get(task)
+        if reported is not None and version is not None and float(reported) != version:
+            print(f"⚠️ {task}: 结果的任务版本 {reported} 与已知版本 {version} 不一致，跳过缓存 (请用 --task_versions 指定)")
+            continue
+        key = make_cache_key(fingerprint, task, version, num_fewshot, limit, dtype, evaluator)
+
+        task_data = {field: {task: data[field][task]} for field in PER_TASK_FIELDS
+                     if task in data.get(field, {})}
+        task_data["config"] = config
+
+        write_entry(key, {
+            "key": key,
+            "model_path": os.path.abspath(model_path) if os.path.isdir(model_path) else model_path,
+            "model_fingerprint": fingerprint,
+            "task": task,
+            "task_version": version,
+            "num_fewshot": num_fewshot,
+            "limit": limit,
+            "dtype": dtype,
+            "evaluator": evaluator,
+            "created": time.time(),
+            "last_used": time.time(),
+            "hits": 0,
+            "eval_seconds": eval_seconds,
+            "data": task_data
+        })
+        keys[task] = key
+        stats["stores"] += 1
+
+    save_stats(stats)
+    return keys
+
+def iter_entries():
+    """遍历所有缓存条目"""
+    if not os.path.exists(ENTRIES_DIR):
+        return
+    for filename in sorted(os.listdir(ENTRIES_DIR)):
+        if not filename.endswith(".json"):
+            continue
+        key = filename[:-len(".json")]
+        entry = read_entry(key)
+        if entry is not None:
+            yield key, entry
+
+def collect_garbage(max_age_days=None, max_entries=None, max_size_mb=None, drop_stale=False, dry_run=False):
+    """清理缓存: 过期条目、模型已变化或删除的条目，以及超出容量的最久未使用条目"""
+    now = time.time()
+    entries = list(iter_entries())
+    to_remove = {}
+
+    fingerprints = {}
+    for key, entry in entries:
+        if max_age_days is not None and now - entry.get("last_used", 0) > max_age_days * 86400:
+            to_remove[key] = "过期"
+            continue
+        if drop_stale:
+            model_path = entry.get("model_path", "")
+            if os.path.isabs(model_path) and not os.path.exists(model_path):
+                to_remove[key] = "模型已删除"
+                continue
+            if os.path.isdir(model_path):
+                if model_path not in fingerprints:
+                    fingerprints[model_path] = fingerprint_model(model_path)
+                if fingerprints[model_path] != entry.get("model_fingerprint"):
+                    to_remove[key] = "模型权重已变化"
+
+    # 按最近使用时间淘汰超出数量/容量限制的条目
+    remaining = sorted([(entry.get("last_used", 0), key) for key, entry in entries if key not in to_remove], reverse=True)
+    total_size = 0
+    for i, (_, key) in enumerate(remaining):
+        total_size += os.path.getsize(entry_path(key))
+        if max_entries is not None and i >= max_entries:
+            to_remove[key] = "超出条目数上限"
+        elif max_size_mb is not None and total_size > max_size_mb * 1024 * 1024:
+            to_remove[key] = "超出容量上限"
+
+    for key, reason in to_remove.items():
+        print(f"{'[dry-run] ' if dry_run else ''}删除 {key[:12]}... ({reason})")
+        if not dry_run:
+            os.remove(entry_path(key))
+
+    if not dry_run and to_remove:
+        stats = load_stats()
+        stats["evicted"] += len(to_remove)
+        save_stats(stats)
+    return len(to_remove)
+
+def print_stats():
+    """打印缓存统计"""
+    stats = load_stats()
+    entries = list(iter_entries())
+    total_size = sum(os.path.getsize(entry_path(key)) for key, _ in entries)
+    models = {entry.get("model_fingerprint") for _, entry in entries}
+    lookups = stats["hits"] + stats["misses"]
+
+    print("📦 评估结果缓存统计")
+    print(f"   缓存目录: {CACHE_DIR}")
+    print(f"   条目数: {len(entries)} (模型: {len(models)})")
+    print(f"   占用空间: {total_size / 1024:.1f} KB")
+    print(f"   查询: {lookups} 次, 命中: {stats['hits']}, 未命中: {stats['misses']}"
+          + (f", 命中率: {stats['hits'] / lookups * 100:.1f}%" if lookups else ""))
+    print(f"   写入: {stats['stores']}, 淘汰: {stats['evicted']}")
+    print(f"   节省评估时间: {stats['seconds_saved'] / 3600:.2f} 小时")
+
+    for key, entry in sorted(entries, key=lambda item: -item[1].get("last_used", 0)):
+        last_used = datetime.fromtimestamp(entry.get("last_used", 0)).strftime("%Y-%m-%d %H:%M")
+        print(f"   - {key[:12]} {entry.get('task')} v{entry.get('task_version')} "
+              f"fewshot={entry.get('num_fewshot')} limit={entry.get('limit')} dtype={entry.get('dtype')} "
+              f"evaluator={entry.get('evaluator', DEFAULT_EVALUATOR)} "
+              f"hits={entry.get('hits', 0)} last={last_used} {entry.get('model_path')}")
+
+def parse_task_versions(text):
+    """解析 task=version,task=version 形式的参数"""
+    if not text:
+        return None
+    versions = {}
+    for item in text.split(","):
+        task, version = item.split("=", 1)
+        versions[task.strip()] = float(version)
+    return versions
+
+def parse_limit(text):
+    if text is None:
+        return None
+    value = float(text)
+    return int(value) if value.is_integer() and value >= 1 else value
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="lm-eval评估结果缓存")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_key_args(sub):
+        sub.add_argument("--model_path", required=True, help="模型目录或Hub模型名")
+        sub.add_argument("--num_fewshot", type=int, default=None, help="few-shot数量 (默认使用任务默认值)")
+        sub.add_argument("--limit", type=str, default=None, help="每个任务的样本上限")
+        sub.add_argument("--task_versions", type=str, default=None, help="显式指定任务版本, 如 gsm8k=3,hellaswag=1")
+        sub.add_argument("--evaluator", type=str, default=None, choices=EVALUATORS,
+                         help=f"产生结果的评估工具 (lookup默认{DEFAULT_EVALUATOR}，store默认从结果文件判断)")
+
+    lookup_parser = subparsers.add_parser("lookup", help="查找缓存结果，全部命中时退出码为0")
+    add_key_args(lookup_parser)
+    lookup_parser.add_argument("--tasks", required=True, help="逗号分隔的任务列表")
+    lookup_parser.add_argument("--dtype", default="auto", help="评估使用的数据类型")
+    lookup_parser.add_argument("--output_file", default=None, help="命中时将结果写入该文件")
+
+    store_parser = subparsers.add_parser("store", help="将lm-eval结果文件写入缓存")
+    add_key_args(store_parser)
+    store_parser.add_argument("--results_file", required=True, help="lm-eval输出的结果JSON")
+    store_parser.add_argument("--dtype", default=None, help="评估使用的数据类型 (默认从model_args解析)")
+
+    subparsers.add_parser("stats", help="显示缓存统计")
+
+    gc_parser = subparsers.add_parser("gc", help="清理/淘汰缓存条目")
+    gc_parser.add_argument("--max_age_days", type=float, default=None, help="删除超过该天数未使用的条目")
+    gc_parser.add_argument("--max_entries", type=int, default=None, help="最多保留的条目数 (按最近使用)")
+    gc_parser.add_argument("--max_size_mb", type=float, default=None, help="缓存最大容量 (MB)")
+    gc_parser.add_argument("--drop_stale", action="store_true", help="删除模型已删除或权重已变化的条目")
+    gc_parser.add_argument("--dry_run", action="store_true", help="只显示将被删除的条目")
+
+    args = parser.parse_args()
+
+    if args.command == "lookup":
+        tasks = [task.strip() for task in args.tasks.split(",") if task.strip()]
+        merged, missing = lookup(args.model_path, tasks, args.num_fewshot, parse_limit(args.limit),
+                                 args.dtype, parse_task_versions(args.task_versions), args.evaluator or DEFAULT_EVALUATOR)
+        if merged is None:
+            print(f"❌ 缓存未命中: {', '.join(missing)}")
+            sys.exit(1)
+        print(f"✓ 缓存命中: {', '.join(tasks)}")
+        if args.output_file:
+            output_dir = os.path.dirname(args.output_file)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            with open(args.output_file, 'w') as f:
+                json.dump(merged, f, indent=2)
+            print(f"✓ 缓存结果已写入: {args.output_file}")
+
+    elif args.command == "store":
+        try:
+            with open(args.results_file, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"❌ 读取结果文件时出错: {args.results_file} - {e}")
+            sys.exit(1)
+        if data.get("eval_cache", {}).get("hit"):
+            print("⚠️ 结果文件本身来自缓存，跳过写入")
+            return
+        keys = store(args.model_path, data, args.num_fewshot, parse_limit(args.limit),
+                     args.dtype, parse_task_versions(args.task_versions), args.evaluator)
+        for task, key in keys.items():
+            print(f"✓ 已缓存 {task}: {key[:12]}...")
+
+    elif args.command == "stats":
+        print_stats()
+
+    elif args.command == "gc":
+        removed = collect_garbage(args.max_age_days, args.max_entries, args.max_size_mb,
+                                  args.drop_stale, args.dry_run)
+        print(f"✅ 清理完成，{'将' if args.dry_run else '已'}删除 {removed} 个条目")
+
+if __name__ == "__main__":
+    main()
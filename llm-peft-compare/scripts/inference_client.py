@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+inference_server.py 的压测客户端 (只依赖标准库)
+
+并发发送补全请求 (默认流式)，统计每个请求的首token延迟 (TTFT) 和总延迟，
+汇总请求/秒、生成token/秒和延迟分位数，最后读取服务端的 /metrics。
+
+用法:
+  python scripts/inference_client.py --port 8000 --num_requests 64 --concurrency 8 --max_tokens 64
+  python scripts/inference_client.py --port 8000 --prompt "What is machine learning?"
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+DEFAULT_PROMPTS = os.path.join(PROJECT_ROOT, "data", "alpaca_train_5k.jsonl")
+
+
+def load_prompts(file_path=DEFAULT_PROMPTS, n=64):
+    """从指令数据中取prompt (与训练文本的格式一致: 指令 + 输入)"""
+    prompts = []
+    with open(file_path) as f:
+        for line in f:
+            item = json.loads(line)
+            prompts.append(f"{item['instruction']} {item.get('input', '')}".strip() if "instruction" in item
+                           else item["prompt"])
+            if len(prompts) >= n:
+                break
+    return prompts
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+async def _send(host, port, method, path, payload=None):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    return reader, writer, status
+
+async def fetch_json(host, port, path, payload=None):
+    """发送请求并读取完整的JSON响应，返回 (状态码, 响应)"""
+    reader, writer, status = await _send(host, port, "POST" if payload is not None else "GET", path, payload)
+    data = await reader.read()
+    writer.close()
+    return status, json.loads(data) if data else None
+
+async def complete(host, port, prompt, max_tokens=64, stop=None, temperature=0.0, stream=True, adapter=None):
+    """发送一个补全请求，返回 {text, finish_reason, completion_tokens, ttft, latency, status}"""
+    payload = {"prompt": prompt, "max_tokens": max_tokens, "stop": stop or [], "temperature": temperature,
+               "stream": stream, "adapter": adapter}
+    start = time.perf_counter()
+    if not stream:
+        status, response = await fetch_json(host, port, "/v1/completions", payload)
+        latency = time.perf_counter() - start
+        if status != 200:
+            return {"status": status, "error": response.get("error"), "latency": latency}
+        return {"status": status, "text": response["choices"][0]["text"],
+                "finish_reason": response["choices"][0]["finish_reason"],
+                "completion_tokens": response["usage"]["completion_tokens"], "ttft": response["timing"]["ttft"],
+                "latency": latency}
+
+    reader, writer, status = await _send(host, port, "POST", "/v1/completions", payload)
+    if status != 200:
+        data = await reader.read()
+        writer.close()
+        return {"status": status, "error": json.loads(data).get("error"), "latency": time.perf_counter() - start}
+    text, ttft, finish_reason, completion_tokens = [], None, None, 0
+    # 服务端推送 "data: {...}\n\n"，以 "data: [DONE]" 结束
+    async for line in reader:
+        line = line.strip()
+        if not line.startswith(b"data: "):
+            continue
+        if line == b"data: [DONE]":
+            break
+        chunk = json.loads(line[6:])
+        if ttft is None:
+            ttft = time.perf_counter() - start
+        text.append(chunk["choices"][0]["text"])
+        finish_reason = chunk["choices"][0]["finish_reason"] or finish_reason
+        if "usage" in chunk:
+            completion_tokens = chunk["usage"]["completion_tokens"]
+    writer.close()
+    return {"status": status, "text": "".join(text), "finish_reason": finish_reason,
+            "completion_tokens": completion_tokens, "ttft": ttft, "latency": time.perf_counter() - start}
+
+async def load_test(host, port, prompts, concurrency=8, max_tokens=64, stop=None, stream=True, adapters=None):
+    """最多concurrency个请求同时在途，返回 (按prompt顺序的结果, 汇总)
+
+    adapters: 可选的适配器名称列表，第i个请求使用 adapters[i % len(adapters)]
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index, prompt):
+        adapter = adapters[index % len(adapters)] if adapters else None
+        async with semaphore:
+            return await complete(host, port, prompt, max_tokens, stop, stream=stream, adapter=adapter)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run(index, prompt) for index, prompt in enumerate(prompts)))
+    elapsed = time.perf_counter() - start
+    ok = [result for result in results if result["status"] == 200]
+    latencies = [result["latency"] for result in ok]
+    ttfts = [result["ttft"] for result in ok if result["ttft"] is not None]
+    tokens = sum(result["completion_tokens"] for result in ok)
+    summary = {
+        "requests": len(results), "failed": len(results) - len(ok), "concurrency": concurrency,
+        "elapsed": elapsed, "requests_per_second": len(ok) / elapsed, "tokens_per_second": tokens / elapsed,
+        "completion_tokens": tokens,
+        "latency_p50": percentile(latencies, 50), "latency_p95": percentile(latencies, 95),
+        "ttft_p50": percentile(ttfts, 50), "ttft_p95": percentile(ttfts, 95)
+    }
+    return results, summary
+
+def format_summary(summary):
+    return (f"并发 {summary['concurrency']:>3}: {summary['requests']} 个请求 ({summary['failed']} 个失败), "
+            f"{summary['elapsed']:.2f}s, {summary['requests_per_second']:.2f} 请求/s, "
+            f"{summary['tokens_per_second']:.1f} token/s, 延迟 p50 {summary['latency_p50'] * 1000:.0f}ms "
+            f"p95 {summary['latency_p95'] * 1000:.0f}ms, TTFT p50 {summary['ttft_p50'] * 1000:.0f}ms "
+            f"p95 {summary['ttft_p95'] * 1000:.0f}ms")
+
+async def _main(args):
+    stop = args.stop.split(",") if args.stop else None
+    if args.prompt:
+        result = await complete(args.host, args.port, args.prompt, args.max_tokens, stop, args.temperature,
+                                stream=not args.no_stream, adapter=args.adapters)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+
+    prompts = load_prompts(args.prompts_file, args.num_requests)
+    adapters = args.adapters.split(",") if args.adapters else None
+    _, summary = await load_test(args.host, args.port, prompts, args.concurrency, args.max_tokens, stop,
+                                 stream=not args.no_stream, adapters=adapters)
+    print(format_summary(summary))
+    _, metrics = await fetch_json(args.host, args.port, "/metrics")
+    print("服务端指标:")
+    print(json.dumps(metrics, ensure_ascii=False, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(description="推理服务压测客户端")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--prompt", type=str, default=None, help="只发送一个请求并打印结果")
+    parser.add_argument("--prompts_file", type=str, default=DEFAULT_PROMPTS,
+                        help="JSONL，每行含 instruction(+input) 或 prompt 字段")
+    parser.add_argument("--num_requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max_tokens", type=int, default=64)
+    parser.add_argument("--stop", type=str, default=None, help="逗号分隔的停止串")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--adapters", type=str, default=None,
+                        help="逗号分隔的适配器名称 (服务端 --adapters)，请求轮流使用")
+    parser.add_argument("--no_stream", action="store_true", help="等待完整响应，不使用流式输出")
+    args = parser.parse_args()
+    asyncio.run(_main(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地推理服务 (asyncio，只依赖标准库的HTTP): 连续批处理 + KV缓存预算 + 流式输出
+
+- 加载 models/ 下的合并模型，或 基础模型+适配器目录 (自动读取adapter_config.json)
+- POST /v1/completions  {"prompt", "max_tokens", "stop", "temperature", "stream"}
+  stream=true 时以 text/event-stream 逐段推送 ("data: {...}"，以 "data: [DONE]" 结束)
+- GET /metrics  请求数、延迟/TTFT分位数、吞吐量、平均批大小、KV缓存占用
+- GET /health
+- --adapters name=path,...: 基础模型只加载一份，请求用 "adapter" 字段选择适配器，
+  同一批中的请求可以使用不同的适配器 (multi_lora.py); 不指定时使用基础模型
+
+调度: 模型前向在单独的线程中执行，事件循环只负责收发。每一步先接纳等待中的请求
+(单独prefill后加入批)，再对整批解码一步 (generation_engine.GenerationEngine)。
+结束 (停止串/EOS/max_tokens) 或客户端断开的行立即移出批。
+KV预算按最坏情况计算: 缓存是右对齐的矩形，宽度等于最长的行，
+所以接纳条件是 (行数+1) × max(各行的 prompt+max_tokens) ≤ --kv_budget_tokens。
+
+用法:
+  python scripts/inference_server.py --model_path models/tinyllama_1.1b-instruction-lora-merged --port 8000
+  python scripts/inference_server.py --model_path models/tinyllama_1.1b-instruction-lora/final --port 8000
+  python scripts/inference_server.py --model_path TinyLlama/TinyLlama-1.1B-Chat-v1.0 \
+      --adapters lora=models/tinyllama_1.1b-instruction-lora/final,qlora=models/tinyllama_1.1b-instruction-qlora/final
+  python scripts/inference_client.py --port 8000 --num_requests 64 --concurrency 8
+  # CPU自检: 随机微型模型，输出与逐题贪心生成一致，并比较不同并发下的吞吐量
+  python scripts/inference_server.py --self_test
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+MODELS_DIR = os.path.join(PROJECT_ROOT, "models")
+
+DEFAULT_MAX_TOKENS = 128
+
+
+class RequestError(Exception):
+    """请求参数不合法 (返回HTTP 400)"""
+
+@dataclass
+class Completion:
+    """一个补全请求的状态; tokens/emitted 只在模型线程中修改，events 只在事件循环中读取"""
+    request_id: str
+    prompt_ids: list
+    max_tokens: int
+    temperature: float
+    checker: object
+    events: asyncio.Queue
+    arrival: float = field(default_factory=time.perf_counter)
+    tokens: list = field(default_factory=list)
+    emitted: int = 0
+    admitted: float = None
+    first_token: float = None
+    finish_reason: str = None
+    cancelled: bool = False
+    adapter: int = -1
+
+    @property
+    def reach(self):
+        """这一行最终可能占用的KV长度"""
+        return len(self.prompt_ids) + self.max_tokens
+
+class ServerMetrics:
+    def __init__(self, window=1000):
+        self.started = time.perf_counter()
+        self.counts = {"completed": 0, "rejected": 0, "cancelled": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                       "decode_steps": 0, "row_steps": 0}
+        self.latency = deque(maxlen=window)
+        self.ttft = deque(maxlen=window)
+        self.queue_wait = deque(maxlen=window)
+        self.busy_seconds = 0.0
+        self.kv = {"cache_tokens": 0, "reserved_tokens": 0, "peak_cache_tokens": 0, "peak_reserved_tokens": 0}
+
+    def finish(self, completion):
+        now = time.perf_counter()
+        self.counts["cancelled" if completion.cancelled else "completed"] += 1
+        self.counts["prompt_tokens"] += len(completion.prompt_ids)
+        self.counts["completion_tokens"] += len(completion.tokens)
+        if not completion.cancelled:
+            self.latency.append(now - completion.arrival)
+            self.ttft.append(completion.first_token - completion.arrival)
+            self.queue_wait.append(completion.admitted - completion.arrival)
+
+    def snapshot(self, scheduler):
+        from inference_client import percentile
+
+        uptime = time.perf_counter() - self.started
+        summary = {name: {"p50": percentile(list(values), 50), "p95": percentile(list(values), 95)}
+                   for name, values in [("latency", self.latency), ("ttft", self.ttft),
+                                        ("queue_wait", self.queue_wait)]}
+        return {
+            **self.counts,
+            "running": len(scheduler.rows), "waiting": len(scheduler.waiting),
+            "uptime_seconds": uptime, "busy_seconds": self.busy_seconds,
+            "completion_tokens_per_second": self.counts["completion_tokens"] / max(self.busy_seconds, 1e-9),
+            "mean_batch_size": self.counts["row_steps"] / max(self.counts["decode_steps"], 1),
+            **{f"{name}_{q}": value for name, values in summary.items() for q, value in values.items()},
+            "kv_budget_tokens": scheduler.kv_budget_tokens,
+            **{f"kv_{key}": value for key, value in self.kv.items()},
+            "kv_bytes_per_token": scheduler.kv_bytes_per_token
+        }
+
+class Scheduler:
+    """连续批处理: 等待队列 + 当前批 (KV缓存/attention_mask/位置)"""
+
+    def __init__(self, model, tokenizer, max_batch_size=16, kv_budget_tokens=None, max_length=None, adapters=None):
+        from generation_engine import GenerationEngine
+
+        self.engine = GenerationEngine(model, tokenizer, max_batch_size, max_length=max_length)
+        self.tokenizer = tokenizer
+        self.adapters = adapters
+        self.max_batch_size = max_batch_size
+        self.max_length = self.engine.max_length
+        self.kv_budget_tokens = kv_budget_tokens or max_batch_size * self.max_length
+        config = model.config
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        self.kv_bytes_per_token = (2 * config.num_hidden_layers * kv_heads * head_dim
+                                   * next(model.parameters()).element_size())
+        self.metrics = ServerMetrics()
+        self.waiting = deque()
+        self.rows = []
+        self.cache = self.attention_mask = self.positions = None
+        self.wakeup = asyncio.Event()
+        # 模型前向只在这一个线程中执行
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, completion):
+        if completion.reach > self.kv_budget_tokens:
+            self.metrics.counts["rejected"] += 1
+            raise RequestError(f"prompt ({len(completion.prompt_ids)} tokens) + max_tokens ({completion.max_tokens}) "
+                               f"超过KV缓存预算 {self.kv_budget_tokens} tokens")
+        self.waiting.append(completion)
+        self.wakeup.set()
+
+    def _reserved(self, extra=None):
+        rows = self.rows + ([extra] if extra else [])
+        return len(rows) * max((row.reach for row in rows), default=0)
+
+    def _fits(self, completion):
+        return len(self.rows) < self.max_batch_size and self._reserved(completion) <= self.kv_budget_tokens
+
+    def _use_adapters(self, completions):
+        """下一次前向中每行使用的适配器"""
+        if self.adapters is not None:
+            self.adapters.set_adapter_ids([completion.adapter for completion in completions])
+
+    def _pick(self, logits, temperature):
+        import torch
+
+        if temperature <= 0:
+            return int(logits.argmax())
+        return int(torch.multinomial(torch.softmax(logits.float() / temperature, dim=-1), 1))
+
+    def _record(self, completion, token, events):
+        """追加一个token，检查是否结束，并计算可以推送的新文本"""
+        completion.first_token = completion.first_token or time.perf_counter()
+        checker = completion.checker
+        if token == self.engine.eos_token_id:
+            completion.finish_reason = "stop"
+        else:
+            completion.tokens.append(token)
+            if checker.hit(completion.tokens):
+                completion.finish_reason = "stop"
+            elif len(completion.tokens) >= completion.max_tokens or \
+                    len(completion.prompt_ids) + len(completion.tokens) >= self.max_length:
+                completion.finish_reason = "length"
+
+        if completion.finish_reason:
+            text = checker.finalize(completion.tokens)
+            safe = len(text)
+        else:
+            text = self.tokenizer.decode(completion.tokens, skip_special_tokens=True)
+            # 可能是停止串开头的部分先不推送; 不完整的多字节字符 (解码为U+FFFD) 也先保留
+            safe = len(text.rstrip("�")) - max((len(stop) - 1 for stop in checker.until), default=0)
+        if safe > completion.emitted or completion.finish_reason:
+            events.append((completion, text[completion.emitted:max(safe, completion.emitted)],
+                           completion.finish_reason))
+            completion.emitted = max(safe, completion.emitted)
+
+    def _drop_finished(self, events):
+        for row in self.rows:
+            if row.cancelled and not row.finish_reason:
+                row.finish_reason = "cancelled"
+                events.append((row, "", row.finish_reason))
+        keep = [slot for slot, row in enumerate(self.rows) if not (row.finish_reason or row.cancelled)]
+        if len(keep) == len(self.rows):
+            return
+        if keep:
+            self.attention_mask, self.positions = self.engine.select(self.cache, self.attention_mask, self.positions,
+                                                                     keep)
+        else:
+            self.cache = self.attention_mask = self.positions = None
+        self.rows = [self.rows[slot] for slot in keep]
+
+    def step(self):
+        """在模型线程中执行: 接纳新请求 + 整批解码一步，返回 [(请求, 新文本, 结束原因)]"""
+        import torch
+
+        events = []
+        with torch.no_grad():
+            admitted = []
+            while self.waiting and self._fits(self.waiting[0]):
+                completion = self.waiting.popleft()
+                if completion.cancelled:
+                    completion.finish_reason = "cancelled"
+                    events.append((completion, "", completion.finish_reason))
+                    continue
+                completion.admitted = time.perf_counter()
+                admitted.append(completion)
+                self.rows.append(completion)
+            if admitted:
+                if self.cache is None:
+                    self._use_adapters(admitted)
+                    self.cache, self.attention_mask, self.positions, logits = self.engine.prefill(
+                        [completion.prompt_ids for completion in admitted])
+                else:
+                    logits = []
+                    for completion in admitted:
+                        self._use_adapters([completion])
+                        self.attention_mask, self.positions, row_logits = self.engine.append(
+                            self.cache, self.attention_mask, self.positions, completion.prompt_ids)
+                        logits.append(row_logits)
+                for completion, row_logits in zip(admitted, logits):
+                    self._record(completion, self._pick(row_logits, completion.temperature), events)
+            self._drop_finished(events)
+
+            if self.rows:
+                self._use_adapters(self.rows)
+                self.cache, self.attention_mask, self.positions, logits = self.engine.decode(
+                    self.cache, self.attention_mask, self.positions, [row.tokens[-1] for row in self.rows])
+                for completion, row_logits in zip(self.rows, logits):
+                    self._record(completion, self._pick(row_logits, completion.temperature), events)
+                self.metrics.counts["decode_steps"] += 1
+                self.metrics.counts["row_steps"] += len(self.rows)
+
+            kv = self.metrics.kv
+            kv["cache_tokens"] = int(self.attention_mask.numel()) if self.rows else 0
+            kv["reserved_tokens"] = self._reserved()
+            kv["peak_cache_tokens"] = max(kv["peak_cache_tokens"], kv["cache_tokens"])
+            kv["peak_reserved_tokens"] = max(kv["peak_reserved_tokens"], kv["reserved_tokens"])
+            self._drop_finished(events)
+        return events
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.rows and not self.waiting:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            start = time.perf_counter()
+            events = await loop.run_in_executor(self.executor, self.step)
+            self.metrics.busy_seconds += time.perf_counter() - start
+            # 结束原因在记录时一并保存: 同一步里一个请求可能先有普通文本再结束
+            for completion, text, finish_reason in events:
+                completion.events.put_nowait((text, finish_reason))
+                if finish_reason:
+                    self.metrics.finish(completion)
+
+class InferenceServer:
+    def __init__(self, model, tokenizer, model_name="model", max_batch_size=16, kv_budget_tokens=None,
+                 max_length=None, adapters=None):
+        """adapters: 可选的 multi_lora.MultiLoraModel (已包装model)"""
+        self.tokenizer = tokenizer
+        self.model_name = model_name
+        self.adapters = adapters
+        self.scheduler = Scheduler(model, tokenizer, max_batch_size, kv_budget_tokens, max_length, adapters)
+        self.next_id = 0
+
+    def create_completion(self, body):
+        from generation_engine import StopChecker
+
+        prompt = body.get("prompt")
+        if not isinstance(prompt, str) or not prompt:
+            raise RequestError("prompt 必须是非空字符串")
+        stop = body.get("stop") or []
+        stop = [stop] if isinstance(stop, str) else list(stop)
+        max_tokens = int(body.get("max_tokens", DEFAULT_MAX_TOKENS))
+        if max_tokens < 1:
+            raise RequestError("max_tokens 必须大于0")
+        prompt_ids = self.tokenizer(prompt)["input_ids"]
+        # 与lm-eval相同: 过长的prompt保留末尾
+        prompt_ids = prompt_ids[-max(1, self.scheduler.max_length - max_tokens):]
+        adapter = -1
+        if body.get("adapter") is not None:
+            if self.adapters is None:
+                raise RequestError("服务没有加载适配器 (--adapters)")
+            try:
+                adapter = self.adapters.adapter_index(body["adapter"])
+            except KeyError as e:
+                raise RequestError(str(e.args[0]))
+        self.next_id += 1
+        return Completion(f"cmpl-{self.next_id}", prompt_ids, max_tokens, float(body.get("temperature", 0.0)),
+                          StopChecker(self.tokenizer, stop), asyncio.Queue(), adapter=adapter)
+
+    def _chunk(self, completion, text, finish_reason):
+        chunk = {"id": completion.request_id, "object": "text_completion", "model": self.model_name,
+                 "choices": [{"index": 0, "text": text, "finish_reason": finish_reason}]}
+        if finish_reason:
+            chunk["usage"] = {"prompt_tokens": len(completion.prompt_ids),
+                              "completion_tokens": len(completion.tokens)}
+        return chunk
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and path == "/health":
+                await self._respond(writer, 200, {"status": "ok", "model": self.model_name})
+            elif method == "GET" and path == "/metrics":
+                await self._respond(writer, 200, self.scheduler.metrics.snapshot(self.scheduler))
+            elif method == "POST" and path == "/v1/completions":
+                await self._complete(writer, json.loads(body or b"{}"))
+            else:
+                await self._respond(writer, 404, {"error": f"未知的路径: {method} {path}"})
+        except RequestError as e:
+            await self._respond(writer, 400, {"error": str(e)})
+        except (ValueError, KeyError) as e:
+            await self._respond(writer, 400, {"error": f"无法解析请求: {e}"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+    async def _complete(self, writer, body):
+        completion = self.create_completion(body)
+        self.scheduler.submit(completion)
+        stream = bool(body.get("stream", False))
+        if stream:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+        pieces = []
+        try:
+            while True:
+                text, finish_reason = await completion.events.get()
+                if stream:
+                    chunk = json.dumps(self._chunk(completion, text, finish_reason), ensure_ascii=False)
+                    writer.write(f"data: {chunk}\n\n".encode("utf-8"))
+                    await writer.drain()
+                pieces.append(text)
+                if finish_reason:
+                    break
+        except ConnectionError:
+            # 客户端断开: 调度器在下一步把这一行移出批
+            completion.cancelled = True
+            raise
+
+        if stream:
+            writer.write(b"data: [DONE]\n\n")
+            await writer.drain()
+            return
+        response = self._chunk(completion, "".join(pieces), completion.finish_reason)
+        response["timing"] = {"queue": completion.admitted - completion.arrival,
+                              "ttft": completion.first_token - completion.arrival,
+                              "latency": time.perf_counter() - completion.arrival}
+        await self._respond(writer, 200, response)
+
+    async def start(self, host="127.0.0.1", port=8000):
+        """启动HTTP服务和调度循环，返回 (asyncio.Server, 调度任务)"""
+        server = await asyncio.start_server(self.handle, host, port)
+        return server, asyncio.create_task(self.scheduler.run())
+
+def resolve_model_path(model_path):
+    """允许只写 models/ 下的目录名; 训练输出目录解析到其中保存适配器的 final/"""
+    from multi_lora import resolve_adapter_dir
+
+    if not os.path.exists(model_path) and os.path.isdir(os.path.join(MODELS_DIR, model_path)):
+        model_path = os.path.join(MODELS_DIR, model_path)
+    if os.path.isdir(model_path) and not os.path.exists(os.path.join(model_path, "config.json")):
+        return resolve_adapter_dir(model_path)
+    return model_path
+
+async def _serve(args):
+    from mini_eval import load_model
+
+    model_path = resolve_model_path(args.model_path)
+    print(f"加载模型: {model_path}")
+    model, tokenizer = load_model(model_path, args.peft, args.device, args.dtype)
+    adapters = None
+    if args.adapters:
+        from multi_lora import MultiLoraModel
+
+        paths = dict(item.split("=", 1) for item in args.adapters.split(","))
+        adapters = MultiLoraModel(model, {name: resolve_model_path(path) for name, path in paths.items()})
+        print(f"✓ 加载 {len(paths)} 个适配器: {', '.join(paths)} (LoRA权重 {adapters.nbytes() / 2 ** 20:.1f}MB)")
+    app = InferenceServer(model, tokenizer, os.path.basename(model_path.rstrip("/")), args.max_batch_size,
+                          args.kv_budget_tokens, args.max_length, adapters)
+    server, scheduler = await app.start(args.host, args.port)
+    budget = app.scheduler.kv_budget_tokens
+    print(f"✓ 服务已启动: http://{args.host}:{args.port} (最大批 {args.max_batch_size}, KV预算 {budget} tokens, "
+          f"约 {budget * app.scheduler.kv_bytes_per_token / 2 ** 20:.0f}MB)")
+    async with server:
+        await asyncio.gather(server.serve_forever(), scheduler)
+
+async def _self_test(num_requests=32, max_tokens=48):
+    import torch
+    from tiny_model import build_tiny_model
+    from generation_engine import generate_one_by_one
+    from inference_client import load_prompts, load_test, complete, fetch_json, format_summary
+
+    torch.manual_seed(0)
+    model, tokenizer = build_tiny_model(hidden_size=128, num_layers=2, seed=0)
+    prompts = load_prompts(n=num_requests)
+    # 随机模型不会生成自然的结束符; 用常见的两字母片段作停止串，使各请求在不同长度结束
+    stop = ["ar", "ie"]
+    reference = generate_one_by_one(model, tokenizer, [tokenizer(prompt)["input_ids"] for prompt in prompts], stop,
+                                    max_tokens)
+    ok = True
+
+    def check(name, passed, detail=""):
+        nonlocal ok
+        print(f"{'✓' if passed else '❌'} {name}{': ' + detail if detail else ''}")
+        ok = ok and passed
+
+    summaries = []
+    for concurrency, budget in [(1, None), (8, None), (8, 300)]:
+        app = InferenceServer(model, tokenizer, "tiny", max_batch_size=8, kv_budget_tokens=budget)
+        server, scheduler = await app.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        results, summary = await load_test("127.0.0.1", port, prompts, concurrency, max_tokens, stop)
+        _, metrics = await fetch_json("127.0.0.1", port, "/metrics")
+        label = f"并发 {concurrency}" + (f", KV预算 {budget}" if budget else "")
+        matches = sum(result.get("text") == expected for result, expected in zip(results, reference))
+        check(f"{label}: 流式输出与逐题贪心生成一致", matches == num_requests, f"{matches}/{num_requests}")
+        summaries.append((label, summary, metrics))
+
+        if budget:
+            check("KV预算: 预留峰值不超过预算", metrics["kv_peak_reserved_tokens"] <= budget,
+                  f"预留峰值 {metrics['kv_peak_reserved_tokens']}, 实际缓存峰值 {metrics['kv_peak_cache_tokens']}, "
+                  f"预算 {budget}, 平均批大小 {metrics['mean_batch_size']:.1f}")
+            rejected = await complete("127.0.0.1", port, "hello " * 300, max_tokens=budget, stream=False)
+            check("超过KV预算的请求返回400", rejected["status"] == 400, rejected.get("error", ""))
+        elif concurrency > 1:
+            single = await complete("127.0.0.1", port, prompts[0], max_tokens, stop, stream=False)
+            check("非流式响应与流式一致", single["text"] == results[0]["text"])
+            fields = ["completed", "latency_p50", "ttft_p95", "completion_tokens_per_second", "mean_batch_size",
+                      "kv_peak_cache_tokens"]
+            check("/metrics 字段", all(name in metrics for name in fields) and metrics["completed"] == num_requests)
+        server.close()
+        await server.wait_closed()
+        scheduler.cancel()
+
+    print(f"\n{num_requests} 个请求, max_tokens={max_tokens}, 停止串 {stop}")
+    for label, summary, metrics in summaries:
+        print(f"{format_summary(summary)}  平均批大小 {metrics['mean_batch_size']:.1f}  [{label}]")
+    ok = ok and summaries[1][1]["tokens_per_second"] > summaries[0][1]["tokens_per_second"]
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="本地推理服务 (连续批处理)")
+    parser.add_argument("--model_path", type=str, default=None, help="合并模型目录或适配器目录 (可只写models/下的名字)")
+    parser.add_argument("--peft", type=str, default=None, help="另外指定适配器目录")
+    parser.add_argument("--adapters", type=str, default=None,
+                        help="name=path,... 在同一个基础模型上同时提供多个适配器 (--model_path 为基础模型)")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="auto", choices=["auto", "float32", "float16", "bfloat16"])
+    parser.add_argument("--max_batch_size", type=int, default=16)
+    parser.add_argument("--kv_budget_tokens", type=int, default=None,
+                        help="KV缓存预算 (tokens，包括padding); 默认 max_batch_size × max_length")
+    parser.add_argument("--max_length", type=int, default=None, help="prompt+生成的最大长度，默认取模型配置")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用随机微型模型自检")
+    args = parser.parse_args()
+
+    if args.self_test:
+        if not asyncio.run(_self_test()):
+            print("❌ 推理服务自检失败")
+            raise SystemExit(1)
+        print("✅ 推理服务自检通过")
+        return
+
+    if not args.model_path:
+        parser.error("需要 --model_path")
+    asyncio.run(_serve(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+逐请求log-likelihood缓存 - 以(模型指纹, 上下文, 续写)为键的本地SQLite存储
+
+基础模型、LoRA和QLoRA在HellaSwag/MMLU上的上下文完全相同，只有模型不同；
+缓存按模型指纹隔离，评估中断后重跑或新增指标时已计算的请求不再重算。
+
+用法:
+  python scripts/loglik_cache.py stats
+  python scripts/loglik_cache.py clear --model_fingerprint <指纹前缀>
+"""
+
+import os
+import sqlite3
+import hashlib
+import argparse
+
+# 配置
+DEFAULT_CACHE_PATH = "results/loglik_cache.sqlite"
+
+# SQLite单条语句的参数上限较低，批量查询时分块
+QUERY_CHUNK_SIZE = 500
+
+
+def request_key(context, continuation):
+    """计算单个请求的键 (上下文与续写之间用不可见分隔符隔开)"""
+    return hashlib.sha1(f"{context}\x1f{continuation}".encode("utf-8")).hexdigest()
+
+class LoglikCache:
+    """(模型指纹, 请求键) -> (logprob, is_greedy) 的SQLite存储"""
+
+    def __init__(self, db_path=DEFAULT_CACHE_PATH):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        # WAL模式: 写入不阻塞读取，进程崩溃时已提交的数据不会丢失
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS loglik ("
+            " model TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " logprob REAL NOT NULL,"
+            " is_greedy INTEGER NOT NULL,"
+            " PRIMARY KEY (model, key))"
+        )
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model, keys):
+        """批量查询，返回 {键: (logprob, is_greedy)}，只包含命中的键"""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), QUERY_CHUNK_SIZE):
+            chunk = unique_keys[i:i + QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT key, logprob, is_greedy FROM loglik WHERE model = ? AND key IN ({placeholders})",
+                [model] + chunk
+            )
+            for key, logprob, is_greedy in rows:
+                found[key] = (logprob, bool(is_greedy))
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, model, items):
+        """批量写入 [(键, logprob, is_greedy)] 并立即提交"""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO loglik (model, key, logprob, is_greedy) VALUES (?, ?, ?, ?)",
+            [(model, key, float(logprob), int(bool(is_greedy))) for key, logprob, is_greedy in items]
+        )
+        self.conn.commit()
+
+    def model_counts(self):
+        """每个模型指纹缓存的请求数"""
+        return self.conn.execute(
+            "SELECT model, COUNT(*) FROM loglik GROUP BY model ORDER BY COUNT(*) DESC"
+        ).fetchall()
+
+    def clear(self, model_prefix=None):
+        """删除某个模型(按指纹前缀)或全部的缓存，返回删除的行数"""
+        if model_prefix:
+            cursor = self.conn.execute("DELETE FROM loglik WHERE model LIKE ?", [model_prefix + "%"])
+        else:
+            cursor = self.conn.execute("DELETE FROM loglik")
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+        return cursor.rowcount
+
+    def close(self):
+        self.conn.close()
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="log-likelihood请求缓存管理")
+    parser.add_argument("--cache_path", type=str, default=DEFAULT_CACHE_PATH, help="SQLite缓存文件路径")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="显示缓存统计")
+    clear_parser = subparsers.add_parser("clear", help="清除缓存")
+    clear_parser.add_argument("--model_fingerprint", type=str, default=None, help="只清除该指纹(前缀)的模型")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cache_path):
+        print(f"❌ 缓存文件不存在: {args.cache_path}")
+        return
+
+    cache = LoglikCache(args.cache_path)
+    if args.command == "stats":
+        counts = cache.model_counts()
+        print("📦 log-likelihood缓存统计")
+        print(f"   缓存文件: {args.cache_path} ({os.path.getsize(args.cache_path) / 1024 / 1024:.2f} MB)")
+        print(f"   请求总数: {sum(count for _, count in counts)}")
+        for model, count in counts:
+            print(f"   - {model[:16]}: {count} 条")
+    elif args.command == "clear":
+        removed = cache.clear(args.model_fingerprint)
+        print(f"✅ 已删除 {removed} 条缓存")
+    cache.close()
+
+if __name__ == "__main__":
+    main()
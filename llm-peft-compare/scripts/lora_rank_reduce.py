@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练后的LoRA秩压缩 (SVD)
+
+训练时的秩是固定的 (LoRA r=8，MPS/回退的QLoRA r=16)，但训练得到的 ΔW = scaling·B·A
+往往集中在少数几个方向上。本脚本对每个模块的 B·A 做SVD:
+- 报告每个模块在各个秩下保留的能量 (奇异值平方和的比例)
+- 按目标秩或能量阈值截断，写出新的适配器目录 (--per_module 时每个模块单独选秩，写入rank_pattern)
+- 截断后的适配器仍是普通PEFT LoRA，可以直接用PeftModel/multi_lora.py加载，
+  未合并推理时每个模块的两次小矩阵乘法和适配器文件都变小
+
+SVD不直接分解 (out, in) 的 ΔW: 先对B和Aᵀ做QR，只需分解 r×r 的小矩阵。
+
+用法:
+  # 只报告能量分布
+  python scripts/lora_rank_reduce.py --adapter_dir models/tinyllama_1.1b-instruction-lora/final
+  # 截断到秩4 / 每个模块保留99%能量，并比较适配器前向延迟
+  python scripts/lora_rank_reduce.py --adapter_dir models/tinyllama_1.1b-instruction-lora/final --rank 4 --benchmark
+  python scripts/lora_rank_reduce.py --adapter_dir models/tinyllama_1.1b-instruction-lora/final --energy 0.99 --per_module
+  python scripts/lora_rank_reduce.py --self_test
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import torch
+
+from multi_lora import load_adapter
+
+ADAPTER_WEIGHTS = "adapter_model.safetensors"
+ADAPTER_CONFIG = "adapter_config.json"
+# 报告能量时列出的秩
+REPORT_RANKS = [1, 2, 4, 8, 16, 32, 64]
+
+
+def svd_factors(lora_a, lora_b, scaling):
+    """scaling·B·A 的紧凑SVD，返回 (U [out, r], S [r], Vh [r, in])"""
+    q_b, r_b = torch.linalg.qr(lora_b.double())
+    q_a, r_a = torch.linalg.qr(lora_a.double().T)
+    u, s, vh = torch.linalg.svd(scaling * r_b @ r_a.T)
+    return q_b @ u, s, vh @ q_a.T
+
+def energy_curve(singular_values):
+    """保留前k个奇异值时的能量比例 (k=1..r)"""
+    energy = singular_values.pow(2).cumsum(0)
+    return (energy / energy[-1].clamp(min=1e-30)).tolist()
+
+def rank_for_energy(singular_values, threshold):
+    curve = energy_curve(singular_values)
+    return next((index + 1 for index, value in enumerate(curve) if value >= threshold - 1e-9), len(curve))
+
+def module_scaling(config, name, rank):
+    """与PEFT相同的缩放系数 (alpha_pattern按模块名后缀匹配)"""
+    alpha = next((value for pattern, value in config.get("alpha_pattern", {}).items()
+                  if re.match(rf"(.*\.)?{pattern}$", name)), config["lora_alpha"])
+    return alpha / (rank ** 0.5 if config.get("use_rslora") else rank)
+
+def analyze_adapter(adapter_dir):
+    """返回 (配置, {模块名: {"rank", "factors": (U, S, Vh)}})"""
+    config, layers = load_adapter(adapter_dir)
+    spectra = {}
+    for name, (lora_a, lora_b, scaling) in layers.items():
+        spectra[name] = {"rank": lora_a.shape[0], "factors": svd_factors(lora_a, lora_b, scaling)}
+    return config, spectra
+
+def choose_ranks(spectra, rank=None, energy=None, per_module=False):
+    """{模块名: 新秩}; 统一秩时取所有模块所需秩的最大值"""
+    if rank is None and energy is None:
+        raise ValueError("需要目标秩或能量阈值")
+    needed = {}
+    for name, spectrum in spectra.items():
+        singular_values = spectrum["factors"][1]
+        needed[name] = rank_for_energy(singular_values, energy) if energy is not None else rank
+        needed[name] = max(1, min(needed[name], spectrum["rank"]))
+    if per_module:
+        return needed
+    uniform = max(needed.values())
+    return {name: min(uniform, spectrum["rank"]) for name, spectrum in spectra.items()}
+
+def format_spectra(spectra, ranks=None):
+    """每个模块在各个秩下的能量表"""
+    max_rank = max(spectrum["rank"] for spectrum in spectra.values())
+    columns = [r for r in REPORT_RANKS if r <= max_rank]
+    header = f"{'模块':<45} {'秩':>4} " + " ".join(f"{'r=' + str(r):>7}" for r in columns)
+    if ranks:
+        header += f" {'新秩':>5} {'相对误差':>9}"
+    lines = [header]
+    for name, spectrum in spectra.items():
+        curve = energy_curve(spectrum["factors"][1])
+        line = f"{name:<45} {spectrum['rank']:>4} " + " ".join(
+            f"{curve[min(r, len(curve)) - 1] * 100:>6.2f}%" for r in columns)
+        if ranks:
+            # ||ΔW - ΔW_k||_F / ||ΔW||_F = sqrt(1 - 能量)
+            error = max(0.0, 1 - curve[ranks[name] - 1]) ** 0.5
+            line += f" {ranks[name]:>5} {error:>9.4f}"
+        lines.append(line)
+    return "\n".join(lines)
+
+def write_reduced_adapter(adapter_dir, output_dir, config, spectra, ranks):
+    """按ranks截断并写出PEFT格式的适配器，返回新配置"""
+    from safetensors.torch import load_file, save_file
+
+    dtype = next(iter(load_file(os.path.join(adapter_dir, ADAPTER_WEIGHTS)).values())).dtype
+    counts = {}
+    for value in ranks.values():
+        counts[value] = counts.get(value, 0) + 1
+    # 最常见的秩作为r，其余写入rank_pattern (完整模块名，与PEFT的后缀匹配规则兼容)
+    default_rank = max(counts, key=lambda value: (counts[value], value))
+    new_config = dict(config)
+    new_config["r"] = default_rank
+    new_config["rank_pattern"] = {re.escape(name): value for name, value in ranks.items() if value != default_rank}
+
+    state = {}
+    for name, spectrum in spectra.items():
+        u, s, vh = spectrum["factors"]
+        k = ranks[name]
+        root = s[:k].sqrt()
+        # 奇异值平均分给A和B; B再除以新秩下的缩放系数，使 scaling'·B'·A' = 截断后的ΔW
+        lora_a = root[:, None] * vh[:k]
+        lora_b = u[:, :k] * root[None, :] / module_scaling(new_config, name, k)
+        state[f"base_model.model.{name}.lora_A.weight"] = lora_a.to(dtype).contiguous()
+        state[f"base_model.model.{name}.lora_B.weight"] = lora_b.to(dtype).contiguous()
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_file(state, os.path.join(output_dir, ADAPTER_WEIGHTS), metadata={"format": "pt"})
+    with open(os.path.join(output_dir, ADAPTER_CONFIG), 'w') as f:
+        json.dump(new_config, f, indent=2)
+    # 分词器、README等其余文件原样复制
+    for filename in os.listdir(adapter_dir):
+        source = os.path.join(adapter_dir, filename)
+        if filename not in (ADAPTER_WEIGHTS, ADAPTER_CONFIG) and os.path.isfile(source):
+            shutil.copy2(source, os.path.join(output_dir, filename))
+    return new_config
+
+def reduce_adapter(adapter_dir, output_dir, rank=None, energy=None, per_module=False):
+    """分析并截断适配器，返回 {模块名: 新秩}"""
+    config, spectra = analyze_adapter(adapter_dir)
+    ranks = choose_ranks(spectra, rank, energy, per_module)
+    print(format_spectra(spectra, ranks))
+    write_reduced_adapter(adapter_dir, output_dir, config, spectra, ranks)
+    before = os.path.getsize(os.path.join(adapter_dir, ADAPTER_WEIGHTS))
+    after = os.path.getsize(os.path.join(output_dir, ADAPTER_WEIGHTS))
+    print(f"✓ 截断后的适配器已保存: {output_dir} (秩 {sorted(set(ranks.values()))}, "
+          f"{before / 1024:.1f}KB -> {after / 1024:.1f}KB)")
+    return ranks
+
+def _adapter_seconds(layers, tokens, repeats):
+    """只计算所有模块的LoRA分支 (x·Aᵀ)·Bᵀ 的耗时"""
+    inputs = {name: torch.randn(tokens, lora_a.shape[1], generator=torch.Generator().manual_seed(0))
+              for name, (lora_a, _, _) in layers.items()}
+    # 缩放系数预先乘进B，只比较两次矩阵乘法
+    factors = {name: (lora_a.T.contiguous(), (lora_b * scaling).T.contiguous())
+               for name, (lora_a, lora_b, scaling) in layers.items()}
+    timings = []
+    with torch.no_grad():
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for name, (lora_a, lora_b) in factors.items():
+                (inputs[name] @ lora_a) @ lora_b
+            timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+def benchmark(adapter_dir, reduced_dir, base_model=None, batch_size=8, seq_len=64, repeats=5):
+    """未合并推理: 原适配器与截断适配器的前向延迟和logits差异"""
+    import copy
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM
+
+    if base_model is None:
+        with open(os.path.join(adapter_dir, ADAPTER_CONFIG)) as f:
+            base_model = AutoModelForCausalLM.from_pretrained(json.load(f)["base_model_name_or_path"],
+                                                              dtype=torch.float32)
+    base_model.eval()
+    input_ids = torch.randint(3, base_model.config.vocab_size, (batch_size, seq_len),
+                              generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        base_logits = base_model(input_ids).logits
+
+    results = {}
+    for label, path in [("原适配器", adapter_dir), ("截断适配器", reduced_dir)]:
+        model = PeftModel.from_pretrained(copy.deepcopy(base_model), path).eval()
+        timings = []
+        with torch.no_grad():
+            model(input_ids[:1, :8])  # 预热
+            for _ in range(repeats):
+                start = time.perf_counter()
+                logits = model(input_ids).logits
+                timings.append(time.perf_counter() - start)
+        _, layers = load_adapter(path)
+        # 取中位数，减少单CPU上的抖动
+        results[label] = {"seconds": sorted(timings)[repeats // 2], "logits": logits,
+                          "adapter_seconds": _adapter_seconds(layers, batch_size * seq_len, 4 * repeats),
+                          "adapter_bytes": os.path.getsize(os.path.join(path, ADAPTER_WEIGHTS))}
+
+    # 截断带来的变化相对于适配器本身带来的变化
+    reference, reduced = results["原适配器"]["logits"], results["截断适配器"]["logits"]
+    relative_change = float((reduced - reference).norm() / (reference - base_logits).norm().clamp(min=1e-12))
+    print(f"\nbatch={batch_size}, seq_len={seq_len}")
+    print(f"{'适配器':<12} {'模型前向':>10} {'LoRA分支':>10} {'文件大小':>10}")
+    for label, result in results.items():
+        print(f"{label:<12} {result['seconds'] * 1000:>8.1f}ms {result['adapter_seconds'] * 1000:>8.2f}ms "
+              f"{result['adapter_bytes'] / 1024:>8.1f}KB")
+    print(f"截断引起的logits变化 / 适配器引起的logits变化: {relative_change:.4f}")
+    return {label: {key: value for key, value in result.items() if key != "logits"}
+            for label, result in results.items()}, relative_change
+
+def _save_decaying_adapter(base_model, adapter_dir, rank=16, decay=(0.5, 0.8), seed=0):
+    """随机适配器，B的第j列乘以 decay^j，模拟训练后能量集中在少数方向上的ΔW
+
+    decay: (注意力层, MLP层)，衰减不同时按能量选出的秩也不同
+    """
+    import copy
+    from peft import LoraConfig, get_peft_model
+
+    torch.manual_seed(seed)
+    config = LoraConfig(r=rank, lora_alpha=2 * rank, target_modules=["q_proj", "k_proj", "v_proj", "o_proj",
+                                                                      "gate_proj", "up_proj", "down_proj"],
+                        alpha_pattern={"down_proj": rank}, init_lora_weights=False, lora_dropout=0.0,
+                        task_type="CAUSAL_LM")
+    peft_model = get_peft_model(copy.deepcopy(base_model), config)
+    with torch.no_grad():
+        for name, param in peft_model.named_parameters():
+            if "lora_B" in name:
+                param.mul_(decay[".mlp." in name] ** torch.arange(rank, dtype=param.dtype))
+    peft_model.save_pretrained(adapter_dir)
+
+def self_test(hidden_size=256, num_layers=2, seed=0):
+    from peft import PeftModel
+    from tiny_model import build_tiny_model
+
+    base_model, _ = build_tiny_model(hidden_size=hidden_size, num_layers=num_layers,
+                                     intermediate_size=hidden_size * 2, seed=seed)
+    base_model.eval()
+    input_ids = torch.randint(3, base_model.config.vocab_size, (2, 32), generator=torch.Generator().manual_seed(1))
+    ok = True
+    with tempfile.TemporaryDirectory() as work_dir:
+        adapter_dir = os.path.join(work_dir, "final")
+        _save_decaying_adapter(base_model, adapter_dir)
+
+        def logits(path):
+            import copy
+            model = PeftModel.from_pretrained(copy.deepcopy(base_model), path).eval()
+            with torch.no_grad():
+                return model(input_ids).logits
+
+        reference = logits(adapter_dir)
+
+        # 1) 不截断 (秩不变) 只是重新分解，结果与原适配器相同
+        full_dir = os.path.join(work_dir, "final-r16")
+        reduce_adapter(adapter_dir, full_dir, rank=16)
+        full_diff = float((logits(full_dir) - reference).abs().max())
+        print(f"秩不变的重新分解与原适配器的最大差异: {full_diff:.2e}")
+        ok = ok and full_diff < 1e-4
+
+        # 2) 每个模块保留99%能量: 秩变小，rank_pattern可被PEFT和multi_lora正确读取
+        energy_dir = os.path.join(work_dir, "final-e0.99")
+        ranks = reduce_adapter(adapter_dir, energy_dir, energy=0.99, per_module=True)
+        _, layers = load_adapter(energy_dir)
+        layout_ok = all(layers[name][0].shape[0] == rank for name, rank in ranks.items())
+        config, spectra = analyze_adapter(adapter_dir)
+        _, reduced_spectra = analyze_adapter(energy_dir)
+        # 截断后的ΔW与原ΔW的相对误差 <= sqrt(1 - 0.99)
+        errors = []
+        for name in spectra:
+            u, s, vh = spectra[name]["factors"]
+            ru, rs, rvh = reduced_spectra[name]["factors"]
+            delta = (u * s) @ vh
+            errors.append(float(((ru * rs) @ rvh - delta).norm() / delta.norm()))
+        print(f"新秩 {sorted(set(ranks.values()))}, 各模块读取的秩与rank_pattern一致: {layout_ok}, "
+              f"ΔW最大相对误差 {max(errors):.4f}")
+        ok = ok and layout_ok and len(set(ranks.values())) > 1 and max(ranks.values()) < 16
+        ok = ok and max(errors) <= 0.1 + 1e-6
+
+        results, relative_change = benchmark(adapter_dir, energy_dir, base_model, batch_size=8, seq_len=64)
+        ok = ok and relative_change < 0.2
+        ok = ok and results["截断适配器"]["adapter_bytes"] < results["原适配器"]["adapter_bytes"]
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="训练后用SVD压缩LoRA适配器的秩")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用随机微型模型和随机适配器自检")
+    parser.add_argument("--adapter_dir", type=str, default=None, help="适配器目录 (如 models/*/final)")
+    parser.add_argument("--output_dir", type=str, default=None, help="默认为 [adapter_dir]-r[秩] 或 -e[能量]")
+    parser.add_argument("--rank", type=int, default=None, help="目标秩")
+    parser.add_argument("--energy", type=float, default=None, help="保留的能量比例 (如0.99)")
+    parser.add_argument("--per_module", action="store_true", help="每个模块单独选秩 (写入rank_pattern)")
+    parser.add_argument("--benchmark", action="store_true", help="比较截断前后的未合并推理延迟")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seq_len", type=int, default=64)
+    args = parser.parse_args()
+
+    if args.self_test:
+        if not self_test():
+            print("❌ LoRA秩压缩自检失败")
+            raise SystemExit(1)
+        print("✅ LoRA秩压缩自检通过")
+        return
+
+    if not args.adapter_dir:
+        parser.error("需要 --adapter_dir 或 --self_test")
+    if args.rank is None and args.energy is None:
+        _, spectra = analyze_adapter(args.adapter_dir)
+        print(format_spectra(spectra))
+        return
+
+    suffix = f"r{args.rank}" if args.rank is not None else f"e{args.energy}"
+    output_dir = args.output_dir or f"{args.adapter_dir.rstrip('/')}-{suffix}"
+    reduce_adapter(args.adapter_dir, output_dir, args.rank, args.energy, args.per_module)
+    if args.benchmark:
+        benchmark(args.adapter_dir, output_dir, batch_size=args.batch_size, seq_len=args.seq_len)
+
+if __name__ == "__main__":
+    main()
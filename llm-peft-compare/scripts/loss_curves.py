@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练损失曲线分析 - 读取所有运行的 trainer_state.json log_history
+
+- 每个运行目录取最新checkpoint的log_history，解析为NumPy数组并缓存 (按文件修改时间/大小失效)
+- EMA平滑损失 (带偏差校正)
+- 按已见token数对齐不同批量大小/梯度累积的运行 (或按total_flos折算的计算量)
+- 相同计算量下的损失、收敛速度指标 (达到最终损失附近所需token数、曲线下面积)
+- 一次性绘制所有运行的叠加曲线
+
+用法:
+  python scripts/loss_curves.py --models_dir models --seq_len 512
+"""
+
+import os
+import csv
+import glob
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+# 配置
+CACHE_DIR = "results/loss_curves_cache"
+FIGURES_DIR = "results/figures"
+SUMMARY_FILE = "results/loss_curves_summary.csv"
+
+# log_history中解析的字段
+HISTORY_FIELDS = ["step", "epoch", "loss", "learning_rate", "grad_norm", "num_input_tokens_seen"]
+
+
+def find_runs(models_dir):
+    """查找所有运行: 每个运行目录使用global_step最大的checkpoint"""
+    runs = {}
+    for state_file in glob.glob(os.path.join(models_dir, "**", "trainer_state.json"), recursive=True):
+        checkpoint_dir = os.path.dirname(state_file)
+        run_dir = os.path.dirname(checkpoint_dir) if os.path.basename(checkpoint_dir).startswith("checkpoint-") else checkpoint_dir
+        run_name = os.path.relpath(run_dir, models_dir)
+        step = int(os.path.basename(checkpoint_dir).split("-")[-1]) if "checkpoint-" in checkpoint_dir else -1
+        if run_name not in runs or step > runs[run_name][0]:
+            runs[run_name] = (step, state_file)
+    return {name: state_file for name, (_, state_file) in sorted(runs.items())}
+
+def _read_training_args(checkpoint_dir):
+    """从training_args.bin读取 (per_device_batch_size, gradient_accumulation_steps, world_size)，失败返回None"""
+    path = os.path.join(checkpoint_dir, "training_args.bin")
+    if not os.path.exists(path):
+        return None
+    try:
+        import torch
+        training_args = torch.load(path, weights_only=False)
+        return (training_args.per_device_train_batch_size,
+                training_args.gradient_accumulation_steps,
+                training_args.world_size)
+    except Exception as e:
+        print(f"⚠️ 无法读取 {path}: {e}")
+        return None
+
+def load_history(state_file, use_cache=True):
+    """解析trainer_state.json为数组字典，结果缓存为.npz"""
+    stat = os.stat(state_file)
+    cache_key = hashlib.sha1(f"{os.path.abspath(state_file)}:{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()
+    cache_file = os.path.join(CACHE_DIR, f"{cache_key}.npz")
+    if use_cache and os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=False) as cached:
+            history = {key: cached[key] for key in cached.files}
+        history["meta"] = json.loads(str(history.pop("meta_json")))
+        return history
+
+    with open(state_file, 'r') as f:
+        state = json.load(f)
+
+    # 只保留训练日志 (带loss的条目)，评估/汇总条目跳过
+    entries = [entry for entry in state.get("log_history", []) if "loss" in entry]
+    history = {
+        field: np.array([entry.get(field, np.nan) for entry in entries], dtype=np.float64)
+        for field in HISTORY_FIELDS
+    }
+
+    checkpoint_dir = os.path.dirname(state_file)
+    training_args = _read_training_args(checkpoint_dir)
+    meta = {
+        "train_batch_size": state.get("train_batch_size"),
+        "global_step": state.get("global_step"),
+        "total_flos": state.get("total_flos"),
+        "logging_steps": state.get("logging_steps"),
+        "gradient_accumulation_steps": training_args[1] if training_args else None,
+        "world_size": training_args[2] if training_args else None
+    }
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    np.savez(cache_file, meta_json=np.array(json.dumps(meta)), **history)
+    history["meta"] = meta
+    return history
+
+def ema(values, alpha=0.9):
+    """带偏差校正的指数滑动平均 (与TensorBoard平滑一致)"""
+    smoothed = np.empty_like(values)
+    average = 0.0
+    for i, value in enumerate(values):
+        average = alpha * average + (1 - alpha) * value
+        smoothed[i] = average / (1 - alpha ** (i + 1))
+    return smoothed
+
+def tokens_seen(history, seq_len, default_accumulation=1):
+    """每条日志对应的已见token数: 优先使用num_input_tokens_seen，否则由批量配置推算"""
+    recorded = history["num_input_tokens_seen"]
+    if np.all(np.isfinite(recorded)) and np.all(recorded > 0):
+        return recorded
+    meta = history["meta"]
+    batch = meta.get("train_batch_size") or 1
+    accumulation = meta.get("gradient_accumulation_steps") or default_accumulation
+    world_size = meta.get("world_size") or 1
+    return history["step"] * batch * accumulation * world_size * seq_len
+
+def flos_seen(history):
+    """按total_flos线性折算每条日志对应的计算量"""
+    meta = history["meta"]
+    if not meta.get("total_flos") or not meta.get("global_step"):
+        return None
+    return history["step"] * (meta["total_flos"] / meta["global_step"])
+
+def convergence_metrics(x, smoothed, tolerance=0.05):
+    """收敛速度指标: 达到 (最终损失 × (1+tolerance)) 所需的x、曲线下平均损失"""
+    final = smoothed[-1]
+    reached = np.nonzero(smoothed <= final * (1 + tolerance))[0]
+    x_to_converge = float(x[reached[0]]) if len(reached) else float("nan")
+    mean_loss = float(np.trapezoid(smoothed, x) / (x[-1] - x[0])) if len(x) > 1 else float(smoothed[0])
+    return {
+        "initial_loss": float(smoothed[0]),
+        "final_loss": float(final),
+        "x_to_converge": x_to_converge,
+        "mean_loss": mean_loss
+    }
+
+def loss_at_budget(x, smoothed, budget):
+    """在给定计算量处插值得到的平滑损失 (超出范围返回NaN)"""
+    if budget < x[0] or budget > x[-1]:
+        return float("nan")
+    return float(np.interp(budget, x, smoothed))
+
+def analyze(runs, seq_len, alpha, axis, default_accumulation, use_cache=True):
+    """加载并分析所有运行，返回 {运行名: 数据}"""
+    analyzed = {}
+    for name, state_file in runs.items():
+        history = load_history(state_file, use_cache)
+        if len(history["loss"]) == 0:
+            print(f"⚠️ {name} 没有训练日志，跳过")
+            continue
+        x = flos_seen(history) if axis == "flos" else tokens_seen(history, seq_len, default_accumulation)
+        if x is None:
+            print(f"⚠️ {name} 缺少total_flos，改用token数")
+            x = tokens_seen(history, seq_len, default_accumulation)
+        smoothed = ema(history["loss"], alpha)
+        analyzed[name] = {"x": x, "loss": history["loss"], "smoothed": smoothed, "meta": history["meta"]}
+    return analyzed
+
+def plot_overlay(analyzed, axis, budgets, output_path):
+    """在一张图中绘制所有运行的原始损失(淡色)和平滑损失"""
+    fig, (ax_curve, ax_budget) = plt.subplots(1, 2, figsize=(16, 6), gridspec_kw={"width_ratios": [2, 1]})
+    colors = plt.cm.tab10(np.linspace(0, 1, max(len(analyzed), 1)))
+    for color, (name, run) in zip(colors, analyzed.items()):
+        ax_curve.plot(run["x"], run["loss"], color=color, alpha=0.2, linewidth=0.8)
+        ax_curve.plot(run["x"], run["smoothed"], color=color, linewidth=2, label=name)
+    for budget in budgets:
+        ax_curve.axvline(budget, color="gray", linestyle=":", linewidth=1)
+    ax_curve.set_xlabel("计算量 (FLOs)" if axis == "flos" else "已见token数")
+    ax_curve.set_ylabel("训练损失")
+    ax_curve.set_title("训练损失曲线 (EMA平滑)")
+    ax_curve.grid(True, linestyle='--', alpha=0.7)
+    ax_curve.legend(fontsize=8)
+
+    # 相同计算量下的损失
+    if budgets:
+        names = list(analyzed)
+        width = 0.8 / len(budgets)
+        for i, budget in enumerate(budgets):
+            values = [loss_at_budget(analyzed[name]["x"], analyzed[name]["smoothed"], budget) for name in names]
+            ax_budget.bar(np.arange(len(names)) + i * width, values, width, label=f"{budget:.3g}")
+        ax_budget.set_xticks(np.arange(len(names)) + width * (len(budgets) - 1) / 2)
+        ax_budget.set_xticklabels(names, rotation=30, ha='right', fontsize=8)
+        ax_budget.set_ylabel("平滑损失")
+        ax_budget.set_title("相同计算量下的损失")
+        ax_budget.legend(title="计算量", fontsize=8)
+
+    plt.tight_layout()
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    plt.savefig(output_path, dpi=200)
+    plt.close(fig)
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="训练损失曲线分析")
+    parser.add_argument("--models_dir", type=str, default="models", help="包含各运行输出目录的根目录")
+    parser.add_argument("--seq_len", type=int, default=512, help="每个样本的token数 (训练使用padding=max_length)")
+    parser.add_argument("--default_accumulation", type=int, default=1,
+                        help="无法读取training_args.bin时假定的梯度累积步数")
+    parser.add_argument("--alpha", type=float, default=0.9, help="EMA平滑系数")
+    parser.add_argument("--axis", type=str, default="tokens", choices=["tokens", "flos"], help="对齐运行所用的横轴")
+    parser.add_argument("--budgets", type=str, default=None, help="逗号分隔的计算量预算 (默认取公共范围的25/50/100%%)")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="收敛判定: 距最终损失的相对差")
+    parser.add_argument("--no_cache", action="store_true", help="不使用已解析的缓存")
+    parser.add_argument("--output_figure", type=str, default=os.path.join(FIGURES_DIR, "loss_curves.png"))
+    parser.add_argument("--output_csv", type=str, default=SUMMARY_FILE)
+    args = parser.parse_args()
+
+    runs = find_runs(args.models_dir)
+    if not runs:
+        print(f"❌ 在 {args.models_dir} 下没有找到trainer_state.json")
+        return
+    print(f"发现 {len(runs)} 个运行")
+
+    analyzed = analyze(runs, args.seq_len, args.alpha, args.axis, args.default_accumulation, not args.no_cache)
+    if not analyzed:
+        return
+
+    # 所有运行共同覆盖的计算量范围
+    common_max = min(run["x"][-1] for run in analyzed.values())
+    if args.budgets:
+        budgets = [float(value) for value in args.budgets.split(",")]
+    else:
+        budgets = [common_max * fraction for fraction in (0.25, 0.5, 1.0)]
+
+    rows = []
+    for name, run in analyzed.items():
+        metrics = convergence_metrics(run["x"], run["smoothed"], args.tolerance)
+        row = {"run": name, "steps": int(run["meta"].get("global_step") or 0), "x_total": float(run["x"][-1])}
+        row.update(metrics)
+        for budget in budgets:
+            row[f"loss@{budget:.3g}"] = loss_at_budget(run["x"], run["smoothed"], budget)
+        rows.append(row)
+        print(f"📈 {name}: 步数={row['steps']}, 最终损失={metrics['final_loss']:.4f}, "
+              f"收敛所需{args.axis}={metrics['x_to_converge']:.3g}, "
+              + ", ".join(f"loss@{budget:.3g}={row[f'loss@{budget:.3g}']:.4f}" for budget in budgets))
+
+    os.makedirs(os.path.dirname(args.output_csv) or ".", exist_ok=True)
+    with open(args.output_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"✓ 汇总已保存: {args.output_csv}")
+
+    plot_overlay(analyzed, args.axis, budgets, args.output_figure)
+    print(f"✓ 图表已保存: {args.output_figure}")
+
+if __name__ == "__main__":
+    main()
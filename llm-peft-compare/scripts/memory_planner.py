@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+训练前的显存/内存预算规划
+
+只根据模型配置 (hidden_size、层数、词表等)、微调方法、序列长度和优化器估算
+参数/梯度/优化器状态/激活值占用，在给定预算内选择最大的micro-batch，
+同时保持有效批大小 (batch_size × gradient_accumulation_steps) 不变。
+可选 --probe 在子进程中用随机初始化的模型实际跑一步训练确认峰值占用。
+
+用法:
+  python scripts/memory_planner.py --model_size tiny --method lora --budget_gb 16
+  python scripts/memory_planner.py --model_name models/tiny-random-llama --method qlora --budget_gb 2 --probe
+  python scripts/memory_planner.py --self_test
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from dataclasses import dataclass
+
+from train_instruction import model_options
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+GB = 1024 ** 3
+DTYPE_BYTES = {"fp32": 4, "fp16": 2, "bf16": 2}
+# 每个可训练参数的优化器状态字节数 (AdamW两个状态与参数同dtype; 8bit为每状态1字节; Adafactor单独按分解状态计算)
+OPTIMIZER_STATES = {"adamw": 2, "adamw_8bit": 2, "adafactor": 0, "sgd": 0}
+# 各设备可用的精度，按数值稳定性从高到低
+DEVICE_PRECISIONS = {"cpu": ["fp32"], "mps": ["fp32", "fp16"], "cuda": ["fp32", "bf16", "fp16"]}
+# train_instruction.detect_device 在各设备上实际使用的精度
+TRAIN_PRECISION = {"cpu": "fp32", "mps": "fp32", "cuda": "fp16"}
+
+# 无法联网读取配置时使用的已知模型结构
+KNOWN_CONFIGS = {
+    "TinyLlama/TinyLlama-1.1B-Chat-v1.0": {
+        "model_type": "llama", "vocab_size": 32000, "hidden_size": 2048, "num_hidden_layers": 22,
+        "num_attention_heads": 32, "num_key_value_heads": 4, "intermediate_size": 5632,
+        "tie_word_embeddings": False
+    },
+    "microsoft/phi-2": {
+        "model_type": "phi", "vocab_size": 51200, "hidden_size": 2560, "num_hidden_layers": 32,
+        "num_attention_heads": 32, "num_key_value_heads": 32, "intermediate_size": 10240,
+        "tie_word_embeddings": False
+    },
+    "mistralai/Mistral-7B-v0.1": {
+        "model_type": "mistral", "vocab_size": 32000, "hidden_size": 4096, "num_hidden_layers": 32,
+        "num_attention_heads": 32, "num_key_value_heads": 8, "intermediate_size": 14336,
+        "tie_word_embeddings": False
+    }
+}
+
+# 与train_instruction.build_model一致的默认LoRA设置 (秩, 目标模块)
+LORA_DEFAULTS = {
+    "lora": (8, ["q_proj", "v_proj", "k_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]),
+    "qlora": (16, ["q_proj", "k_proj", "v_proj", "o_proj"])
+}
+
+
+@dataclass
+class ModelShape:
+    """估算所需的模型结构"""
+    model_type: str
+    vocab_size: int
+    hidden_size: int
+    num_layers: int
+    num_heads: int
+    num_kv_heads: int
+    intermediate_size: int
+    tied_embeddings: bool
+
+    @classmethod
+    def from_config(cls, config):
+        get = config.get if isinstance(config, dict) else lambda key, default=None: getattr(config, key, default)
+        num_heads = get("num_attention_heads")
+        return cls(
+            model_type=get("model_type", "llama"),
+            vocab_size=get("vocab_size"),
+            hidden_size=get("hidden_size"),
+            num_layers=get("num_hidden_layers"),
+            num_heads=num_heads,
+            num_kv_heads=get("num_key_value_heads") or num_heads,
+            intermediate_size=get("intermediate_size"),
+            tied_embeddings=bool(get("tie_word_embeddings", False))
+        )
+
+    @property
+    def gated_mlp(self):
+        # Llama/Mistral: gate/up/down三个投影; Phi: fc1/fc2
+        return self.model_type != "phi"
+
+    def linear_shapes(self):
+        """每层线性模块 {名称: (输入维度, 输出维度)}，名称统一使用Llama命名"""
+        head_dim = self.hidden_size // self.num_heads
+        kv_dim = self.num_kv_heads * head_dim
+        h, i = self.hidden_size, self.intermediate_size
+        shapes = {"q_proj": (h, h), "k_proj": (h, kv_dim), "v_proj": (h, kv_dim), "o_proj": (h, h),
+                  "up_proj": (h, i), "down_proj": (i, h)}
+        if self.gated_mlp:
+            shapes["gate_proj"] = (h, i)
+        return shapes
+
+    def embedding_params(self):
+        return self.vocab_size * self.hidden_size * (1 if self.tied_embeddings else 2)
+
+    def layer_linear_params(self):
+        return sum(n_in * n_out for n_in, n_out in self.linear_shapes().values())
+
+    def total_params(self):
+        # 每层两个norm + 最终norm
+        norms = (2 * self.num_layers + 1) * self.hidden_size
+        return self.embedding_params() + self.num_layers * self.layer_linear_params() + norms
+
+def load_model_shape(model_name):
+    """读取模型结构: 本地目录/缓存的config.json → 已知配置 → 联网下载config"""
+    from transformers import AutoConfig
+
+    try:
+        return ModelShape.from_config(AutoConfig.from_pretrained(model_name, trust_remote_code=True,
+                                                                 local_files_only=True))
+    except Exception:
+        pass
+    if model_name in KNOWN_CONFIGS:
+        return ModelShape.from_config(KNOWN_CONFIGS[model_name])
+    try:
+        return ModelShape.from_config(AutoConfig.from_pretrained(model_name, trust_remote_code=True))
+    except Exception as e:
+        raise ValueError(f"无法读取模型配置: {model_name} ({e})")
+
+def lora_params(shape, lora_r, target_modules):
+    """LoRA可训练参数数量: 每个目标模块 r × (输入 + 输出)"""
+    shapes = shape.linear_shapes()
+    per_layer = sum(lora_r * (shapes[name][0] + shapes[name][1]) for name in target_modules if name in shapes)
+    return per_layer * shape.num_layers
+
+def factored_state_params(shape, method, lora_r=None, target_modules=None):
+    """Adafactor分解后的二阶矩元素数: 每个可训练矩阵只保存 行数 + 列数"""
+    shapes = shape.linear_shapes()
+    if method == "full":
+        per_layer = sum(n_in + n_out for n_in, n_out in shapes.values()) + 2 * shape.hidden_size
+        embeddings = (shape.vocab_size + shape.hidden_size) * (1 if shape.tied_embeddings else 2)
+        return per_layer * shape.num_layers + embeddings
+    default_r, default_targets = LORA_DEFAULTS[method]
+    r = lora_r or default_r
+    # 每个目标模块: A (r × 输入) 与 B (输出 × r)
+    per_layer = sum(2 * r + shapes[name][0] + shapes[name][1] for name in target_modules or default_targets
+                    if name in shapes)
+    return per_layer * shape.num_layers
+
+def estimate_memory(shape, method, seq_len, micro_batch, precision="fp32", optimizer="adamw",
+                    lora_r=None, target_modules=None, quant_bits=4, quant_group_size=64,
+                    gradient_checkpointing=False, loss_chunk_size=None):
+    """估算一步训练的峰值占用 (字节)，返回各部分明细
+
+    gradient_checkpointing: 只保存每层的输入，反向时逐层重算 (同一时刻只有一层的完整激活值)
+    loss_chunk_size: 分块交叉熵 (chunked_loss.py)，同一时刻只有chunk_size个token的logits
+    """
+    w = DTYPE_BYTES[precision]
+    total_params = shape.total_params()
+    linear_params = shape.num_layers * shape.layer_linear_params()
+
+    # 参数
+    if method == "qlora":
+        # 解码层线性权重量化 (每组一个fp16缩放系数)，其余保持原精度
+        quantized = linear_params * quant_bits / 8 + linear_params / quant_group_size * 2
+        weights = quantized + (total_params - linear_params) * w
+    else:
+        weights = total_params * w
+
+    # 可训练参数: 全参数微调与参数同dtype; PEFT默认把适配器提升为fp32
+    if method == "full":
+        trainable, trainable_bytes = total_params, w
+    else:
+        default_r, default_targets = LORA_DEFAULTS[method]
+        trainable = lora_params(shape, lora_r or default_r, target_modules or default_targets)
+        trainable_bytes = 4
+        weights += trainable * trainable_bytes
+    gradients = trainable * trainable_bytes
+    if optimizer == "adamw":
+        optimizer_states = trainable * trainable_bytes * OPTIMIZER_STATES[optimizer]
+    elif optimizer == "adafactor":
+        optimizer_states = factored_state_params(shape, method, lora_r, target_modules) * 4
+    else:
+        # 8bit状态每256个值一个fp32缩放系数
+        optimizer_states = trainable * OPTIMIZER_STATES[optimizer] * (1 + 4 / 256)
+
+    # 激活值: 反向传播需要保存的中间结果 (冻结层也需要对输入求梯度)
+    tokens = micro_batch * seq_len
+    shapes = shape.linear_shapes()
+    h, i = shape.hidden_size, shape.intermediate_size
+    per_token = (
+        6 * h  # 两个norm的输入/输出、attention输出、残差
+        + shapes["q_proj"][1] + shapes["k_proj"][1] + shapes["v_proj"][1]
+        + (4 * i if shape.gated_mlp else 2 * i)  # gate/up输出、激活函数输出、乘积
+        + shape.num_heads * seq_len  # 注意力概率 (非融合实现)
+    )
+    if method != "full":
+        # 每个LoRA目标模块: dropout后的输入副本 + 秩为r的中间结果
+        default_r, default_targets = LORA_DEFAULTS[method]
+        per_token += sum(shapes[name][0] + (lora_r or default_r)
+                         for name in target_modules or default_targets if name in shapes)
+    if gradient_checkpointing:
+        activations = tokens * (h * shape.num_layers + per_token) * w
+    else:
+        activations = tokens * per_token * w * shape.num_layers
+    # logits (模型dtype) + 计算损失时的fp32副本和梯度
+    logit_tokens = min(tokens, loss_chunk_size) if loss_chunk_size else tokens
+    logits = logit_tokens * shape.vocab_size * (w + 4 + 4)
+
+    # 量化层前向/反向时临时还原的单层权重
+    transient = max(n_in * n_out for n_in, n_out in shapes.values()) * w if method == "qlora" else 0
+    if optimizer == "adamw_8bit":
+        # 8-bit AdamW更新单个参数时临时还原的fp32状态/中间结果 (约6份最大参数)
+        largest = shape.vocab_size * h if method == "full" else max(n_in for n_in, _ in shapes.values()) * (lora_r or 16)
+        transient += largest * 4 * 6
+
+    parts = {
+        "weights": weights,
+        "gradients": gradients,
+        "optimizer": optimizer_states,
+        "activations": activations,
+        "logits": logits,
+        "transient": transient
+    }
+    parts["total"] = sum(parts.values())
+    parts["trainable_params"] = trainable
+    parts["total_params"] = total_params
+    return parts
+
+def divisors_desc(n):
+    return [d for d in range(n, 0, -1) if n % d == 0]
+
+def plan(shape, method, seq_len, budget_gb, effective_batch, device="cpu", optimizer="adamw",
+         overhead_gb=0.5, safety_margin=0.1, precisions=None, **estimate_kwargs):
+    """在预算内为每个精度选择最大的micro-batch，返回 (最佳方案, 全部候选)
+
+    方案: {"precision", "micro_batch", "gradient_accumulation_steps", "estimate"}; 都放不下时最佳方案为None
+    """
+    usable = (budget_gb - overhead_gb) * GB * (1 - safety_margin)
+    candidates = []
+    for precision in precisions or DEVICE_PRECISIONS[device]:
+        for micro_batch in divisors_desc(effective_batch):
+            estimate = estimate_memory(shape, method, seq_len, micro_batch, precision, optimizer, **estimate_kwargs)
+            if estimate["total"] <= usable:
+                candidates.append({
+                    "precision": precision,
+                    "micro_batch": micro_batch,
+                    "gradient_accumulation_steps": effective_batch // micro_batch,
+                    "estimate": estimate
+                })
+                break
+    # micro-batch最大者优先; 相同时优先训练脚本在该设备上使用的精度，其次列表中靠前 (数值更稳定) 的精度
+    best = max(candidates, key=lambda c: (c["micro_batch"], c["precision"] == TRAIN_PRECISION.get(device)),
+               default=None)
+    return best, candidates
+
+def format_gb(n_bytes):
+    return f"{n_bytes / GB:.2f}GB"
+
+def print_estimate(estimate):
+    for key in ["weights", "gradients", "optimizer", "activations", "logits", "transient"]:
+        print(f"  {key:<12} {format_gb(estimate[key]):>10}")
+    print(f"  {'total':<12} {format_gb(estimate['total']):>10}")
+
+def detect_device_type():
+    import torch
+    if torch.backends.mps.is_available():
+        return "mps"
+    if torch.cuda.is_available():
+        return "cuda"
+    return "cpu"
+
+def probe(model_name, method, seq_len, micro_batch, precision, optimizer, device, quant_bits=4, quant_group_size=64,
+          lora_r=None, target_modules=None, gradient_checkpointing=False, loss_chunk_size=None):
+    """在子进程中随机初始化模型并执行几步训练
+
+    返回 {"peak_bytes": 实测峰值 (不含Python/torch自身占用), "step_time": 单步耗时 (秒)}，失败时返回None
+    """
+    request = {
+        "model_name": model_name, "method": method, "seq_len": seq_len, "micro_batch": micro_batch,
+        "precision": precision, "optimizer": optimizer, "device": device, "quant_bits": quant_bits,
+        "quant_group_size": quant_group_size, "lora_r": lora_r, "target_modules": target_modules,
+        "gradient_checkpointing": gradient_checkpointing, "loss_chunk_size": loss_chunk_size
+    }
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--probe_worker", json.dumps(request)],
+        capture_output=True, text=True, cwd=SCRIPT_DIR
+    )
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    print(result.stdout[-2000:])
+    print(result.stderr[-2000:])
+    return None
+
+def _max_rss_bytes():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux以KB为单位，macOS以字节为单位
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def probe_worker(request):
+    """--probe_worker: 构建随机模型并执行几次前向/反向/优化器更新"""
+    import time
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[request["precision"]]
+    device = request["device"]
+    method = request["method"]
+    config = AutoConfig.from_pretrained(request["model_name"], trust_remote_code=True)
+    baseline = _max_rss_bytes()
+
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype).to(device)
+    if method != "full":
+        from peft import LoraConfig, get_peft_model
+        if method == "qlora":
+            from quantized_linear import quantize_model
+            quantize_model(model, bits=request["quant_bits"], group_size=request["quant_group_size"], verbose=False)
+        default_r, default_targets = LORA_DEFAULTS[method]
+        model = get_peft_model(model, LoraConfig(r=request["lora_r"] or default_r, lora_alpha=32,
+                                                 target_modules=request["target_modules"] or default_targets,
+                                                 lora_dropout=0.05, task_type="CAUSAL_LM"))
+    model.train()
+    if request.get("gradient_checkpointing"):
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        if method != "full":
+            model.enable_input_require_grads()
+
+    params = [p for p in model.parameters() if p.requires_grad]
+    if request["optimizer"] == "sgd":
+        optimizer = torch.optim.SGD(params, lr=1e-4)
+    elif request["optimizer"] == "adamw_8bit":
+        from adam8bit import AdamW8bit
+        optimizer = AdamW8bit(params, lr=1e-4)
+    elif request["optimizer"] == "adafactor":
+        from transformers.optimization import Adafactor
+        optimizer = Adafactor(params, lr=1e-4, scale_parameter=False, relative_step=False)
+    else:
+        optimizer = torch.optim.AdamW(params, lr=1e-4)
+
+    input_ids = torch.randint(0, config.vocab_size, (request["micro_batch"], request["seq_len"]), device=device)
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+        baseline = 0
+    batch = {"input_ids": input_ids, "labels": input_ids}
+    # 三步: 第一步分配优化器状态，耗时取后两步的平均
+    step_times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        if request.get("loss_chunk_size"):
+            from chunked_loss import causal_lm_loss
+            loss = causal_lm_loss(model, batch, request["loss_chunk_size"])
+        else:
+            loss = model(**batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        step_times.append(time.perf_counter() - start)
+
+    peak = torch.cuda.max_memory_allocated() if device == "cuda" else _max_rss_bytes() - baseline
+    print(json.dumps({"peak_bytes": peak, "step_time": sum(step_times[1:]) / 2}))
+
+def run_plan(args):
+    model_name = args.model_name or model_options[args.model_size]["name"]
+    shape = load_model_shape(model_name)
+    device = args.device if args.device != "auto" else detect_device_type()
+    effective_batch = args.batch_size * args.gradient_accumulation_steps
+    target_modules = args.lora_target_modules.split(",") if args.lora_target_modules else None
+    precisions = args.precisions.split(",") if args.precisions else None
+    loss_chunk_size = args.loss_chunk_size if args.chunked_loss else None
+    estimate_kwargs = {"lora_r": args.lora_r, "target_modules": target_modules,
+                       "quant_bits": args.quant_bits, "quant_group_size": args.quant_group_size,
+                       "gradient_checkpointing": args.gradient_checkpointing, "loss_chunk_size": loss_chunk_size}
+
+    print(f"模型: {model_name} ({shape.model_type}, hidden={shape.hidden_size}, layers={shape.num_layers}, "
+          f"vocab={shape.vocab_size})")
+    print(f"方法: {args.method}, 设备: {device}, 优化器: {args.optimizer}, 序列长度: {args.max_length}, "
+          f"有效批大小: {effective_batch}, 预算: {args.budget_gb}GB")
+
+    best, candidates = plan(shape, args.method, args.max_length, args.budget_gb, effective_batch, device,
+                            args.optimizer, args.overhead_gb, args.safety_margin, precisions, **estimate_kwargs)
+    for candidate in candidates:
+        print(f"\n{candidate['precision']}: micro-batch {candidate['micro_batch']} × "
+              f"累积 {candidate['gradient_accumulation_steps']}")
+        print_estimate(candidate["estimate"])
+
+    if best is None:
+        minimum = min(estimate_memory(shape, args.method, args.max_length, 1, p, args.optimizer, **estimate_kwargs)["total"]
+                      for p in precisions or DEVICE_PRECISIONS[device])
+        print(f"\n❌ 预算内放不下micro-batch=1 (至少需要约 "
+              f"{format_gb(minimum / (1 - args.safety_margin) + args.overhead_gb * GB)})，"
+              f"请减小 --max_length、改用 lora/qlora 或启用 --gradient_checkpointing/--chunked_loss")
+        return None
+
+    if args.probe:
+        usable = (args.budget_gb - args.overhead_gb) * GB
+        for micro_batch in divisors_desc(best["micro_batch"]):
+            print(f"\n探测: {best['precision']} micro-batch {micro_batch} ...")
+            result = probe(model_name, args.method, args.max_length, micro_batch, best["precision"], args.optimizer,
+                           device, args.quant_bits, args.quant_group_size, args.lora_r, target_modules,
+                           args.gradient_checkpointing, loss_chunk_size)
+            if result is None:
+                print("⚠️ 探测运行失败，保留估算结果")
+                break
+            peak = result["peak_bytes"]
+            estimate = estimate_memory(shape, args.method, args.max_length, micro_batch, best["precision"],
+                                       args.optimizer, **estimate_kwargs)["total"]
+            print(f"实测峰值 {format_gb(peak)}, 估算 {format_gb(estimate)}, 单步 {result['step_time']:.2f}s")
+            if peak <= usable:
+                best["micro_batch"] = micro_batch
+                best["gradient_accumulation_steps"] = effective_batch // micro_batch
+                best["probed_peak_bytes"] = peak
+                break
+            print("⚠️ 实测超出预算，尝试更小的micro-batch")
+        else:
+            print("❌ 实测即使micro-batch=1也超出预算")
+            return None
+
+    print(f"\n✅ 推荐: {best['precision']}, --batch_size {best['micro_batch']} "
+          f"--gradient_accumulation_steps {best['gradient_accumulation_steps']}")
+    if best["precision"] != TRAIN_PRECISION[device]:
+        print(f"提示: train_instruction.py在{device}上使用{TRAIN_PRECISION[device]}，"
+              f"推荐的{best['precision']}需要相应修改训练精度")
+    return best
+
+def self_test():
+    """微型Llama配置: 比较估算与实测峰值，并检查规划逻辑"""
+    import tempfile
+    from tiny_model import build_tiny_model
+
+    model, _ = build_tiny_model(hidden_size=256, num_layers=4, num_heads=8, num_kv_heads=4, intermediate_size=688)
+    shape = ModelShape.from_config(model.config)
+    ok = True
+    with tempfile.TemporaryDirectory() as model_dir:
+        model.config.save_pretrained(model_dir)
+        print(f"{'方法':<6} {'batch':>5} {'估算':>9} {'实测':>9} {'比值':>6}")
+        for method in ["full", "lora", "qlora"]:
+            for micro_batch in [2, 8]:
+                estimate = estimate_memory(shape, method, 256, micro_batch)["total"]
+                result = probe(model_dir, method, 256, micro_batch, "fp32", "adamw", "cpu")
+                if result is None:
+                    return False
+                peak = result["peak_bytes"]
+                ratio = estimate / peak
+                print(f"{method:<6} {micro_batch:>5} {format_gb(estimate):>9} {format_gb(peak):>9} {ratio:>6.2f}")
+                # RSS包含分配器缓存，只要求估算在同一数量级
+                ok = ok and 0.5 <= ratio <= 2.0
+
+    # 规划: micro-batch整除有效批大小，预算越大micro-batch不减小，qlora不多于lora
+    previous = 0
+    for budget in [0.6, 0.8, 1.0, 2.0]:
+        best, _ = plan(shape, "lora", 256, budget, 16, overhead_gb=0.3)
+        micro_batch = best["micro_batch"] if best else 0
+        ok = ok and micro_batch >= previous and (micro_batch == 0 or 16 % micro_batch == 0)
+        previous = micro_batch
+    lora = estimate_memory(shape, "lora", 256, 4)["total"]
+    qlora = estimate_memory(shape, "qlora", 256, 4)["total"]
+    full = estimate_memory(shape, "full", 256, 4)["total"]
+    ok = ok and qlora < full and lora < full
+    tiny = load_model_shape("TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    print(f"TinyLlama参数量估算: {tiny.total_params() / 1e9:.3f}B")
+    ok = ok and abs(tiny.total_params() / 1.1e9 - 1) < 0.05
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="训练前的显存/内存预算规划")
+    parser.add_argument("--model_size", type=str, default="small", choices=["tiny", "small", "medium"])
+    parser.add_argument("--model_name", type=str, default=None, help="覆盖模型名或本地模型目录")
+    parser.add_argument("--method", type=str, default="lora", choices=["full", "lora", "qlora"])
+    parser.add_argument("--max_length", type=int, default=512, help="序列长度")
+    parser.add_argument("--batch_size", type=int, default=4, help="当前micro-batch (与累积步数相乘得到有效批大小)")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=4)
+    parser.add_argument("--optimizer", type=str, default="adamw", choices=list(OPTIMIZER_STATES))
+    parser.add_argument("--budget_gb", type=float, default=16.0, help="可用显存/内存 (GB)")
+    parser.add_argument("--overhead_gb", type=float, default=0.5, help="框架/CUDA上下文等固定开销 (GB)")
+    parser.add_argument("--safety_margin", type=float, default=0.1, help="预算中预留的比例")
+    parser.add_argument("--device", type=str, default="auto", choices=["auto", "cpu", "mps", "cuda"])
+    parser.add_argument("--precisions", type=str, default=None, help="逗号分隔的候选精度 (默认按设备)")
+    parser.add_argument("--lora_r", type=int, default=None)
+    parser.add_argument("--lora_target_modules", type=str, default=None)
+    parser.add_argument("--quant_bits", type=int, default=4, choices=[4, 8])
+    parser.add_argument("--quant_group_size", type=int, default=64)
+    parser.add_argument("--gradient_checkpointing", action="store_true", help="按启用梯度检查点估算")
+    parser.add_argument("--chunked_loss", action="store_true", help="按分块交叉熵损失估算")
+    parser.add_argument("--loss_chunk_size", type=int, default=1024, help="分块损失每块的token数")
+    parser.add_argument("--probe", action="store_true", help="用随机初始化模型实际跑一步确认峰值")
+    parser.add_argument("--probe_worker", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用微型模型配置自检")
+    args = parser.parse_args()
+
+    if args.probe_worker:
+        probe_worker(json.loads(args.probe_worker))
+        return
+    if args.self_test:
+        if not self_test():
+            print("❌ 内存规划自检失败")
+            raise SystemExit(1)
+        print("✅ 内存规划自检通过")
+        return
+    if run_plan(args) is None:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
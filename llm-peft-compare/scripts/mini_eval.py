@@ -0,0 +1,638 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线的轻量评估工具: 从本地JSONL读取任务，不依赖lm-evaluation-harness或联网下载数据集
+
+- 任务文件: data/eval_tasks/{task}.jsonl (评估样本) 和可选的 {task}.fewshot.jsonl (few-shot样本池)
+  hellaswag / mmlu_high_school_computer_science / gsm8k 直接使用HF数据集的原始字段
+  (可在联网机器上用 --export_tasks 导出)，prompt与lm-eval的任务配置一致;
+  其他任务使用通用格式: 多选 {"query", "choices", "gold"}，生成 {"query", "answer"}
+- 多选题: 所有 (上下文, 选项) 请求按总长度降序分批，右侧padding后一次前向
+  (--shared_prefix 时改用prefix_scoring.py按上下文复用KV缓存)，可选log-likelihood缓存
+- 生成题: generation_engine.py 批量贪心解码，增量检查停止串，结束的行立即换入新题目;
+  --draft_model 时改为逐题投机解码 (speculative.py，结果相同)
+- few-shot: 每个任务用固定种子抽取一组示例，示例前缀只编码一次，各题拼接自己的编码
+  (与lm-eval每题重新抽样不同，但各模型看到的prompt完全相同)
+- 输出与 eval_results/ 中lm-eval结果文件相同的JSON结构，analyze_results.py可直接读取
+
+用法:
+  python scripts/mini_eval.py --model_path models/tinyllama_1.1b-instruction-lora-merged \\
+      --tasks hellaswag,gsm8k,mmlu_high_school_computer_science \\
+      --output_file results/model_comparison/tinyllama_1.1b_lora_merged.json
+  # 在联网机器上导出任务文件
+  python scripts/mini_eval.py --export_tasks --tasks hellaswag,gsm8k,mmlu_high_school_computer_science
+  # CPU自检: 随机微型模型 + 合成任务文件
+  python scripts/mini_eval.py --self_test
+"""
+
+import os
+import re
+import json
+import math
+import time
+import random
+import argparse
+import tempfile
+from dataclasses import dataclass, field
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+TASK_DIR = os.path.join(PROJECT_ROOT, "data", "eval_tasks")
+
+FEWSHOT_SEED = 1234
+
+
+@dataclass
+class TaskSpec:
+    """一个任务的prompt和指标配置 (对应lm-eval任务YAML中的字段)"""
+    name: str
+    output_type: str
+    version: float = 0.0
+    num_fewshot: int = 0
+    description: str = ""
+    target_delimiter: str = " "
+    fewshot_delimiter: str = "\n\n"
+    until: list = field(default_factory=list)
+    max_gen_toks: int = 256
+    # HF数据集 (导出任务文件时使用): (路径, 子集, 评估split, few-shot split)
+    dataset: tuple = None
+    # 原始样本 -> 通用格式
+    to_doc: object = None
+
+    @property
+    def metrics(self):
+        if self.output_type == "generate_until":
+            return ["exact_match"]
+        return ["acc", "acc_norm"] if self.name == "hellaswag" else ["acc"]
+
+def _hellaswag_preprocess(text):
+    text = text.strip()
+    text = text.replace(" [title]", ". ")
+    text = re.sub("\\[.*?\\]", "", text)
+    return text.replace("  ", " ")
+
+def _hellaswag_doc(doc):
+    ctx = doc["ctx_a"] + " " + doc["ctx_b"].capitalize()
+    return {"query": _hellaswag_preprocess(doc["activity_label"] + ": " + ctx),
+            "choices": [_hellaswag_preprocess(ending) for ending in doc["endings"]],
+            "gold": int(doc["label"])}
+
+def _mmlu_doc(doc):
+    options = "".join(f"\n{letter}. {choice}" for letter, choice in zip("ABCD", doc["choices"]))
+    return {"query": f"{doc['question'].strip()}{options}\nAnswer:", "choices": list("ABCD"), "gold": int(doc["answer"])}
+
+def _gsm8k_doc(doc):
+    return {"query": f"Question: {doc['question']}\nAnswer:", "answer": doc["answer"]}
+
+def _generic_doc(doc):
+    return doc
+
+TASKS = {
+    "hellaswag": TaskSpec("hellaswag", "multiple_choice", version=1.0, dataset=("Rowan/hellaswag", None, "validation", "train"),
+                          to_doc=_hellaswag_doc),
+    "mmlu_high_school_computer_science": TaskSpec(
+        "mmlu_high_school_computer_science", "multiple_choice", version=1.0,
+        description="The following are multiple choice questions (with answers) about high school computer science.\n\n",
+        dataset=("cais/mmlu", "high_school_computer_science", "test", "dev"), to_doc=_mmlu_doc),
+    "gsm8k": TaskSpec("gsm8k", "generate_until", version=3.0, num_fewshot=5,
+                      until=["Question:", "</s>", "<|im_end|>"], dataset=("gsm8k", "main", "test", "train"),
+                      to_doc=_gsm8k_doc),
+}
+
+# GSM8K答案抽取 (与lm-eval gsm8k.yaml的过滤器一致)
+STRICT_ANSWER = re.compile(r"#### (\-?[0-9\.\,]+)")
+FLEXIBLE_ANSWER = re.compile(r"(-?[$0-9.,]{2,})|(-?[0-9]+)")
+IGNORE_PATTERNS = [re.compile(pattern) for pattern in [",", "\\$", "(?s).*#### ", "\\.$"]]
+INVALID_ANSWER = "[invalid]"
+
+
+def get_task_spec(name):
+    """内置任务返回其配置; 其他任务按本地文件的第一行推断为多选或生成任务"""
+    if name in TASKS:
+        return TASKS[name]
+    return TaskSpec(name, "multiple_choice", to_doc=_generic_doc)
+
+def load_task_docs(spec, task_dir, limit=None):
+    """返回 (评估样本, few-shot样本池)，都已转换为通用格式"""
+    def read(path):
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [spec.to_doc(json.loads(line)) for line in f if line.strip()]
+
+    path = os.path.join(task_dir, f"{spec.name}.jsonl")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"任务文件不存在: {path} (可在联网机器上用 --export_tasks 导出)")
+    docs = read(path)
+    if spec.name not in TASKS and docs and "choices" not in docs[0]:
+        spec.output_type = "generate_until"
+    pool = read(os.path.join(task_dir, f"{spec.name}.fewshot.jsonl"))
+    if limit is not None:
+        docs = docs[:int(limit) if limit >= 1 else max(1, int(len(docs) * limit))]
+    return docs, pool
+
+def doc_target(spec, doc):
+    return doc["choices"][doc["gold"]] if spec.output_type == "multiple_choice" else doc["answer"]
+
+def build_fewshot_prefix(spec, docs, pool, num_fewshot, seed=FEWSHOT_SEED):
+    """固定的few-shot前缀 (任务描述 + 示例)，返回 (前缀, 评估样本)
+
+    没有few-shot样本池时从评估样本中抽取示例，并把它们从评估样本中移除
+    """
+    if num_fewshot <= 0:
+        return spec.description, docs
+    if not pool:
+        print(f"⚠️ {spec.name} 没有few-shot样本池，从评估样本中取 {num_fewshot} 条作示例")
+        pool, docs = docs[:num_fewshot], docs[num_fewshot:]
+    shots = random.Random(seed).sample(pool, min(num_fewshot, len(pool)))
+    examples = [doc["query"] + spec.target_delimiter + doc_target(spec, doc) for doc in shots]
+    return spec.description + spec.fewshot_delimiter.join(examples) + spec.fewshot_delimiter, docs
+
+class PromptEncoder:
+    """编码 (上下文, 续写) 请求，分词方式与lm-eval HFLM._encode_pair一致
+
+    同一任务的上下文都以相同的few-shot前缀开头: 前缀只编码一次并缓存，题目部分在前缀的最后一个字符
+    (分隔符中的换行) 之后单独编码再拼接。每个前缀第一次使用时与整体编码比较，不一致时回退到整体编码。
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.prefix_cache = {}
+        self.splice_ok = {}
+        self.cache_hits = 0
+
+    def encode(self, text):
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def _encode_after(self, anchor, text):
+        """text接在anchor之后时的编码"""
+        return self.encode(anchor + text)[len(self.encode(anchor)):]
+
+    def encode_pair(self, prefix, query, continuation):
+        context = prefix + query
+        n_spaces = len(context) - len(context.rstrip())
+        if n_spaces > 0:
+            continuation = context[-n_spaces:] + continuation
+            context = context[:-n_spaces]
+            query = query[:len(query) - n_spaces] if n_spaces <= len(query) else ""
+
+        if prefix and self.splice_ok.get(prefix, True) and len(context) > len(prefix):
+            if prefix in self.prefix_cache:
+                self.cache_hits += 1
+            else:
+                self.prefix_cache[prefix] = self.encode(prefix)
+            prefix_enc = self.prefix_cache[prefix]
+            anchor = prefix[-1]
+            query_enc = self._encode_after(anchor, query)
+            whole_enc = self._encode_after(anchor, query + continuation)
+            context_enc = prefix_enc + query_enc
+            continuation_enc = whole_enc[len(query_enc):]
+            if prefix not in self.splice_ok:
+                joint_context, joint_continuation = self._encode_joint(context, continuation)
+                self.splice_ok[prefix] = (context_enc, continuation_enc) == (joint_context, joint_continuation)
+                if not self.splice_ok[prefix]:
+                    print("⚠️ 分词器在前缀边界处的拼接编码与整体编码不一致，改用整体编码")
+                    return joint_context, joint_continuation
+            return context_enc, continuation_enc
+        return self._encode_joint(context, continuation)
+
+    def _encode_joint(self, context, continuation):
+        whole_enc = self.encode(context + continuation)
+        context_enc = self.encode(context)
+        return context_enc, whole_enc[len(context_enc):]
+
+def score_loglikelihood(model, requests, batch_size=16, max_length=2048, pad_token_id=0):
+    """requests: [(context_enc, continuation_enc)] -> [(logprob, is_greedy)]
+
+    去重后按总长度降序分批 (每批长度相近，padding少)，右侧padding，因果注意力下padding不影响有效位置
+    """
+    import torch
+    import torch.nn.functional as F
+
+    device = next(model.parameters()).device
+    unique = list(dict.fromkeys((tuple(context), tuple(continuation)) for context, continuation in requests))
+    unique.sort(key=lambda pair: -(len(pair[0]) + len(pair[1])))
+
+    scores = {}
+    with torch.no_grad():
+        for start in range(0, len(unique), batch_size):
+            batch = unique[start:start + batch_size]
+            # 与lm-eval相同: 左截断到max_length，最后一个token不作为输入
+            inputs = [(list(context) + list(continuation))[-(max_length + 1):][:-1] for context, continuation in batch]
+            width = max(len(ids) for ids in inputs)
+            input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+            for row, ids in enumerate(inputs):
+                input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+                attention_mask[row, :len(ids)] = 1
+            logits = model(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device)).logits
+
+            for row, (pair, ids) in enumerate(zip(batch, inputs)):
+                continuation = torch.tensor(pair[1], dtype=torch.long, device=device)
+                logprobs = F.log_softmax(logits[row, len(ids) - len(continuation):len(ids)].float(), dim=-1)
+                total = logprobs.gather(-1, continuation.unsqueeze(-1)).sum()
+                scores[pair] = (float(total), bool((logprobs.argmax(dim=-1) == continuation).all()))
+    return [scores[(tuple(context), tuple(continuation))] for context, continuation in requests]
+
+def extract_answers(text):
+    """GSM8K的两种答案抽取: strict-match (#### 后的数字) 和 flexible-extract (最后一个数字)"""
+    strict = STRICT_ANSWER.findall(text)
+    flexible = FLEXIBLE_ANSWER.findall(text)
+    return {
+        "strict-match": strict[0].strip() if strict else INVALID_ANSWER,
+        "flexible-extract": next((group for group in flexible[-1] if group), INVALID_ANSWER).strip() if flexible
+        else INVALID_ANSWER
+    }
+
+def normalize_answer(text):
+    """exact_match比较前的处理 (ignore_case + regexes_to_ignore)"""
+    for pattern in IGNORE_PATTERNS:
+        text = pattern.sub("", text)
+    return text.lower()
+
+def mean_stderr(values):
+    if len(values) < 2:
+        return 0.0
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((value - mean) ** 2 for value in values) / (len(values) - 1) / len(values))
+
+class MiniEvaluator:
+    """在同一进程内加载模型并依次评估本地任务"""
+
+    def __init__(self, model, tokenizer, batch_size=16, max_length=None, shared_prefix=False, cache=None,
+                 fingerprint=None, speculative=None):
+        """speculative: 可选的 speculative.SpeculativeDecoder，用于生成任务"""
+        self.model = model
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.max_length = max_length or getattr(model.config, "max_position_embeddings", 2048)
+        self.encoder = PromptEncoder(tokenizer)
+        self.shared_prefix = shared_prefix
+        self.cache = cache
+        self.fingerprint = fingerprint
+        self.speculative = speculative
+
+    def loglikelihood(self, requests):
+        """requests: [(上下文文本, 续写文本, context_enc, continuation_enc)]"""
+        from loglik_cache import request_key
+
+        keys = [request_key(context, continuation) for context, continuation, _, _ in requests]
+        cached = self.cache.get_many(self.fingerprint, keys) if self.cache else {}
+        pending = [index for index, key in enumerate(keys) if key not in cached]
+        if pending:
+            if self.shared_prefix:
+                from prefix_scoring import PrefixScorer
+                scorer = PrefixScorer(self.model, self.max_length, self.batch_size)
+                scores = scorer.score_requests([(None, requests[i][2], requests[i][3]) for i in pending])
+            else:
+                scores = score_loglikelihood(self.model, [(requests[i][2], requests[i][3]) for i in pending],
+                                             self.batch_size, self.max_length, self.tokenizer.pad_token_id or 0)
+            computed = {keys[i]: score for i, score in zip(pending, scores)}
+            if self.cache:
+                self.cache.put_many(self.fingerprint, [(key, lp, greedy) for key, (lp, greedy) in computed.items()])
+            cached.update(computed)
+        return [cached[key] for key in keys]
+
+    def evaluate_multiple_choice(self, spec, docs, prefix):
+        requests = []
+        for doc in docs:
+            for choice in doc["choices"]:
+                continuation = spec.target_delimiter + choice
+                context_enc, continuation_enc = self.encoder.encode_pair(prefix, doc["query"], continuation)
+                requests.append((prefix + doc["query"], continuation, context_enc, continuation_enc))
+        scores = iter(self.loglikelihood(requests))
+
+        per_doc = {"acc,none": [], "acc_norm,none": []}
+        for doc in docs:
+            logprobs = [next(scores)[0] for _ in doc["choices"]]
+            # acc_norm: 按选项的字符数归一化 (与lm-eval一致，不含分隔符)
+            lengths = [len(choice) for choice in doc["choices"]]
+            per_doc["acc,none"].append(float(max(range(len(logprobs)), key=logprobs.__getitem__) == doc["gold"]))
+            normalized = [lp / length for lp, length in zip(logprobs, lengths)]
+            per_doc["acc_norm,none"].append(float(max(range(len(normalized)), key=normalized.__getitem__) == doc["gold"]))
+        if "acc_norm" not in spec.metrics:
+            per_doc.pop("acc_norm,none")
+        return per_doc
+
+    def evaluate_generation(self, spec, docs, prefix):
+        from generation_engine import GenerationEngine
+
+        prompts = [self.encoder.encode_pair(prefix, doc["query"], "")[0] for doc in docs]
+        if self.speculative is not None:
+            limit = max(1, self.max_length - spec.max_gen_toks)
+            completions = [self.speculative.generate_text(prompt[-limit:], spec.max_gen_toks, spec.until)
+                           for prompt in prompts]
+        else:
+            engine = GenerationEngine(self.model, self.tokenizer, self.batch_size, max_length=self.max_length)
+            completions = engine.generate(prompts, spec.until, spec.max_gen_toks)
+
+        per_doc = {"exact_match,strict-match": [], "exact_match,flexible-extract": []}
+        for doc, completion in zip(docs, completions):
+            target = normalize_answer(doc["answer"])
+            for filter_name, answer in extract_answers(completion).items():
+                per_doc[f"exact_match,{filter_name}"].append(float(normalize_answer(answer) == target))
+        return per_doc
+
+    def evaluate_task(self, name, task_dir=TASK_DIR, num_fewshot=None, limit=None):
+        """返回 (lm-eval格式的任务结果, 任务配置, 样本数, TaskSpec)"""
+        spec = get_task_spec(name)
+        docs, pool = load_task_docs(spec, task_dir, limit)
+        num_fewshot = spec.num_fewshot if num_fewshot is None else num_fewshot
+        original = len(docs)
+        prefix, docs = build_fewshot_prefix(spec, docs, pool, num_fewshot)
+
+        if spec.output_type == "multiple_choice":
+            per_doc = self.evaluate_multiple_choice(spec, docs, prefix)
+        else:
+            per_doc = self.evaluate_generation(spec, docs, prefix)
+
+        results = {"alias": name}
+        for key, values in per_doc.items():
+            metric, filter_name = key.split(",", 1)
+            results[key] = sum(values) / max(len(values), 1)
+            results[f"{metric}_stderr,{filter_name}"] = mean_stderr(values)
+        config = {
+            "task": name,
+            "dataset_path": os.path.join(task_dir, f"{name}.jsonl"),
+            "description": spec.description,
+            "target_delimiter": spec.target_delimiter,
+            "fewshot_delimiter": spec.fewshot_delimiter,
+            "num_fewshot": num_fewshot,
+            "output_type": spec.output_type,
+            "metric_list": [{"metric": metric, "aggregation": "mean", "higher_is_better": True} for metric in spec.metrics],
+            "metadata": {"version": spec.version}
+        }
+        if spec.output_type == "generate_until":
+            config["generation_kwargs"] = {"until": spec.until, "do_sample": False, "max_gen_toks": spec.max_gen_toks}
+        return results, config, {"original": original, "effective": len(docs)}, spec
+
+def load_model(model_path, peft=None, device="cpu", dtype="auto"):
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    torch_dtype = {"auto": "auto", "float32": torch.float32, "float16": torch.float16,
+                   "bfloat16": torch.bfloat16}[dtype]
+    adapter_config = os.path.join(model_path, "adapter_config.json")
+    if peft is None and os.path.exists(adapter_config):
+        # 传入的是适配器目录: 从适配器配置中找到基础模型
+        with open(adapter_config) as f:
+            model_path, peft = json.load(f)["base_model_name_or_path"], model_path
+    from quantize_export import is_quantized_dir, load_quantized
+    if peft is None and is_quantized_dir(model_path):
+        # quantize_export.py导出的int8/int4模型
+        model = load_quantized(model_path, device, None if dtype == "auto" else torch_dtype)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_path, dtype=torch_dtype).to(device)
+    if peft:
+        from peft import PeftModel
+        model = PeftModel.from_pretrained(model, peft)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
+    return model, tokenizer
+
+def evaluate(model, tokenizer, tasks, task_dir=TASK_DIR, num_fewshot=None, limit=None, batch_size=16,
+             max_length=None, shared_prefix=False, cache=None, fingerprint=None, model_name="model", model_args="",
+             device="cpu", speculative=None):
+    """评估多个任务，返回与lm-eval结果文件相同结构的字典"""
+    import transformers
+
+    start = time.perf_counter()
+    evaluator = MiniEvaluator(model, tokenizer, batch_size, max_length, shared_prefix, cache, fingerprint,
+                              speculative)
+    output = {key: {} for key in ["results", "group_subtasks", "configs", "versions", "n-shot", "higher_is_better",
+                                  "n-samples"]}
+    for name in tasks:
+        task_start = time.perf_counter()
+        results, config, n_samples, spec = evaluator.evaluate_task(name, task_dir, num_fewshot, limit)
+        output["results"][name] = results
+        output["group_subtasks"][name] = []
+        output["configs"][name] = config
+        output["versions"][name] = spec.version
+        output["n-shot"][name] = config["num_fewshot"]
+        output["higher_is_better"][name] = {metric: True for metric in spec.metrics}
+        output["n-samples"][name] = n_samples
+        summary = ", ".join(f"{key} {value * 100:.2f}%" for key, value in results.items()
+                            if key != "alias" and "_stderr" not in key)
+        print(f"✓ {name} ({n_samples['effective']} 个样本, {time.perf_counter() - task_start:.1f}s): {summary}")
+
+    end = time.perf_counter()
+
+    def special(token):
+        return [token, str(tokenizer.convert_tokens_to_ids(token))] if token else None
+    output["config"] = {
+        "model": "mini_eval",
+        "model_args": model_args,
+        "model_num_parameters": sum(param.numel() for param in model.parameters()),
+        "model_dtype": str(next(model.parameters()).dtype),
+        "batch_size": str(batch_size),
+        "device": device,
+        "limit": limit,
+        "fewshot_seed": FEWSHOT_SEED
+    }
+    output.update({
+        "git_hash": None,
+        "date": time.time(),
+        "transformers_version": transformers.__version__,
+        "tokenizer_pad_token": special(tokenizer.pad_token),
+        "tokenizer_eos_token": special(tokenizer.eos_token),
+        "tokenizer_bos_token": special(tokenizer.bos_token),
+        "eot_token_id": tokenizer.eos_token_id,
+        "max_length": evaluator.max_length,
+        "task_hashes": {},
+        "model_source": "mini_eval",
+        "model_name": model_name,
+        "model_name_sanitized": model_name.replace("/", "__"),
+        "system_instruction": None,
+        "fewshot_as_multiturn": False,
+        "chat_template": None,
+        "start_time": start,
+        "end_time": end,
+        "total_evaluation_time_seconds": str(end - start),
+        "prompt_cache": {"prefix_encodings": len(evaluator.encoder.prefix_cache),
+                         "prefix_hits": evaluator.encoder.cache_hits}
+    })
+    if speculative is not None:
+        report = speculative.report()
+        output["speculative"] = {**report, "enabled": speculative.enabled, "num_speculative_tokens": speculative.k}
+        if speculative.enabled:
+            print(f"投机解码: 接受率 {report['acceptance_rate'] * 100:.1f}%, "
+                  f"每次目标前向 {report['tokens_per_target_forward']:.2f} tokens")
+    return output
+
+def export_tasks(tasks, task_dir=TASK_DIR):
+    """在联网机器上把HF数据集导出为本地任务文件 (保留原始字段)"""
+    from datasets import load_dataset
+
+    os.makedirs(task_dir, exist_ok=True)
+    for name in tasks:
+        spec = TASKS[name]
+        path, subset, eval_split, fewshot_split = spec.dataset
+        for split, suffix in [(eval_split, ""), (fewshot_split, ".fewshot")]:
+            dataset = load_dataset(path, subset, split=split)
+            output = os.path.join(task_dir, f"{name}{suffix}.jsonl")
+            with open(output, 'w') as f:
+                for row in dataset:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            print(f"✓ 导出 {name} ({split}, {len(dataset)} 条) -> {output}")
+
+def _write_synthetic_tasks(task_dir, num_docs=24, seed=0):
+    """按三个内置任务的原始字段格式生成合成样本"""
+    rng = random.Random(seed)
+    words = "the a cat dog runs jumps over under quickly slowly red blue house tree river".split()
+    sentence = lambda n: " ".join(rng.choice(words) for _ in range(n))
+    rows = {
+        "hellaswag.jsonl": [{"activity_label": "Walking", "ctx_a": sentence(20), "ctx_b": sentence(8),
+                             "endings": [sentence(rng.randint(4, 10)) + " [title] end" for _ in range(4)],
+                             "label": str(rng.randint(0, 3))} for _ in range(num_docs)],
+        "mmlu_high_school_computer_science.jsonl": [{"question": sentence(15) + "?", "choices": [sentence(3) for _ in range(4)],
+                                                      "answer": rng.randint(0, 3)} for _ in range(num_docs)],
+        "gsm8k.jsonl": [], "gsm8k.fewshot.jsonl": []
+    }
+    for key in ["gsm8k.jsonl", "gsm8k.fewshot.jsonl"]:
+        for _ in range(num_docs // 3 if key == "gsm8k.jsonl" else 10):
+            a, b = rng.randint(1, 50), rng.randint(1, 50)
+            rows[key].append({"question": f"{sentence(6)} {a} and {b}. How many in total?",
+                              "answer": f"{sentence(5)} {a} + {b} = <<{a}+{b}={a + b}>>{a + b}\n#### {a + b}"})
+    os.makedirs(task_dir, exist_ok=True)
+    for filename, items in rows.items():
+        with open(os.path.join(task_dir, filename), 'w') as f:
+            for item in items:
+                f.write(json.dumps(item) + "\n")
+
+def self_test(work_dir):
+    """合成任务 + 随机微型模型: 检查打分/分词拼接/答案抽取的正确性、输出结构和耗时"""
+    import torch
+    from tiny_model import build_tiny_model
+    from prefix_scoring import PrefixScorer
+
+    task_dir = os.path.join(work_dir, "eval_tasks")
+    _write_synthetic_tasks(task_dir)
+    model, tokenizer = build_tiny_model(hidden_size=64, num_layers=2, seed=0)
+    ok = True
+
+    # 1) 按长度排序分批的打分与逐请求的朴素打分一致
+    encoder = PromptEncoder(tokenizer)
+    spec = TASKS["hellaswag"]
+    docs, _ = load_task_docs(spec, task_dir, limit=6)
+    requests = [encoder.encode_pair("", doc["query"], " " + choice) for doc in docs for choice in doc["choices"]]
+    batched = score_loglikelihood(model, requests, batch_size=5, pad_token_id=tokenizer.pad_token_id)
+    naive = PrefixScorer(model)
+    reference = [naive.score_naive(context, [continuation])[0] for context, continuation in requests]
+    max_diff = max(abs(a[0] - b[0]) for a, b in zip(batched, reference))
+    greedy_mismatch = sum(a[1] != b[1] for a, b in zip(batched, reference))
+    print(f"分批打分与逐请求打分: 最大差 {max_diff:.2e}, is_greedy不一致 {greedy_mismatch}")
+    ok = ok and max_diff < 1e-3 and greedy_mismatch == 0
+
+    # 2) few-shot前缀缓存的拼接编码与整体编码一致
+    spec = TASKS["gsm8k"]
+    docs, pool = load_task_docs(spec, task_dir)
+    prefix, docs = build_fewshot_prefix(spec, docs, pool, 5)
+    splice_ok = True
+    for doc in docs:
+        spliced = encoder.encode_pair(prefix, doc["query"], " " + doc["answer"])
+        splice_ok = splice_ok and spliced == encoder._encode_joint(prefix + doc["query"], " " + doc["answer"])
+    print(f"few-shot前缀拼接编码与整体编码一致: {splice_ok} (前缀缓存命中 {encoder.cache_hits} 次)")
+    ok = ok and splice_ok and encoder.cache_hits == len(docs) - 1
+
+    # 3) GSM8K答案抽取与exact_match
+    answers = extract_answers("She has 3 + 4 = 7 apples.\n#### 7")
+    flexible = extract_answers("The answer is $1,234.")
+    checks = answers == {"strict-match": "7", "flexible-extract": "7"} and flexible["strict-match"] == INVALID_ANSWER
+    checks = checks and normalize_answer(flexible["flexible-extract"]) == normalize_answer("so\n#### 1,234")
+    print(f"答案抽取: {answers}, {flexible} -> {'正确' if checks else '错误'}")
+    ok = ok and checks
+
+    # 4) 完整评估: 输出结构与eval_results中的lm-eval结果一致
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    output = evaluate(model, tokenizer, list(TASKS), task_dir, batch_size=16, model_name="tiny-random-llama")
+    elapsed = time.perf_counter() - start
+    print(f"三个任务评估用时: {elapsed:.1f}s")
+
+    reference_dir = os.path.join(PROJECT_ROOT, "eval_results")
+    with open(os.path.join(reference_dir, sorted(os.listdir(reference_dir))[0])) as f:
+        reference_output = json.load(f)
+    missing_fields = [key for key in ["results", "configs", "versions", "n-shot", "higher_is_better", "n-samples",
+                                      "config", "model_name", "total_evaluation_time_seconds"] if key not in output]
+    metric_keys_match = all(set(output["results"][task]) == set(reference_output["results"][task]) for task in TASKS)
+    print(f"结果字段缺失: {missing_fields or '无'}; 各任务指标键与eval_results一致: {metric_keys_match}")
+    ok = ok and not missing_fields and metric_keys_match and output["n-shot"] == reference_output["n-shot"]
+    return ok and elapsed < 120
+
+def main():
+    parser = argparse.ArgumentParser(description="离线的轻量评估工具 (本地JSONL任务文件)")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用随机微型模型和合成任务自检")
+    parser.add_argument("--export_tasks", action="store_true", help="从HF Hub导出任务文件到 --task_dir (需要联网)")
+    parser.add_argument("--model_path", type=str, default=None, help="模型目录或LoRA适配器目录")
+    parser.add_argument("--peft", type=str, default=None, help="可选的LoRA适配器目录")
+    parser.add_argument("--tasks", type=str, default="hellaswag,gsm8k,mmlu_high_school_computer_science")
+    parser.add_argument("--task_dir", type=str, default=TASK_DIR, help="本地任务文件目录")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="auto", choices=["auto", "float32", "float16", "bfloat16"])
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_length", type=int, default=None)
+    parser.add_argument("--num_fewshot", type=int, default=None, help="覆盖各任务的默认few-shot数")
+    parser.add_argument("--limit", type=float, default=None, help="每个任务最多评估的样本数 (<1时为比例)")
+    parser.add_argument("--shared_prefix", action="store_true", help="多选题按上下文复用KV缓存打分 (prefix_scoring.py)")
+    parser.add_argument("--cache_path", type=str, default=None, help="可选的log-likelihood缓存文件")
+    parser.add_argument("--output_file", type=str, default=None, help="结果JSON输出路径")
+    parser.add_argument("--draft_model", type=str, default=None,
+                        help="生成任务使用投机解码的草稿模型 (目录或tiny/small/medium)")
+    parser.add_argument("--num_speculative_tokens", type=int, default=4)
+    args = parser.parse_args()
+    tasks = [task.strip() for task in args.tasks.split(",") if task.strip()]
+
+    if args.self_test:
+        with tempfile.TemporaryDirectory() as work_dir:
+            ok = self_test(work_dir)
+        if not ok:
+            print("❌ 离线评估自检失败")
+            raise SystemExit(1)
+        print("✅ 离线评估自检通过")
+        return
+
+    if args.export_tasks:
+        export_tasks(tasks, args.task_dir)
+        return
+
+    if not args.model_path or not args.output_file:
+        parser.error("评估需要 --model_path 和 --output_file")
+
+    print(f"评估模型: {args.model_path}")
+    model, tokenizer = load_model(args.model_path, args.peft, args.device, args.dtype)
+    cache = fingerprint = None
+    if args.cache_path:
+        import hashlib
+        from eval_cache import fingerprint_model
+        from loglik_cache import LoglikCache
+        cache = LoglikCache(args.cache_path)
+        parts = [fingerprint_model(args.model_path)] + ([fingerprint_model(args.peft)] if args.peft else [])
+        parts.append(f"dtype={model.dtype},max_length={args.max_length}")
+        fingerprint = hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    speculative = None
+    if args.draft_model:
+        from speculative import SpeculativeDecoder, resolve_draft_model
+        draft_path = resolve_draft_model(args.draft_model)
+        print(f"草稿模型: {draft_path}")
+        draft, draft_tokenizer = load_model(draft_path, device=args.device, dtype=args.dtype)
+        speculative = SpeculativeDecoder(model, draft, tokenizer, args.num_speculative_tokens, draft_tokenizer)
+
+    model_args = f"pretrained={args.model_path},dtype={args.dtype}" + (f",peft={args.peft}" if args.peft else "")
+    output = evaluate(model, tokenizer, tasks, args.task_dir, args.num_fewshot, args.limit, args.batch_size,
+                      args.max_length, args.shared_prefix, cache, fingerprint, args.model_path, model_args, args.device,
+                      speculative)
+    if cache:
+        output["loglik_cache"] = {"model_fingerprint": fingerprint, "hits": cache.hits, "misses": cache.misses}
+        cache.close()
+
+    output_dir = os.path.dirname(args.output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output_file, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"✓ 评估结果已保存: {args.output_file}")
+
+if __name__ == "__main__":
+    main()
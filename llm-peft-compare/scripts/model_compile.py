@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+注意力实现选择 (eager / sdpa) 与 torch.compile
+
+- set_attn_implementation: 对已加载的模型 (包括PeftModel) 切换注意力实现
+- setup_compile_cache: inductor/triton的编译产物写到固定目录 (默认 results/compile_cache)，
+  FX图缓存和AOTAutograd缓存命中时，之后的运行只需要很少的编译时间
+- compile_for_inference: 只编译forward (generate仍然可用)，dynamic=True 避免每个新长度都重新编译
+
+训练时通过 train_instruction.py --attn_implementation sdpa --torch_compile 启用 (Trainer负责编译)，
+合并后的生成测试通过 save_merged_model.py 的同名参数启用。
+
+用法 (每种配置在独立子进程中运行，报告预热/编译耗时、稳定后的单步耗时和tokens/s;
+编译的配置运行两次，第二次使用第一次写入的编译缓存):
+  python scripts/model_compile.py --benchmark
+  python scripts/model_compile.py --self_test
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+COMPILE_CACHE_DIR = os.path.join(PROJECT_ROOT, "results", "compile_cache")
+ATTN_IMPLEMENTATIONS = ["eager", "sdpa"]
+
+
+def setup_compile_cache(cache_dir=None):
+    """设置编译缓存目录 (须在第一次编译之前调用)，返回绝对路径"""
+    import torch._functorch.config as functorch_config
+    import torch._inductor.config as inductor_config
+
+    cache_dir = os.path.abspath(cache_dir or COMPILE_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(cache_dir, "triton"))
+    inductor_config.fx_graph_cache = True
+    # 训练图 (前向+反向) 的缓存
+    functorch_config.enable_autograd_cache = True
+    return cache_dir
+
+def set_attn_implementation(model, attn_implementation):
+    """切换注意力实现; attn_implementation为None时保持模型默认 (transformers默认使用sdpa)"""
+    if not attn_implementation:
+        return model
+    base = model.get_base_model() if hasattr(model, "get_base_model") else model
+    base.set_attn_implementation(attn_implementation)
+    print(f"✓ 注意力实现: {attn_implementation}")
+    return model
+
+def compile_for_inference(model, mode=None, cache_dir=None):
+    """编译model.forward; 生成时KV缓存长度每步都在变化，使用动态形状"""
+    import torch
+
+    cache_dir = setup_compile_cache(cache_dir)
+    model.forward = torch.compile(model.forward, mode=mode, dynamic=True)
+    print(f"✓ torch.compile (mode={mode or 'default'}, 缓存: {cache_dir})")
+    return model
+
+def _median(values):
+    return sorted(values)[len(values) // 2]
+
+def benchmark_worker(request):
+    """--worker: 随机微型模型 + LoRA，测量训练步和贪心生成 (预热与稳定阶段分开计时)"""
+    import torch
+    from peft import LoraConfig, get_peft_model
+    from tiny_model import build_tiny_model
+
+    if request["compile"]:
+        setup_compile_cache(request["cache_dir"])
+    torch.manual_seed(0)
+    model, _ = build_tiny_model(hidden_size=request["hidden_size"], num_layers=request["num_layers"],
+                                intermediate_size=request["hidden_size"] * 2, seed=0)
+    model.set_attn_implementation(request["attn_implementation"])
+    batch_size, seq_len = request["batch_size"], request["seq_len"]
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(3, model.config.vocab_size, (batch_size, seq_len), generator=generator)
+    result = {}
+
+    # 训练: LoRA前向+反向+优化器更新 (与Trainer的torch_compile相同，编译整个模型)
+    peft_model = get_peft_model(model, LoraConfig(r=8, lora_alpha=16, lora_dropout=0.0, task_type="CAUSAL_LM",
+                                                  target_modules=["q_proj", "k_proj", "v_proj", "o_proj"]))
+    peft_model.train()
+    train_model = torch.compile(peft_model) if request["compile"] else peft_model
+    optimizer = torch.optim.AdamW([p for p in peft_model.parameters() if p.requires_grad], lr=1e-4)
+    timings, losses = [], []
+    for _ in range(request["train_steps"] + 1):
+        start = time.perf_counter()
+        loss = train_model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        timings.append(time.perf_counter() - start)
+        losses.append(loss.item())
+    result["train_warmup"] = timings[0]
+    result["train_step"] = _median(timings[1:])
+    result["train_tokens_per_second"] = batch_size * seq_len / result["train_step"]
+    result["first_loss"] = losses[0]
+
+    # 推理: 合并适配器后逐条贪心生成
+    model = peft_model.merge_and_unload().eval()
+    if request["compile"]:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    prompt = input_ids[:1, :request["prompt_len"]]
+    max_new_tokens = request["max_new_tokens"]
+    timings, outputs = [], []
+    with torch.no_grad():
+        for _ in range(request["generate_runs"] + 1):
+            start = time.perf_counter()
+            output = model.generate(prompt, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                                    do_sample=False, pad_token_id=0)
+            timings.append(time.perf_counter() - start)
+            outputs.append(output[0, prompt.shape[1]:].tolist())
+    result["generate_warmup"] = timings[0]
+    result["generate_tokens_per_second"] = max_new_tokens / _median(timings[1:])
+    result["generated"] = outputs[-1]
+    print(json.dumps(result))
+
+def run_worker(request):
+    """在子进程中运行一种配置 (编译状态互不影响)，失败时返回None"""
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(request)],
+                            capture_output=True, text=True, cwd=SCRIPT_DIR)
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    print(result.stdout[-2000:])
+    print(result.stderr[-2000:])
+    return None
+
+def benchmark(cache_dir=None, attn_implementations=None, hidden_size=256, num_layers=2, batch_size=4, seq_len=128,
+              train_steps=5, prompt_len=32, max_new_tokens=32, generate_runs=3):
+    """每种 (注意力实现, 是否编译) 配置的训练/生成耗时; 编译的配置运行两次 (冷缓存/热缓存)"""
+    cache_dir = os.path.abspath(cache_dir or COMPILE_CACHE_DIR)
+    base_request = {"hidden_size": hidden_size, "num_layers": num_layers, "batch_size": batch_size,
+                    "seq_len": seq_len, "train_steps": train_steps, "prompt_len": prompt_len,
+                    "max_new_tokens": max_new_tokens, "generate_runs": generate_runs, "cache_dir": cache_dir}
+    results = {}
+    for attn_implementation in attn_implementations or ATTN_IMPLEMENTATIONS:
+        for compiled in (False, True):
+            for run in range(2 if compiled else 1):
+                label = f"{attn_implementation}{' + compile' if compiled else ''}"
+                if compiled:
+                    label += " (热缓存)" if run else " (首次)"
+                print(f"运行: {label} ...", flush=True)
+                result = run_worker(dict(base_request, attn_implementation=attn_implementation, compile=compiled))
+                if result is None:
+                    print(f"⚠️ {label} 运行失败")
+                    continue
+                results[label] = result
+
+    print(f"\n微型Llama (hidden={hidden_size}, layers={num_layers}), 训练 batch={batch_size} seq={seq_len}, "
+          f"生成 {max_new_tokens} tokens, 编译缓存: {cache_dir}")
+    print(f"{'配置':<24} {'训练预热':>9} {'训练单步':>9} {'训练tokens/s':>12} {'生成预热':>9} {'生成tokens/s':>12}")
+    for label, result in results.items():
+        print(f"{label:<24} {result['train_warmup']:>8.2f}s {result['train_step'] * 1000:>7.1f}ms "
+              f"{result['train_tokens_per_second']:>12.0f} {result['generate_warmup']:>8.2f}s "
+              f"{result['generate_tokens_per_second']:>12.1f}")
+    return results
+
+def self_test():
+    """各配置的损失和贪心生成一致; 热缓存时编译的预热耗时低于首次"""
+    with tempfile.TemporaryDirectory() as cache_dir:
+        results = benchmark(cache_dir, hidden_size=128, seq_len=64, train_steps=3, max_new_tokens=16,
+                            generate_runs=2)
+    if len(results) != 6:
+        return False
+    reference = results["eager"]
+    loss_diff = max(abs(result["first_loss"] - reference["first_loss"]) for result in results.values())
+    same_generation = all(result["generated"] == reference["generated"] for result in results.values())
+    print(f"\n各配置第一步损失最大差: {loss_diff:.2e}, 贪心生成一致: {same_generation}")
+    cache_ok = True
+    for attn_implementation in ATTN_IMPLEMENTATIONS:
+        cold = results[f"{attn_implementation} + compile (首次)"]
+        warm = results[f"{attn_implementation} + compile (热缓存)"]
+        print(f"{attn_implementation}: 编译预热 训练 {cold['train_warmup']:.1f}s -> {warm['train_warmup']:.1f}s, "
+              f"生成 {cold['generate_warmup']:.1f}s -> {warm['generate_warmup']:.1f}s")
+        cache_ok = cache_ok and warm["train_warmup"] < cold["train_warmup"]
+        cache_ok = cache_ok and warm["generate_warmup"] < cold["generate_warmup"]
+    return loss_diff < 1e-4 and same_generation and cache_ok
+
+def main():
+    parser = argparse.ArgumentParser(description="注意力实现与torch.compile基准")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用微型模型自检 (使用临时编译缓存)")
+    parser.add_argument("--benchmark", action="store_true", help="比较各配置的预热、单步耗时和tokens/s")
+    parser.add_argument("--cache_dir", type=str, default=None, help=f"编译缓存目录 (默认 {COMPILE_CACHE_DIR})")
+    parser.add_argument("--attn_implementations", type=str, default=",".join(ATTN_IMPLEMENTATIONS))
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seq_len", type=int, default=128)
+    parser.add_argument("--max_new_tokens", type=int, default=32)
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        benchmark_worker(json.loads(args.worker))
+        return
+
+    if args.self_test:
+        if not self_test():
+            print("❌ 注意力/编译自检失败")
+            raise SystemExit(1)
+        print("✅ 注意力/编译自检通过")
+        return
+
+    if not args.benchmark:
+        parser.print_help()
+        return
+    benchmark(args.cache_dir, [name.strip() for name in args.attn_implementations.split(",") if name.strip()],
+              args.hidden_size, args.num_layers, args.batch_size, args.seq_len, max_new_tokens=args.max_new_tokens)
+
+if __name__ == "__main__":
+    main()
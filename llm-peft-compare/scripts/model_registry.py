@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+进程级模型/分词器缓存
+
+超参数搜索或 训练→合并→评估 流程在同一进程内会多次加载同一个基础模型。
+ModelRegistry 在第一次加载时保留一份基础权重的原始副本:
+- 与safetensors文件内容相同的张量直接内存映射 (只读共享，不占额外内存)
+- 其余张量 (dtype转换后的权重、非持久buffer等) 保留一份内存副本
+之后每次取模型只在meta设备上构建结构并把参数指向原始副本，LoRA实例复用同一组
+PEFT包装并只重新初始化适配器参数。需要原地修改基础权重 (全参数微调、合并LoRA) 时
+使用 copy_weights=True 得到私有副本。
+
+用法 (CPU自检: 与from_pretrained结果对比并报告节省的加载时间):
+  python scripts/model_registry.py --self_test
+"""
+
+import os
+import glob
+import json
+import mmap
+import time
+import argparse
+
+import torch
+
+# safetensors dtype -> torch dtype
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool
+}
+
+
+def mmap_safetensors(path):
+    """以只读内存映射方式打开safetensors文件，返回 {名称: 张量} (张量共享映射内存，不复制)"""
+    with open(path, 'rb') as f:
+        # safetensors: 8字节小端头长度 + JSON头 (包含所有张量的名称/形状/偏移)
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    # ACCESS_COPY: 写入只影响本进程的私有页，文件和其他进程不受影响
+    buffer = torch.frombuffer(mapped, dtype=torch.uint8)
+    data_start = 8 + header_len
+
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__" or info["dtype"] not in SAFETENSORS_DTYPES:
+            continue
+        start, end = info["data_offsets"]
+        raw = buffer[data_start + start:data_start + end]
+        tensors[name] = raw.view(SAFETENSORS_DTYPES[info["dtype"]]).reshape(info["shape"])
+    return tensors
+
+def _resolve_model_dir(model_name):
+    """本地目录直接使用; Hub模型名尝试解析到本地缓存快照 (不联网)"""
+    if os.path.isdir(model_name):
+        return model_name
+    try:
+        from huggingface_hub import snapshot_download
+        return snapshot_download(model_name, local_files_only=True)
+    except Exception:
+        return None
+
+def _named_tensors(model):
+    """模型中所有参数和buffer (含非持久buffer、共享权重的每个名称)"""
+    for module_name, module in model.named_modules(remove_duplicate=False):
+        prefix = f"{module_name}." if module_name else ""
+        for name, param in module._parameters.items():
+            if param is not None:
+                yield prefix + name, module, name, True
+        for name, buffer in module._buffers.items():
+            if buffer is not None:
+                yield prefix + name, module, name, False
+
+class ModelRegistry:
+    """缓存基础模型权重和分词器，按需产生新的模型实例"""
+
+    def __init__(self):
+        self._tokenizers = {}
+        # {(模型名, dtype): {"config", "tensors", "mapped", "load_time"}}
+        self._bases = {}
+        # {(模型名, dtype, LoRA配置): PeftModel}
+        self._peft_models = {}
+        self.load_time = 0.0
+        self.saved_time = 0.0
+        self.hits = 0
+
+    def tokenizer(self, model_name, pad_with_eos=True):
+        """同一模型名只加载一次分词器 (pad_with_eos: 以eos作为pad，与训练脚本一致)"""
+        key = (model_name, pad_with_eos)
+        if key in self._tokenizers:
+            self.hits += 1
+            tokenizer, load_time = self._tokenizers[key]
+            self.saved_time += load_time
+            return tokenizer
+
+        from transformers import AutoTokenizer
+
+        start = time.perf_counter()
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if pad_with_eos:
+            tokenizer.pad_token = tokenizer.eos_token
+        load_time = time.perf_counter() - start
+        self.load_time += load_time
+        self._tokenizers[key] = (tokenizer, load_time)
+        return tokenizer
+
+    def _base(self, model_name, dtype):
+        key = (model_name, str(dtype))
+        if key in self._bases:
+            return self._bases[key]
+
+        from transformers import AutoModelForCausalLM
+
+        start = time.perf_counter()
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype, device_map="cpu")
+
+        # 文件中与加载结果完全一致的张量改为内存映射，其余保留内存副本
+        mapped = {}
+        model_dir = _resolve_model_dir(model_name)
+        if model_dir:
+            for path in sorted(glob.glob(os.path.join(model_dir, "*.safetensors"))):
+                mapped.update(mmap_safetensors(path))
+
+        tensors = {}
+        n_mapped = 0
+        for full_name, module, name, _ in _named_tensors(model):
+            tensor = getattr(module, name).detach()
+            candidate = mapped.get(full_name)
+            if (candidate is not None and candidate.dtype == tensor.dtype and candidate.shape == tensor.shape
+                    and torch.equal(candidate, tensor)):
+                tensors[full_name] = candidate
+                n_mapped += 1
+            else:
+                tensors[full_name] = tensor
+        load_time = time.perf_counter() - start
+
+        base = {"config": model.config, "tensors": tensors, "mapped": n_mapped, "load_time": load_time}
+        self._bases[key] = base
+        self.load_time += load_time
+        print(f"✓ 基础模型已缓存: {model_name} ({dtype}), {n_mapped}/{len(tensors)} 个张量内存映射, 加载 {load_time:.2f}s")
+        return base
+
+    def model(self, model_name, dtype=torch.float32, copy_weights=False):
+        """新的基础模型实例
+
+        copy_weights=False 时参数直接指向缓存的原始权重 (冻结基础权重的LoRA训练/推理);
+        需要原地修改权重 (全参数微调、merge_and_unload) 时必须传 copy_weights=True。
+        """
+        from transformers import AutoModelForCausalLM
+
+        key = (model_name, str(dtype))
+        cached = key in self._bases
+        base = self._base(model_name, dtype)
+
+        start = time.perf_counter()
+        with torch.device("meta"):
+            model = AutoModelForCausalLM.from_config(base["config"], torch_dtype=dtype)
+        for full_name, module, name, is_param in _named_tensors(model):
+            tensor = base["tensors"][full_name]
+            if copy_weights:
+                tensor = tensor.clone()
+            if is_param:
+                module._parameters[name] = torch.nn.Parameter(tensor, requires_grad=copy_weights)
+            else:
+                module._buffers[name] = tensor
+        if not copy_weights:
+            model.requires_grad_(False)
+        # 共享权重 (如lm_head与embed_tokens) 在copy_weights时会被分别复制，重新绑定
+        model.tie_weights()
+        model.eval()
+
+        if cached:
+            self.hits += 1
+            self.saved_time += max(0.0, base["load_time"] - (time.perf_counter() - start))
+        return model
+
+    def peft_model(self, model_name, lora_config, dtype=torch.float32, seed=None):
+        """LoRA包装的模型实例: 相同 (模型, dtype, LoRA配置) 复用包装，只重新初始化适配器参数
+
+        复用时之前返回的实例会被重置，调用方不应同时持有两个相同配置的实例。
+        """
+        from peft import get_peft_model
+        from peft.tuners.lora import LoraLayer
+
+        key = (model_name, str(dtype), repr(lora_config))
+        if seed is not None:
+            torch.manual_seed(seed)
+        if key not in self._peft_models:
+            self._peft_models[key] = get_peft_model(self.model(model_name, dtype), lora_config)
+            return self._peft_models[key]
+
+        start = time.perf_counter()
+        peft_model = self._peft_models[key]
+        for module in peft_model.modules():
+            if isinstance(module, LoraLayer):
+                for adapter_name in module.lora_A:
+                    module.reset_lora_parameters(adapter_name, lora_config.init_lora_weights)
+        peft_model.train()
+        base = self._bases[(model_name, str(dtype))]
+        self.hits += 1
+        self.saved_time += max(0.0, base["load_time"] - (time.perf_counter() - start))
+        return peft_model
+
+    def report(self):
+        """打印缓存统计"""
+        print(f"模型缓存: 首次加载 {self.load_time:.2f}s, 命中 {self.hits} 次, 节省约 {self.saved_time:.2f}s")
+        return {"load_time": self.load_time, "hits": self.hits, "saved_time": self.saved_time}
+
+def self_test(n_instances=5, hidden_size=256, num_layers=4, seed=0):
+    """用本地微型checkpoint比较 from_pretrained 与缓存实例的输出和耗时"""
+    import tempfile
+    from transformers import AutoModelForCausalLM
+    from peft import LoraConfig, get_peft_model
+    from tiny_model import create_tiny_model
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        create_tiny_model(model_dir, hidden_size=hidden_size, num_layers=num_layers,
+                          intermediate_size=hidden_size * 2, seed=seed)
+        lora_config = LoraConfig(r=8, lora_alpha=16, target_modules=["q_proj", "v_proj"], lora_dropout=0.0,
+                                 task_type="CAUSAL_LM")
+        input_ids = torch.randint(3, 1000, (2, 32), generator=torch.Generator().manual_seed(seed))
+
+        # 朴素路径: 每次都从磁盘加载并包装
+        start = time.perf_counter()
+        for _ in range(n_instances):
+            naive = get_peft_model(AutoModelForCausalLM.from_pretrained(model_dir, torch_dtype=torch.float32),
+                                   LoraConfig(**lora_config.to_dict()))
+        naive_time = time.perf_counter() - start
+        naive.eval()
+        with torch.no_grad():
+            reference = naive(input_ids).logits
+
+        registry = ModelRegistry()
+        start = time.perf_counter()
+        for _ in range(n_instances):
+            cached = registry.peft_model(model_dir, lora_config)
+        cached_time = time.perf_counter() - start
+
+        # 训练一步修改适配器后再次取出，适配器应被重置 (B=0，输出等于基础模型)
+        lora_b = next(param for name, param in cached.named_parameters() if "lora_B" in name)
+        with torch.no_grad():
+            lora_b.add_(1.0)
+        cached = registry.peft_model(model_dir, lora_config)
+        cached.eval()
+        with torch.no_grad():
+            output = cached(input_ids).logits
+        max_diff = float((output - reference).abs().max())
+
+        # 两个普通实例共享同一块基础权重内存
+        first = registry.model(model_dir)
+        second = registry.model(model_dir)
+        shared = all(a.data_ptr() == b.data_ptr() for a, b in zip(first.parameters(), second.parameters()))
+        private = registry.model(model_dir, copy_weights=True)
+        with torch.no_grad():
+            next(private.parameters()).add_(1.0)
+        untouched = torch.equal(next(first.parameters()), next(AutoModelForCausalLM.from_pretrained(model_dir).parameters()))
+
+    print(f"实例数: {n_instances}, 模型: hidden={hidden_size}, layers={num_layers}")
+    print(f"from_pretrained + get_peft_model: {naive_time:.3f}s")
+    print(f"ModelRegistry.peft_model: {cached_time:.3f}s ({naive_time / cached_time:.1f}x)")
+    print(f"重置后与新加载模型的logits最大差值: {max_diff:.2e}")
+    print(f"基础权重共享: {shared}, copy_weights修改不影响原始权重: {untouched}")
+    registry.report()
+    return max_diff, shared and untouched
+
+def main():
+    parser = argparse.ArgumentParser(description="进程级模型/分词器缓存")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用本地微型checkpoint自检")
+    parser.add_argument("--n_instances", type=int, default=5)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_layers", type=int, default=4)
+    args = parser.parse_args()
+
+    if not args.self_test:
+        parser.print_help()
+        return
+
+    max_diff, ok = self_test(args.n_instances, args.hidden_size, args.num_layers)
+    if max_diff > 1e-5 or not ok:
+        print("❌ 缓存实例与新加载的模型不一致")
+        raise SystemExit(1)
+    print("✅ 缓存实例与新加载的模型一致")
+
+if __name__ == "__main__":
+    main()
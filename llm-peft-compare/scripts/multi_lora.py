@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多适配器混合批推理: 一个基础模型 + 多个LoRA适配器，同一批中的每一行可以使用不同的适配器
+
+- 基于PEFT的混合批推理 (load_adapter 加载多个适配器 + 前向时的 adapter_names):
+  基础权重只有一份，每个LoRA层按行分组，各组用自己的适配器计算增量后写回原位置
+- MultiLoraModel 在每个LoRA层上注册前向预钩子，把当前批每行的适配器名称作为 adapter_names 传入，
+  因此不经过PeftModel.forward的调用方 (如generation_engine.py直接调用原模型) 也能使用
+- 适配器编号 -1 表示只用基础模型 (PEFT中的 "__base__")
+- 基础模型可以是普通模型、bitsandbytes量化模型或quantized_linear.py的QuantizedLinear模型 (与QLoRA训练相同)
+
+inference_server.py --adapters 使用本模块，一个服务同时提供多个微调结果。
+load_adapter 读取适配器权重 (lora_rank_reduce.py使用)。
+
+用法:
+  # CPU自检: 与PEFT逐适配器前向比较结果，并比较吞吐量
+  python scripts/multi_lora.py --self_test
+  # 对真实适配器做同样的比较
+  python scripts/multi_lora.py --adapters models/tinyllama_1.1b-instruction-lora/final,models/tinyllama_1.1b-instruction-qlora/final
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import tempfile
+from functools import partial
+from contextlib import contextmanager
+
+import torch
+
+
+def resolve_adapter_dir(adapter_dir):
+    """训练输出目录 (models/xxx-instruction-lora) 的适配器保存在其下的 final/ 中"""
+    final_dir = os.path.join(adapter_dir, "final")
+    if not os.path.exists(os.path.join(adapter_dir, "adapter_config.json")) and \
+            os.path.exists(os.path.join(final_dir, "adapter_config.json")):
+        return final_dir
+    return adapter_dir
+
+def load_adapter(adapter_dir):
+    """读取适配器目录，返回 (配置, {模块名: (A, B, 缩放系数)})"""
+    from safetensors.torch import load_file
+
+    adapter_dir = resolve_adapter_dir(adapter_dir)
+    with open(os.path.join(adapter_dir, "adapter_config.json")) as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA" or config.get("use_dora"):
+        raise ValueError(f"只支持普通LoRA适配器: {adapter_dir}")
+    if config.get("modules_to_save"):
+        raise ValueError(f"不支持modules_to_save: {adapter_dir}")
+
+    state = load_file(os.path.join(adapter_dir, "adapter_model.safetensors"))
+    layers = {}
+    for key, tensor in state.items():
+        if not key.endswith(".lora_A.weight"):
+            if ".lora_A." not in key and ".lora_B." not in key:
+                raise ValueError(f"不支持的适配器权重: {key}")
+            continue
+        name = key[:-len(".lora_A.weight")].removeprefix("base_model.model.")
+        lora_a = tensor.float()
+        lora_b = state[key.replace(".lora_A.", ".lora_B.")].float()
+        rank = lora_a.shape[0]
+        # alpha_pattern与PEFT相同: 按模块名后缀匹配
+        alpha = next((value for pattern, value in config.get("alpha_pattern", {}).items()
+                      if re.match(rf"(.*\.)?{pattern}$", name)), config["lora_alpha"])
+        scaling = alpha / (rank ** 0.5 if config.get("use_rslora") else rank)
+        layers[name] = (lora_a, lora_b, scaling)
+    return config, layers
+
+def _adapter_names_hook(multi, module, args, kwargs):
+    """LoRA层前向预钩子: 传入当前批每行的适配器名称"""
+    names = multi.adapter_names
+    kwargs["adapter_names"] = names if names is not None else ["__base__"] * args[0].shape[0]
+    return args, kwargs
+
+class MultiLoraModel:
+    """基础模型 + 多个适配器; 在 use(adapter_ids) 中前向时每行使用自己的适配器"""
+
+    def __init__(self, model, adapters):
+        """adapters: {名称: 适配器目录}; 原地向model中注入所有适配器的LoRA层"""
+        from peft import PeftModel
+        from peft.tuners.lora import LoraLayer
+
+        self.names = list(adapters)
+        paths = [resolve_adapter_dir(path) for path in adapters.values()]
+        self.peft_model = PeftModel.from_pretrained(model, paths[0], adapter_name=self.names[0])
+        for name, path in zip(self.names[1:], paths[1:]):
+            self.peft_model.load_adapter(path, adapter_name=name)
+        self.peft_model.eval()
+        # PeftModel原地替换目标层，调用方仍然可以直接使用原模型
+        self.model = model
+        self.adapter_names = None
+        self.layers = [module for module in model.modules() if isinstance(module, LoraLayer)]
+        self.hooks = [layer.register_forward_pre_hook(partial(_adapter_names_hook, self), with_kwargs=True)
+                      for layer in self.layers]
+
+    def adapter_index(self, name):
+        """适配器名称 -> 编号; None 表示基础模型"""
+        if name is None:
+            return -1
+        if name not in self.names:
+            raise KeyError(f"未加载的适配器: {name} (可用: {self.names})")
+        return self.names.index(name)
+
+    def set_adapter_ids(self, adapter_ids):
+        """之后每次前向中每行使用的适配器编号 (None: 所有行只用基础模型)"""
+        if adapter_ids is None:
+            self.adapter_names = None
+            return
+        self.adapter_names = [self.names[index] if index >= 0 else "__base__" for index in adapter_ids]
+
+    @contextmanager
+    def use(self, adapter_ids):
+        self.set_adapter_ids(adapter_ids)
+        try:
+            yield self.model
+        finally:
+            self.adapter_names = None
+
+    def nbytes(self):
+        """所有适配器的LoRA权重字节数"""
+        return sum(param.numel() * param.element_size() for name, param in self.model.named_parameters()
+                   if "lora_" in name)
+
+def _model_nbytes(model):
+    from quantized_linear import model_nbytes
+    return model_nbytes(model)
+
+def compare(base_model, adapter_dirs, batch_size=16, seq_len=64, repeats=3, seed=0):
+    """混合批前向与PEFT逐适配器前向比较 (结果和吞吐量)"""
+    import copy
+    from peft import PeftModel
+
+    names = [f"a{index}" for index in range(len(adapter_dirs))]
+    generator = torch.Generator().manual_seed(seed)
+    vocab_size = base_model.config.vocab_size
+    input_ids = torch.randint(3, vocab_size, (batch_size, seq_len), generator=generator)
+    # 每行随机选一个适配器，-1为基础模型
+    assignment = torch.randint(-1, len(names), (batch_size,), generator=generator).tolist()
+
+    peft_model = PeftModel.from_pretrained(copy.deepcopy(base_model), adapter_dirs[0], adapter_name=names[0])
+    for name, adapter_dir in zip(names[1:], adapter_dirs[1:]):
+        peft_model.load_adapter(adapter_dir, adapter_name=name)
+    peft_model.eval()
+
+    def sequential():
+        """按适配器分组，每组切换适配器后单独前向"""
+        logits = torch.empty(batch_size, seq_len, vocab_size)
+        for index in sorted(set(assignment)):
+            rows = [row for row, value in enumerate(assignment) if value == index]
+            if index < 0:
+                with peft_model.disable_adapter():
+                    logits[rows] = peft_model(input_ids[rows]).logits
+            else:
+                peft_model.set_adapter(names[index])
+                logits[rows] = peft_model(input_ids[rows]).logits
+        return logits
+
+    multi = MultiLoraModel(copy.deepcopy(base_model), dict(zip(names, adapter_dirs)))
+
+    def mixed():
+        with multi.use(assignment) as model:
+            return model(input_ids).logits
+
+    methods = [("逐适配器前向 (PEFT)", sequential), ("混合批 (adapter_names)", mixed)]
+    results = {}
+    with torch.no_grad():
+        reference = sequential()
+        for name, method in methods:
+            method()  # 预热
+            start = time.perf_counter()
+            for _ in range(repeats):
+                logits = method()
+            elapsed = (time.perf_counter() - start) / repeats
+            results[name] = {"seconds": elapsed, "max_diff": float((logits - reference).abs().max())}
+
+    base_bytes = _model_nbytes(base_model)
+    print(f"{len(names)} 个适配器, batch={batch_size}, seq_len={seq_len}, 每行适配器: {assignment}")
+    print(f"{'方式':<20} {'耗时':>9} {'tokens/s':>10} {'加速比':>7} {'最大差异':>10}")
+    base_time = results[methods[0][0]]["seconds"]
+    for name, result in results.items():
+        print(f"{name:<20} {result['seconds'] * 1000:>7.1f}ms {batch_size * seq_len / result['seconds']:>10.0f} "
+              f"{base_time / result['seconds']:>6.2f}x {result['max_diff']:>10.2e}")
+    print(f"内存: 每个适配器一份合并模型 {len(names) * base_bytes / 2 ** 20:.1f}MB, "
+          f"共享基础模型 {(base_bytes + multi.nbytes()) / 2 ** 20:.1f}MB (其中LoRA权重 {multi.nbytes() / 2 ** 20:.2f}MB)")
+    return results
+
+def _save_random_adapters(base_model, work_dir, seed=0):
+    """不同秩/alpha/目标模块的随机适配器 (B不为0，否则与基础模型相同)"""
+    import copy
+    from peft import LoraConfig, get_peft_model
+
+    settings = [
+        {"r": 4, "lora_alpha": 8, "target_modules": ["q_proj", "v_proj"]},
+        {"r": 8, "lora_alpha": 32, "target_modules": ["q_proj", "k_proj", "v_proj", "o_proj"]},
+        {"r": 16, "lora_alpha": 16, "target_modules": ["q_proj", "v_proj", "gate_proj", "up_proj", "down_proj"],
+         "use_rslora": True},
+        {"r": 8, "lora_alpha": 16, "target_modules": ["v_proj", "down_proj"], "rank_pattern": {"down_proj": 2},
+         "alpha_pattern": {"down_proj": 4}},
+    ]
+    adapter_dirs = []
+    for index, setting in enumerate(settings):
+        torch.manual_seed(seed + index)
+        peft_model = get_peft_model(copy.deepcopy(base_model), LoraConfig(init_lora_weights=False, lora_dropout=0.0,
+                                                                          task_type="CAUSAL_LM", **setting))
+        adapter_dir = os.path.join(work_dir, f"adapter_{index}")
+        peft_model.save_pretrained(adapter_dir)
+        adapter_dirs.append(adapter_dir)
+    return adapter_dirs
+
+def self_test(hidden_size=256, num_layers=4, seed=0):
+    from tiny_model import build_tiny_model
+    from generation_engine import GenerationEngine
+
+    base_model, tokenizer = build_tiny_model(hidden_size=hidden_size, num_layers=num_layers,
+                                             intermediate_size=hidden_size * 2, seed=seed)
+    base_model.eval()
+    ok = True
+    with tempfile.TemporaryDirectory() as work_dir:
+        adapter_dirs = _save_random_adapters(base_model, work_dir, seed)
+        for batch_size, seq_len in [(16, 64), (32, 1)]:
+            results = compare(base_model, adapter_dirs, batch_size, seq_len, seed=seed)
+            ok = ok and all(result["max_diff"] < 1e-3 for result in results.values())
+            print()
+
+        # 基础模型的线性层为QuantizedLinear (weight为None，权重是uint8打包的int4)
+        import copy
+        from quantized_linear import quantize_model
+        quantized_model = copy.deepcopy(base_model)
+        quantize_model(quantized_model, bits=4, verbose=False)
+        print("int4量化基础模型:")
+        results = compare(quantized_model, adapter_dirs, 16, 16, repeats=1, seed=seed)
+        ok = ok and all(result["max_diff"] < 1e-3 for result in results.values())
+        print()
+
+        # 生成: 混合批的贪心结果与每个适配器单独生成一致
+        from peft import PeftModel
+        multi = MultiLoraModel(copy.deepcopy(base_model), {f"a{i}": d for i, d in enumerate(adapter_dirs)})
+        prompts = [torch.randint(3, base_model.config.vocab_size, (length,),
+                                 generator=torch.Generator().manual_seed(length)).tolist() for length in (20, 35, 50, 65, 80)]
+        assignment = [-1, 0, 1, 2, 3]
+        engine = GenerationEngine(multi.model, tokenizer, batch_size=len(prompts), refill=False)
+        with multi.use(assignment):
+            cache, attention_mask, positions, logits = engine.prefill(prompts)
+            mixed = [logits.argmax(dim=-1).tolist()]
+            for _ in range(7):
+                cache, attention_mask, positions, logits = engine.decode(cache, attention_mask, positions, mixed[-1])
+                mixed.append(logits.argmax(dim=-1).tolist())
+        mixed = [list(column) for column in zip(*mixed)]
+        expected = []
+        for prompt, index in zip(prompts, assignment):
+            model = copy.deepcopy(base_model) if index < 0 else PeftModel.from_pretrained(copy.deepcopy(base_model),
+                                                                                        adapter_dirs[index])
+            output = model.generate(torch.tensor([prompt]), max_new_tokens=8, do_sample=False, eos_token_id=None,
+                                    pad_token_id=0)
+            expected.append(output[0, len(prompt):].tolist())
+        generation_ok = mixed == expected
+        print(f"{'✓' if generation_ok else '❌'} 混合批贪心生成与各适配器单独生成一致: {generation_ok}")
+        ok = ok and generation_ok
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="多适配器混合批推理")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用随机微型模型和随机适配器自检")
+    parser.add_argument("--adapters", type=str, default=None, help="逗号分隔的适配器目录 (基础模型须相同)")
+    parser.add_argument("--base_model", type=str, default=None, help="默认取第一个适配器配置中的基础模型")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--seq_len", type=int, default=64)
+    args = parser.parse_args()
+
+    if args.self_test:
+        if not self_test():
+            print("❌ 多适配器推理自检失败")
+            raise SystemExit(1)
+        print("✅ 多适配器推理自检通过")
+        return
+
+    if not args.adapters:
+        parser.error("需要 --adapters 或 --self_test")
+    from transformers import AutoModelForCausalLM
+
+    adapter_dirs = [resolve_adapter_dir(path.strip()) for path in args.adapters.split(",") if path.strip()]
+    base_path = args.base_model
+    if base_path is None:
+        with open(os.path.join(adapter_dirs[0], "adapter_config.json")) as f:
+            base_path = json.load(f)["base_model_name_or_path"]
+    base_model = AutoModelForCausalLM.from_pretrained(base_path, dtype=torch.float32).eval()
+    compare(base_model, adapter_dirs, args.batch_size, args.seq_len)
+
+if __name__ == "__main__":
+    main()
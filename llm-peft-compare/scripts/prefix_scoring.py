@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享前缀的多选题log-likelihood打分引擎
+
+HellaSwag的4个结尾、MMLU的4个选项共享同一段较长的上下文。朴素做法对每个选项
+都把完整的 上下文+选项 送入模型; 这里先对上下文做一次前向并保留KV缓存，
+再把所有选项作为一个批次在缓存之上增量打分。
+
+用法 (CPU自检: 与朴素路径比较log-likelihood并报告加速比):
+  python scripts/prefix_scoring.py --self_test
+"""
+
+import copy
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+
+class PrefixScorer:
+    """对 (context_enc, continuation_enc) 请求打分，同一上下文只计算一次"""
+
+    def __init__(self, model, max_length=None, max_batch_size=32):
+        self.model = model
+        self.max_length = max_length or getattr(model.config, "max_position_embeddings", 2048)
+        self.max_batch_size = max_batch_size
+        self.device = next(model.parameters()).device
+
+    def _continuation_logprobs(self, first_logits, cont_logits, cont_ids, cont_lens):
+        """由上下文最后位置的logits和续写部分的logits计算每个续写的总logprob和是否贪心"""
+        # 位置j的logits预测续写的第j+1个token; 第一个token由上下文最后位置预测
+        logits = torch.cat([first_logits.unsqueeze(1), cont_logits[:, :-1]], dim=1)
+        logprobs = F.log_softmax(logits.float(), dim=-1)
+        token_logprobs = logprobs.gather(-1, cont_ids.unsqueeze(-1)).squeeze(-1)
+        greedy_match = logprobs.argmax(dim=-1) == cont_ids
+
+        positions = torch.arange(cont_ids.shape[1], device=cont_ids.device).unsqueeze(0)
+        valid = positions < cont_lens.unsqueeze(1)
+        totals = (token_logprobs * valid).sum(dim=1)
+        greedy = (greedy_match | ~valid).all(dim=1)
+        return [(float(total), bool(is_greedy)) for total, is_greedy in zip(totals, greedy)]
+
+    def _pad_continuations(self, continuations):
+        lengths = torch.tensor([len(cont) for cont in continuations], device=self.device)
+        cont_ids = torch.zeros(len(continuations), int(lengths.max()), dtype=torch.long, device=self.device)
+        for i, cont in enumerate(continuations):
+            cont_ids[i, :len(cont)] = torch.tensor(cont, dtype=torch.long)
+        return cont_ids, lengths
+
+    @torch.no_grad()
+    def score_group(self, context_enc, continuations):
+        """对一个上下文的所有续写打分，返回 [(logprob, is_greedy)]"""
+        # 超出最大长度需要左截断时，各续写的截断位置不同，无法共享前缀
+        # (上下文和完整的续写都会输入模型，共 len(上下文) + len(续写) 个位置)
+        if len(context_enc) + max(len(cont) for cont in continuations) >= self.max_length + 1:
+            return self.score_naive(context_enc, continuations)
+
+        ctx = torch.tensor([context_enc], dtype=torch.long, device=self.device)
+        ctx_out = self.model(ctx, use_cache=True)
+        first_logits = ctx_out.logits[:, -1]
+        ctx_cache = ctx_out.past_key_values
+
+        results = []
+        for start in range(0, len(continuations), self.max_batch_size):
+            chunk = continuations[start:start + self.max_batch_size]
+            cont_ids, cont_lens = self._pad_continuations(chunk)
+
+            # 每个分块使用上下文缓存的独立副本 (前向会原地追加缓存)
+            cache = copy.deepcopy(ctx_cache)
+            cache.batch_repeat_interleave(len(chunk))
+            # 续写右侧padding，因果注意力保证padding不影响有效位置
+            attention_mask = torch.cat([
+                torch.ones(len(chunk), ctx.shape[1], dtype=torch.long, device=self.device),
+                (torch.arange(cont_ids.shape[1], device=self.device).unsqueeze(0) < cont_lens.unsqueeze(1)).long()
+            ], dim=1)
+            out = self.model(cont_ids, attention_mask=attention_mask, past_key_values=cache, use_cache=True)
+            results.extend(self._continuation_logprobs(
+                first_logits.expand(len(chunk), -1), out.logits, cont_ids, cont_lens
+            ))
+        return results
+
+    @torch.no_grad()
+    def score_naive(self, context_enc, continuations):
+        """朴素路径: 每个续写都与完整上下文拼接后整体前向 (与lm-eval HFLM相同的截断方式)"""
+        results = []
+        for cont in continuations:
+            inp = (list(context_enc) + list(cont))[-(self.max_length + 1):][:-1]
+            inp = torch.tensor([inp], dtype=torch.long, device=self.device)
+            logits = self.model(inp).logits[:, -len(cont):]
+            cont_ids = torch.tensor([cont], dtype=torch.long, device=self.device)
+            logprobs = F.log_softmax(logits.float(), dim=-1)
+            total = logprobs.gather(-1, cont_ids.unsqueeze(-1)).sum()
+            greedy = bool((logprobs.argmax(dim=-1) == cont_ids).all())
+            results.append((float(total), greedy))
+        return results
+
+    def score_requests(self, requests):
+        """对lm-eval格式的请求 [(args, context_enc, continuation_enc)] 打分，保持输入顺序"""
+        groups = {}
+        for index, (_, context_enc, continuation_enc) in enumerate(requests):
+            groups.setdefault(tuple(context_enc), []).append((index, continuation_enc))
+
+        results = [None] * len(requests)
+        for context_enc, members in groups.items():
+            scores = self.score_group(list(context_enc), [cont for _, cont in members])
+            for (index, _), score in zip(members, scores):
+                results[index] = score
+        return results
+
+def self_test(num_questions=8, num_choices=4, context_tokens=256, choice_tokens=12, seed=0):
+    """用随机微型Llama比较共享前缀路径与朴素路径，返回最大log-likelihood差值"""
+    from tiny_model import build_tiny_model
+
+    model, _ = build_tiny_model(seed=seed)
+    vocab_size = model.config.vocab_size
+    generator = torch.Generator().manual_seed(seed)
+
+    groups = []
+    for _ in range(num_questions):
+        context = torch.randint(3, vocab_size, (context_tokens,), generator=generator).tolist()
+        choices = [
+            torch.randint(3, vocab_size, (int(torch.randint(2, choice_tokens + 1, (1,), generator=generator)),),
+                          generator=generator).tolist()
+            for _ in range(num_choices)
+        ]
+        groups.append((context, choices))
+
+    scorer = PrefixScorer(model)
+    # 预热
+    scorer.score_group(*groups[0])
+    scorer.score_naive(*groups[0])
+
+    start = time.perf_counter()
+    naive = [scorer.score_naive(context, choices) for context, choices in groups]
+    naive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    shared = [scorer.score_group(context, choices) for context, choices in groups]
+    shared_time = time.perf_counter() - start
+
+    max_diff = 0.0
+    greedy_mismatch = 0
+    for naive_scores, shared_scores in zip(naive, shared):
+        for (naive_lp, naive_greedy), (shared_lp, shared_greedy) in zip(naive_scores, shared_scores):
+            max_diff = max(max_diff, abs(naive_lp - shared_lp))
+            greedy_mismatch += int(naive_greedy != shared_greedy)
+
+    print(f"题目数: {num_questions}, 每题选项: {num_choices}, 上下文长度: {context_tokens} tokens")
+    print(f"朴素路径耗时: {naive_time:.3f}s")
+    print(f"共享前缀耗时: {shared_time:.3f}s")
+    print(f"加速比: {naive_time / shared_time:.2f}x")
+    print(f"log-likelihood最大差值: {max_diff:.2e}, is_greedy不一致: {greedy_mismatch}")
+    return max_diff, greedy_mismatch
+
+def main():
+    parser = argparse.ArgumentParser(description="共享前缀多选题打分引擎")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用随机微型模型自检")
+    parser.add_argument("--num_questions", type=int, default=8)
+    parser.add_argument("--context_tokens", type=int, default=256)
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="允许的log-likelihood差值")
+    args = parser.parse_args()
+
+    if not args.self_test:
+        parser.print_help()
+        return
+
+    max_diff, greedy_mismatch = self_test(num_questions=args.num_questions, context_tokens=args.context_tokens)
+    if max_diff > args.tolerance or greedy_mismatch:
+        print("❌ 共享前缀路径与朴素路径结果不一致")
+        raise SystemExit(1)
+    print("✅ 共享前缀路径与朴素路径结果一致")
+
+if __name__ == "__main__":
+    main()
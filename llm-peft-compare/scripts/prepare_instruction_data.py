@@ -28,6 +28,13 @@ with open("data/alpaca_train.jsonl", "w") as f:
 
 print(f"已保存 {len(train_data)} 条训练数据到 data/alpaca_train.jsonl")
 
+# 保留原始字段 (instruction/input/output)，train_instruction.py 读取这种格式
+with open("data/alpaca_train_raw.jsonl", "w") as f:
+    for item in dataset["train"]:
+        f.write(json.dumps({"instruction": item["instruction"], "input": item["input"], "output": item["output"]}) + "\n")
+
+print(f"已保存原始格式数据到 data/alpaca_train_raw.jsonl")
+
 # 用于测试的小数据集
 with open("data/alpaca_test.jsonl", "w") as f:
     for item in train_data[:100]:  # 只取前100条
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+合并模型的仅权重int8/int4导出 (CPU推理)
+
+*-merged 目录是只用于推理/评估的完整精度副本。本脚本在 save_merged_model.py 之后:
+- 把线性层权重按输入维度分组做对称int8/int4量化 (quantized_linear.py)，
+  以 qweight/scales/bias 的形式和其余张量一起保存为一个safetensors文件
+- quantization_config.json 记录每个量化层的形状和分组，共享的张量 (如绑定的lm_head) 只保存一份
+- load_quantized 在meta设备上构建模型结构，把量化层替换为QuantizedLinear，
+  再把参数指向内存映射的文件内容; 推理时按块即时反量化
+- --compare 报告文件大小、加载时间、tokens/s、logits误差，以及在本地评估任务上的准确率差异
+  (CPU上没有整数矩阵乘法内核，即时反量化比完整精度慢; 收益主要是磁盘/内存占用)
+
+用法:
+  python scripts/quantize_export.py --model_dir models/tinyllama_1.1b-instruction-lora-merged --bits 4
+  python scripts/quantize_export.py --model_dir models/tinyllama_1.1b-instruction-lora-merged --bits 8 \\
+      --compare --task_dir data/eval_tasks --limit 200
+  python scripts/quantize_export.py --self_test
+"""
+
+import os
+import json
+import time
+import argparse
+import tempfile
+
+import torch
+
+from quantized_linear import DEFAULT_GROUP_SIZE, DEFAULT_TARGET_MODULES, QuantizedLinear, quantize_model
+
+QUANT_CONFIG = "quantization_config.json"
+WEIGHTS_FILE = "model.safetensors"
+# 推理导出默认也量化lm_head (与词嵌入绑定时跳过)
+EXPORT_TARGET_MODULES = DEFAULT_TARGET_MODULES + ["lm_head"]
+DEFAULT_PROMPTS = ["What is machine learning?", "Explain the difference between LoRA and QLoRA.",
+                   "Write a short poem about the ocean.", "How do I sort a list in Python?"]
+
+
+def is_quantized_dir(model_dir):
+    return os.path.exists(os.path.join(model_dir, QUANT_CONFIG))
+
+def dir_nbytes(model_dir):
+    """目录中权重文件的总字节数"""
+    from eval_cache import WEIGHT_SUFFIXES
+    return sum(os.path.getsize(os.path.join(model_dir, name)) for name in os.listdir(model_dir)
+               if name.endswith(WEIGHT_SUFFIXES))
+
+def export_quantized(model, tokenizer, output_dir, bits=4, group_size=DEFAULT_GROUP_SIZE, target_modules=None,
+                     source=None, verbose=True):
+    """原地量化model并保存到output_dir，返回quantization_config"""
+    from safetensors.torch import save_file
+    from model_registry import _named_tensors
+
+    target_modules = list(target_modules or EXPORT_TARGET_MODULES)
+    if "lm_head" in target_modules and getattr(model.config, "tie_word_embeddings", False):
+        # 量化后无法再与嵌入层共享，反而多存一份
+        print("⚠️ lm_head与词嵌入绑定，保持原精度")
+        target_modules.remove("lm_head")
+    report = quantize_model(model, bits, group_size, target_modules, verbose)
+    if not report:
+        raise ValueError(f"没有匹配 {target_modules} 的线性层")
+
+    modules = {}
+    for name, module in model.named_modules():
+        if isinstance(module, QuantizedLinear):
+            modules[name] = {"in_features": module.in_features, "out_features": module.out_features,
+                             "group_size": module.group_size, "bias": module.bias is not None}
+
+    # 包括非持久buffer (RoPE的inv_freq等); 同一存储的多个名称只保存第一个
+    tensors, tied, seen = {}, {}, {}
+    for full_name, module, name, _ in _named_tensors(model):
+        tensor = getattr(module, name).detach()
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tuple(tensor.stride()))
+        if key in seen:
+            tied[full_name] = seen[key]
+            continue
+        seen[key] = full_name
+        tensors[full_name] = tensor.contiguous()
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_file(tensors, os.path.join(output_dir, WEIGHTS_FILE), metadata={"format": "pt"})
+    config = {"quant_method": "weight_only", "bits": bits, "group_size": group_size,
+              "compute_dtype": str(model.dtype).replace("torch.", ""), "modules": modules, "tied": tied,
+              "source": source}
+    with open(os.path.join(output_dir, QUANT_CONFIG), 'w') as f:
+        json.dump(config, f, indent=2)
+    model.config.save_pretrained(output_dir)
+    if model.generation_config is not None:
+        model.generation_config.save_pretrained(output_dir)
+    if tokenizer is not None:
+        tokenizer.save_pretrained(output_dir)
+    return config
+
+def export(model_dir, output_dir, bits=4, group_size=DEFAULT_GROUP_SIZE, target_modules=None):
+    """加载合并后的模型 (保持保存时的dtype) 并导出"""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    model = AutoModelForCausalLM.from_pretrained(model_dir, dtype="auto", device_map="cpu")
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    config = export_quantized(model, tokenizer, output_dir, bits, group_size, target_modules, source=model_dir)
+    before, after = dir_nbytes(model_dir), dir_nbytes(output_dir)
+    print(f"✓ int{bits}模型已导出: {output_dir} ({before / 1024 ** 2:.1f}MB -> {after / 1024 ** 2:.1f}MB, "
+          f"{before / after:.2f}x)")
+    return config
+
+def load_quantized(model_dir, device="cpu", dtype=None):
+    """加载export_quantized导出的模型
+
+    dtype: 可选的计算精度 (默认使用导出时的精度); 缩放系数始终保持float16
+    """
+    from transformers import AutoConfig, AutoModelForCausalLM
+    from model_registry import _named_tensors, mmap_safetensors
+
+    with open(os.path.join(model_dir, QUANT_CONFIG)) as f:
+        quant_config = json.load(f)
+    dtype = dtype or getattr(torch, quant_config["compute_dtype"])
+
+    config = AutoConfig.from_pretrained(model_dir)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config, dtype=dtype)
+        for full_name, spec in quant_config["modules"].items():
+            parent_name, _, child_name = full_name.rpartition(".")
+            parent = model.get_submodule(parent_name)
+            setattr(parent, child_name, QuantizedLinear(spec["in_features"], spec["out_features"], quant_config["bits"],
+                                                        spec["group_size"], spec["bias"], compute_dtype=dtype))
+
+    tensors = mmap_safetensors(os.path.join(model_dir, WEIGHTS_FILE))
+    loaded = {}
+    for full_name, module, name, is_param in _named_tensors(model):
+        source = quant_config["tied"].get(full_name, full_name)
+        if source not in tensors:
+            raise ValueError(f"量化模型缺少张量: {full_name}")
+        if source not in loaded:
+            tensor = tensors[source]
+            if tensor.is_floating_point() and name != "scales":
+                tensor = tensor.to(dtype)
+            loaded[source] = torch.nn.Parameter(tensor, requires_grad=False) if is_param else tensor
+        if is_param:
+            module._parameters[name] = loaded[source]
+        else:
+            module._buffers[name] = loaded[source]
+    model.eval()
+    return model.to(device)
+
+def measure_generation(model, tokenizer, prompts=None, max_new_tokens=32):
+    """逐条贪心生成固定数量的token，返回 (tokens/s, 生成文本)"""
+    prompts = prompts or DEFAULT_PROMPTS
+    device = next(model.parameters()).device
+    texts, generated = [], 0
+    start = time.perf_counter()
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors="pt").to(device)
+        with torch.no_grad():
+            output = model.generate(**inputs, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                                    do_sample=False, pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id)
+        new_tokens = output[0, inputs["input_ids"].shape[1]:]
+        generated += len(new_tokens)
+        texts.append(tokenizer.decode(new_tokens, skip_special_tokens=True))
+    return generated / (time.perf_counter() - start), texts
+
+def logits_agreement(reference, quantized, input_ids):
+    """两个模型logits的相对误差和top-1一致率"""
+    with torch.no_grad():
+        expected = reference(input_ids).logits.float()
+        actual = quantized(input_ids).logits.float()
+    relative_error = float((actual - expected).norm() / expected.norm())
+    top1 = float((actual.argmax(-1) == expected.argmax(-1)).float().mean())
+    return relative_error, top1
+
+def _task_metrics(output):
+    """{任务: {指标: 值}}，去掉stderr和别名"""
+    return {task: {metric: value for metric, value in results.items()
+                   if isinstance(value, (int, float)) and "stderr" not in metric}
+            for task, results in output["results"].items()}
+
+def compare(model_dir, quantized_dir, tasks=None, task_dir=None, limit=None, batch_size=16, max_new_tokens=32,
+            seq_len=128):
+    """完整精度与量化模型的对比报告"""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    import mini_eval
+
+    start = time.perf_counter()
+    reference = AutoModelForCausalLM.from_pretrained(model_dir, dtype="auto", device_map="cpu").eval()
+    reference_load = time.perf_counter() - start
+    start = time.perf_counter()
+    quantized = load_quantized(quantized_dir)
+    quantized_load = time.perf_counter() - start
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
+
+    with open(os.path.join(quantized_dir, QUANT_CONFIG)) as f:
+        bits = json.load(f)["bits"]
+    input_ids = torch.randint(3, reference.config.vocab_size, (2, seq_len), generator=torch.Generator().manual_seed(0))
+    relative_error, top1 = logits_agreement(reference, quantized, input_ids)
+    reference_speed, reference_texts = measure_generation(reference, tokenizer, max_new_tokens=max_new_tokens)
+    quantized_speed, quantized_texts = measure_generation(quantized, tokenizer, max_new_tokens=max_new_tokens)
+    report = {
+        "bits": bits,
+        "size_mb": {"full": dir_nbytes(model_dir) / 1024 ** 2, "quantized": dir_nbytes(quantized_dir) / 1024 ** 2},
+        "load_seconds": {"full": reference_load, "quantized": quantized_load},
+        "tokens_per_second": {"full": reference_speed, "quantized": quantized_speed},
+        "logits_relative_error": relative_error,
+        "top1_agreement": top1,
+        "same_generations": sum(a == b for a, b in zip(reference_texts, quantized_texts)),
+        "num_generations": len(reference_texts)
+    }
+    report["size_reduction"] = report["size_mb"]["full"] / report["size_mb"]["quantized"]
+
+    task_dir = task_dir or mini_eval.TASK_DIR
+    if tasks and os.path.isdir(task_dir):
+        metrics = {}
+        for name, model in [("full", reference), ("quantized", quantized)]:
+            output = mini_eval.evaluate(model, tokenizer, tasks, task_dir, limit=limit, batch_size=batch_size,
+                                        model_name=name)
+            metrics[name] = _task_metrics(output)
+        report["accuracy"] = metrics
+        report["accuracy_delta"] = {task: {metric: value - metrics["full"][task][metric]
+                                           for metric, value in results.items()}
+                                    for task, results in metrics["quantized"].items()}
+    elif tasks:
+        print(f"⚠️ 评估任务目录不存在，跳过准确率对比: {task_dir}")
+    return report
+
+def format_report(report):
+    lines = [
+        f"int{report['bits']} 导出: {report['size_mb']['full']:.1f}MB -> {report['size_mb']['quantized']:.1f}MB "
+        f"({report['size_reduction']:.2f}x)",
+        f"加载时间: {report['load_seconds']['full']:.2f}s -> {report['load_seconds']['quantized']:.2f}s",
+        f"生成速度: {report['tokens_per_second']['full']:.1f} -> {report['tokens_per_second']['quantized']:.1f} token/s",
+        f"logits相对误差: {report['logits_relative_error']:.4f}, top-1一致率: {report['top1_agreement'] * 100:.1f}%, "
+        f"贪心生成相同: {report['same_generations']}/{report['num_generations']}"
+    ]
+    for task, deltas in report.get("accuracy_delta", {}).items():
+        values = ", ".join(f"{metric} {report['accuracy']['full'][task][metric]:.4f} -> "
+                           f"{report['accuracy']['quantized'][task][metric]:.4f} ({delta:+.4f})"
+                           for metric, delta in deltas.items())
+        lines.append(f"  {task}: {values}")
+    return "\n".join(lines)
+
+def self_test(work_dir, hidden_size=256, num_layers=2):
+    """随机微型模型: 导出/加载往返一致、分块反量化与整体反量化一致，并输出对比报告"""
+    import mini_eval
+    from tiny_model import build_tiny_model
+
+    model, tokenizer = build_tiny_model(hidden_size=hidden_size, num_layers=num_layers,
+                                        intermediate_size=hidden_size * 2, seed=0)
+    model_dir = os.path.join(work_dir, "tiny-merged")
+    model.save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    task_dir = os.path.join(work_dir, "eval_tasks")
+    mini_eval._write_synthetic_tasks(task_dir)
+    input_ids = torch.randint(3, model.config.vocab_size, (2, 48), generator=torch.Generator().manual_seed(1))
+    ok, sizes = True, {}
+
+    for bits in (8, 4):
+        output_dir = f"{model_dir}-int{bits}"
+        in_memory, _ = build_tiny_model(hidden_size=hidden_size, num_layers=num_layers,
+                                        intermediate_size=hidden_size * 2, seed=0)
+        export_quantized(in_memory, tokenizer, output_dir, bits, source=model_dir, verbose=False)
+        loaded = load_quantized(output_dir)
+
+        # 1) 加载结果与导出前的量化模型逐位一致，且没有遗留在meta设备上的张量
+        with torch.no_grad():
+            expected = in_memory(input_ids).logits
+            actual = loaded(input_ids).logits
+        on_meta = [name for name, tensor in list(loaded.named_parameters()) + list(loaded.named_buffers())
+                   if tensor.is_meta]
+        round_trip = torch.equal(expected, actual) and not on_meta
+        print(f"int{bits} 导出/加载往返一致: {round_trip} (meta张量 {len(on_meta)} 个)")
+
+        # 2) 推理时的分块反量化与训练路径的整体反量化一致
+        layer = loaded.lm_head
+        hidden = torch.randn(3, hidden_size)
+        with torch.no_grad():
+            blocked = layer(hidden)
+        full = torch.nn.functional.linear(hidden, layer.dequantize(), layer.bias)
+        blocked_ok = torch.allclose(blocked, full, atol=1e-5)
+        print(f"int{bits} 分块反量化与整体反量化一致: {blocked_ok}")
+
+        report = compare(model_dir, output_dir, list(mini_eval.TASKS), task_dir, limit=12, max_new_tokens=16)
+        print(format_report(report))
+        sizes[bits] = report["size_mb"]["quantized"]
+        # 随机权重是量化最不利的情况; 词嵌入保持原精度，在微型模型 (词表32000) 中占大部分体积
+        tolerance = 0.05 if bits == 8 else 0.3
+        ok = ok and round_trip and blocked_ok and report["size_reduction"] > 1.5
+        ok = ok and report["logits_relative_error"] < tolerance and "accuracy_delta" in report
+    return ok and sizes[4] < sizes[8]
+
+def main():
+    parser = argparse.ArgumentParser(description="合并模型的仅权重int8/int4导出与对比")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用随机微型模型自检")
+    parser.add_argument("--model_dir", type=str, default=None, help="save_merged_model.py输出的合并模型目录")
+    parser.add_argument("--output_dir", type=str, default=None, help="输出目录，默认为 [model_dir]-int[bits]")
+    parser.add_argument("--bits", type=int, default=4, choices=[4, 8])
+    parser.add_argument("--group_size", type=int, default=DEFAULT_GROUP_SIZE)
+    parser.add_argument("--target_modules", type=str, default=",".join(EXPORT_TARGET_MODULES),
+                        help="逗号分隔的线性层名称")
+    parser.add_argument("--compare", action="store_true", help="导出后与完整精度模型对比")
+    parser.add_argument("--tasks", type=str, default="hellaswag,gsm8k,mmlu_high_school_computer_science")
+    parser.add_argument("--task_dir", type=str, default=None, help="mini_eval.py的本地任务文件目录")
+    parser.add_argument("--limit", type=float, default=None, help="每个任务最多评估的样本数 (<1时为比例)")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--report_file", type=str, default=None, help="对比报告JSON输出路径")
+    args = parser.parse_args()
+
+    if args.self_test:
+        with tempfile.TemporaryDirectory() as work_dir:
+            ok = self_test(work_dir)
+        if not ok:
+            print("❌ 量化导出自检失败")
+            raise SystemExit(1)
+        print("✅ 量化导出自检通过")
+        return
+
+    if not args.model_dir:
+        parser.error("导出需要 --model_dir")
+    output_dir = args.output_dir or f"{args.model_dir.rstrip('/')}-int{args.bits}"
+    target_modules = [name.strip() for name in args.target_modules.split(",") if name.strip()]
+    export(args.model_dir, output_dir, args.bits, args.group_size, target_modules)
+
+    if args.compare:
+        tasks = [task.strip() for task in args.tasks.split(",") if task.strip()]
+        report = compare(args.model_dir, output_dir, tasks, args.task_dir, args.limit, args.batch_size)
+        print(format_report(report))
+        report_file = args.report_file or os.path.join(output_dir, "quantization_report.json")
+        report_dir = os.path.dirname(report_file)
+        if report_dir:
+            os.makedirs(report_dir, exist_ok=True)
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"✓ 对比报告已保存: {report_file}")
+
+if __name__ == "__main__":
+    main()
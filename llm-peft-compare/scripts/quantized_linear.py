@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+不依赖bitsandbytes的仅权重量化 (int8 / int4)，用于CPU/MPS上的QLoRA训练
+
+- 冻结的nn.Linear权重按输入维度分组做对称量化，每组一个缩放系数
+  (int4每两个值打包成一个字节)
+- 前向时按需反量化后做矩阵乘法; 反向只保存量化权重，需要时重新反量化，
+  不会为每一层保留一份完整精度的权重
+- QuantizedLinear是nn.Linear的子类，可以直接作为PEFT LoRA的目标模块
+- 推理 (no_grad) 时按输出行分块反量化并计算，临时浮点权重只有一块大小
+
+用法 (CPU自检: 报告每个模块节省的字节数、量化误差，并验证LoRA梯度):
+  python scripts/quantized_linear.py --self_test --bits 4
+"""
+
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+DEFAULT_GROUP_SIZE = 64
+# 推理时每次反量化的输出行数
+INFERENCE_BLOCK_ROWS = 256
+# 默认量化解码层中的所有线性层 (lm_head保持原精度)
+DEFAULT_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+
+
+def quantize_weight(weight, bits=8, group_size=DEFAULT_GROUP_SIZE):
+    """对称分组量化，返回 (qweight, scales, group_size)
+
+    int8: qweight为 (out, in) 的int8; int4: qweight为 (out, in/2) 的uint8 (低4位在前)
+    """
+    out_features, in_features = weight.shape
+    if in_features % group_size != 0:
+        # 无法整除时每行一组
+        group_size = in_features
+    qmax = 127 if bits == 8 else 7
+
+    grouped = weight.detach().float().reshape(out_features, in_features // group_size, group_size)
+    scales = grouped.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / qmax
+    q = torch.clamp(torch.round(grouped / scales), -qmax, qmax).to(torch.int8).reshape(out_features, in_features)
+
+    if bits == 4:
+        unsigned = (q + 8).to(torch.uint8)
+        q = unsigned[:, 0::2] | (unsigned[:, 1::2] << 4)
+    return q.contiguous(), scales.reshape(out_features, -1).to(torch.float16), group_size
+
+def dequantize_weight(qweight, scales, bits, group_size, out_features, in_features, dtype=torch.float32):
+    """还原为 (out, in) 的浮点权重"""
+    if bits == 4:
+        low = (qweight & 0x0F).to(torch.int8) - 8
+        high = (qweight >> 4).to(torch.int8) - 8
+        q = torch.stack([low, high], dim=-1).reshape(out_features, in_features)
+    else:
+        q = qweight
+    grouped = q.reshape(out_features, in_features // group_size, group_size).to(dtype)
+    return (grouped * scales.to(dtype).unsqueeze(-1)).reshape(out_features, in_features)
+
+class _QuantizedMatmul(torch.autograd.Function):
+    """x @ W^T + b，W由量化权重即时还原; 反向重新反量化而不是保存浮点权重"""
+
+    @staticmethod
+    def forward(ctx, x, qweight, scales, bias, layer):
+        weight = layer.dequantize(x.dtype)
+        ctx.save_for_backward(qweight, scales)
+        ctx.layer = layer
+        return F.linear(x, weight, bias)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_input = None
+        if ctx.needs_input_grad[0]:
+            weight = ctx.layer.dequantize(grad_output.dtype)
+            grad_input = grad_output @ weight
+        # 量化权重和偏置都是冻结的
+        return grad_input, None, None, None, None
+
+class QuantizedLinear(nn.Linear):
+    """仅权重量化的冻结线性层"""
+
+    def __init__(self, in_features, out_features, bits=8, group_size=DEFAULT_GROUP_SIZE, bias=True,
+                 device=None, compute_dtype=torch.float32):
+        # 不调用nn.Linear.__init__，避免分配完整精度的权重
+        nn.Module.__init__(self)
+        if bits not in (4, 8):
+            raise ValueError(f"只支持4/8位量化: {bits}")
+        if bits == 4 and in_features % 2 != 0:
+            raise ValueError(f"int4量化要求输入维度为偶数: {in_features}")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.compute_dtype = compute_dtype
+        packed = in_features // 2 if bits == 4 else in_features
+        self.register_buffer("qweight", torch.zeros(out_features, packed, dtype=torch.uint8 if bits == 4 else torch.int8,
+                                                   device=device))
+        self.register_buffer("scales", torch.zeros(out_features, in_features // group_size, dtype=torch.float16,
+                                                  device=device))
+        self.register_buffer("bias", torch.zeros(out_features, dtype=compute_dtype, device=device) if bias else None)
+        # PEFT按weight/qweight推断设备; 这里没有浮点权重
+        self.weight = None
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, group_size=DEFAULT_GROUP_SIZE):
+        qweight, scales, group_size = quantize_weight(linear.weight, bits, group_size)
+        layer = cls(linear.in_features, linear.out_features, bits, group_size, bias=linear.bias is not None,
+                    device=linear.weight.device, compute_dtype=linear.weight.dtype)
+        layer.qweight.copy_(qweight)
+        layer.scales.copy_(scales)
+        if linear.bias is not None:
+            layer.bias.copy_(linear.bias.detach())
+        return layer
+
+    def dequantize(self, dtype=None):
+        return dequantize_weight(self.qweight, self.scales, self.bits, self.group_size,
+                                 self.out_features, self.in_features, dtype or self.compute_dtype)
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        if not torch.is_grad_enabled():
+            return self._blocked_linear(x, bias)
+        return _QuantizedMatmul.apply(x, self.qweight, self.scales, bias, self)
+
+    def _blocked_linear(self, x, bias, block_rows=INFERENCE_BLOCK_ROWS):
+        """按输出行分块: 反量化一块权重 -> 计算对应的输出列 (结果与整体反量化相同)"""
+        if self.out_features <= block_rows:
+            return F.linear(x, self.dequantize(x.dtype), bias)
+        output = x.new_empty(*x.shape[:-1], self.out_features)
+        for start in range(0, self.out_features, block_rows):
+            end = min(start + block_rows, self.out_features)
+            weight = dequantize_weight(self.qweight[start:end], self.scales[start:end], self.bits, self.group_size,
+                                       end - start, self.in_features, x.dtype)
+            output[..., start:end] = F.linear(x, weight, bias[start:end] if bias is not None else None)
+        return output
+
+    def nbytes(self):
+        return sum(tensor.numel() * tensor.element_size() for tensor in (self.qweight, self.scales, self.bias)
+                   if tensor is not None)
+
+    def extra_repr(self):
+        return (f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, "
+                f"group_size={self.group_size}, bias={self.bias is not None}")
+
+def quantize_model(model, bits=8, group_size=DEFAULT_GROUP_SIZE, target_modules=None, verbose=True):
+    """把模型中名称匹配target_modules的nn.Linear替换为QuantizedLinear (原地)，返回每个模块的字节报告"""
+    target_modules = target_modules or DEFAULT_TARGET_MODULES
+    report = []
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if type(child) is not nn.Linear or child_name not in target_modules:
+                continue
+            full_name = f"{name}.{child_name}" if name else child_name
+            before = sum(t.numel() * t.element_size() for t in (child.weight, child.bias) if t is not None)
+            quantized = QuantizedLinear.from_linear(child, bits, group_size)
+            setattr(module, child_name, quantized)
+            report.append((full_name, before, quantized.nbytes()))
+
+    if verbose and report:
+        for full_name, before, after in report:
+            print(f"量化模块: {full_name} {before / 1024:.1f}KB -> {after / 1024:.1f}KB")
+        total_before = sum(before for _, before, _ in report)
+        total_after = sum(after for _, _, after in report)
+        print(f"✓ int{bits}量化 {len(report)} 个线性层: {total_before / 1024 ** 2:.2f}MB -> "
+              f"{total_after / 1024 ** 2:.2f}MB (节省 {(total_before - total_after) / 1024 ** 2:.2f}MB, "
+              f"{(1 - total_after / total_before) * 100:.1f}%)")
+    return report
+
+def model_nbytes(model):
+    """模型参数和buffer占用的字节数"""
+    tensors = {id(t): t for t in list(model.parameters()) + list(model.buffers())}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+def self_test(bits=4, group_size=DEFAULT_GROUP_SIZE, hidden_size=256, num_layers=2, seed=0):
+    """量化微型模型，比较输出误差，包装LoRA并检查梯度"""
+    from peft import LoraConfig, get_peft_model
+    from tiny_model import build_tiny_model
+
+    model, _ = build_tiny_model(hidden_size=hidden_size, num_layers=num_layers, intermediate_size=hidden_size * 2,
+                                seed=seed)
+    input_ids = torch.randint(3, model.config.vocab_size, (2, 64), generator=torch.Generator().manual_seed(seed))
+    with torch.no_grad():
+        reference = model(input_ids).logits
+
+    bytes_before = model_nbytes(model)
+    report = quantize_model(model, bits, group_size)
+    bytes_after = model_nbytes(model)
+    with torch.no_grad():
+        quantized = model(input_ids).logits
+    relative_error = float((quantized - reference).norm() / reference.norm())
+
+    lora_config = LoraConfig(r=8, lora_alpha=16, target_modules=["q_proj", "v_proj"], lora_dropout=0.0,
+                             task_type="CAUSAL_LM")
+    peft_model = get_peft_model(model, lora_config)
+    peft_model.train()
+    optimizer = torch.optim.AdamW([p for p in peft_model.parameters() if p.requires_grad], lr=1e-2)
+
+    # 第一步: B初始化为0，只有B有梯度; 更新后第二步A也应有梯度
+    grads = {}
+    losses = []
+    for _ in range(2):
+        optimizer.zero_grad()
+        loss = peft_model(input_ids, labels=input_ids).loss
+        loss.backward()
+        losses.append(loss.item())
+        for name, param in peft_model.named_parameters():
+            if param.requires_grad:
+                grads[name] = float(param.grad.abs().sum()) if param.grad is not None else 0.0
+        optimizer.step()
+
+    trainable = [name for name, param in peft_model.named_parameters() if param.requires_grad]
+    frozen_ok = all(not param.requires_grad for name, param in peft_model.named_parameters() if "lora_" not in name)
+    grads_ok = all(grads[name] > 0 for name in trainable)
+    quantized_layers = sum(isinstance(module, QuantizedLinear) for module in peft_model.modules())
+
+    print(f"\n模型字节数: {bytes_before / 1024 ** 2:.2f}MB -> {bytes_after / 1024 ** 2:.2f}MB "
+          f"(量化层 {len(report)} 个，其中 {quantized_layers} 个仍为QuantizedLinear)")
+    print(f"logits相对误差: {relative_error:.4f}")
+    print(f"LoRA参数 {len(trainable)} 个, 全部有梯度: {grads_ok}, 其余参数冻结: {frozen_ok}")
+    print(f"两步损失: {losses[0]:.4f} -> {losses[1]:.4f}")
+    return relative_error, grads_ok and frozen_ok
+
+def main():
+    parser = argparse.ArgumentParser(description="仅权重int8/int4量化线性层")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用随机微型模型自检")
+    parser.add_argument("--bits", type=int, default=4, choices=[4, 8])
+    parser.add_argument("--group_size", type=int, default=DEFAULT_GROUP_SIZE)
+    args = parser.parse_args()
+
+    if not args.self_test:
+        parser.print_help()
+        return
+
+    relative_error, grads_ok = self_test(args.bits, args.group_size)
+    # 随机初始化的权重接近均匀分布，是量化最不利的情况
+    tolerance = 0.05 if args.bits == 8 else 0.25
+    if relative_error > tolerance or not grads_ok:
+        print("❌ 量化自检失败")
+        raise SystemExit(1)
+    print("✅ 量化自检通过")
+
+if __name__ == "__main__":
+    main()
@@ -39,7 +39,10 @@ echo "评估模型: $MODEL_ID (微调方法: $METHOD)"
 
 # 确保评估框架存在
 EVAL_DIR="lm-evaluation-harness"
-if [ ! -d "$EVAL_DIR" ]; then
+if [ "$USE_MINI_EVAL" == "true" ]; then
+    # 离线评估不需要lm-eval，只保留目录结构 (后面在其中执行命令)
+    mkdir -p "$EVAL_DIR"
+elif [ ! -d "$EVAL_DIR" ]; then
     echo "克隆评估框架..."
     git clone https://github.com/EleutherAI/lm-evaluation-harness.git
     cd lm-evaluation-harness
@@ -121,15 +124,55 @@ LOG_FILE="$PARENT_DIR/eval_logs_${MODEL_TYPE}.log"
 # 将命令修改为同时输出到日志文件
 CMD="$CMD --tasks $TASKS --device $DEVICE --batch_size $BATCH_SIZE --output_path $OUTPUT_FILE"
 
-echo "执行命令: $CMD"
-# 运行命令并将输出同时保存到日志文件
-eval "$CMD" | tee "$LOG_FILE"
+# 评估数据类型 (与上面的dtype参数一致)
+EVAL_DTYPE="auto"
+if [ "$DEVICE" == "mps" ]; then
+    EVAL_DTYPE="float16"
+fi
+
+# 使用逐请求log-likelihood缓存的评估入口 (中断后重跑只计算缺失的请求)
+if [ "$USE_LOGLIK_CACHE" == "true" ]; then
+    CMD="python $PARENT_DIR/scripts/cached_lm_eval.py --model_path $ABSOLUTE_MODEL_PATH --dtype $EVAL_DTYPE"
+    CMD="$CMD --tasks $TASKS --device $DEVICE --batch_size $BATCH_SIZE"
+    CMD="$CMD --cache_path $PARENT_DIR/results/loglik_cache.sqlite --output_file $OUTPUT_FILE"
+fi
+
+# 离线评估: 读取 data/eval_tasks/ 下的本地任务文件，不需要lm-evaluation-harness和联网
+if [ "$USE_MINI_EVAL" == "true" ]; then
+    CMD="python $PARENT_DIR/scripts/mini_eval.py --model_path $ABSOLUTE_MODEL_PATH --dtype $EVAL_DTYPE"
+    CMD="$CMD --tasks $TASKS --device $DEVICE --batch_size $BATCH_SIZE"
+    CMD="$CMD --task_dir $PARENT_DIR/data/eval_tasks --output_file $OUTPUT_FILE"
+fi
+
+# 评估结果缓存 (权重、任务版本和few-shot配置都未变化时直接复用结果)
+CACHE_ARGS="--model_path $ABSOLUTE_MODEL_PATH --dtype $EVAL_DTYPE"
+# mini_eval的结果单独缓存，不会被之后的lm-eval评估复用 (反之亦然)
+if [ "$USE_MINI_EVAL" == "true" ]; then
+    CACHE_ARGS="$CACHE_ARGS --evaluator mini_eval"
+fi
+CACHE_HIT="false"
+if [ "$NO_EVAL_CACHE" != "true" ]; then
+    # 在项目根目录运行，缓存位于 results/eval_cache
+    (cd "$PARENT_DIR" && python scripts/eval_cache.py lookup $CACHE_ARGS --tasks $TASKS --output_file "$OUTPUT_FILE") && CACHE_HIT="true"
+fi
+
+if [ "$CACHE_HIT" == "true" ]; then
+    echo "✓ 使用缓存的评估结果，跳过lm-eval (设置 NO_EVAL_CACHE=true 强制重新评估)"
+else
+    echo "执行命令: $CMD"
+    # 运行命令并将输出同时保存到日志文件
+    eval "$CMD" | tee "$LOG_FILE"
+fi
 
 # 检查结果是否成功生成
 if [ -f "$OUTPUT_FILE" ]; then
     echo "✓ 评估结果已保存: $OUTPUT_FILE"
     # 创建额外备份
     cp "$OUTPUT_FILE" "$PARENT_DIR/results/raw_data/${MODEL_TYPE}_$(date +%Y%m%d_%H%M%S).json"
+    # 写入评估结果缓存
+    if [ "$CACHE_HIT" != "true" ]; then
+        (cd "$PARENT_DIR" && python scripts/eval_cache.py store $CACHE_ARGS --results_file "$OUTPUT_FILE")
+    fi
 else
     echo "❌ 警告: 评估结果文件未生成: $OUTPUT_FILE"
     
@@ -168,10 +211,12 @@ fi
 
 cd $PARENT_DIR
 
-# 运行分析脚本
-echo ""
-echo "📊 分析结果..."
-python scripts/analyze_results.py
+# 运行分析脚本 (流水线中由单独的analyze阶段统一运行)
+if [ "$SKIP_ANALYSIS" != "true" ]; then
+    echo ""
+    echo "📊 分析结果..."
+    python scripts/analyze_results.py
+fi
 
 echo "=================================================="
 echo "✅ 评估完成!"
@@ -7,16 +7,6 @@ import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from peft import PeftModel, PeftConfig
 
-# 参数设置
-parser = argparse.ArgumentParser(description="合并LoRA权重到基础模型并保存")
-parser.add_argument("--model_size", type=str, default="tiny", choices=["tiny", "small", "medium"], 
-                    help="模型大小: tiny (TinyLlama), small (Phi-2), medium (Mistral/LLaMA-2)")
-parser.add_argument("--method", type=str, default="lora", choices=["lora", "qlora"],
-                    help="微调方法: lora, qlora")
-parser.add_argument("--output_dir", type=str, default=None,
-                    help="输出目录，默认为models/[model_id]-instruction-[method]-merged")
-args = parser.parse_args()
-
 # 选择模型
 model_map = {
     "tiny": {"name": "TinyLlama/TinyLlama-1.1B-Chat-v1.0", "id": "tinyllama_1.1b"},
@@ -24,75 +14,158 @@ model_map = {
     "medium": {"name": "mistralai/Mistral-7B-v0.1", "id": "mistral_7b"}
 }
 
-selected_model = model_map[args.model_size]
-MODEL_NAME = selected_model["name"]
-MODEL_ID = selected_model["id"]
-
-# 设置路径
-BASE_MODEL_PATH = MODEL_NAME
-ADAPTER_PATH = f"models/{MODEL_ID}-instruction-{args.method}/final"
-
-if args.output_dir:
-    OUTPUT_PATH = args.output_dir
-else:
-    OUTPUT_PATH = f"models/{MODEL_ID}-instruction-{args.method}-merged"
-
-print(f"基础模型: {BASE_MODEL_PATH}")
-print(f"适配器路径: {ADAPTER_PATH}")
-print(f"输出路径: {OUTPUT_PATH}")
-
-# 检查目录是否存在
-if not os.path.exists(ADAPTER_PATH):
-    raise ValueError(f"适配器路径不存在: {ADAPTER_PATH}, 请先完成微调")
-
-# 加载模型
-print("加载基础模型...")
-device = "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
-print(f"使用设备: {device}")
-
-# 在CPU上加载模型以便于合并
-base_model = AutoModelForCausalLM.from_pretrained(
-    BASE_MODEL_PATH,
-    device_map="cpu",
-    torch_dtype=torch.float32  # 使用float32以避免精度问题
-)
-tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_PATH)
-
-# 加载适配器
-print("加载LoRA适配器...")
-model = PeftModel.from_pretrained(base_model, ADAPTER_PATH)
-
-# 合并权重
-print("合并LoRA权重到基础模型...")
-model = model.merge_and_unload()
-
-# 保存合并后的模型
-print(f"保存合并后的模型到 {OUTPUT_PATH}...")
-model.save_pretrained(OUTPUT_PATH)
-tokenizer.save_pretrained(OUTPUT_PATH)
-
-print(f"✅ 模型合并并保存成功！完整模型位于: {OUTPUT_PATH}")
-
-# 简单测试（可选）
-test_texts = [
-    "写一个简短的问候语",
-    "解释什么是机器学习"
-]
-
-print("\n模型测试:")
-model = model.to(device)
-model.eval()
-
-for text in test_texts:
-    print(f"\n输入: {text}")
-    inputs = tokenizer(text, return_tensors="pt").to(device)
-    with torch.no_grad():
-        outputs = model.generate(
-            inputs["input_ids"], 
-            max_new_tokens=50,
-            temperature=0.7,
-            top_p=0.9,
-            do_sample=True
+
+def merge_adapter(base_model_path, adapter_path, output_path, registry=None):
+    """加载基础模型和适配器，合并后保存，返回 (合并后的模型, 分词器)
+
+    registry: 可选的 model_registry.ModelRegistry，同一进程内合并多个适配器时复用基础权重
+    """
+    # 检查目录是否存在
+    if not os.path.exists(adapter_path):
+        raise ValueError(f"适配器路径不存在: {adapter_path}, 请先完成微调")
+
+    # 在CPU上加载模型以便于合并
+    print("加载基础模型...")
+    if registry is not None:
+        # merge_and_unload会原地修改基础权重，必须使用私有副本
+        base_model = registry.model(base_model_path, torch.float32, copy_weights=True)
+        tokenizer = registry.tokenizer(base_model_path, pad_with_eos=False)
+    else:
+        base_model = AutoModelForCausalLM.from_pretrained(
+            base_model_path,
+            device_map="cpu",
+            torch_dtype=torch.float32  # 使用float32以避免精度问题
         )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    print(f"输出: {response}") 
\ No newline at end of file
+        tokenizer = AutoTokenizer.from_pretrained(base_model_path)
+
+    # 加载适配器
+    print("加载LoRA适配器...")
+    model = PeftModel.from_pretrained(base_model, adapter_path)
+
+    # 合并权重
+    print("合并LoRA权重到基础模型...")
+    model = model.merge_and_unload()
+
+    # 保存合并后的模型
+    print(f"保存合并后的模型到 {output_path}...")
+    model.save_pretrained(output_path)
+    tokenizer.save_pretrained(output_path)
+
+    print(f"✅ 模型合并并保存成功！完整模型位于: {output_path}")
+    return model, tokenizer
+
+def test_generation(model, tokenizer, device, draft_model=None, num_speculative_tokens=4, attn_implementation=None,
+                    torch_compile=False, compile_cache_dir=None):
+    """简单测试（可选）; 指定draft_model时用投机解码做贪心生成，并报告接受率
+
+    attn_implementation / torch_compile: 生成时使用的注意力实现和是否编译forward (见model_compile.py)
+    """
+    import time
+    from model_compile import set_attn_implementation, compile_for_inference
+    test_texts = [
+        "写一个简短的问候语",
+        "解释什么是机器学习"
+    ]
+
+    print("\n模型测试:")
+    model = model.to(device)
+    model.eval()
+    set_attn_implementation(model, attn_implementation)
+    if torch_compile:
+        compile_for_inference(model, cache_dir=compile_cache_dir)
+
+    if draft_model:
+        test_speculative_generation(model, tokenizer, test_texts, draft_model, device, num_speculative_tokens)
+        return
+
+    for text in test_texts:
+        print(f"\n输入: {text}")
+        inputs = tokenizer(text, return_tensors="pt").to(device)
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs = model.generate(
+                inputs["input_ids"],
+                max_new_tokens=50,
+                temperature=0.7,
+                top_p=0.9,
+                do_sample=True
+            )
+        elapsed = time.perf_counter() - start
+        response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+        print(f"输出: {response}")
+        # 编译时第一条包含编译耗时
+        new_tokens = outputs.shape[1] - inputs["input_ids"].shape[1]
+        print(f"生成 {new_tokens} tokens, {elapsed:.2f}s ({new_tokens / elapsed:.1f} tokens/s)")
+
+def test_speculative_generation(model, tokenizer, test_texts, draft_model, device, num_speculative_tokens=4):
+    """草稿模型提出token、合并后的模型验证; 分词器不一致时自动退回普通贪心解码"""
+    import time
+    from mini_eval import load_model
+    from speculative import SpeculativeDecoder, resolve_draft_model, greedy_target_only
+
+    draft_path = resolve_draft_model(draft_model)
+    print(f"草稿模型: {draft_path}")
+    draft, draft_tokenizer = load_model(draft_path, device=device, dtype="float32")
+    decoder = SpeculativeDecoder(model, draft, tokenizer, num_speculative_tokens, draft_tokenizer)
+    target_time = speculative_time = 0.0
+    for text in test_texts:
+        prompt = tokenizer(text)["input_ids"]
+        start = time.perf_counter()
+        tokens = decoder.generate(prompt, max_new_tokens=50)
+        speculative_time += time.perf_counter() - start
+        start = time.perf_counter()
+        reference = greedy_target_only(model, tokenizer, prompt, 50)
+        target_time += time.perf_counter() - start
+        print(f"\n输入: {text}")
+        print(f"输出: {tokenizer.decode(tokens, skip_special_tokens=True)}")
+        if tokens != reference:
+            print("⚠️ 投机解码输出与普通贪心解码不一致")
+    report = decoder.report()
+    print(f"\n投机解码: 接受率 {report['acceptance_rate'] * 100:.1f}%, "
+          f"每次目标前向 {report['tokens_per_target_forward']:.2f} tokens, "
+          f"加速比 {target_time / max(speculative_time, 1e-9):.2f}x")
+
+def main():
+    # 参数设置
+    parser = argparse.ArgumentParser(description="合并LoRA权重到基础模型并保存")
+    parser.add_argument("--model_size", type=str, default="tiny", choices=["tiny", "small", "medium"],
+                        help="模型大小: tiny (TinyLlama), small (Phi-2), medium (Mistral/LLaMA-2)")
+    parser.add_argument("--method", type=str, default="lora", choices=["lora", "qlora"],
+                        help="微调方法: lora, qlora")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help="输出目录，默认为models/[model_id]-instruction-[method]-merged")
+    parser.add_argument("--draft_model", type=str, default=None,
+                        help="生成测试使用投机解码的草稿模型 (目录或tiny/small/medium)")
+    parser.add_argument("--num_speculative_tokens", type=int, default=4)
+    parser.add_argument("--attn_implementation", type=str, default=None, choices=["eager", "sdpa"],
+                        help="生成测试使用的注意力实现 (默认使用模型配置)")
+    parser.add_argument("--torch_compile", action="store_true", help="生成测试前用torch.compile编译forward")
+    parser.add_argument("--compile_cache_dir", type=str, default=None, help="编译缓存目录 (默认 results/compile_cache)")
+    args = parser.parse_args()
+
+    selected_model = model_map[args.model_size]
+    MODEL_NAME = selected_model["name"]
+    MODEL_ID = selected_model["id"]
+
+    # 设置路径
+    BASE_MODEL_PATH = MODEL_NAME
+    ADAPTER_PATH = f"models/{MODEL_ID}-instruction-{args.method}/final"
+
+    if args.output_dir:
+        OUTPUT_PATH = args.output_dir
+    else:
+        OUTPUT_PATH = f"models/{MODEL_ID}-instruction-{args.method}-merged"
+
+    print(f"基础模型: {BASE_MODEL_PATH}")
+    print(f"适配器路径: {ADAPTER_PATH}")
+    print(f"输出路径: {OUTPUT_PATH}")
+
+    device = "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"使用设备: {device}")
+
+    model, tokenizer = merge_adapter(BASE_MODEL_PATH, ADAPTER_PATH, OUTPUT_PATH)
+    test_generation(model, tokenizer, device, args.draft_model, args.num_speculative_tokens, args.attn_implementation,
+                    args.torch_compile, args.compile_cache_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+逐样本统计显著性分析 - 配对bootstrap置信区间与配对置换检验
+
+MMLU-CS只有100道题 (acc_stderr约0.045)，多数方法之间的差异都在噪声范围内。
+本模块读取lm-eval `--log_samples` 输出的逐样本结果，转换为按doc_id排序的
+.npy数组 (之后以内存映射方式加载)，对同一模型的两种方法做配对比较。
+
+向量化实现: 对取值离散的逐样本差值 (准确率类指标只有 -1/0/1)，
+bootstrap重采样的均值只取决于各取值被抽中的次数，直接从多项分布抽样;
+符号翻转置换检验同理从二项分布抽样。上万次重采样也不需要 (B, n) 的下标矩阵。
+
+用法:
+  # 将lm-eval逐样本输出转换为数组 (运行名建议使用 模型_方法，如 tinyllama_lora)
+  python scripts/significance.py convert --samples_dir results/samples_raw/xxx --run tinyllama_lora
+  # 与基础模型比较
+  python scripts/significance.py compare --baseline tinyllama_base --runs tinyllama_lora,tinyllama_qlora
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import argparse
+
+import numpy as np
+
+# 配置
+SAMPLES_DIR = "results/samples"
+
+# 每个任务用于显著性分析的 (指标, 过滤器)
+TASK_METRICS = {
+    "hellaswag": ("acc", "none"),
+    "gsm8k": ("exact_match", "flexible-extract"),
+    "mmlu_high_school_computer_science": ("acc", "none")
+}
+
+# 取值种类不超过该数目时使用多项分布抽样，否则按块生成重采样下标
+MAX_DISCRETE_VALUES = 64
+RESAMPLE_CHUNK = 256
+
+
+def _array_name(task, metric, filter_name):
+    return f"{task}__{metric}__{filter_name}"
+
+def convert_samples(samples_dir, run, output_root=SAMPLES_DIR):
+    """将 samples_{task}_{date}.jsonl 转换为 {run}/{task}__{metric}__{filter}.npy"""
+    run_dir = os.path.join(output_root, run)
+    os.makedirs(run_dir, exist_ok=True)
+    written = []
+
+    for path in sorted(glob.glob(os.path.join(samples_dir, "**", "samples_*.jsonl"), recursive=True)):
+        match = re.match(r"samples_(.+)_\d{4}-\d{2}-\d{2}T[\d\-\.]+\.jsonl$", os.path.basename(path))
+        task = match.group(1) if match else os.path.basename(path)[len("samples_"):-len(".jsonl")]
+
+        # {(metric, filter): {doc_id: value}}
+        values = {}
+        with open(path, 'r') as f:
+            for line in f:
+                sample = json.loads(line)
+                filter_name = sample.get("filter", "none")
+                for metric in sample.get("metrics", []):
+                    if isinstance(sample.get(metric), (int, float)):
+                        values.setdefault((metric, filter_name), {})[sample["doc_id"]] = sample[metric]
+
+        for (metric, filter_name), by_doc in values.items():
+            doc_ids = np.array(sorted(by_doc), dtype=np.int64)
+            scores = np.array([by_doc[doc_id] for doc_id in doc_ids], dtype=np.float32)
+            name = _array_name(task, metric, filter_name)
+            np.save(os.path.join(run_dir, f"{name}.npy"), scores)
+            np.save(os.path.join(run_dir, f"{name}.doc_ids.npy"), doc_ids)
+            written.append((name, len(scores), float(scores.mean())))
+    return written
+
+def load_scores(run, task, metric=None, filter_name=None, root=SAMPLES_DIR):
+    """以内存映射方式加载某次运行的逐样本得分，返回 (doc_ids, scores)，不存在时返回None"""
+    if metric is None:
+        metric, filter_name = TASK_METRICS.get(task, ("acc", "none"))
+    name = _array_name(task, metric, filter_name or "none")
+    path = os.path.join(root, run, f"{name}.npy")
+    if not os.path.exists(path):
+        return None
+    scores = np.load(path, mmap_mode='r')
+    doc_ids = np.load(os.path.join(root, run, f"{name}.doc_ids.npy"), mmap_mode='r')
+    return doc_ids, scores
+
+def align_pair(first, second):
+    """按doc_id对齐两次运行的得分 (只保留共同的样本)"""
+    doc_a, scores_a = first
+    doc_b, scores_b = second
+    if len(doc_a) == len(doc_b) and np.array_equal(doc_a, doc_b):
+        return np.asarray(scores_a, dtype=np.float64), np.asarray(scores_b, dtype=np.float64)
+    _, index_a, index_b = np.intersect1d(doc_a, doc_b, assume_unique=True, return_indices=True)
+    return np.asarray(scores_a[index_a], dtype=np.float64), np.asarray(scores_b[index_b], dtype=np.float64)
+
+def bootstrap_means(values, n_resamples=10000, seed=0):
+    """返回 n_resamples 个bootstrap重采样均值"""
+    rng = np.random.default_rng(seed)
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    unique, counts = np.unique(values, return_counts=True)
+
+    if len(unique) <= MAX_DISCRETE_VALUES:
+        # 有放回抽n次时各取值被抽中的次数服从多项分布
+        draws = rng.multinomial(n, counts / n, size=n_resamples)
+        return draws @ unique / n
+
+    means = np.empty(n_resamples)
+    for start in range(0, n_resamples, RESAMPLE_CHUNK):
+        size = min(RESAMPLE_CHUNK, n_resamples - start)
+        indices = rng.integers(0, n, size=(size, n), dtype=np.int32)
+        means[start:start + size] = values[indices].mean(axis=1)
+    return means
+
+def paired_bootstrap(scores_a, scores_b, n_resamples=10000, alpha=0.05, seed=0):
+    """配对bootstrap: 返回 b - a 的均值差及其 (1-alpha) 置信区间"""
+    diff = np.asarray(scores_b, dtype=np.float64) - np.asarray(scores_a, dtype=np.float64)
+    means = bootstrap_means(diff, n_resamples, seed)
+    low, high = np.quantile(means, [alpha / 2, 1 - alpha / 2])
+    return {"mean_diff": float(diff.mean()), "ci_low": float(low), "ci_high": float(high), "n": len(diff)}
+
+def paired_permutation_test(scores_a, scores_b, n_permutations=10000, seed=0):
+    """配对置换检验 (随机交换每对样本的方法标签)，返回双侧p值"""
+    rng = np.random.default_rng(seed)
+    diff = np.asarray(scores_b, dtype=np.float64) - np.asarray(scores_a, dtype=np.float64)
+    observed = abs(diff.sum())
+    magnitudes, counts = np.unique(np.abs(diff[diff != 0]), return_counts=True)
+    if len(magnitudes) == 0:
+        return 1.0
+
+    if len(magnitudes) <= MAX_DISCRETE_VALUES:
+        # 同一绝对值的m个差值中取正号的个数服从Binomial(m, 0.5)
+        positives = rng.binomial(counts, 0.5, size=(n_permutations, len(counts)))
+        stats = (2 * positives - counts) @ magnitudes
+    else:
+        nonzero = diff[diff != 0]
+        stats = np.empty(n_permutations)
+        for start in range(0, n_permutations, RESAMPLE_CHUNK):
+            size = min(RESAMPLE_CHUNK, n_permutations - start)
+            signs = rng.integers(0, 2, size=(size, len(nonzero)), dtype=np.int8) * 2 - 1
+            stats[start:start + size] = signs @ nonzero
+
+    # 加1校正，避免p值为0
+    return float((np.sum(np.abs(stats) >= observed - 1e-12) + 1) / (n_permutations + 1))
+
+def significance_stars(p_value):
+    """p值对应的显著性标记"""
+    if p_value is None:
+        return ""
+    if p_value < 0.001:
+        return "***"
+    if p_value < 0.01:
+        return "**"
+    if p_value < 0.05:
+        return "*"
+    return "n.s."
+
+def compare_runs(baseline, run, task, n_resamples=10000, seed=0, root=SAMPLES_DIR):
+    """比较两次运行在某任务上的逐样本得分，缺少数据时返回None"""
+    first = load_scores(baseline, task, root=root)
+    second = load_scores(run, task, root=root)
+    if first is None or second is None:
+        return None
+    scores_a, scores_b = align_pair(first, second)
+    if len(scores_a) == 0:
+        return None
+    result = paired_bootstrap(scores_a, scores_b, n_resamples, seed=seed)
+    result["p_value"] = paired_permutation_test(scores_a, scores_b, n_resamples, seed=seed)
+    result["stars"] = significance_stars(result["p_value"])
+    result["baseline_mean"] = float(scores_a.mean())
+    result["run_mean"] = float(scores_b.mean())
+    return result
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="逐样本显著性分析")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert", help="将lm-eval逐样本输出转换为.npy数组")
+    convert_parser.add_argument("--samples_dir", required=True, help="包含samples_*.jsonl的目录")
+    convert_parser.add_argument("--run", required=True, help="运行名，如 tinyllama_lora")
+
+    compare_parser = subparsers.add_parser("compare", help="配对bootstrap和置换检验")
+    compare_parser.add_argument("--baseline", required=True, help="基线运行名，如 tinyllama_base")
+    compare_parser.add_argument("--runs", required=True, help="逗号分隔的对比运行名")
+    compare_parser.add_argument("--tasks", default=",".join(TASK_METRICS), help="逗号分隔的任务")
+    compare_parser.add_argument("--n_resamples", type=int, default=10000, help="重采样/置换次数")
+    compare_parser.add_argument("--seed", type=int, default=0)
+    compare_parser.add_argument("--output_file", default="results/significance.json", help="结果JSON")
+
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        written = convert_samples(args.samples_dir, args.run)
+        if not written:
+            print(f"❌ 在 {args.samples_dir} 中没有找到samples_*.jsonl")
+            return
+        for name, count, mean in written:
+            print(f"✓ {args.run}/{name}: {count} 个样本, 均值 {mean * 100:.2f}%")
+        return
+
+    report = {}
+    for run in [run.strip() for run in args.runs.split(",") if run.strip()]:
+        for task in [task.strip() for task in args.tasks.split(",") if task.strip()]:
+            start = time.perf_counter()
+            result = compare_runs(args.baseline, run, task, args.n_resamples, args.seed)
+            elapsed = time.perf_counter() - start
+            if result is None:
+                print(f"⚠️ 缺少逐样本数据: {args.baseline} / {run} / {task}")
+                continue
+            report.setdefault(run, {})[task] = result
+            print(f"{run} vs {args.baseline} [{task}] (n={result['n']}): "
+                  f"差值 {result['mean_diff'] * 100:+.2f}% "
+                  f"95%CI [{result['ci_low'] * 100:+.2f}%, {result['ci_high'] * 100:+.2f}%] "
+                  f"p={result['p_value']:.4f} {result['stars']} ({elapsed:.2f}s)")
+
+    output_dir = os.path.dirname(args.output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output_file, 'w') as f:
+        json.dump({"baseline": args.baseline, "n_resamples": args.n_resamples, "comparisons": report}, f, indent=2)
+    print(f"✓ 显著性结果已保存: {args.output_file}")
+
+if __name__ == "__main__":
+    main()
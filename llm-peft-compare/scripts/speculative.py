@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+投机解码 (贪心): 小的草稿模型 (如TinyLlama，可以是微调后的) 先连续提出k个token，
+目标模型 (Phi-2 / Mistral 等) 一次前向验证这k个token
+
+- 目标模型对 [上一个token, 草稿1..k] 一次前向，得到k+1个位置的贪心token;
+  接受与草稿一致的最长前缀，再加上目标模型在第一个不一致位置 (或全部接受后下一个位置) 的token
+- 两个模型的KV缓存都裁剪到已确认的长度，被拒绝的草稿不会留在缓存中
+- 输出与只用目标模型贪心解码完全相同; 报告接受率、每次目标前向确认的token数和加速比
+- 草稿与目标的分词器不一致 (词表不同) 时给出提示并退回普通的贪心解码
+- 加速取决于接受率和"验证k+1个token的前向 ≈ 1个token的前向"是否成立: 大模型在GPU上解码受显存带宽限制时成立;
+  单CPU上的微型模型是计算受限的，验证的开销随k增长，自检中的加速比接近1
+
+mini_eval.py --draft_model 用于生成任务，save_merged_model.py --draft_model 用于合并后的生成测试。
+--draft_model 可以写 train_instruction.py 中 model_options 的名字 (tiny/small/medium)。
+
+用法:
+  # CPU自检: 两个共用分词器的随机微型模型，检查输出一致并报告接受率/加速比
+  python scripts/speculative.py --self_test
+  python scripts/speculative.py --target_model models/phi_2.7b-instruction-lora-merged \\
+      --draft_model models/tinyllama_1.1b-instruction-lora-merged --num_speculative_tokens 4
+"""
+
+import time
+import argparse
+
+import torch
+
+DEFAULT_NUM_SPECULATIVE_TOKENS = 4
+
+
+def tokenizers_compatible(target_tokenizer, draft_tokenizer):
+    """两个分词器把同一个token映射到同一个id (词表和特殊token一致) 时才能直接交换token id"""
+    if target_tokenizer is draft_tokenizer:
+        return True
+    return (target_tokenizer.get_vocab() == draft_tokenizer.get_vocab()
+            and target_tokenizer.eos_token_id == draft_tokenizer.eos_token_id
+            and target_tokenizer.bos_token_id == draft_tokenizer.bos_token_id)
+
+def crop_cache(cache, length):
+    """只保留前length个位置的KV"""
+    for layer in cache.layers:
+        layer.keys = layer.keys[:, :, :length]
+        layer.values = layer.values[:, :, :length]
+
+def resolve_draft_model(name):
+    """model_options中的名字 (tiny/small/medium) -> HF模型名，其他原样返回"""
+    from train_instruction import model_options
+    return model_options[name]["name"] if name in model_options else name
+
+class SpeculativeDecoder:
+    """单条序列的投机贪心解码; 分词器不一致时 enabled=False，只用目标模型"""
+
+    def __init__(self, target, draft, tokenizer, num_speculative_tokens=DEFAULT_NUM_SPECULATIVE_TOKENS,
+                 draft_tokenizer=None):
+        self.target = target
+        self.draft = draft
+        self.tokenizer = tokenizer
+        self.k = num_speculative_tokens
+        self.device = next(target.parameters()).device
+        self.enabled = draft is not None and tokenizers_compatible(tokenizer, draft_tokenizer or tokenizer)
+        if draft is not None and self.enabled and draft.config.vocab_size > target.config.vocab_size:
+            # 草稿可能提出目标模型没有的id
+            self.enabled = False
+        if draft is not None and not self.enabled:
+            print("⚠️ 草稿模型与目标模型的分词器/词表不一致，退回普通贪心解码")
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"proposed": 0, "accepted": 0, "target_forwards": 0, "draft_forwards": 0, "generated": 0}
+
+    def _forward(self, model, tokens, cache, keep=1):
+        """前向tokens，返回 (最后keep个位置的logits, 缓存)"""
+        input_ids = torch.tensor([tokens], dtype=torch.long, device=self.device)
+        out = model(input_ids=input_ids, past_key_values=cache, use_cache=True, logits_to_keep=keep)
+        return out.logits[0], out.past_key_values
+
+    @torch.no_grad()
+    def generate(self, prompt, max_new_tokens=256, until=(), eos_token_id=None):
+        """prompt: token id列表，返回生成的token id列表 (不含EOS; 遇到停止串时包含停止串所在的token)"""
+        from generation_engine import StopChecker
+
+        checker = StopChecker(self.tokenizer, until)
+        eos_token_id = self.tokenizer.eos_token_id if eos_token_id is None else eos_token_id
+        prompt = list(prompt)
+        # 缓存中是除最后一个已确认token之外的全部token; 最后一个token在下一次前向时输入
+        logits, target_cache = self._forward(self.target, prompt, None)
+        self.stats["target_forwards"] += 1
+        generated = [int(logits[-1].argmax())]
+        target_length = len(prompt)
+        draft_cache, draft_length = None, 0
+
+        while generated[-1] != eos_token_id and len(generated) < max_new_tokens and not checker.hit(generated):
+            tokens = prompt + generated
+            k = min(self.k, max_new_tokens - len(generated)) if self.enabled else 0
+            proposals = []
+            if k > 0:
+                # 草稿: 先补上缓存中缺少的已确认token，再逐个提出k个token
+                logits, draft_cache = self._forward(self.draft, tokens[draft_length:], draft_cache)
+                draft_length = len(tokens)
+                proposals.append(int(logits[-1].argmax()))
+                for _ in range(k - 1):
+                    logits, draft_cache = self._forward(self.draft, proposals[-1:], draft_cache)
+                    proposals.append(int(logits[-1].argmax()))
+                self.stats["draft_forwards"] += k
+                # 草稿缓存中有 已确认token + proposals[:-1]
+
+            logits, target_cache = self._forward(self.target, tokens[target_length:] + proposals, target_cache,
+                                                 keep=len(proposals) + 1)
+            self.stats["target_forwards"] += 1
+            verified = logits.argmax(dim=-1).tolist()
+            accepted = 0
+            while accepted < len(proposals) and proposals[accepted] == verified[accepted]:
+                accepted += 1
+            new_tokens = proposals[:accepted] + [verified[accepted]]
+            self.stats["proposed"] += len(proposals)
+            self.stats["accepted"] += accepted
+
+            # 逐个追加，保证EOS/停止串/长度上限的位置与普通贪心解码相同
+            for token in new_tokens:
+                generated.append(token)
+                if token == eos_token_id or len(generated) >= max_new_tokens or checker.hit(generated):
+                    break
+            target_length = len(prompt) + len(generated) - 1
+            crop_cache(target_cache, target_length)
+            if draft_cache is not None:
+                draft_length = min(draft_length + len(proposals) - 1, target_length)
+                crop_cache(draft_cache, draft_length)
+
+        if generated[-1] == eos_token_id:
+            generated.pop()
+        self.stats["generated"] += len(generated)
+        return generated
+
+    def generate_text(self, prompt, max_new_tokens=256, until=()):
+        """生成并解码，截断到第一个停止串"""
+        from generation_engine import StopChecker
+        return StopChecker(self.tokenizer, until).finalize(self.generate(prompt, max_new_tokens, until))
+
+    def report(self):
+        stats = self.stats
+        acceptance = stats["accepted"] / max(stats["proposed"], 1)
+        per_forward = stats["generated"] / max(stats["target_forwards"], 1)
+        return {**stats, "acceptance_rate": acceptance, "tokens_per_target_forward": per_forward}
+
+def greedy_target_only(model, tokenizer, prompt, max_new_tokens, until=()):
+    """基线: 只用目标模型，HF generate贪心解码"""
+    from generation_engine import StopChecker
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    checker = StopChecker(tokenizer, until)
+
+    class StopOnText(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            hit = checker.hit(input_ids[0, len(prompt):].tolist())
+            return torch.full((input_ids.shape[0],), hit, dtype=torch.bool, device=input_ids.device)
+
+    device = next(model.parameters()).device
+    input_ids = torch.tensor([prompt], dtype=torch.long, device=device)
+    with torch.no_grad():
+        output = model.generate(input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=max_new_tokens,
+                                do_sample=False, pad_token_id=tokenizer.pad_token_id,
+                                eos_token_id=tokenizer.eos_token_id,
+                                stopping_criteria=StoppingCriteriaList([StopOnText()]))
+    tokens = output[0, len(prompt):].tolist()
+    if tokenizer.eos_token_id in tokens:
+        tokens = tokens[:tokens.index(tokenizer.eos_token_id)]
+    return tokens
+
+def _extend_with_damped_layers(draft, extra_layers, damping=0.1, seed=0):
+    """构造与草稿高度一致的更大目标模型: 草稿的全部权重 + extra_layers个输出投影缩小的随机层
+
+    随机初始化的两个模型几乎不会给出相同的贪心token，这样构造可以在CPU上演示接受率高时的加速
+    """
+    import copy
+
+    config = copy.deepcopy(draft.config)
+    config.num_hidden_layers += extra_layers
+    torch.manual_seed(seed)
+    target = type(draft)(config)
+    # 草稿中没有的是新增的层
+    target.load_state_dict(draft.state_dict(), strict=False)
+    with torch.no_grad():
+        for layer in target.model.layers[draft.config.num_hidden_layers:]:
+            layer.self_attn.o_proj.weight.mul_(damping)
+            layer.mlp.down_proj.weight.mul_(damping)
+    return target.eval()
+
+def benchmark(target, drafts, tokenizer, prompts, max_new_tokens=32, num_speculative_tokens=DEFAULT_NUM_SPECULATIVE_TOKENS,
+              until=()):
+    """drafts: [(名称, 草稿模型, 草稿分词器)]; 返回 {名称: 报告}，每个报告含与基线是否一致"""
+    start = time.perf_counter()
+    reference = [greedy_target_only(target, tokenizer, prompt, max_new_tokens, until) for prompt in prompts]
+    base_time = time.perf_counter() - start
+    results = {"只用目标模型": {"seconds": base_time, "matches": len(prompts)}}
+    for name, draft, draft_tokenizer in drafts:
+        decoder = SpeculativeDecoder(target, draft, tokenizer, num_speculative_tokens, draft_tokenizer)
+        start = time.perf_counter()
+        outputs = [decoder.generate(prompt, max_new_tokens, until) for prompt in prompts]
+        elapsed = time.perf_counter() - start
+        results[name] = {**decoder.report(), "seconds": elapsed, "enabled": decoder.enabled,
+                         "matches": sum(a == b for a, b in zip(outputs, reference))}
+
+    tokens = sum(len(output) for output in reference)
+    print(f"{len(prompts)} 个prompt, 共生成 {tokens} tokens, k={num_speculative_tokens}")
+    print(f"{'方式':<22} {'耗时':>7} {'tokens/s':>9} {'加速比':>7} {'接受率':>7} {'token/目标前向':>13} {'与基线一致':>10}")
+    for name, result in results.items():
+        acceptance = f"{result['acceptance_rate'] * 100:.0f}%" if result.get("enabled") else "-"
+        per_forward = f"{result['tokens_per_target_forward']:.2f}" if "tokens_per_target_forward" in result else "1.00"
+        print(f"{name:<22} {result['seconds']:>6.2f}s {tokens / result['seconds']:>9.1f} "
+              f"{base_time / result['seconds']:>6.2f}x {acceptance:>7} {per_forward:>13} "
+              f"{result['matches']:>6}/{len(prompts)}")
+    return results
+
+def self_test(num_prompts=4, max_new_tokens=40, num_speculative_tokens=3, seed=0):
+    from transformers import AutoTokenizer
+    from tiny_model import build_tiny_model, TOKENIZER_DIR
+
+    # 草稿: 1层; 目标: 草稿 + 5个近似恒等的层 (单token前向约为草稿的2.3倍)
+    # 单CPU上验证k个token的前向耗时随k增长 (3个token约为1个的1.2倍，5个约1.8倍)，所以k取3
+    draft, tokenizer = build_tiny_model(hidden_size=768, num_layers=1, num_heads=12, num_kv_heads=4,
+                                        intermediate_size=3072, seed=seed)
+    target = _extend_with_damped_layers(draft, extra_layers=5, damping=0.03, seed=seed + 1)
+    independent, _ = build_tiny_model(hidden_size=64, num_layers=1, seed=seed + 2)
+    # 词表不同的分词器 (多一个token): 应当退回普通贪心解码
+    other_tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_DIR)
+    other_tokenizer.add_tokens(["<extra_token>"])
+
+    generator = torch.Generator().manual_seed(seed)
+    prompts = [torch.randint(3, target.config.vocab_size, (int(length),), generator=generator).tolist()
+               for length in torch.randint(16, 96, (num_prompts,), generator=generator)]
+    drafts = [("草稿=目标的前1层", draft, tokenizer),
+              ("草稿=独立随机小模型", independent, tokenizer),
+              ("分词器不一致 (退回)", independent, other_tokenizer)]
+    greedy_target_only(target, tokenizer, prompts[0], 4)  # 预热
+    results = benchmark(target, drafts, tokenizer, prompts, max_new_tokens, num_speculative_tokens)
+    # 停止串: 截断位置也必须与基线一致
+    stop_results = benchmark(target, drafts[:1], tokenizer, prompts, max_new_tokens, num_speculative_tokens,
+                             until=["ar", "ie"])
+
+    ok = all(result["matches"] == num_prompts for result in list(results.values()) + list(stop_results.values()))
+    ok = ok and not results["分词器不一致 (退回)"]["enabled"]
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="投机解码 (贪心)")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用随机微型模型自检")
+    parser.add_argument("--target_model", type=str, default=None, help="目标模型目录 (合并模型或适配器目录)")
+    parser.add_argument("--draft_model", type=str, default="tiny", help="草稿模型目录，或model_options中的名字")
+    parser.add_argument("--num_speculative_tokens", type=int, default=DEFAULT_NUM_SPECULATIVE_TOKENS)
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--num_prompts", type=int, default=8)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    if args.self_test:
+        if not self_test():
+            print("❌ 投机解码自检失败")
+            raise SystemExit(1)
+        print("✅ 投机解码自检通过")
+        return
+
+    if not args.target_model:
+        parser.error("需要 --target_model 或 --self_test")
+    from mini_eval import load_model
+    from inference_client import load_prompts
+
+    target, tokenizer = load_model(args.target_model, device=args.device)
+    draft, draft_tokenizer = load_model(resolve_draft_model(args.draft_model), device=args.device)
+    prompts = [tokenizer(prompt)["input_ids"] for prompt in load_prompts(n=args.num_prompts)]
+    benchmark(target, [(f"草稿={args.draft_model}", draft, draft_tokenizer)], tokenizer, prompts,
+              args.max_new_tokens, args.num_speculative_tokens)
+
+if __name__ == "__main__":
+    main()
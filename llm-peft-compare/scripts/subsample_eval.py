@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+低成本评估模式 - 分层随机子样本 + 随时可用的估计值
+
+完整评估一个TinyLlama变体需要近两个小时。本脚本按轮次评估每个任务的分层随机子集
+(每轮样本量按倍数增长)，每轮输出当前准确率及95%置信区间，并在以下任一条件满足时提前停止:
+- 所有模型的置信区间宽度都小于阈值
+- 各方法之间的排名已确定 (相邻名次的配对差值置信区间不包含0)
+
+所有模型使用同一组样本，因此方法之间的比较是配对的。结果JSON带有 "subsampled" 标记，
+analyze_results.py 和 update_evaluation_record.py 会区别显示。
+
+用法:
+  python scripts/subsample_eval.py \
+      --models tinyllama_1.1b_lora=models/tinyllama_1.1b-instruction-lora-merged,tinyllama_1.1b_qlora=models/tinyllama_1.1b-instruction-qlora-merged \
+      --tasks hellaswag,mmlu_high_school_computer_science --ci_width 0.03
+  # CPU自检: 标准误覆盖率模拟 + 随机微型模型和本地任务的端到端评估
+  python scripts/subsample_eval.py --self_test
+"""
+
+import os
+import sys
+import json
+import math
+import argparse
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import torch
+from lm_eval import simple_evaluate
+from lm_eval.tasks import TaskManager, get_task_dict
+from lm_eval.utils import handle_non_serializable
+
+from cached_lm_eval import CachedHFLM
+from significance import TASK_METRICS
+
+Z_95 = 1.959964
+
+
+def stratum_key(task, doc):
+    """每个任务的分层依据"""
+    if task == "hellaswag":
+        return doc.get("activity_label", "")
+    if task == "gsm8k":
+        # 按解题步骤数分层 (答案中的换行数)
+        steps = str(doc.get("answer", "")).count("\n")
+        return min(steps, 8)
+    if task.startswith("mmlu_"):
+        return doc.get("answer", "")
+    return ""
+
+def stratified_order(strata, seed=0):
+    """生成分层随机顺序: 任意前缀中各层所占比例都接近总体比例"""
+    rng = np.random.default_rng(seed)
+    by_stratum = {}
+    for index, key in enumerate(strata):
+        by_stratum.setdefault(key, []).append(index)
+
+    # 每层内部随机打乱，按 (层内名次+随机偏移)/层大小 排序后交错合并
+    keyed = []
+    for members in by_stratum.values():
+        members = rng.permutation(members)
+        offset = rng.random()
+        for rank, index in enumerate(members):
+            keyed.append(((rank + offset) / len(members), int(index)))
+    keyed.sort()
+    return [index for _, index in keyed]
+
+def stratified_estimate(scores, strata, population_sizes):
+    """分层估计的均值及其标准误 (含有限总体校正)
+
+    只抽到1个样本的层无法估计层内方差，使用各层合并的层内方差 (不能按0计算:
+    HellaSwag按activity_label分层时，前几轮大多数层只有1个样本，标准误会被明显低估)。
+    """
+    total = sum(population_sizes.values())
+    groups = _group(scores, strata)
+    pooled_ss, pooled_df = 0.0, 0
+    for values in groups.values():
+        if len(values) > 1:
+            pooled_ss += float(np.var(values, ddof=1)) * (len(values) - 1)
+            pooled_df += len(values) - 1
+    # 所有层都只有1个样本时退回到全部样本的方差
+    pooled_var = pooled_ss / pooled_df if pooled_df else (float(np.var(scores, ddof=1)) if len(scores) > 1 else 0.0)
+
+    mean = 0.0
+    variance = 0.0
+    for key, values in groups.items():
+        weight = population_sizes[key] / total
+        n_h = len(values)
+        mean += weight * float(np.mean(values))
+        var_h = float(np.var(values, ddof=1)) if n_h > 1 else pooled_var
+        fpc = 1 - n_h / population_sizes[key]
+        variance += weight ** 2 * var_h / n_h * fpc
+    # 未抽到的层按已抽样层的权重重新归一化
+    covered = sum(population_sizes[key] for key in set(strata)) / total
+    return mean / covered, math.sqrt(variance) / covered
+
+def _group(scores, strata):
+    groups = {}
+    for score, key in zip(scores, strata):
+        groups.setdefault(key, []).append(score)
+    return groups
+
+def evaluate_subset(lm, task, indices, task_manager, num_fewshot=None):
+    """用lm-eval评估指定样本，返回 {原始下标: {指标键: 值}}"""
+    selected = sorted(indices)
+    output = simple_evaluate(
+        model=lm,
+        tasks=[task],
+        num_fewshot=num_fewshot,
+        samples={task: selected},
+        log_samples=True,
+        task_manager=task_manager,
+        # 标准误由逐样本结果按分层估计计算; lm-eval的自助法会启动进程池 (在守护进程中不允许)
+        bootstrap_iters=0
+    )
+    per_doc = {}
+    for sample in output["samples"][task]:
+        # 指定samples时lm-eval记录的doc_id已经是样本在数据集中的原始下标
+        index = sample["doc_id"]
+        filter_name = sample.get("filter", "none")
+        for metric in sample.get("metrics", []):
+            if isinstance(sample.get(metric), (int, float)):
+                per_doc.setdefault(index, {})[f"{metric},{filter_name}"] = float(sample[metric])
+    if set(per_doc) != set(selected):
+        raise RuntimeError(f"{task}: lm-eval返回的样本下标与所选样本不一致 "
+                           f"(多出 {sorted(set(per_doc) - set(selected))[:5]}, 缺少 {sorted(set(selected) - set(per_doc))[:5]})")
+    return per_doc
+
+def check_se_coverage(n_strata=190, population=10000, sample_size=200, repeats=1000, seed=0):
+    """模拟大多数层只抽到1个样本的情形: 平均标准误与估计值的实际标准差相近，95%置信区间覆盖率接近95%"""
+    rng = np.random.default_rng(seed)
+    # 与HellaSwag的activity_label类似: 约190个大小相近的层，各层的正确率不同
+    sizes = rng.lognormal(0.0, 0.5, n_strata)
+    sizes = np.maximum(1, (sizes / sizes.sum() * population).astype(int))
+    strata_all = np.repeat(np.arange(n_strata), sizes).tolist()
+    rates = rng.uniform(0.2, 0.8, n_strata)
+    scores_all = (rng.random(len(strata_all)) < rates[strata_all]).astype(float)
+    population_sizes = {key: int(size) for key, size in enumerate(sizes)}
+    truth = float(scores_all.mean())
+
+    estimates, stderrs, covered = [], [], 0
+    for repeat in range(repeats):
+        indices = stratified_order(strata_all, seed=repeat)[:sample_size]
+        mean, stderr = stratified_estimate([scores_all[i] for i in indices], [strata_all[i] for i in indices],
+                                           population_sizes)
+        estimates.append(mean)
+        stderrs.append(stderr)
+        covered += abs(mean - truth) <= Z_95 * stderr
+    singleton = sum(1 for count in _group(indices, [strata_all[i] for i in indices]).values() if len(count) == 1)
+    ratio = float(np.mean(stderrs)) / float(np.std(estimates))
+    coverage = covered / repeats
+    print(f"标准误覆盖率模拟: {singleton}/{len(set(strata_all[i] for i in indices))} 个层只有1个样本, "
+          f"平均标准误/实际标准差 = {ratio:.3f}, 95%置信区间覆盖率 {coverage * 100:.1f}%")
+    return ratio > 0.95 and coverage > 0.93
+
+def write_local_task(task_dir, name="local_subsample_check", num_docs=24, seed=0):
+    """写入一个读取本地JSONL的lm-eval任务 (loglikelihood，逐样本指标为连续的对数似然)，用于离线自检"""
+    rng = np.random.default_rng(seed)
+    words = ["the", "cat", "sat", "on", "a", "mat", "dog", "ran", "to", "big", "red", "house", "under", "tree"]
+    os.makedirs(task_dir, exist_ok=True)
+    data_file = os.path.join(task_dir, f"{name}.jsonl")
+    with open(data_file, 'w') as f:
+        for index in range(num_docs):
+            length = int(rng.integers(3, 9))
+            f.write(json.dumps({"id": index, "text": " ".join(rng.choice(words, length)),
+                                "target": " ".join(rng.choice(words, 2))}) + "\n")
+    with open(os.path.join(task_dir, f"{name}.yaml"), 'w') as f:
+        f.write(f"task: {name}\n"
+                f"dataset_path: json\n"
+                f"dataset_kwargs:\n  data_files:\n    test: {data_file}\n"
+                f"test_split: test\n"
+                f"output_type: loglikelihood\n"
+                f"doc_to_text: \"{{{{text}}}}\"\n"
+                f"doc_to_target: \" {{{{target}}}}\"\n"
+                f"metric_list:\n  - metric: perplexity\n    aggregation: perplexity\n    higher_is_better: false\n"
+                f"  - metric: acc\n    aggregation: mean\n    higher_is_better: true\n"
+                f"metadata:\n  version: 1.0\n")
+    return name
+
+def ranking_settled(names, per_model_scores, strata, population_sizes):
+    """相邻名次之间的配对差值置信区间都不包含0时，排名已确定"""
+    if len(names) < 2:
+        return False
+    estimates = {name: stratified_estimate(per_model_scores[name], strata, population_sizes)[0] for name in names}
+    ranked = sorted(names, key=lambda name: -estimates[name])
+    for better, worse in zip(ranked, ranked[1:]):
+        diff = np.array(per_model_scores[better]) - np.array(per_model_scores[worse])
+        mean, stderr = stratified_estimate(diff, strata, population_sizes)
+        if mean - Z_95 * stderr <= 0:
+            return False
+    return True
+
+def self_test(work_dir):
+    """端到端: 本地任务上子样本评估的逐样本结果与完整评估中对应样本的结果一致"""
+    from tiny_model import create_tiny_model
+
+    model_dir = create_tiny_model(os.path.join(work_dir, "model"), hidden_size=64, num_layers=2, seed=0)
+    task = write_local_task(os.path.join(work_dir, "tasks"))
+    task_manager = TaskManager(include_path=os.path.join(work_dir, "tasks"))
+    lm = CachedHFLM(pretrained=model_dir, device="cpu", dtype="float32", batch_size=8,
+                    cache_path=os.path.join(work_dir, "loglik_cache.sqlite"))
+
+    docs = list(get_task_dict([task], task_manager)[task].eval_docs)
+    full = evaluate_subset(lm, task, list(range(len(docs))), task_manager)
+    # 分层顺序的一个前缀 (乱序、不连续的原始下标)
+    indices = stratified_order([doc["id"] % 3 for doc in docs], seed=7)[:9]
+    subset = evaluate_subset(lm, task, indices, task_manager)
+
+    max_diff = max(abs(subset[index][key] - full[index][key]) for index in indices for key in subset[index])
+    distinct = len({round(full[index]["perplexity,none"], 6) for index in indices})
+    print(f"所选样本: {indices}")
+    print(f"子样本与完整评估的逐样本最大差异: {max_diff:.2e} (不同的逐样本值: {distinct}/{len(indices)})")
+    return sorted(subset) == sorted(indices) and max_diff < 1e-4 and distinct == len(indices)
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="分层子样本评估，置信区间足够窄或排名确定时提前停止")
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用微型模型和本地任务自检逐样本结果的对应关系")
+    parser.add_argument("--models", type=str, default=None, help="逗号分隔的 名称=模型路径")
+    parser.add_argument("--tasks", type=str, default="hellaswag,gsm8k,mmlu_high_school_computer_science")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="auto")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_fewshot", type=int, default=None)
+    parser.add_argument("--initial_size", type=int, default=200, help="第一轮每个任务的样本数")
+    parser.add_argument("--growth", type=float, default=2.0, help="每轮样本量增长倍数")
+    parser.add_argument("--ci_width", type=float, default=0.03, help="95%%置信区间宽度阈值 (比例)")
+    parser.add_argument("--max_fraction", type=float, default=1.0, help="最多评估的样本比例")
+    parser.add_argument("--no_ranking_stop", action="store_true", help="排名确定时不提前停止")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output_dir", type=str, default="results/model_comparison")
+    parser.add_argument("--cache_path", type=str, default="results/loglik_cache.sqlite", help="log-likelihood缓存文件")
+    parser.add_argument("--include_path", type=str, default=None, help="额外的lm-eval任务YAML目录 (本地任务)")
+    args = parser.parse_args()
+
+    if args.self_test:
+        ok = check_se_coverage()
+        with tempfile.TemporaryDirectory() as work_dir:
+            ok = self_test(work_dir) and ok
+        if not ok:
+            print("❌ 子样本评估自检失败")
+            sys.exit(1)
+        print("✅ 子样本评估自检通过")
+        return
+    if not args.models:
+        parser.error("需要 --models")
+
+    models = {}
+    for item in args.models.split(","):
+        name, path = item.split("=", 1)
+        models[name.strip()] = path.strip()
+    tasks = [task.strip() for task in args.tasks.split(",") if task.strip()]
+
+    # 加载所有模型 (同一批样本依次评估所有模型，保证比较是配对的)
+    lms = {}
+    for name, path in models.items():
+        print(f"加载模型: {name} ({path})")
+        lms[name] = CachedHFLM(pretrained=path, device=args.device, dtype=args.dtype,
+                               batch_size=args.batch_size, cache_path=args.cache_path)
+
+    task_manager = TaskManager(include_path=args.include_path)
+    outputs = {name: {"results": {}, "versions": {}, "n-shot": {}, "n-samples": {}, "subsampled": {}} for name in models}
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress_file = os.path.join(args.output_dir, f"subsample_progress_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+
+    for task in tasks:
+        task_obj = get_task_dict([task], task_manager)[task]
+        docs = list(task_obj.eval_docs)
+        strata_all = [stratum_key(task, doc) for doc in docs]
+        population_sizes = {}
+        for key in strata_all:
+            population_sizes[key] = population_sizes.get(key, 0) + 1
+        order = stratified_order(strata_all, args.seed)
+        primary_metric = ",".join(TASK_METRICS.get(task, ("acc", "none")))
+        max_size = max(1, int(len(docs) * args.max_fraction))
+
+        print(f"\n=== {task}: 共 {len(docs)} 个样本, {len(population_sizes)} 个分层, 主指标 {primary_metric} ===")
+
+        per_doc = {name: {} for name in models}
+        evaluated = 0
+        size = min(args.initial_size, max_size)
+        round_index = 0
+        stop_reason = "达到样本上限"
+        while True:
+            round_index += 1
+            new_indices = order[evaluated:size]
+            for name, lm in lms.items():
+                per_doc[name].update(evaluate_subset(lm, task, new_indices, task_manager, args.num_fewshot))
+            evaluated = size
+
+            indices = order[:evaluated]
+            strata = [strata_all[index] for index in indices]
+            per_model_scores = {name: [per_doc[name][index][primary_metric] for index in indices] for name in models}
+
+            widths = {}
+            for name in models:
+                mean, stderr = stratified_estimate(per_model_scores[name], strata, population_sizes)
+                widths[name] = 2 * Z_95 * stderr
+                print(f"[{task} 第{round_index}轮 n={evaluated}/{len(docs)}] {name}: "
+                      f"{mean * 100:.2f}% ± {Z_95 * stderr * 100:.2f}%")
+                with open(progress_file, 'a') as f:
+                    f.write(json.dumps({"task": task, "round": round_index, "model": name, "n": evaluated,
+                                        "mean": mean, "stderr": stderr}) + "\n")
+            sys.stdout.flush()
+
+            if all(width < args.ci_width for width in widths.values()):
+                stop_reason = f"置信区间宽度 < {args.ci_width}"
+                break
+            if not args.no_ranking_stop and ranking_settled(list(models), per_model_scores, strata, population_sizes):
+                stop_reason = "方法排名已确定"
+                break
+            if evaluated >= max_size:
+                break
+            size = min(max_size, int(math.ceil(evaluated * args.growth)))
+
+        print(f"⏹ {task} 在 n={evaluated} 停止: {stop_reason}")
+
+        # 写入与lm-eval相同结构的结果 (所有指标都用分层估计)
+        indices = order[:evaluated]
+        strata = [strata_all[index] for index in indices]
+        for name in models:
+            metric_keys = sorted({key for index in indices for key in per_doc[name][index]})
+            task_results = {"alias": task}
+            for key in metric_keys:
+                metric, filter_name = key.split(",", 1)
+                values = [per_doc[name][index].get(key, 0.0) for index in indices]
+                mean, stderr = stratified_estimate(values, strata, population_sizes)
+                task_results[key] = mean
+                task_results[f"{metric}_stderr,{filter_name}"] = stderr
+            primary_mean, primary_stderr = stratified_estimate(
+                [per_doc[name][index][primary_metric] for index in indices], strata, population_sizes)
+
+            outputs[name]["results"][task] = task_results
+            outputs[name]["versions"][task] = task_obj.config.metadata.get("version") if task_obj.config.metadata else None
+            outputs[name]["n-shot"][task] = args.num_fewshot
+            outputs[name]["n-samples"][task] = {"original": len(docs), "effective": evaluated}
+            outputs[name]["subsampled"][task] = {
+                "n": evaluated,
+                "population": len(docs),
+                "rounds": round_index,
+                "primary_metric": primary_metric,
+                "ci95": [primary_mean - Z_95 * primary_stderr, primary_mean + Z_95 * primary_stderr],
+                "strata": len(population_sizes),
+                "stop_reason": stop_reason,
+                "seed": args.seed
+            }
+
+    for name, path in models.items():
+        outputs[name]["config"] = {
+            "model": "hf",
+            "model_args": f"pretrained={path},dtype={args.dtype}",
+            "batch_size": args.batch_size,
+            "device": args.device,
+            "num_fewshot": args.num_fewshot,
+            "limit": None,
+            "subsampled": True
+        }
+        output_file = os.path.join(args.output_dir, f"{name}_subsampled.json")
+        with open(output_file, 'w') as f:
+            json.dump(outputs[name], f, indent=2, default=handle_non_serializable)
+        print(f"✓ 子样本评估结果已保存: {output_file}")
+    print(f"✓ 逐轮进度: {progress_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,603 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+超参数搜索 - 基于 train_instruction.py 的并发试验调度
+
+- 搜索空间: 列表为离散取值，{"type": "loguniform"/"uniform"/"int", "low", "high"} 为连续取值
+- 搜索方式: grid (网格) / random (随机) / tpe (基于已完成试验的树结构Parzen估计，一种轻量贝叶斯优化)
+- 每个试验作为独立子进程运行，按设备槽位并发 (每块GPU一个槽位，或若干CPU槽位)；
+  --in_process 时在当前进程内串行运行，分词器、分词后的数据集和基础模型权重只加载一次
+- 异步连续减半 (ASHA) 早停: 试验在各阶梯步数 (min_steps × eta^k) 上的训练损失
+  (从metrics.jsonl中取该步为止的记录) 不在已到达该阶梯试验的前 1/eta 时被终止
+- 结果写入 results/sweeps/<名称>/ 下的 trials.jsonl 和 leaderboard.csv
+
+用法:
+  python scripts/sweep.py --name tiny_lora --method lora --model_size tiny --search random --n_trials 16 \
+      --max_steps 300 --min_steps 30 --space '{"lr": {"type": "loguniform", "low": 1e-5, "high": 1e-3}, "lora_r": [4, 8, 16]}'
+  # CPU端到端自检 (随机微型模型 + 几百条数据)
+  python scripts/sweep.py --self_test
+"""
+
+import os
+import sys
+import csv
+import json
+import math
+import time
+import shlex
+import argparse
+import itertools
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+TRAIN_SCRIPT = os.path.join(SCRIPT_DIR, "train_instruction.py")
+SWEEPS_DIR = os.path.join(PROJECT_ROOT, "results", "sweeps")
+
+DEFAULT_SPACE = {
+    "lr": {"type": "loguniform", "low": 1e-5, "high": 1e-3},
+    "lora_r": [4, 8, 16, 32],
+    "lora_alpha": [16, 32, 64],
+    "lora_target_modules": [
+        "q_proj,v_proj",
+        "q_proj,k_proj,v_proj,o_proj",
+        "q_proj,k_proj,v_proj,o_proj,gate_proj,up_proj,down_proj"
+    ]
+}
+
+# 搜索空间键 -> train_instruction.py 参数
+PARAM_FLAGS = {
+    "lr": "--lr",
+    "lora_r": "--lora_r",
+    "lora_alpha": "--lora_alpha",
+    "lora_dropout": "--lora_dropout",
+    "lora_target_modules": "--lora_target_modules",
+    "batch_size": "--batch_size",
+    "gradient_accumulation_steps": "--gradient_accumulation_steps",
+    "warmup_steps": "--warmup_steps"
+}
+
+# TPE在已完成多少个试验之后才开始建模 (之前随机采样)
+TPE_STARTUP_TRIALS = 5
+# 计算试验得分时平均最近几条损失记录
+LOSS_WINDOW = 3
+
+
+def parse_space(spec):
+    """搜索空间: JSON字符串或JSON文件路径"""
+    if spec is None:
+        return dict(DEFAULT_SPACE)
+    if os.path.exists(spec):
+        with open(spec, 'r') as f:
+            space = json.load(f)
+    else:
+        space = json.loads(spec)
+    for name, domain in space.items():
+        if name not in PARAM_FLAGS:
+            raise ValueError(f"不支持的搜索参数: {name} (可选: {', '.join(PARAM_FLAGS)})")
+        if isinstance(domain, dict) and domain.get("type") not in ("loguniform", "uniform", "int"):
+            raise ValueError(f"{name}: 未知的取值类型 {domain.get('type')}")
+    return space
+
+def grid_configs(space):
+    """网格搜索的所有组合 (要求所有参数都是离散取值)"""
+    for name, domain in space.items():
+        if not isinstance(domain, list):
+            raise ValueError(f"网格搜索要求离散取值，{name} 是连续区间")
+    names = list(space)
+    for values in itertools.product(*(space[name] for name in names)):
+        yield dict(zip(names, values))
+
+def _to_unit(domain, value):
+    """连续取值映射到 [0, 1] (loguniform在对数空间)"""
+    low, high = domain["low"], domain["high"]
+    if domain["type"] == "loguniform":
+        return (math.log(value) - math.log(low)) / (math.log(high) - math.log(low))
+    return (value - low) / (high - low)
+
+def _from_unit(domain, unit):
+    low, high = domain["low"], domain["high"]
+    unit = min(max(unit, 0.0), 1.0)
+    if domain["type"] == "loguniform":
+        return float(math.exp(math.log(low) + unit * (math.log(high) - math.log(low))))
+    if domain["type"] == "int":
+        return int(round(low + unit * (high - low)))
+    return float(low + unit * (high - low))
+
+def sample_config(space, rng):
+    """从搜索空间均匀随机采样一组参数"""
+    config = {}
+    for name, domain in space.items():
+        if isinstance(domain, list):
+            config[name] = domain[int(rng.integers(len(domain)))]
+        else:
+            config[name] = _from_unit(domain, rng.random())
+    return config
+
+def _parzen_log_density(domain, observations, value):
+    """一维Parzen估计的对数密度 (离散: 加一平滑频率; 连续: [0,1]上的高斯核 + 均匀先验)"""
+    if isinstance(domain, list):
+        count = sum(1 for observed in observations if observed == value)
+        return math.log((count + 1) / (len(observations) + len(domain)))
+    points = np.array([_to_unit(domain, observed) for observed in observations])
+    bandwidth = max(0.1, 1.0 / math.sqrt(len(points) + 1))
+    unit = _to_unit(domain, value)
+    kernels = np.exp(-0.5 * ((unit - points) / bandwidth) ** 2) / (bandwidth * math.sqrt(2 * math.pi))
+    return math.log((kernels.sum() + 1.0) / (len(points) + 1))
+
+def _sample_parzen(domain, observations, rng):
+    """从好试验的Parzen分布采样"""
+    if isinstance(domain, list):
+        weights = np.array([1 + sum(1 for observed in observations if observed == value) for value in domain], dtype=float)
+        return domain[int(rng.choice(len(domain), p=weights / weights.sum()))]
+    points = [_to_unit(domain, observed) for observed in observations]
+    # 以 1/(n+1) 的概率从均匀先验采样
+    index = int(rng.integers(len(points) + 1))
+    if index == len(points):
+        return _from_unit(domain, rng.random())
+    bandwidth = max(0.1, 1.0 / math.sqrt(len(points) + 1))
+    return _from_unit(domain, rng.normal(points[index], bandwidth))
+
+def tpe_suggest(space, history, rng, gamma=0.25, n_candidates=24):
+    """树结构Parzen估计: 从好试验的分布采样候选，选 l(x)/g(x) 最大的一个
+
+    history: [(config, score)]，score越小越好，被剪枝的试验score为inf
+    """
+    finished = [(config, score) for config, score in history if score is not None]
+    if len(finished) < TPE_STARTUP_TRIALS:
+        return sample_config(space, rng)
+
+    ranked = sorted(finished, key=lambda item: item[1])
+    n_good = max(1, int(math.ceil(gamma * len(ranked))))
+    good = [config for config, _ in ranked[:n_good]]
+    bad = [config for config, _ in ranked[n_good:]]
+
+    best_config, best_score = None, -math.inf
+    for _ in range(n_candidates):
+        candidate = {name: _sample_parzen(domain, [config[name] for config in good], rng)
+                     for name, domain in space.items()}
+        score = sum(
+            _parzen_log_density(domain, [config[name] for config in good], candidate[name])
+            - _parzen_log_density(domain, [config[name] for config in bad], candidate[name])
+            for name, domain in space.items()
+        )
+        if score > best_score:
+            best_config, best_score = candidate, score
+    return best_config
+
+class AshaPruner:
+    """异步连续减半: 试验到达每个阶梯时，只有损失位于该阶梯前 1/eta 的试验继续训练"""
+
+    def __init__(self, min_steps, max_steps, eta=3):
+        self.eta = eta
+        self.rungs = []
+        step = min_steps
+        while min_steps > 0 and step < max_steps:
+            self.rungs.append(step)
+            step *= eta
+        # {阶梯步数: {试验ID: 损失}}
+        self.rung_losses = {rung: {} for rung in self.rungs}
+
+    def report(self, trial_id, records):
+        """记录试验在新到达的各阶梯上的损失，返回是否应当终止该试验
+
+        一次轮询可能跨过多个阶梯，每个阶梯的损失都取该阶梯步数为止的记录，保证同一阶梯上比较的是相同的训练步数。
+        """
+        last_step = records[-1]["step"] if records else 0
+        for rung in self.rungs:
+            if last_step < rung or trial_id in self.rung_losses[rung]:
+                continue
+            loss = window_loss([record for record in records if record["step"] <= rung])
+            if loss is None:
+                continue
+            losses = self.rung_losses[rung]
+            losses[trial_id] = loss
+            # 阶梯上的试验数不足eta时无法比较，直接晋级
+            keep = max(1, len(losses) // self.eta)
+            if len(losses) >= self.eta and sorted(losses.values())[keep - 1] < loss:
+                return True
+        return False
+
+    def highest_rung(self, trial_id):
+        reached = [rung for rung in self.rungs if trial_id in self.rung_losses[rung]]
+        return max(reached) if reached else 0
+
+def detect_slots(slots_spec, cpu_slots):
+    """解析设备槽位: "auto" 为每块GPU一个槽位 (无GPU时使用cpu_slots个CPU槽位)"""
+    if slots_spec and slots_spec != "auto":
+        return [slot.strip() for slot in slots_spec.split(",") if slot.strip()]
+    try:
+        import torch
+        gpu_count = torch.cuda.device_count()
+    except ImportError:
+        gpu_count = 0
+    if gpu_count:
+        return [f"cuda:{index}" for index in range(gpu_count)]
+    return ["cpu"] * cpu_slots
+
+def slot_env(slot, n_cpu_slots):
+    """子进程环境: GPU槽位只暴露对应的GPU，CPU槽位平分CPU线程"""
+    env = dict(os.environ)
+    if slot.startswith("cuda"):
+        env["CUDA_VISIBLE_DEVICES"] = slot.split(":", 1)[1] if ":" in slot else "0"
+    else:
+        env["CUDA_VISIBLE_DEVICES"] = ""
+        env["OMP_NUM_THREADS"] = str(max(1, (os.cpu_count() or 1) // max(1, n_cpu_slots)))
+    env["TOKENIZERS_PARALLELISM"] = "false"
+    return env
+
+def read_metrics(path):
+    """读取试验的metrics.jsonl"""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 正在写入的最后一行
+                    break
+    return records
+
+def window_loss(records):
+    """最近几条损失记录的平均值"""
+    if not records:
+        return None
+    return float(np.mean([record["loss"] for record in records[-LOSS_WINDOW:]]))
+
+class Trial:
+    """一个试验子进程及其状态"""
+
+    def __init__(self, trial_id, config, sweep_dir):
+        self.trial_id = trial_id
+        self.config = config
+        self.trial_dir = os.path.join(sweep_dir, f"trial_{trial_id:03d}")
+        self.metrics_file = os.path.join(self.trial_dir, "metrics.jsonl")
+        self.log_file = os.path.join(self.trial_dir, "train.log")
+        self.status = "pending"
+        self.slot = None
+        self.process = None
+        self.records = []
+        self.start_time = None
+        self.end_time = None
+
+    def launch(self, slot, base_args, env):
+        os.makedirs(self.trial_dir, exist_ok=True)
+        cmd = [sys.executable, TRAIN_SCRIPT] + base_args + [
+            "--output_dir", self.trial_dir,
+            "--metrics_file", self.metrics_file,
+            "--no_save"
+        ]
+        for name, value in self.config.items():
+            cmd += [PARAM_FLAGS[name], str(value)]
+        with open(os.path.join(self.trial_dir, "command.txt"), 'w') as f:
+            f.write(" ".join(shlex.quote(part) for part in cmd) + "\n")
+        self._log = open(self.log_file, 'w')
+        self.process = subprocess.Popen(cmd, stdout=self._log, stderr=subprocess.STDOUT, env=env, cwd=PROJECT_ROOT)
+        self.slot = slot
+        self.status = "running"
+        self.start_time = time.time()
+
+    def finish(self, status):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+            self._log.close()
+            self.records = read_metrics(self.metrics_file)
+        self.status = status
+        self.end_time = time.time()
+
+    @property
+    def last_step(self):
+        return self.records[-1]["step"] if self.records else 0
+
+    @property
+    def loss(self):
+        return window_loss(self.records)
+
+    def summary(self, pruner):
+        return {
+            "trial": self.trial_id,
+            "status": self.status,
+            "slot": self.slot,
+            "steps": self.last_step,
+            "rung": pruner.highest_rung(self.trial_id),
+            "loss": self.loss,
+            "time": round((self.end_time or time.time()) - (self.start_time or time.time()), 1),
+            **self.config
+        }
+
+def _plan(args, space):
+    """返回 (网格配置列表或None, 试验数, 剪枝器)"""
+    pruner = AshaPruner(args.min_steps, args.max_steps, args.eta) if not args.no_prune else AshaPruner(0, 0)
+    print(f"ASHA阶梯 (步数): {pruner.rungs or '不剪枝'}")
+    if args.search == "grid":
+        configs = list(grid_configs(space))
+        if args.n_trials:
+            configs = configs[:args.n_trials]
+        return configs, len(configs), pruner
+    return None, args.n_trials, pruner
+
+def next_config(args, space, configs, trials, rng):
+    """下一个试验的参数"""
+    if configs is not None:
+        return configs[len(trials)]
+    if args.search == "tpe":
+        history = [(trial.config, trial.loss if trial.status == "completed" else math.inf)
+                   for trial in trials if trial.status in ("completed", "pruned")]
+        return tpe_suggest(space, history, rng)
+    return sample_config(space, rng)
+
+def _record_finished(trial, pruner, sweep_dir):
+    with open(os.path.join(sweep_dir, "trials.jsonl"), 'a') as f:
+        f.write(json.dumps(trial.summary(pruner)) + "\n")
+
+def run_sweep(args, space, base_args, sweep_dir):
+    """调度所有试验直到完成，返回试验列表"""
+    rng = np.random.default_rng(args.seed)
+    slots = detect_slots(args.slots, args.cpu_slots)
+    n_cpu_slots = sum(1 for slot in slots if not slot.startswith("cuda"))
+    print(f"设备槽位: {', '.join(slots)}")
+    configs, n_trials, pruner = _plan(args, space)
+
+    trials = []
+    free_slots = list(slots)
+    running = []
+
+    while len(trials) < n_trials or running:
+        # 空闲槽位启动新试验
+        while free_slots and len(trials) < n_trials:
+            config = next_config(args, space, configs, trials, rng)
+            trial = Trial(len(trials), config, sweep_dir)
+            slot = free_slots.pop(0)
+            trial.launch(slot, base_args, slot_env(slot, n_cpu_slots))
+            trials.append(trial)
+            running.append(trial)
+            print(f"▶ 试验 {trial.trial_id} [{slot}]: {config}")
+
+        time.sleep(args.poll_interval)
+
+        for trial in list(running):
+            trial.records = read_metrics(trial.metrics_file)
+            if trial.records and pruner.report(trial.trial_id, trial.records):
+                trial.finish("pruned")
+                print(f"✂ 试验 {trial.trial_id} 在第 {trial.last_step} 步被剪枝 (损失 {trial.loss:.4f})")
+            elif trial.process.poll() is not None:
+                status = "completed" if trial.process.returncode == 0 else "failed"
+                trial.finish(status)
+                if status == "completed":
+                    print(f"✓ 试验 {trial.trial_id} 完成: 损失 {trial.loss:.4f} ({trial.last_step} 步)")
+                else:
+                    print(f"❌ 试验 {trial.trial_id} 失败 (返回码 {trial.process.returncode})，见 {trial.log_file}")
+            else:
+                continue
+            running.remove(trial)
+            free_slots.append(trial.slot)
+            _record_finished(trial, pruner, sweep_dir)
+
+    return trials, pruner
+
+def run_sweep_in_process(args, space, base_args, sweep_dir):
+    """在当前进程内串行运行所有试验，复用分词器、分词后的数据集和基础模型权重"""
+    import train_instruction
+    from transformers import TrainerCallback
+    from model_registry import ModelRegistry
+
+    rng = np.random.default_rng(args.seed)
+    configs, n_trials, pruner = _plan(args, space)
+    parser = train_instruction.build_parser()
+
+    class PruningCallback(TrainerCallback):
+        def __init__(self, trial):
+            self.trial = trial
+
+        def on_log(self, args, state, control, logs=None, **kwargs):
+            if not logs or "loss" not in logs:
+                return
+            self.trial.records.append({"step": state.global_step, "loss": logs["loss"]})
+            if pruner.report(self.trial.trial_id, self.trial.records):
+                self.trial.status = "pruned"
+                control.should_training_stop = True
+
+    registry = ModelRegistry()
+    datasets = {}
+    trials = []
+    while len(trials) < n_trials:
+        config = next_config(args, space, configs, trials, rng)
+        trial = Trial(len(trials), config, sweep_dir)
+        trials.append(trial)
+        print(f"▶ 试验 {trial.trial_id} [进程内]: {config}")
+
+        argv = base_args + ["--output_dir", trial.trial_dir, "--metrics_file", trial.metrics_file, "--no_save"]
+        for name, value in config.items():
+            argv += [PARAM_FLAGS[name], str(value)]
+        train_config = train_instruction.TrainConfig.from_args(parser.parse_args(argv))
+
+        # 分词器和基础权重由registry缓存; 数据集按 (文件, 条数, 长度) 缓存
+        tokenizer = registry.tokenizer(train_config.resolved_model_name)
+        data_key = (train_config.resolved_train_file, train_config.max_samples, train_config.resolved_max_length)
+        if data_key not in datasets:
+            dataset = train_instruction.load_dataset_from_jsonl(train_config.resolved_train_file, train_config.max_samples)
+            datasets[data_key] = train_instruction.tokenize_dataset(dataset, tokenizer, train_config.resolved_max_length)
+
+        trial.slot = "in_process"
+        trial.status = "running"
+        trial.start_time = time.time()
+        try:
+            train_instruction.run_training(train_config, tokenizer=tokenizer, tokenized_dataset=datasets[data_key],
+                                           callbacks=[PruningCallback(trial)], registry=registry)
+        except Exception as e:
+            print(f"❌ 试验 {trial.trial_id} 失败: {e}")
+            trial.finish("failed")
+        else:
+            trial.finish("pruned" if trial.status == "pruned" else "completed")
+        if trial.status == "pruned":
+            print(f"✂ 试验 {trial.trial_id} 在第 {trial.last_step} 步被剪枝 (损失 {trial.loss:.4f})")
+        elif trial.status == "completed":
+            print(f"✓ 试验 {trial.trial_id} 完成: 损失 {trial.loss:.4f} ({trial.last_step} 步)")
+        _record_finished(trial, pruner, sweep_dir)
+
+    registry.report()
+    return trials, pruner
+
+def write_leaderboard(trials, pruner, sweep_dir):
+    """排行榜: 完成的试验按损失排序，其后是按到达阶梯排序的被剪枝试验"""
+    status_order = {"completed": 0, "pruned": 1, "failed": 2}
+    rows = [trial.summary(pruner) for trial in trials]
+    rows.sort(key=lambda row: (status_order.get(row["status"], 3), -row["rung"],
+                               row["loss"] if row["loss"] is not None else math.inf))
+    leaderboard_file = os.path.join(sweep_dir, "leaderboard.csv")
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    with open(leaderboard_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print("\n排行榜:")
+    for rank, row in enumerate(rows, 1):
+        loss = f"{row['loss']:.4f}" if row["loss"] is not None else "-"
+        params = ", ".join(f"{key}={row[key]}" for key in trials[row["trial"]].config)
+        print(f"{rank:>3}. 试验 {row['trial']:<3} {row['status']:<9} 步数 {row['steps']:<5} 损失 {loss:<8} {params}")
+    print(f"✓ 排行榜已保存: {leaderboard_file}")
+    return rows
+
+def build_base_args(args):
+    """所有试验共用的 train_instruction.py 参数"""
+    base_args = [
+        "--method", args.method,
+        "--model_size", args.model_size,
+        "--max_steps", str(args.max_steps),
+        "--logging_steps", str(args.logging_steps),
+        "--seed", str(args.seed)
+    ]
+    # 试验子进程在项目根目录运行，本地路径转为绝对路径
+    model_name = os.path.abspath(args.model_name) if args.model_name and os.path.exists(args.model_name) else args.model_name
+    train_file = os.path.abspath(args.train_file) if args.train_file else None
+    for flag, value in (("--model_name", model_name), ("--train_file", train_file),
+                        ("--max_samples", args.max_samples), ("--max_length", args.max_length),
+                        ("--batch_size", args.batch_size),
+                        ("--gradient_accumulation_steps", args.gradient_accumulation_steps),
+                        ("--warmup_steps", args.warmup_steps)):
+        if value is not None:
+            base_args += [flag, str(value)]
+    if args.extra_args:
+        base_args += shlex.split(args.extra_args)
+    return base_args
+
+def configure_self_test(args):
+    """CPU自检: 随机微型模型 + 300条数据 + 两个CPU槽位"""
+    from tiny_model import create_tiny_model
+
+    tiny_dir = os.path.join(SWEEPS_DIR, "self_test_tiny_model")
+    if not os.path.exists(os.path.join(tiny_dir, "config.json")):
+        create_tiny_model(tiny_dir)
+    args.name = args.name or "self_test"
+    args.method = "lora"
+    args.model_size = "tiny"
+    args.model_name = os.path.abspath(tiny_dir)
+    args.train_file = args.train_file or os.path.join(PROJECT_ROOT, "data", "alpaca_train_5k.jsonl")
+    args.max_samples = 300
+    args.max_length = 64
+    args.batch_size = 4
+    args.gradient_accumulation_steps = 1
+    args.warmup_steps = 0
+    args.max_steps = 18
+    args.min_steps = 2
+    args.logging_steps = 2
+    args.search = "random"
+    args.n_trials = 6
+    args.slots = "cpu,cpu"
+    args.poll_interval = 1.0
+    return {
+        "lr": {"type": "loguniform", "low": 1e-4, "high": 3e-2},
+        "lora_r": [2, 4, 8],
+        "lora_target_modules": ["q_proj,v_proj", "q_proj,k_proj,v_proj,o_proj"]
+    }
+
+def check_rung_losses():
+    """一次报告跨过多个阶梯时，每个阶梯记录的是该阶梯步数为止的损失"""
+    pruner = AshaPruner(min_steps=2, max_steps=20, eta=3)
+    records = [{"step": step, "loss": 10.0 - step} for step in range(1, 19)]
+    pruner.report(0, records)
+    expected = {rung: window_loss(records[:rung]) for rung in pruner.rungs}
+    actual = {rung: pruner.rung_losses[rung].get(0) for rung in pruner.rungs}
+    print(f"阶梯损失: {actual}")
+    return actual == expected and len(set(actual.values())) == len(pruner.rungs)
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="train_instruction.py 超参数搜索 (并发槽位 + ASHA早停)")
+    parser.add_argument("--name", type=str, default=None, help="搜索名称 (默认按时间生成)")
+    parser.add_argument("--space", type=str, default=None, help="搜索空间JSON字符串或文件 (默认LoRA r/alpha/目标模块/学习率)")
+    parser.add_argument("--search", type=str, default="random", choices=["grid", "random", "tpe"])
+    parser.add_argument("--n_trials", type=int, default=None, help="试验数 (random/tpe必需; grid时截断)")
+    parser.add_argument("--method", type=str, default="lora", choices=["lora", "qlora"])
+    parser.add_argument("--model_size", type=str, default="tiny", choices=["tiny", "small", "medium"])
+    parser.add_argument("--model_name", type=str, default=None, help="覆盖模型名或本地模型目录")
+    parser.add_argument("--train_file", type=str, default=None)
+    parser.add_argument("--max_samples", type=int, default=None)
+    parser.add_argument("--max_length", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=None)
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=None)
+    parser.add_argument("--warmup_steps", type=int, default=None)
+    parser.add_argument("--max_steps", type=int, default=300, help="每个试验的最大训练步数")
+    parser.add_argument("--min_steps", type=int, default=30, help="第一个ASHA阶梯的步数")
+    parser.add_argument("--eta", type=int, default=3, help="每个阶梯保留 1/eta 的试验")
+    parser.add_argument("--no_prune", action="store_true", help="禁用早停")
+    parser.add_argument("--logging_steps", type=int, default=10)
+    parser.add_argument("--slots", type=str, default="auto", help="逗号分隔的设备槽位，如 cuda:0,cuda:1 或 cpu,cpu")
+    parser.add_argument("--cpu_slots", type=int, default=1, help="无GPU且slots=auto时的CPU槽位数")
+    parser.add_argument("--in_process", action="store_true", help="在当前进程内串行运行试验 (复用分词器和数据集)")
+    parser.add_argument("--poll_interval", type=float, default=5.0, help="检查试验进度的间隔 (秒)")
+    parser.add_argument("--extra_args", type=str, default="", help="透传给 train_instruction.py 的其他参数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--self_test", action="store_true", help="在CPU上用随机微型模型端到端自检")
+    args = parser.parse_args()
+
+    space = configure_self_test(args) if args.self_test else parse_space(args.space)
+    if args.search != "grid" and not args.n_trials:
+        parser.error("random/tpe搜索需要指定 --n_trials")
+
+    name = args.name or f"{args.method}_{args.model_size}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    sweep_dir = os.path.join(SWEEPS_DIR, name)
+    os.makedirs(sweep_dir, exist_ok=True)
+    base_args = build_base_args(args)
+    with open(os.path.join(sweep_dir, "sweep_config.json"), 'w') as f:
+        json.dump({"space": space, "search": args.search, "n_trials": args.n_trials, "eta": args.eta,
+                   "min_steps": args.min_steps, "max_steps": args.max_steps, "base_args": base_args}, f, indent=2)
+
+    print(f"超参数搜索: {name} ({args.search})")
+    start = time.time()
+    if args.in_process:
+        trials, pruner = run_sweep_in_process(args, space, base_args, sweep_dir)
+    else:
+        trials, pruner = run_sweep(args, space, base_args, sweep_dir)
+    rows = write_leaderboard(trials, pruner, sweep_dir)
+
+    completed = [row for row in rows if row["status"] == "completed"]
+    pruned = [row for row in rows if row["status"] == "pruned"]
+    print(f"总耗时: {time.time() - start:.1f}s, 完成 {len(completed)}, 剪枝 {len(pruned)}, "
+          f"失败 {len(rows) - len(completed) - len(pruned)}")
+
+    if args.self_test:
+        if not completed or len(completed) + len(pruned) != len(rows):
+            print("❌ 自检失败: 存在失败的试验或没有完成的试验")
+            raise SystemExit(1)
+        if not check_rung_losses():
+            print("❌ 自检失败: 一次跨过多个阶梯时记录的不是各阶梯步数上的损失")
+            raise SystemExit(1)
+        print("✅ 超参数搜索自检通过")
+
+if __name__ == "__main__":
+    main()
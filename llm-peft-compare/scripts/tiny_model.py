@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+创建随机初始化的微型Llama模型，用于在CPU上快速验证评估/训练流程
+
+分词器复用仓库中TinyLlama合并模型目录下的tokenizer文件，无需联网。
+
+用法:
+  python scripts/tiny_model.py --output_dir models/tiny-random-llama
+"""
+
+import os
+import argparse
+
+import torch
+from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+TOKENIZER_DIR = os.path.join(PROJECT_ROOT, "models", "tinyllama_1.1b-instruction-lora-merged")
+
+
+def load_tokenizer():
+    """加载仓库自带的TinyLlama分词器"""
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_DIR)
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+def build_tiny_model(hidden_size=64, num_layers=2, num_heads=4, num_kv_heads=2,
+                     intermediate_size=128, max_position_embeddings=1024, seed=0):
+    """构建随机初始化的微型Llama模型 (词表与TinyLlama分词器一致)"""
+    tokenizer = load_tokenizer()
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=intermediate_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        num_key_value_heads=num_kv_heads,
+        max_position_embeddings=max_position_embeddings,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id
+    )
+    torch.manual_seed(seed)
+    model = LlamaForCausalLM(config)
+    model.eval()
+    return model, tokenizer
+
+def create_tiny_model(output_dir, **kwargs):
+    """构建微型模型并保存到目录，返回目录路径"""
+    model, tokenizer = build_tiny_model(**kwargs)
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    return output_dir
+
+def main():
+    parser = argparse.ArgumentParser(description="创建随机初始化的微型Llama模型")
+    parser.add_argument("--output_dir", type=str, default="models/tiny-random-llama", help="输出目录")
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    create_tiny_model(args.output_dir, hidden_size=args.hidden_size, num_layers=args.num_layers, seed=args.seed)
+    print(f"✅ 微型模型已保存到: {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
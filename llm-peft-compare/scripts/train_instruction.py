@@ -1,34 +1,36 @@
+"""
+指令微调训练 (full / LoRA / QLoRA)
+
+既可作为脚本运行，也可作为库导入复用 (超参数搜索、基准测试在同一进程内多次训练):
+- TrainConfig: 训练配置 (与命令行参数一一对应)
+- load_dataset_from_jsonl / load_tokenizer / tokenize_dataset: 数据阶段
+- build_model: 按方法构建模型 (LoRA配置见 build_lora_config)
+- run_training: 组装Trainer并训练，可传入已加载的分词器和已分词的数据集，
+  或传入 model_registry.ModelRegistry 复用同一进程内已加载的基础权重
+
+torch/transformers/peft/datasets 等重依赖在函数内部按需导入，`--help` 不需要加载它们。
+
+用法:
+  python scripts/train_instruction.py --method lora --model_size tiny --epochs 1
+  # 数据并行 (CPU上使用gloo后端，只有rank 0打印日志和写checkpoint)
+  torchrun --nproc_per_node 2 scripts/train_instruction.py --method lora --model_size tiny --epochs 1
+  # 每200步保存checkpoint，后台低优先级进程同时评估 (结果见 results/checkpoint_evals/)
+  python scripts/train_instruction.py --method lora --model_size tiny --save_steps 200 --watch_checkpoints
+  # 同上，留出集损失连续3次评估没有改善时提前结束训练
+  python scripts/train_instruction.py --method lora --model_size tiny --save_steps 200 --watch_checkpoints \
+      --stop_patience 3 --min_delta 0.01
+  # 选择注意力实现并用torch.compile编译 (编译缓存见 model_compile.py)
+  python scripts/train_instruction.py --method lora --model_size tiny --attn_implementation sdpa --torch_compile
+  # 2个DataLoader工作进程在后台分词和整理批次 (每步的数据等待时间在训练结束时汇总)
+  python scripts/train_instruction.py --method lora --model_size tiny --tokenize_on_the_fly --dataloader_num_workers 2
+"""
+
 import os
-import argparse
-import torch
-from transformers import (
-    AutoModelForCausalLM, 
-    AutoTokenizer, 
-    TrainingArguments, 
-    Trainer, 
-    DataCollatorForLanguageModeling,
-    DataCollatorForSeq2Seq,
-    BitsAndBytesConfig
-)
-from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 import json
-from datasets import Dataset
-import matplotlib.pyplot as plt
-import pandas as pd
-
-# 参数解析
-parser = argparse.ArgumentParser()
-parser.add_argument("--method", type=str, choices=["full", "lora", "qlora"], required=True)
-parser.add_argument("--epochs", type=int, default=3)
-parser.add_argument("--lr", type=float, default=2e-5)
-parser.add_argument("--batch_size", type=int, default=4)
-parser.add_argument("--gradient_accumulation_steps", type=int, default=4)
-parser.add_argument("--use_8bit_adam", action="store_true", help="记录用户希望使用8bit优化器(仅作为信息)")
-parser.add_argument("--model_size", type=str, default="small", choices=["tiny", "small", "medium"], 
-                    help="模型大小: tiny (1B), small (2-3B), medium (7B)")
-args = parser.parse_args()
-
-# 根据选择的模型大小设置模型
+import argparse
+from dataclasses import dataclass, fields
+
+# 可选的模型大小
 model_options = {
     "tiny": {
         "name": "TinyLlama/TinyLlama-1.1B-Chat-v1.0",
@@ -48,269 +50,718 @@ model_options = {
     }
 }
 
-selected_model = model_options[args.model_size]
-MODEL_NAME = selected_model["name"]
-MODEL_ID = selected_model["id"]
-MAX_LENGTH = selected_model.get("max_length", 512)
-EXTRA_ARGS = selected_model.get("extra_args", "")
-
-# 配置
-OUTPUT_DIR = f"models/{MODEL_ID}-instruction-{args.method}"
-
-
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 TRAIN_FILE = os.path.join(PROJECT_ROOT, "data", "alpaca_train.jsonl")
+# 输出目录中出现该文件时训练在当前步结束后停止
+STOP_FILE = "STOP_TRAINING"
 # TRAIN_FILE = "data/alpaca_train.jsonl"
-print(f"数据文件路径: {TRAIN_FILE}")
-
-print(f"选择模型: {MODEL_NAME} ({MODEL_ID})")
-
-# 设备配置
-device_map = "auto"
-if torch.backends.mps.is_available():
-    device_map = "mps"
-    print("使用MPS加速进行训练")
-elif torch.cuda.is_available():
-    print("使用CUDA进行训练")
-else:
-    print("使用CPU进行训练")
-
-# 确保输出目录存在
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-# 根据设备选择适当的torch数据类型
-model_dtype = torch.float16
-if device_map == "mps":
-    # 在MPS上使用float32可能更稳定
-    model_dtype = torch.float32
-    print("在MPS设备上使用float32数据类型")
+
+
+@dataclass
+class TrainConfig:
+    """一次训练的全部配置，字段与命令行参数同名"""
+    method: str = "lora"
+    epochs: int = 3
+    lr: float = 2e-5
+    batch_size: int = 4
+    gradient_accumulation_steps: int = 4
+    use_8bit_adam: bool = False
+    # adamw / adamw_8bit / adafactor (use_8bit_adam等同于adamw_8bit)
+    optimizer: str = "adamw"
+    model_size: str = "small"
+    # LoRA超参数 (不指定时使用各方法的默认值)
+    lora_r: int = None
+    lora_alpha: int = 32
+    lora_dropout: float = 0.05
+    lora_target_modules: str = None
+    # 覆盖默认路径/训练长度
+    model_name: str = None
+    max_length: int = None
+    train_file: str = None
+    max_samples: int = None
+    output_dir: str = None
+    max_steps: int = -1
+    warmup_steps: int = 100
+    logging_steps: int = 10
+    seed: int = 42
+    metrics_file: str = None
+    no_save: bool = False
+    # 无bitsandbytes时QLoRA基础权重的量化位数/分组大小
+    quant_bits: int = 4
+    quant_group_size: int = 64
+    # 长序列训练的内存优化
+    gradient_checkpointing: bool = False
+    chunked_loss: bool = False
+    loss_chunk_size: int = 1024
+    # 数据并行 (torchrun/accelerate launch启动时生效)
+    ddp_backend: str = None
+    log_all_ranks: bool = False
+    # 按步保存checkpoint，并在后台低优先级进程中评估 (见checkpoint_watcher.py)
+    save_steps: int = None
+    watch_checkpoints: bool = False
+    stop_patience: int = 0
+    min_delta: float = 0.0
+    # 注意力实现 (eager / sdpa，默认使用模型自己的设置) 和torch.compile
+    attn_implementation: str = None
+    torch_compile: bool = False
+    torch_compile_mode: str = None
+    compile_cache_dir: str = None
+    # 数据加载: 工作进程数、每个进程预取的批数、锁页内存 (有CUDA时默认启用)、在工作进程中即时分词
+    dataloader_num_workers: int = 0
+    dataloader_prefetch_factor: int = None
+    no_pin_memory: bool = False
+    tokenize_on_the_fly: bool = False
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(**{field.name: getattr(args, field.name) for field in fields(cls)})
+
+    @property
+    def resolved_optimizer(self):
+        return "adamw_8bit" if self.use_8bit_adam else self.optimizer
+
+    @property
+    def model_info(self):
+        return model_options[self.model_size]
+
+    @property
+    def resolved_model_name(self):
+        return self.model_name or self.model_info["name"]
+
+    @property
+    def model_id(self):
+        return self.model_info["id"]
+
+    @property
+    def resolved_max_length(self):
+        return self.max_length or self.model_info.get("max_length", 512)
+
+    @property
+    def resolved_output_dir(self):
+        return self.output_dir or f"models/{self.model_id}-instruction-{self.method}"
+
+    @property
+    def resolved_train_file(self):
+        return self.train_file or TRAIN_FILE
+
+def build_parser():
+    """命令行参数"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--method", type=str, choices=["full", "lora", "qlora"], required=True)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--lr", type=float, default=2e-5)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=4)
+    parser.add_argument("--use_8bit_adam", action="store_true", help="使用8-bit AdamW (等同于 --optimizer adamw_8bit)")
+    parser.add_argument("--optimizer", type=str, default="adamw", choices=["adamw", "adamw_8bit", "adafactor"],
+                        help="adamw_8bit: CUDA+bitsandbytes时为paged_adamw_8bit，否则为纯PyTorch分块8-bit实现; "
+                             "adafactor: 分解的二阶矩")
+    parser.add_argument("--model_size", type=str, default="small", choices=["tiny", "small", "medium"],
+                        help="模型大小: tiny (1B), small (2-3B), medium (7B)")
+    # LoRA超参数 (不指定时使用各方法的默认值)
+    parser.add_argument("--lora_r", type=int, default=None, help="LoRA秩 (默认: lora=8, qlora=8/16)")
+    parser.add_argument("--lora_alpha", type=int, default=32)
+    parser.add_argument("--lora_dropout", type=float, default=0.05)
+    parser.add_argument("--lora_target_modules", type=str, default=None, help="逗号分隔的目标模块，如 q_proj,v_proj")
+    # 覆盖默认路径/训练长度 (超参数搜索和CPU自检使用)
+    parser.add_argument("--model_name", type=str, default=None, help="覆盖模型名或本地模型目录")
+    parser.add_argument("--max_length", type=int, default=None, help="覆盖最大序列长度")
+    parser.add_argument("--train_file", type=str, default=None, help="覆盖训练数据文件")
+    parser.add_argument("--max_samples", type=int, default=None, help="只使用前N条训练数据")
+    parser.add_argument("--output_dir", type=str, default=None, help="覆盖输出目录")
+    parser.add_argument("--max_steps", type=int, default=-1, help="最大训练步数 (>0时覆盖epochs)")
+    parser.add_argument("--warmup_steps", type=int, default=100)
+    parser.add_argument("--logging_steps", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--metrics_file", type=str, default=None, help="每次记录日志时追加一行JSON (step, loss, learning_rate)")
+    parser.add_argument("--no_save", action="store_true", help="不保存checkpoint和最终模型")
+    parser.add_argument("--quant_bits", type=int, default=4, choices=[4, 8], help="QLoRA原生量化位数 (无CUDA/bitsandbytes时)")
+    parser.add_argument("--quant_group_size", type=int, default=64, help="QLoRA原生量化每组的权重数")
+    parser.add_argument("--gradient_checkpointing", action="store_true", help="梯度检查点: 反向时重算激活值以节省内存")
+    parser.add_argument("--chunked_loss", action="store_true", help="分块交叉熵损失，不生成完整的 [batch, seq, vocab] logits")
+    parser.add_argument("--loss_chunk_size", type=int, default=1024, help="分块损失每块的token数")
+    parser.add_argument("--ddp_backend", type=str, default=None, choices=["gloo", "nccl"],
+                        help="数据并行通信后端 (默认: CUDA用nccl，CPU用gloo)")
+    parser.add_argument("--log_all_ranks", action="store_true", help="数据并行时所有进程都打印日志 (默认只有rank 0)")
+    parser.add_argument("--save_steps", type=int, default=None, help="每N步保存一个checkpoint (默认每个epoch)")
+    parser.add_argument("--watch_checkpoints", action="store_true",
+                        help="训练同时在后台低优先级进程中评估每个新checkpoint (留出集损失 + 任务子集)")
+    parser.add_argument("--stop_patience", type=int, default=0,
+                        help="配合--watch_checkpoints: 留出集损失连续N次评估没有改善时提前结束训练 (0: 不停止)")
+    parser.add_argument("--min_delta", type=float, default=0.0,
+                        help="配合--stop_patience: 视为改善的最小留出集损失下降")
+    parser.add_argument("--attn_implementation", type=str, default=None, choices=["eager", "sdpa"],
+                        help="注意力实现 (默认使用模型配置)")
+    parser.add_argument("--torch_compile", action="store_true", help="用torch.compile编译模型")
+    parser.add_argument("--torch_compile_mode", type=str, default=None,
+                        choices=["default", "reduce-overhead", "max-autotune"])
+    parser.add_argument("--compile_cache_dir", type=str, default=None,
+                        help="编译缓存目录 (默认 results/compile_cache)，之后的运行复用已编译的图")
+    parser.add_argument("--dataloader_num_workers", type=int, default=0,
+                        help="DataLoader工作进程数 (0: 在主进程中取数据和整理批次)")
+    parser.add_argument("--dataloader_prefetch_factor", type=int, default=None,
+                        help="每个工作进程提前准备的批数 (默认2，需要 --dataloader_num_workers > 0)")
+    parser.add_argument("--no_pin_memory", action="store_true", help="有CUDA时也不使用锁页内存")
+    parser.add_argument("--tokenize_on_the_fly", action="store_true",
+                        help="不预先分词，取数据时即时分词 (配合工作进程在后台完成)")
+    return parser
+
+def distributed_info():
+    """torchrun/accelerate launch设置的 (rank, world_size, local_rank)，单进程时为 (0, 1, 0)"""
+    return (int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1)),
+            int(os.environ.get("LOCAL_RANK", 0)))
+
+def setup_rank_logging(log_all_ranks=False):
+    """数据并行时只让rank 0打印; log_all_ranks时其余进程的输出加上 [rank N] 前缀"""
+    import builtins
+
+    rank, world_size, _ = distributed_info()
+    if world_size == 1:
+        return
+    builtin_print = builtins.print
+
+    def rank_print(*args, force=False, **kwargs):
+        if rank == 0:
+            builtin_print(*args, **kwargs)
+        elif force or log_all_ranks:
+            builtin_print(f"[rank {rank}]", *args, **kwargs)
+
+    builtins.print = rank_print
+
+def detect_device():
+    """返回 (device_map, 模型数据类型)"""
+    import torch
+
+    _, world_size, local_rank = distributed_info()
+    device_map = "auto"
+    if world_size > 1:
+        # 数据并行: 每个进程持有完整模型，放到本进程的设备上 (CPU时由Trainer处理)
+        device_map = {"": local_rank} if torch.cuda.is_available() else None
+        print(f"使用数据并行训练: {world_size} 个进程")
+    elif torch.backends.mps.is_available():
+        device_map = "mps"
+        print("使用MPS加速进行训练")
+    elif torch.cuda.is_available():
+        print("使用CUDA进行训练")
+    else:
+        print("使用CPU进行训练")
+
+    # 根据设备选择适当的torch数据类型
+    model_dtype = torch.float16
+    if device_map == "mps":
+        # 在MPS上使用float32可能更稳定
+        model_dtype = torch.float32
+        print("在MPS设备上使用float32数据类型")
+    elif not torch.cuda.is_available():
+        # CPU不支持fp16混合精度训练
+        model_dtype = torch.float32
+    return device_map, model_dtype
+
+def format_example(item):
+    """把一条指令数据拼成训练文本 (简单格式，避免过度复杂的结构)"""
+    instruction = item['instruction']
+    input_text = item.get('input', '')
+    output = item['output']
+    if input_text:
+        return f"{instruction} {input_text} {output}"
+    return f"{instruction} {output}"
 
 # 加载数据
-def load_dataset_from_jsonl(file_path):
+def load_dataset_from_jsonl(file_path, max_samples=None):
+    from datasets import Dataset
+
     data = []
     with open(file_path, 'r') as f:
         for line in f:
-            item = json.loads(line)
-            # 创建简单的文本格式，避免过度复杂的结构
-            instruction = item['instruction']
-            input_text = item.get('input', '')
-            output = item['output']
-            
-            # 构建最简单的训练文本
-            if input_text:
-                text = f"{instruction} {input_text} {output}"
-            else:
-                text = f"{instruction} {output}"
-            
-            data.append({'text': text})
-    
+            data.append({'text': format_example(json.loads(line))})
+            if max_samples and len(data) >= max_samples:
+                break
+
     # 打印数据格式信息
     print(f"加载了 {len(data)} 条训练数据")
     if len(data) > 0:
         print(f"数据样例:\n{data[0]['text'][:200]}...")
-    
+
     return Dataset.from_list(data)
 
-train_dataset = load_dataset_from_jsonl(TRAIN_FILE)
-print(f"加载了 {len(train_dataset)} 条训练数据")
-
-# 加载分词器
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-tokenizer.pad_token = tokenizer.eos_token
-
-# 分词函数
-def tokenize_function(examples):
-    # 简单地对文本进行分词
-    result = tokenizer(
-        examples["text"], 
-        truncation=True, 
-        max_length=MAX_LENGTH, 
-        padding="max_length"
+def load_tokenizer(model_name):
+    """加载分词器 (以eos作为pad)"""
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+def tokenize_dataset(dataset, tokenizer, max_length, on_the_fly=False):
+    """分词化数据集，labels为input_ids的副本
+
+    on_the_fly: 不预先处理，每次取样本时分词 (在DataLoader工作进程中执行)
+    """
+    def tokenize_function(examples):
+        # 简单地对文本进行分词
+        result = tokenizer(
+            examples["text"],
+            truncation=True,
+            max_length=max_length,
+            padding="max_length"
+        )
+
+        # 将input_ids复制为labels
+        result["labels"] = result["input_ids"].copy()
+        return result
+
+    if on_the_fly:
+        return dataset.with_transform(tokenize_function)
+    return dataset.map(
+        tokenize_function,
+        batched=True,
+        remove_columns=["text"],
     )
-    
-    # 将input_ids复制为labels
-    result["labels"] = result["input_ids"].copy()
-    return result
-
-# 分词化数据集
-tokenized_datasets = train_dataset.map(
-    tokenize_function,
-    batched=True,
-    remove_columns=["text"],
-)
-
-# 初始化模型和训练配置
-if args.method == "full":
-    print("执行完整微调...")
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME,
-        torch_dtype=model_dtype,
-        device_map=device_map
+
+def build_lora_config(config, default_r, default_target_modules):
+    """按配置构建LoRA配置，未指定的参数使用该方法的默认值"""
+    from peft import LoraConfig
+
+    target_modules = default_target_modules
+    if config.lora_target_modules:
+        target_modules = [name.strip() for name in config.lora_target_modules.split(",") if name.strip()]
+    return LoraConfig(
+        r=config.lora_r or default_r,
+        lora_alpha=config.lora_alpha,
+        target_modules=target_modules,
+        lora_dropout=config.lora_dropout,
+        bias="none",
+        task_type="CAUSAL_LM",
     )
-elif args.method == "lora":
-    print("执行LoRA微调...")
+
+def load_native_quantized_model(config, model_name, model_dtype, device_map):
+    """不依赖bitsandbytes的QLoRA: 冻结的线性层量化为int8/int4 (前向时即时反量化)，再包装LoRA"""
+    from transformers import AutoModelForCausalLM
+    from peft import get_peft_model
+    from quantized_linear import quantize_model
+
     model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME,
+        model_name,
         torch_dtype=model_dtype,
         device_map=device_map
     )
-    # LoRA配置
-    lora_config = LoraConfig(
-        r=8,
-        lora_alpha=32,
-        target_modules=["q_proj", "v_proj", "k_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
-        lora_dropout=0.05,
-        bias="none",
-        task_type="CAUSAL_LM",
-    )
-    model = get_peft_model(model, lora_config)
-    model.print_trainable_parameters()
-elif args.method == "qlora":
-    print("执行QLoRA微调...")
-    
-    # 检查运行环境
-    is_macos = torch.backends.mps.is_available()
-    
-    if is_macos:
-        print("✅ 在Apple Silicon Mac上使用PyTorch原生量化")
-        # 使用PyTorch原生量化替代bitsandbytes
+    quantize_model(model, bits=config.quant_bits, group_size=config.quant_group_size)
+
+    lora_config = build_lora_config(config, 16, ["q_proj", "k_proj", "v_proj", "o_proj"])
+    return get_peft_model(model, lora_config)
+
+def build_model(config, device_map, model_dtype, registry=None):
+    """按微调方法初始化模型
+
+    传入registry时full/lora从缓存的基础权重构建 (qlora的量化加载不经过缓存)
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+    from peft import get_peft_model
+
+    model_name = config.resolved_model_name
+    if registry is not None and config.method == "full":
+        print("执行完整微调 (缓存的基础权重)...")
+        model = registry.model(model_name, model_dtype, copy_weights=True)
+    elif registry is not None and config.method == "lora":
+        print("执行LoRA微调 (缓存的基础权重)...")
+        lora_config = build_lora_config(config, 8, ["q_proj", "v_proj", "k_proj", "o_proj", "gate_proj", "up_proj", "down_proj"])
+        model = registry.peft_model(model_name, lora_config, model_dtype, seed=config.seed)
+        model.print_trainable_parameters()
+    elif config.method == "full":
+        print("执行完整微调...")
         model = AutoModelForCausalLM.from_pretrained(
-            MODEL_NAME,
+            model_name,
             torch_dtype=model_dtype,
             device_map=device_map
         )
-        
-        # 应用PyTorch的动态量化（适用于MPS）
-        try:
-            from torch.quantization import quantize_dynamic
-            # 量化模型的一部分
-            print("应用PyTorch动态量化...")
-            modules_to_quantize = ["q_proj", "k_proj", "v_proj", "o_proj"]
-            for name, module in model.named_modules():
-                if any(q_name in name for q_name in modules_to_quantize):
-                    if isinstance(module, torch.nn.Linear):
-                        print(f"量化模块: {name}")
-                        module = quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
-        except Exception as e:
-            print(f"量化过程中出现警告 (非致命): {e}")
-            print("继续使用标准精度...")
-            
-        # 使用LoRA配置
-        lora_config = LoraConfig(
-            r=16,
-            lora_alpha=32,
-            lora_dropout=0.05,
-            bias="none",
-            task_type="CAUSAL_LM",
-            target_modules=["q_proj", "k_proj", "v_proj", "o_proj"]
+    elif config.method == "lora":
+        print("执行LoRA微调...")
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=model_dtype,
+            device_map=device_map
         )
+        # LoRA配置
+        lora_config = build_lora_config(config, 8, ["q_proj", "v_proj", "k_proj", "o_proj", "gate_proj", "up_proj", "down_proj"])
         model = get_peft_model(model, lora_config)
-        print("已应用LoRA适配器")
+        model.print_trainable_parameters()
+    elif config.method == "qlora":
+        print("执行QLoRA微调...")
+
+        # 检查运行环境
+        is_macos = torch.backends.mps.is_available()
+
+        if not torch.cuda.is_available():
+            print(f"✅ {'在Apple Silicon Mac上' if is_macos else '在CPU上'}使用原生int{config.quant_bits}仅权重量化")
+            model = load_native_quantized_model(config, model_name, model_dtype, device_map)
+            print("已应用LoRA适配器")
+        else:
+            try:
+                from transformers import BitsAndBytesConfig
+                from peft import prepare_model_for_kbit_training
+
+                # 标准QLoRA配置，适用于CUDA环境
+                print("在CUDA环境中使用bitsandbytes...")
+                bnb_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_use_double_quant=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=model_dtype
+                )
+                model = AutoModelForCausalLM.from_pretrained(
+                    model_name,
+                    quantization_config=bnb_config,
+                    device_map=device_map
+                )
+                model = prepare_model_for_kbit_training(model)
+
+                lora_config = build_lora_config(config, 8, None)
+                model = get_peft_model(model, lora_config)
+            except ImportError:
+                print(f"⚠️ bitsandbytes不可用，使用原生int{config.quant_bits}仅权重量化")
+                model = load_native_quantized_model(config, model_name, model_dtype, device_map)
+
+        model.print_trainable_parameters()
+
+    from model_compile import set_attn_implementation
+    return set_attn_implementation(model, config.attn_implementation)
+
+def resolve_optimizer(config):
+    """返回 (TrainingArguments.optim, Trainer的optimizer_cls_and_kwargs)"""
+    name = config.resolved_optimizer
+    if name == "adafactor":
+        return "adafactor", None
+    if name == "adamw_8bit":
+        import torch
+        from adam8bit import AdamW8bit, bitsandbytes_available
+
+        if torch.cuda.is_available() and bitsandbytes_available():
+            return "paged_adamw_8bit", None
+        return "adamw_torch", (AdamW8bit, {"lr": config.lr})
+    return "adamw_torch", None
+
+def resolve_dataloader_options(config):
+    """返回 (工作进程数, 预取批数, 是否锁页内存)"""
+    import torch
+
+    num_workers = config.dataloader_num_workers
+    prefetch_factor = config.dataloader_prefetch_factor
+    if prefetch_factor and num_workers == 0:
+        print("⚠️ --dataloader_prefetch_factor 需要工作进程，已忽略")
+        prefetch_factor = None
+    # 锁页内存只对CUDA的主机到设备拷贝有用 (MPS/CPU不支持或没有意义)
+    pin_memory = torch.cuda.is_available() and not config.no_pin_memory
+    return num_workers, prefetch_factor, pin_memory
+
+def build_training_arguments(config, use_fp16):
+    """Trainer参数"""
+    import torch
+    from transformers import TrainingArguments
+
+    ddp_backend = None
+    multi_cpu = False
+    if distributed_info()[1] > 1:
+        ddp_backend = config.ddp_backend or ("nccl" if torch.cuda.is_available() else "gloo")
+        # 无CUDA时accelerate只有在use_cpu下才进入多进程CPU (gloo) 模式
+        multi_cpu = not torch.cuda.is_available()
+    num_workers, prefetch_factor, pin_memory = resolve_dataloader_options(config)
+    return TrainingArguments(
+        output_dir=config.resolved_output_dir,
+        num_train_epochs=config.epochs,
+        max_steps=config.max_steps,
+        per_device_train_batch_size=config.batch_size,
+        gradient_accumulation_steps=config.gradient_accumulation_steps,
+        warmup_steps=config.warmup_steps,
+        weight_decay=0.01,
+        logging_steps=config.logging_steps,
+        save_strategy="no" if config.no_save else ("steps" if config.save_steps else "epoch"),
+        save_steps=config.save_steps or 500,
+        seed=config.seed,
+        lr_scheduler_type="cosine",
+        learning_rate=config.lr,
+        fp16=use_fp16,  # 根据设备类型决定是否使用fp16
+        optim=resolve_optimizer(config)[0],
+        remove_unused_columns=False,
+        gradient_checkpointing=config.gradient_checkpointing,
+        gradient_checkpointing_kwargs={"use_reentrant": False} if config.gradient_checkpointing else None,
+        ddp_backend=ddp_backend,
+        use_cpu=multi_cpu,
+        # LoRA的冻结参数不参与DDP梯度同步，不需要逐步查找未使用的参数
+        ddp_find_unused_parameters=False if config.method != "full" else None,
+        torch_compile=config.torch_compile,
+        torch_compile_mode=config.torch_compile_mode,
+        dataloader_num_workers=num_workers,
+        dataloader_prefetch_factor=prefetch_factor,
+        dataloader_pin_memory=pin_memory,
+        # 多个epoch之间保留工作进程，不必每个epoch重新启动
+        dataloader_persistent_workers=num_workers > 0,
+    )
+
+def make_metrics_callback(path):
+    """每次记录日志时把训练损失追加到JSONL文件的回调 (超参数搜索据此做早停)"""
+    from transformers import TrainerCallback
+
+    class MetricsFileCallback(TrainerCallback):
+        def __init__(self):
+            metrics_dir = os.path.dirname(path)
+            if metrics_dir:
+                os.makedirs(metrics_dir, exist_ok=True)
+
+        def on_log(self, args, state, control, logs=None, **kwargs):
+            # 数据并行时日志中的损失已在各进程间平均，只由rank 0写入
+            if not logs or "loss" not in logs or not state.is_world_process_zero:
+                return
+            record = {"step": state.global_step, "loss": logs["loss"], "learning_rate": logs.get("learning_rate")}
+            with open(path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+
+    return MetricsFileCallback()
+
+def make_stop_file_callback(output_dir):
+    """输出目录中出现STOP_TRAINING文件时停止训练的回调 (checkpoint_watcher.py发现损失不再下降时写入)"""
+    from transformers import TrainerCallback
+
+    stop_file = os.path.join(output_dir, STOP_FILE)
+
+    class StopFileCallback(TrainerCallback):
+        def on_step_end(self, args, state, control, **kwargs):
+            if os.path.exists(stop_file):
+                with open(stop_file) as f:
+                    reason = f.read().strip()
+                print(f"⚠️ 检测到 {stop_file}，停止训练: {reason}")
+                control.should_training_stop = True
+                control.should_save = True
+
+    return StopFileCallback()
+
+def start_checkpoint_watcher(config):
+    """启动后台checkpoint评估进程 (只由rank 0启动)，返回Popen"""
+    import sys
+    import subprocess
+
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, "checkpoint_watcher.py"),
+           "--run_dir", config.resolved_output_dir, "--base_model", config.resolved_model_name,
+           "--eval_file", config.resolved_train_file, "--max_length", str(config.resolved_max_length),
+           "--training_pid", str(os.getpid()),
+           "--stop_patience", str(config.stop_patience), "--min_delta", str(config.min_delta)]
+    if config.max_samples:
+        cmd += ["--skip_samples", str(config.max_samples)]
+    print(f"✓ 启动后台checkpoint评估: {' '.join(cmd)}")
+    return subprocess.Popen(cmd)
+
+def make_chunked_loss_trainer(chunk_size):
+    """用分块交叉熵计算损失的Trainer子类"""
+    from transformers import Trainer
+    from chunked_loss import causal_lm_loss
+
+    class ChunkedLossTrainer(Trainer):
+        def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+            # 传入num_items_in_batch时已按整个累积批的token数归一化，Trainer不必再除以累积步数
+            self.loss_is_scaled_for_ga = num_items_in_batch is not None
+            loss = causal_lm_loss(model, inputs, chunk_size, num_items_in_batch)
+            return (loss, None) if return_outputs else loss
+
+    return ChunkedLossTrainer
+
+def make_data_wait_trainer(trainer_class):
+    """记录每个优化器步等待数据时间的Trainer子类
+
+    Trainer在每步开始时一次取出梯度累积的全部micro-batch (get_batch_samples)，
+    这段时间就是训练循环等待数据的时间; 两次取数据之间的间隔是一整步的耗时。
+    """
+    import time
+
+    class DataWaitTrainer(trainer_class):
+        data_wait_times = None
+        step_times = None
+        _last_fetch = None
+        _logged = 0
+
+        def get_batch_samples(self, epoch_iterator, num_batches, device):
+            if self.data_wait_times is None:
+                self.data_wait_times, self.step_times = [], []
+            start = time.perf_counter()
+            if self._last_fetch is not None:
+                self.step_times.append(start - self._last_fetch)
+            result = super().get_batch_samples(epoch_iterator, num_batches, device)
+            self.data_wait_times.append(time.perf_counter() - start)
+            self._last_fetch = start
+            return result
+
+        def log(self, logs, *args, **kwargs):
+            # 每次记录损失时附上这段时间内平均每步的数据等待
+            if "loss" in logs and self.data_wait_times and len(self.data_wait_times) > self._logged:
+                recent = self.data_wait_times[self._logged:]
+                logs["data_wait_ms"] = round(sum(recent) / len(recent) * 1000, 2)
+                self._logged = len(self.data_wait_times)
+            super().log(logs, *args, **kwargs)
+
+        def data_wait_summary(self):
+            """{"steps", "mean_wait", "max_wait", "mean_step", "wait_fraction"}; 第一步包含启动工作进程，不计入"""
+            waits = (self.data_wait_times or [])[1:]
+            steps = (self.step_times or [])[1:]
+            if not waits or not steps:
+                return None
+            total_wait = sum(waits[:len(steps)])
+            return {"steps": len(steps), "mean_wait": total_wait / len(steps), "max_wait": max(waits),
+                    "mean_step": sum(steps) / len(steps), "wait_fraction": total_wait / sum(steps),
+                    "first_wait": self.data_wait_times[0]}
+
+    return DataWaitTrainer
+
+def run_training(config, tokenizer=None, tokenized_dataset=None, model=None, callbacks=None, registry=None):
+    """执行一次训练，返回Trainer
+
+    同一进程内多次训练时可传入已加载的分词器/已分词的数据集/已构建的模型，
+    或传入ModelRegistry缓存分词器和基础权重，避免重复加载。
+    """
+    from transformers import Trainer, DataCollatorForLanguageModeling
+
+    output_dir = config.resolved_output_dir
+    max_length = config.resolved_max_length
+    print(f"选择模型: {config.resolved_model_name} ({config.model_id})")
+
+    device_map, model_dtype = detect_device()
+
+    # 确保输出目录存在
+    os.makedirs(output_dir, exist_ok=True)
+
+    if tokenizer is None:
+        tokenizer = registry.tokenizer(config.resolved_model_name) if registry else load_tokenizer(config.resolved_model_name)
+    if tokenized_dataset is None:
+        print(f"数据文件路径: {config.resolved_train_file}")
+        train_dataset = load_dataset_from_jsonl(config.resolved_train_file, config.max_samples)
+        print(f"加载了 {len(train_dataset)} 条训练数据")
+        tokenized_dataset = tokenize_dataset(train_dataset, tokenizer, max_length, config.tokenize_on_the_fly)
+
+    if model is None:
+        model = build_model(config, device_map, model_dtype, registry)
+    elif config.attn_implementation:
+        from model_compile import set_attn_implementation
+        set_attn_implementation(model, config.attn_implementation)
+
+    # 训练参数
+    # 在MPS设备上不使用fp16
+    import torch
+    use_fp16 = device_map != "mps" and torch.cuda.is_available()  # MPS设备和CPU不支持fp16混合精度
+    training_args = build_training_arguments(config, use_fp16)
+
+    # 打印精度信息
+    if device_map == "mps":
+        print("⚠️ 在MPS设备上训练，已禁用fp16混合精度")
+    elif not use_fp16:
+        print("⚠️ 在CPU上训练，使用float32")
     else:
-        try:
-            # 标准QLoRA配置，适用于CUDA环境
-            print("在CUDA环境中使用bitsandbytes...")
-            bnb_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_use_double_quant=True,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype=model_dtype
-            )
-            model = AutoModelForCausalLM.from_pretrained(
-                MODEL_NAME,
-                quantization_config=bnb_config,
-                device_map=device_map
-            )
-            model = prepare_model_for_kbit_training(model)
-            
-            lora_config = LoraConfig(
-                r=8,
-                lora_alpha=32,
-                lora_dropout=0.05,
-                bias="none",
-                task_type="CAUSAL_LM"
-            )
-            model = get_peft_model(model, lora_config)
-        except ImportError:
-            print("⚠️ bitsandbytes不可用，使用标准LoRA")
-            model = AutoModelForCausalLM.from_pretrained(
-                MODEL_NAME,
-                torch_dtype=model_dtype,
-                device_map=device_map
-            )
-            lora_config = LoraConfig(
-                r=16,
-                lora_alpha=32,
-                lora_dropout=0.05,
-                bias="none",
-                task_type="CAUSAL_LM",
-                target_modules=["q_proj", "k_proj", "v_proj", "o_proj"]
-            )
-            model = get_peft_model(model, lora_config)
-    
-    model.print_trainable_parameters()
-
-# 训练参数
-# 在MPS设备上不使用fp16
-use_fp16 = device_map != "mps"  # MPS设备不支持fp16混合精度
-
-training_args = TrainingArguments(
-    output_dir=OUTPUT_DIR,
-    num_train_epochs=args.epochs,
-    per_device_train_batch_size=args.batch_size,
-    gradient_accumulation_steps=args.gradient_accumulation_steps,
-    warmup_steps=100,
-    weight_decay=0.01,
-    logging_steps=10,
-    save_strategy="epoch",
-    lr_scheduler_type="cosine",
-    learning_rate=args.lr,
-    fp16=use_fp16,  # 根据设备类型决定是否使用fp16
-    optim="adamw_torch",
-    remove_unused_columns=False,
-)
-
-# 打印精度信息
-if device_map == "mps":
-    print("⚠️ 在MPS设备上训练，已禁用fp16混合精度")
-else:
-    print("✓ 使用fp16混合精度训练")
-
-# 打印关于优化器的信息
-if args.use_8bit_adam:
-    print("注意: 8bit-adam优化器在Trainer中不直接支持，使用标准优化器")
-
-# 数据校对器
-data_collator = DataCollatorForLanguageModeling(
-    tokenizer=tokenizer,
-    mlm=False,
-    pad_to_multiple_of=8,  # 对齐到8的倍数，提高效率
-    return_tensors="pt"
-)
-
-# 打印数据校对信息
-print(f"使用DataCollatorForLanguageModeling，mlm=False, pad_to_multiple_of=8")
-print(f"最大序列长度: {MAX_LENGTH}")
-
-# 初始化训练器
-trainer = Trainer(
-    model=model,
-    args=training_args,
-    train_dataset=tokenized_datasets,
-    data_collator=data_collator,
-)
-
-# 开始训练
-trainer.train()
-
-# 保存模型
-trainer.save_model(os.path.join(OUTPUT_DIR, "final"))
-print(f"模型保存到 {os.path.join(OUTPUT_DIR, 'final')}")
-
-def plot_model_size_impact():
-    """分析模型规模对微调效果的影响"""
-    
+        print("✓ 使用fp16混合精度训练")
+
+    # 打印关于优化器的信息
+    optim_name, optimizer_cls_and_kwargs = resolve_optimizer(config)
+    if optimizer_cls_and_kwargs is not None:
+        print("✓ 使用纯PyTorch分块8-bit AdamW (bitsandbytes不可用或非CUDA环境)")
+    elif optim_name != "adamw_torch":
+        print(f"✓ 使用优化器: {optim_name}")
+
+    # 数据校对器
+    data_collator = DataCollatorForLanguageModeling(
+        tokenizer=tokenizer,
+        mlm=False,
+        pad_to_multiple_of=8,  # 对齐到8的倍数，提高效率
+        return_tensors="pt"
+    )
+
+    # 打印数据校对信息
+    print(f"使用DataCollatorForLanguageModeling，mlm=False, pad_to_multiple_of=8")
+    print(f"最大序列长度: {max_length}")
+    num_workers, prefetch_factor, pin_memory = resolve_dataloader_options(config)
+    if num_workers > 0:
+        # 分词器在主进程中用过多线程后再fork工作进程会告警，工作进程各自单线程分词
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    print(f"数据加载: {num_workers} 个工作进程, 每个预取 {prefetch_factor or (2 if num_workers else 0)} 批, "
+          f"锁页内存 {'启用' if pin_memory else '未启用'}{', 即时分词' if config.tokenize_on_the_fly else ''}")
+
+    _, world_size, _ = distributed_info()
+    callbacks = list(callbacks or [])
+    if config.metrics_file:
+        callbacks.append(make_metrics_callback(config.metrics_file))
+    stop_file = os.path.join(output_dir, STOP_FILE)
+    if os.path.exists(stop_file) and distributed_info()[0] == 0:
+        # 上一次运行留下的停止标记
+        os.remove(stop_file)
+    if not config.no_save and world_size == 1:
+        # 数据并行时各进程看到文件的步数可能不同，会导致梯度同步挂起，因此只在单进程训练时启用
+        callbacks.append(make_stop_file_callback(output_dir))
+
+    if world_size > 1:
+        # DDP只同步requires_grad的参数: LoRA/QLoRA每步只all-reduce适配器梯度
+        sync_bytes = sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+        effective_batch = config.batch_size * config.gradient_accumulation_steps * world_size
+        print(f"✓ 数据并行: {world_size} 个进程，有效批大小 {effective_batch}，"
+              f"每次同步all-reduce {sync_bytes / 1024 ** 2:.2f}MB梯度"
+              f"{' (仅适配器参数)' if config.method != 'full' else ''}")
+
+    if config.gradient_checkpointing:
+        print("✓ 启用梯度检查点")
+        model.config.use_cache = False
+        # PEFT冻结了嵌入层，需要让嵌入输出带梯度，检查点内的LoRA参数才能收到梯度
+        if config.method != "full" and not getattr(model, "_require_grads_hooks", None):
+            model.enable_input_require_grads()
+    if config.torch_compile:
+        from model_compile import setup_compile_cache
+        cache_dir = setup_compile_cache(config.compile_cache_dir)
+        print(f"✓ 启用torch.compile (mode={config.torch_compile_mode or 'default'}, 编译缓存: {cache_dir})")
+    trainer_class = Trainer
+    if config.chunked_loss:
+        print(f"✓ 使用分块交叉熵损失 (每块 {config.loss_chunk_size} 个token)")
+        trainer_class = make_chunked_loss_trainer(config.loss_chunk_size)
+    trainer_class = make_data_wait_trainer(trainer_class)
+
+    # 初始化训练器
+    trainer = trainer_class(
+        model=model,
+        args=training_args,
+        train_dataset=tokenized_dataset,
+        data_collator=data_collator,
+        callbacks=callbacks or None,
+        optimizer_cls_and_kwargs=optimizer_cls_and_kwargs,
+    )
+
+    watcher = None
+    if config.watch_checkpoints and not config.no_save and distributed_info()[0] == 0:
+        watcher = start_checkpoint_watcher(config)
+
+    # 开始训练
+    trainer.train()
+
+    summary = trainer.data_wait_summary()
+    if summary:
+        print(f"数据等待: 平均每步 {summary['mean_wait'] * 1000:.1f}ms (最长 {summary['max_wait'] * 1000:.1f}ms, "
+              f"首步 {summary['first_wait'] * 1000:.1f}ms), 占单步耗时 {summary['wait_fraction'] * 100:.1f}% "
+              f"({summary['steps']} 步, 平均每步 {summary['mean_step'] * 1000:.0f}ms)")
+        if summary["wait_fraction"] > 0.05:
+            print("⚠️ 训练受数据加载限制，可以增加 --dataloader_num_workers 或 --dataloader_prefetch_factor")
+
+    from adam8bit import optimizer_state_bytes
+    optimizer = getattr(trainer.optimizer, "optimizer", trainer.optimizer)
+    print(f"优化器状态内存 ({config.resolved_optimizer}): {optimizer_state_bytes(optimizer) / 1024 ** 2:.2f}MB")
+
+    # 保存模型
+    if not config.no_save:
+        trainer.save_model(os.path.join(output_dir, "final"))
+        print(f"模型保存到 {os.path.join(output_dir, 'final')}")
+    if watcher is not None:
+        print("等待后台评估完成剩余的checkpoint ...")
+        watcher.wait()
+    return trainer
+
+def plot_model_size_impact(results_data, models, methods, task_map, output_dir="results/figures"):
+    """分析模型规模对微调效果的影响
+
+    results_data: {任务: DataFrame(index=模型, columns=方法)}，与analyze_results.py的结果表结构一致
+    """
+    import matplotlib.pyplot as plt
+
     # 根据模型名称提取模型系列和参数量
     model_info = {
         "llama2_7b": {"family": "LLaMA-2", "size": 7},
@@ -321,7 +772,7 @@ def plot_model_size_impact():
         "pythia_1.4b": {"family": "Pythia", "size": 1.4},
         "pythia_2.8b": {"family": "Pythia", "size": 2.8}
     }
-    
+
     # 按模型系列分组
     families = {}
     for model in models:
@@ -330,28 +781,45 @@ def plot_model_size_impact():
             if family not in families:
                 families[family] = []
             families[family].append(model)
-    
+
+    os.makedirs(output_dir, exist_ok=True)
     # 为每个模型系列创建图表
     for family, family_models in families.items():
         if len(family_models) < 2:
             continue  # 跳过只有一个模型的系列
-            
+
+        # 按参数量排序，折线从小到大
+        family_models = sorted(family_models, key=lambda m: model_info[m]["size"])
         for task in task_map:
+            if task not in results_data:
+                continue
             plt.figure(figsize=(12, 8))
-            
+
             # 提取数据
             sizes = [model_info[m]["size"] for m in family_models]
             for method in methods:
+                if method not in results_data[task].columns:
+                    continue
                 perf_values = [results_data[task].loc[m, method] for m in family_models]
                 plt.plot(sizes, perf_values, 'o-', label=method, linewidth=2, markersize=8)
-            
+
             # 图表设置
             plt.title(f'{family}系列模型规模对{task_map[task]}任务的影响', fontsize=15)
             plt.xlabel('参数量 (B)', fontsize=12)
             plt.ylabel('准确率 (%)', fontsize=12)
             plt.grid(True, linestyle='--', alpha=0.7)
             plt.legend(title="微调方法")
-            
+
             plt.tight_layout()
-            plt.savefig(f"results/figures/{family}_{task}_size_impact.png", dpi=300)
-            plt.close()
\ No newline at end of file
+            plt.savefig(os.path.join(output_dir, f"{family}_{task}_size_impact.png"), dpi=300)
+            plt.close()
+
+def main(argv=None):
+    """命令行入口"""
+    args = build_parser().parse_args(argv)
+    config = TrainConfig.from_args(args)
+    setup_rank_logging(config.log_all_ranks)
+    return run_training(config)
+
+if __name__ == "__main__":
+    main()
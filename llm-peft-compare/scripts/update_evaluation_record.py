@@ -146,6 +146,9 @@ def generate_model_entry(model_id, method, data, date=None):
     if model_id in MODEL_CONFIGS:
         model_size = MODEL_CONFIGS[model_id].get("size", "unknown")
     
+    # 子样本评估的任务 (见subsample_eval.py)，结果为分层估计值
+    subsampled = data.get("subsampled", {})
+    
     # 提取每个任务的结果
     for task_id, task_config in TASK_CONFIGS.items():
         task_alias = task_id
@@ -157,6 +160,8 @@ def generate_model_entry(model_id, method, data, date=None):
             stderr = get_result_value(data.get("results", {}), task_id, metric_key, stderr=True)
             
             formatted_value = format_percentage(value)
+            if task_id in subsampled and value is not None:
+                formatted_value = f"≈{formatted_value}"
             formatted_stderr = f"±{format_percentage(stderr)[:-1]}" if stderr else "N/A"
             
             # 高亮特别重要的指标
@@ -174,6 +179,12 @@ def generate_model_entry(model_id, method, data, date=None):
 - **批量大小**: {batch_size}
 - **数据类型**: {dtype}
 """
+    if subsampled:
+        details = ", ".join(
+            f"{TASK_CONFIGS.get(task_id, {}).get('name', task_id)} {info['n']}/{info['population']}"
+            for task_id, info in subsampled.items()
+        )
+        model_info += f"- **评估方式**: 分层子样本估计 ({details})，≈ 表示估计值\n"
     
     # 合并所有部分
     return f"{section_header}\n\n{results_table}\n{model_info}\n"